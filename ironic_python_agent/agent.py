@@ -37,6 +37,7 @@ from ironic_python_agent import hardware
 from ironic_python_agent import inspector
 from ironic_python_agent import ironic_api_client
 from ironic_python_agent import mdns
+from ironic_python_agent.metrics_lib import metrics_utils
 from ironic_python_agent import netutils
 from ironic_python_agent import utils
 
@@ -74,7 +75,12 @@ def _with_jitter(value, min_multiplier, max_multiplier):
 
 
 class IronicPythonAgentHeartbeater(threading.Thread):
-    """Thread that periodically heartbeats to Ironic."""
+    """Thread that periodically heartbeats to Ironic.
+
+    The thread sleeps until the next heartbeat is due. Forcing a heartbeat
+    or stopping the thread wakes it up immediately, forced heartbeats are
+    still sent at most once in ``min_heartbeat_interval`` seconds.
+    """
 
     # If we could wait at most N seconds between heartbeats, we will instead
     # wait r x N seconds, where r is a random value between these multipliers.
@@ -96,9 +102,12 @@ class IronicPythonAgentHeartbeater(threading.Thread):
         super(IronicPythonAgentHeartbeater, self).__init__()
         self.agent = agent
         self.stop_event = threading.Event()
+        # Notified when a heartbeat is forced or the thread is stopped
+        self.wakeup = threading.Condition()
         self.api = agent.api_client
         self.interval = 0
         self.heartbeat_forced = False
+        self.forced_at = None
         self.previous_heartbeat = 0
 
     def run(self):
@@ -108,23 +117,25 @@ class IronicPythonAgentHeartbeater(threading.Thread):
         self.agent.set_agent_advertise_addr()
 
         while self._run_next():
-            time.sleep(0.1)
+            pass
+
+    def _next_heartbeat(self):
+        """Get the time the next heartbeat is due."""
+        deadline = self.previous_heartbeat + self.interval
+        if self.heartbeat_forced:
+            deadline = min(deadline, self.previous_heartbeat
+                           + self.min_heartbeat_interval)
+        return deadline
 
     def _run_next(self):
-        # The logic here makes sure we don't wait exactly 5 seconds more or
-        # less regardless of the current interval since it may cause a
-        # thundering herd problem when a lot of agents are heartbeating.
-        # Essentially, if the next heartbeat is due in 2 seconds, don't wait 5.
-        # But if the next one is scheduled in 2 minutes, do wait 5 to account
-        # for forced heartbeats.
-        wait = min(
-            self.min_heartbeat_interval,
-            # This operation checks how much of the initially planned interval
-            # we have still left. Compare with 0 in case we overshoot the goal.
-            max(0, self.interval - (_time() - self.previous_heartbeat)),
-        )
-        if self.stop_event.wait(wait):
-            return False  # done
+        with self.wakeup:
+            # Compare with 0 in case we overshoot the deadline. Being woken
+            # up early is fine, the deadline is recalculated on the next run.
+            wait = max(0, self._next_heartbeat() - _time())
+            if wait and not self.stop_event.is_set():
+                self.wakeup.wait(wait)
+            if self.stop_event.is_set():
+                return False  # done
 
         if self._heartbeat_expected():
             self.do_heartbeat()
@@ -139,11 +150,20 @@ class IronicPythonAgentHeartbeater(threading.Thread):
             return True
 
         # Forced heartbeating, but once in 5 seconds
-        if self.heartbeat_forced and elapsed > self.min_heartbeat_interval:
+        if self.heartbeat_forced and elapsed >= self.min_heartbeat_interval:
             return True
 
+        return False
+
     def do_heartbeat(self):
         """Send a heartbeat to Ironic."""
+        metrics = metrics_utils.get_metrics_logger(__name__)
+        with self.wakeup:
+            # A heartbeat forced from now on needs to be sent after this one
+            forced_at = self.forced_at
+            self.heartbeat_forced = False
+            self.forced_at = None
+        started = _time()
         try:
             self.api.heartbeat(
                 uuid=self.agent.get_node_uuid(),
@@ -158,25 +178,42 @@ class IronicPythonAgentHeartbeater(threading.Thread):
             else:
                 LOG.exception('error sending heartbeat to %s',
                               self.agent.api_urls)
+            metrics.send_counter('heartbeat.failures', 1)
+            if forced_at is not None:
+                with self.wakeup:
+                    self.heartbeat_forced = True
+                    if self.forced_at is None:
+                        self.forced_at = forced_at
             self.interval = _with_jitter(self.min_heartbeat_interval,
                                          self.min_error_jitter_multiplier,
                                          self.max_error_jitter_multiplier)
         else:
             LOG.debug('heartbeat successful')
-            self.heartbeat_forced = False
             self.interval = _with_jitter(self.agent.heartbeat_timeout,
                                          self.min_jitter_multiplier,
                                          self.max_jitter_multiplier)
+            if forced_at is not None:
+                metrics.send_timer('heartbeat.forced_delay',
+                                   int((started - forced_at) * 1000))
         self.previous_heartbeat = _time()
+        metrics.send_timer('heartbeat.latency',
+                           int((self.previous_heartbeat - started) * 1000))
         LOG.info('sleeping before next heartbeat, interval: %s', self.interval)
 
     def force_heartbeat(self):
-        self.heartbeat_forced = True
+        """Send a heartbeat as soon as the rate limit allows it."""
+        with self.wakeup:
+            if not self.heartbeat_forced:
+                self.heartbeat_forced = True
+                self.forced_at = _time()
+            self.wakeup.notify_all()
 
     def stop(self):
         """Stop the heartbeat thread."""
         LOG.info('stopping heartbeater')
-        self.stop_event.set()
+        with self.wakeup:
+            self.stop_event.set()
+            self.wakeup.notify_all()
         # Only join if the thread was actually started
         if self.is_alive():
             return self.join()
@@ -422,6 +459,14 @@ class IronicPythonAgent(base.ExecuteCommandMixin):
         """
         return list(self.command_results.values())
 
+    def get_command_results_version(self):
+        """Get the version of the command results.
+
+        :returns: a string which changes every time a command result is
+                  added, removed or completed.
+        """
+        return self.command_results.version
+
     def get_command_result(self, result_id):
         """Get a specific command result by ID.
 
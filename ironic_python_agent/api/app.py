@@ -12,9 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
 import ssl
 import threading
+from urllib import parse as urlparse
 
 from cheroot.ssl import builtin
 from cheroot import wsgi
@@ -25,6 +27,8 @@ from werkzeug import routing
 
 from ironic_python_agent.api import request_log
 from ironic_python_agent import encoding
+from ironic_python_agent.extensions import base
+from ironic_python_agent import image_peers
 from ironic_python_agent.metrics_lib import metrics_utils
 from ironic_python_agent import utils
 
@@ -82,6 +86,36 @@ def jsonify(value, status=200):
     return werkzeug.Response(data, status=status, mimetype='application/json')
 
 
+# Arguments which do not change the representation of a resource
+_IGNORED_ETAG_ARGS = frozenset(['agent_token', 'wait'])
+
+
+def make_etag(request, *versions):
+    """Build the entity tag of a response from the versions of its data."""
+    args = sorted((key, value)
+                  for key, value in request.args.items(multi=True)
+                  if key not in _IGNORED_ETAG_ARGS)
+    data = repr((request.path, args, versions)).encode()
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def conditional_jsonify(request, etag, get_value):
+    """Convert a value to a JSON response unless the client has it already.
+
+    :param request: the request, possibly with an If-None-Match header.
+    :param etag: the entity tag of the current value, see :func:`make_etag`.
+    :param get_value: a callable returning the value, which is only called
+        if the value needs to be sent.
+    :returns: a JSON response with an ETag header or a 304 response.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = werkzeug.Response(status=304)
+    else:
+        response = jsonify(get_value())
+    response.set_etag(etag)
+    return response
+
+
 def make_link(url, rel_name, resource='', resource_args='',
               bookmark=False, type_=None):
     if rel_name == 'describedby':
@@ -146,6 +180,12 @@ class Application(object):
                          methods=['GET']),
             routing.Rule('/v1/commands/', endpoint='run_command',
                          methods=['POST']),
+            routing.Rule('/v1/images/<image_id>/manifest',
+                         endpoint='image_manifest', methods=['GET']),
+            routing.Rule('/v1/images/<image_id>/chunks/<int:index>',
+                         endpoint='image_chunk', methods=['GET']),
+            routing.Rule('/v1/system_logs', endpoint='system_logs',
+                         methods=['GET']),
             # Use the default version (i.e. v1) when the version is missing
             routing.Rule('/status', endpoint='status', methods=['GET']),
             routing.Rule('/commands/', endpoint='list_commands',
@@ -156,6 +196,8 @@ class Application(object):
                          methods=['POST']),
         ])
         self.security_get_token_support = False
+        # Keep threads available for other requests than long polls
+        self._long_polls = threading.BoundedSemaphore(conf.api_threads // 2)
 
     def __call__(self, environ, start_response):
         """WSGI entry point."""
@@ -181,7 +223,8 @@ class Application(object):
         wsgi_app = request_log.RequestLogMiddleware(self)
 
         server = wsgi.Server(bind_addr=bind_addr, wsgi_app=wsgi_app,
-                             server_name='ironic-python-agent')
+                             server_name='ironic-python-agent',
+                             numthreads=self._conf.api_threads)
 
         if self.tls_cert_file and self.tls_key_file:
             # Create SSL context with TLS version enforcement
@@ -273,7 +316,9 @@ class Application(object):
     def api_status(self, request):
         with metrics_utils.get_metrics_logger(__name__).timer('get_status'):
             status = self.agent.get_status()
-            return jsonify(status)
+            # NOTE: the status does not change while the agent is running.
+            etag = make_etag(request, status.started_at, status.version)
+            return conditional_jsonify(request, etag, lambda: status)
 
     def require_agent_token_for_command(func):
         def wrapper(self, request, *args, **kwargs):
@@ -292,19 +337,99 @@ class Application(object):
     @require_agent_token_for_command
     def api_list_commands(self, request):
         with metrics_utils.get_metrics_logger(__name__).timer('list_commands'):
-            results = self.agent.list_command_results()
-            return jsonify({'commands': results})
+            fields = self._get_command_fields(request)
+            limit = request.args.get('limit')
+            if limit is not None:
+                try:
+                    limit = int(limit)
+                    if limit < 1:
+                        raise ValueError()
+                except ValueError:
+                    raise http_exc.BadRequest('Invalid limit %s, expected a '
+                                              'positive integer' % limit)
+            marker = request.args.get('marker')
+
+            # NOTE: getting the version first, so that a change while the
+            # results are listed causes a new tag next time.
+            etag = make_etag(request,
+                             self.agent.get_command_results_version())
+            return conditional_jsonify(
+                request, etag,
+                lambda: self._list_commands(request, fields, limit, marker))
+
+    def _list_commands(self, request, fields, limit, marker):
+        results = self.agent.list_command_results()
+        if marker:
+            ids = [result.id for result in results]
+            try:
+                results = results[ids.index(marker) + 1:]
+            except ValueError:
+                raise http_exc.BadRequest('Marker %s not found' % marker)
+
+        body = {}
+        if limit is not None and len(results) > limit:
+            results = results[:limit]
+            args = dict(request.args, marker=results[-1].id)
+            body['next'] = '%s?%s' % (request.base_url,
+                                      urlparse.urlencode(args))
+        # NOTE: only serializing the requested fields, so that the results
+        # stored on disk are not read unless needed.
+        body['commands'] = [result.serialize(fields) for result in results]
+        return body
+
+    def _get_command_fields(self, request):
+        fields = request.args.get('fields')
+        if not fields:
+            return None
+        fields = fields.split(',')
+        allowed = base.BaseCommandResult.serializable_fields
+        invalid = [field for field in fields if field not in allowed]
+        if invalid:
+            raise http_exc.BadRequest('Invalid fields %s, expected some of '
+                                      '%s' % (', '.join(invalid),
+                                              ', '.join(allowed)))
+        return fields
+
+    def _get_command_wait(self, request):
+        """Get the number of seconds to wait for a command, if any.
+
+        :returns: None to wait for as long as needed, 0 not to wait.
+        """
+        wait = request.args.get('wait')
+        if not wait:
+            return 0
+        try:
+            wait = float(wait)
+        except ValueError:
+            return None if wait.lower() == 'true' else 0
+        if not 0 <= wait < float('inf'):
+            raise http_exc.BadRequest('Invalid wait %s, expected a '
+                                      'non-negative number of seconds'
+                                      % wait)
+        return min(wait, self._conf.max_command_wait)
 
     @require_agent_token_for_command
     def api_get_command(self, request, cmd):
         with metrics_utils.get_metrics_logger(__name__).timer('get_command'):
             result = self.agent.get_command_result(cmd)
-            wait = request.args.get('wait')
+            wait = self._get_command_wait(request)
 
-            if wait and wait.lower() == 'true':
+            if wait is None:
                 result.join()
-
-            return jsonify(result)
+            elif wait:
+                if self._long_polls.acquire(blocking=False):
+                    try:
+                        # Long poll: return as soon as the command is done
+                        result.wait_until_done(wait)
+                    finally:
+                        self._long_polls.release()
+                else:
+                    LOG.debug('Too many requests are waiting for command '
+                              'results, returning the result of command '
+                              '%s immediately', cmd)
+
+            etag = make_etag(request, result.id, result.version)
+            return conditional_jsonify(request, etag, lambda: result)
 
     def api_run_command(self, request):
         body = request.get_json(force=True)
@@ -321,3 +446,48 @@ class Application(object):
             if wait and wait.lower() == 'true':
                 result.join()
             return jsonify(result)
+
+    @require_agent_token_for_command
+    def api_system_logs(self, request):
+        lines = request.args.get('journald_max_lines')
+        if lines is not None:
+            try:
+                lines = int(lines)
+                if lines < 1:
+                    raise ValueError()
+            except ValueError:
+                raise http_exc.BadRequest('Invalid journald_max_lines %s, '
+                                          'expected a positive integer'
+                                          % lines)
+        # NOTE: the tarball is compressed while it is being sent
+        data = utils.stream_system_logs(
+            journald_max_lines=lines, consumer=request.args.get('consumer'))
+        response = werkzeug.Response(data, mimetype='application/gzip',
+                                     direct_passthrough=True)
+        response.headers['Content-Disposition'] = (
+            'attachment; filename="system_logs.tar.gz"')
+        return response
+
+    def api_image_manifest(self, request, image_id):
+        manifest = image_peers.get_manifest(
+            image_id, request.args.get('checksum'),
+            request.headers.get(image_peers.SECRET_HEADER))
+        if manifest is None:
+            raise http_exc.NotFound('Image %s is not shared' % image_id)
+        return jsonify(manifest)
+
+    def api_image_chunk(self, request, image_id, index):
+        with metrics_utils.get_metrics_logger(__name__).timer('image_chunk'):
+            chunk = image_peers.open_chunk(
+                image_id, request.args.get('checksum'),
+                request.headers.get(image_peers.SECRET_HEADER), index)
+            if chunk is None:
+                raise http_exc.NotFound('Chunk %(index)d of image %(image)s '
+                                        'is not shared'
+                                        % {'index': index, 'image': image_id})
+            length, data = chunk
+            response = werkzeug.Response(data,
+                                         mimetype='application/octet-stream',
+                                         direct_passthrough=True)
+            response.content_length = length
+            return response
@@ -13,7 +13,6 @@
 Middleware to log API request details including timing, status codes,
 and request information for debugging purposes.
 """
-import collections.abc
 import time
 
 from oslo_log import log
@@ -39,6 +38,29 @@ def get_real_ip(environ):
         return environ.get('REMOTE_ADDR')
 
 
+class _LoggedResponse(object):
+    """Response body logging the request once it has been sent.
+
+    WSGI servers call close() once the body has been sent or the client has
+    gone away, which allows streaming the body instead of buffering it.
+    """
+
+    def __init__(self, response, log_request):
+        self._response = response
+        self._log_request = log_request
+
+    def __iter__(self):
+        return iter(self._response)
+
+    def close(self):
+        try:
+            close = getattr(self._response, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._log_request()
+
+
 class RequestLogMiddleware(object):
     """Middleware to log request details for debugging."""
 
@@ -71,14 +93,7 @@ class RequestLogMiddleware(object):
                 status_code = 0
             return start_response(status, headers, exc_info)
 
-        # Process the request
-        try:
-            response = self.app(environ, logging_start_response)
-            # Ensure response is consumed if it's a generator
-            if isinstance(response, collections.abc.Iterator):
-                response = list(response)
-            return response
-        finally:
+        def log_request():
             # Calculate request duration
             duration = time.time() - start_time
             duration_ms = round(duration * 1000, 2)
@@ -91,3 +106,17 @@ class RequestLogMiddleware(object):
                       'status': status_code or 'unknown',
                       'duration': duration_ms,
                       'source_ip': get_real_ip(environ) or 'unknown'})
+
+        # Process the request
+        try:
+            response = self.app(environ, logging_start_response)
+        except Exception:
+            log_request()
+            raise
+
+        if isinstance(response, (list, tuple)):
+            # The body is already complete
+            log_request()
+            return response
+        # Log once the body has been sent, without consuming it here
+        return _LoggedResponse(response, log_request)
@@ -59,6 +59,39 @@ cli_opts = [
                 help='The port to listen on. '
                      'Can be supplied as "ipa-listen-port" kernel parameter.'),
 
+    cfg.IntOpt('max_command_wait', min=0,
+               default=int(APARAMS.get('ipa-max-command-wait', 60)),
+               help='Maximum number of seconds a request for a command '
+                    'result may wait for the command to complete when '
+                    'passing a number of seconds in the "wait" argument. '
+                    'Can be supplied as "ipa-max-command-wait" kernel '
+                    'parameter.'),
+
+    cfg.IntOpt('api_threads', min=2,
+               default=int(APARAMS.get('ipa-api-threads', 32)),
+               help='Number of threads serving the agent API. At most half '
+                    'of them wait for command results at the same time, '
+                    'further requests waiting for a number of seconds '
+                    'return the current result immediately. '
+                    'Can be supplied as "ipa-api-threads" kernel '
+                    'parameter.'),
+
+    cfg.IntOpt('command_results_max_count', min=1,
+               default=int(APARAMS.get('ipa-command-results-max-count', 100)),
+               help='Maximum number of command results kept by the agent, '
+                    'the oldest results are removed first. '
+                    'Can be supplied as "ipa-command-results-max-count" '
+                    'kernel parameter.'),
+
+    cfg.IntOpt('command_results_max_memory', min=0,
+               default=int(APARAMS.get('ipa-command-results-max-memory', 16)),
+               help='Maximum size in MiB of the completed command results '
+                    'kept in memory. Once exceeded, the oldest results are '
+                    'compressed and stored on disk until requested. The '
+                    'result of the most recent command is always kept in '
+                    'memory. Can be supplied as '
+                    '"ipa-command-results-max-memory" kernel parameter.'),
+
     # This is intentionally not settable via kernel command line, as it
     # requires configuration parameters which are not configurable over
     # the command line and require files-on-disk.
@@ -348,6 +381,66 @@ cli_opts = [
                    'ipa-image-download-connection-retry-interval', 10),
                help='Interval (in seconds) between two attempts to establish '
                     'connection when downloading an image.'),
+    cfg.BoolOpt('image_download_pipeline',
+                default=APARAMS.get('ipa-image-download-pipeline', False),
+                help='Start writing qcow2 whole disk images to the disk while '
+                     'they are still being downloaded instead of after the '
+                     'download is complete. Only the image header is '
+                     'validated before writing, the checksum and the '
+                     'complete image are validated once the download is '
+                     'finished, after the image has been written. If they '
+                     'fail, the disk metadata is destroyed and the data '
+                     'discarded if the disk supports it. Requires qemu-img '
+                     'with NBD support.'),
+    cfg.StrOpt('image_download_scratch',
+               default=APARAMS.get('ipa-image-download-scratch', 'auto'),
+               choices=[('auto', 'store whole disk images at the end of '
+                                 'the target disk when the ramdisk does not '
+                                 'have enough free space'),
+                        ('ramdisk', 'always store images in the ramdisk')],
+               help='Where to store images before writing them to the '
+                    'target disk.'),
+    cfg.IntOpt('image_download_ramdisk_reserve', min=0,
+               default=int(APARAMS.get(
+                   'ipa-image-download-ramdisk-reserve', 512)),
+               help='Amount of memory (in MiB) to keep free in the ramdisk '
+                    'when storing an image in it. Larger images are stored '
+                    'on the target disk if image_download_scratch is '
+                    '"auto".'),
+    cfg.BoolOpt('image_write_verification',
+                default=APARAMS.get('ipa-image-write-verification', False),
+                help='Read images back from the device after writing them, '
+                     'bypassing the page cache, and compare them with the '
+                     'downloaded image. Regions known to be zero are '
+                     'skipped. Fails the deployment on any difference.'),
+    cfg.IntOpt('image_write_verification_threads', min=1,
+               default=int(APARAMS.get(
+                   'ipa-image-write-verification-threads', 4)),
+               help='Number of threads reading and hashing the written '
+                    'image concurrently when image_write_verification is '
+                    'enabled.'),
+    cfg.BoolOpt('image_peer_distribution',
+                default=APARAMS.get('ipa-image-peer-distribution', False),
+                help='Share downloaded images with other agents through '
+                     'the agent API and download images from the agents '
+                     'listed in image_peers or in the image information '
+                     'provided by ironic, falling back to the image URLs '
+                     'for the chunks no peer can provide.'),
+    cfg.ListOpt('image_peers',
+                default=APARAMS.get('ipa-image-peers', ''),
+                help='URLs of the APIs of the agents to download images '
+                     'from when image_peer_distribution is enabled, e.g. '
+                     '"http://192.0.2.10:9999". Peers provided by ironic '
+                     'in the image information take precedence.'),
+    cfg.StrOpt('image_peers_secret',
+               default=APARAMS.get('ipa-image-peers-secret'),
+               secret=True,
+               help='Secret shared by the agents deploying the same images '
+                    'when image_peer_distribution is enabled. Images are '
+                    'only served to and downloaded from peers presenting '
+                    'it, and are not shared without a secret. A secret '
+                    'provided by ironic in the image information takes '
+                    'precedence.'),
     cfg.IntOpt('image_download_max_duration', min=0,
                default=int(APARAMS.get(
                    'ipa-image-download-max-duration', 0)),
@@ -403,6 +496,78 @@ cli_opts = [
                      'cleaning from inadvertently destroying a running '
                      'cluster which may be visible over a storage fabric '
                      'such as FibreChannel.'),
+    cfg.BoolOpt('erase_verification',
+                default=APARAMS.get('ipa-erase-verification', False),
+                help='Whether to verify that a device reads back as erased '
+                     'after it has been successfully erased by the '
+                     'erase_devices clean step. A random sample of blocks '
+                     'is read and checked for zero or pattern fill, the '
+                     'sample size is defined by the '
+                     'erase_verification_confidence and '
+                     'erase_verification_tolerance options. Can be '
+                     'overridden per node via the '
+                     '"agent_erase_verification" driver internal info. '
+                     'Can be supplied as "ipa-erase-verification" '
+                     'kernel parameter.'),
+    cfg.FloatOpt('erase_verification_confidence',
+                 default=0.99,
+                 min=0.5, max=0.999999,
+                 help='Probability with which the erase verification '
+                      'detects a device where at least '
+                      'erase_verification_tolerance of the blocks have not '
+                      'been erased.'),
+    cfg.FloatOpt('erase_verification_tolerance',
+                 default=0.001,
+                 min=0.000001, max=0.5,
+                 help='Fraction of non-erased blocks that the erase '
+                      'verification must be able to detect. Lower values '
+                      'increase the number of sampled blocks.'),
+    cfg.IntOpt('erase_verification_block_size',
+               default=4096,
+               min=512,
+               help='Size in bytes of each block read by the erase '
+                    'verification. Must be a multiple of the logical '
+                    'block size of the devices.'),
+    cfg.IntOpt('erase_verification_threads',
+               default=8,
+               min=1,
+               help='Number of concurrent readers used when verifying '
+                    'a single device.'),
+    cfg.IntOpt('disk_erasure_controller_concurrency',
+               default=APARAMS.get('ipa-disk-erasure-controller-concurrency',
+                                   0),
+               min=0,
+               help='Maximum number of devices erased concurrently on the '
+                    'same storage controller (HBA, RAID controller or '
+                    'NVMe device) when the disk_erasure_concurrency of the '
+                    'node is greater than 1. Set to 0 to only balance '
+                    'the erasures across controllers without a limit. Can '
+                    'be overridden per node via the '
+                    '"disk_erasure_controller_concurrency" driver internal '
+                    'info. Can be supplied as '
+                    '"ipa-disk-erasure-controller-concurrency" kernel '
+                    'parameter.'),
+    cfg.BoolOpt('enable_nvme_sanitize',
+                default=APARAMS.get('ipa-enable-nvme-sanitize', False),
+                help='Whether to erase NVMe devices using the sanitize '
+                     'command (crypto or block erase) instead of format '
+                     'when the controller supports it. Sanitize runs in '
+                     'the background on the controller, so it is started '
+                     'on all eligible controllers at once and its progress '
+                     'is polled from the sanitize log. Sanitize is only '
+                     'used on controllers whose namespaces are all being '
+                     'erased. Can be supplied as "ipa-enable-nvme-sanitize" '
+                     'kernel parameter.'),
+    cfg.IntOpt('nvme_sanitize_poll_interval',
+               default=5,
+               min=1,
+               help='Interval in seconds between checks of the NVMe '
+                    'sanitize log while a sanitize operation is running.'),
+    cfg.IntOpt('nvme_sanitize_timeout',
+               default=3600,
+               min=1,
+               help='Maximum time in seconds to wait for an NVMe sanitize '
+                    'operation to complete.'),
     cfg.BoolOpt('md5_enabled',
                 default=True,
                 help='If the MD5 algorithm is enabled for file checksums. '
@@ -413,6 +578,15 @@ cli_opts = [
                help='Time in seconds to wait for an HTTP request TCP socket '
                     'used by an API request to a remote service to enter '
                     'a state where a request can be transmitted.'),
+    cfg.IntOpt('system_logs_max_size',
+               default=int(APARAMS.get('ipa-system-logs-max-size', 256)),
+               min=0,
+               help='Maximum size in MiB of the uncompressed system logs '
+                    'collected by the agent. Sources exceeding it are '
+                    'truncated, which is reported in the '
+                    'collection_report.json file of the logs. Set to 0 to '
+                    'collect all logs. Can be supplied as '
+                    '"ipa-system-logs-max-size" kernel parameter.'),
     cfg.BoolOpt('config_drive_rebuild',
                 default=False,
                 help='If the agent should rebuild the configuration drive '
@@ -461,7 +635,36 @@ disk_utils_opts = [
                     'GPT partitioned systems for local boot in BIOS.'),
     cfg.StrOpt('dd_block_size',
                default='1M',
-               help='Block size to use when writing to the nodes disk.'),
+               help='Block size to use when writing to the nodes disk. '
+                    'Ignored for block devices if write_tuning is '
+                    'enabled.'),
+    cfg.StrOpt('write_tuning',
+               default='disabled',
+               choices=[('disabled', 'use dd_block_size and the qemu-img '
+                                     'defaults'),
+                        ('sysfs', 'derive the dd block size, the number of '
+                                  'qemu-img coroutines and whether qemu-img '
+                                  'writes out of order from the request '
+                                  'queue limits of the device in sysfs'),
+                        ('calibrate', 'like sysfs, then time direct writes '
+                                      'of zeroes to the beginning of the '
+                                      'device with block sizes around the '
+                                      'derived one and use the fastest')],
+               help='How to tune writing images and config drives to block '
+                    'devices with dd and qemu-img.'),
+    cfg.IntOpt('write_calibration_size',
+               default=16,
+               min=1,
+               help='Amount of data in MiB written with each block size '
+                    'when write_tuning is set to "calibrate".'),
+    cfg.IntOpt('write_calibration_threshold',
+               default=1024,
+               min=0,
+               help='Minimum amount of data in MiB written with dd to a '
+                    'device for it to be calibrated when write_tuning is '
+                    'set to "calibrate". Smaller writes, e.g. of config '
+                    'drives, use the request queue limits only. Each '
+                    'device is calibrated once.'),
     cfg.IntOpt('partition_detection_attempts',
                default=3,
                min=1,
@@ -477,6 +680,19 @@ disk_utils_opts = [
     cfg.IntOpt('image_convert_attempts',
                default=3,
                help='Number of attempts to convert an image.'),
+    cfg.BoolOpt('native_metadata_wipe',
+                default=True,
+                help='Destroy disk metadata by zeroing the regions holding '
+                     'partition tables and known superblocks directly, only '
+                     'using wipefs for the signatures that remain. If '
+                     'disabled, wipefs, dd and sgdisk are always used.'),
+    cfg.BoolOpt('udev_targeted_settle',
+                default=True,
+                help='When waiting for udev after changing a disk, only wait '
+                     'for the events of this disk and its partitions instead '
+                     'of the whole udev event queue. Requires "udevadm '
+                     'trigger --settle" (systemd 238 or newer), the whole '
+                     'queue is waited for otherwise.'),
 ]
 
 disk_part_opts = [
@@ -491,7 +707,14 @@ disk_part_opts = [
                help='The maximum number of times to check that the device is '
                     'not accessed by another process. If the device is still '
                     'busy after that, the disk partitioning will be treated as'
-                    ' having failed.')
+                    ' having failed.'),
+    cfg.StrOpt('check_device_method',
+               default='native',
+               choices=[('native', 'scan file descriptors in /proc and wake '
+                                   'up as soon as the device is closed'),
+                        ('fuser', 'poll the fuser utility')],
+               help='How to check that the device is not accessed by '
+                    'another process.'),
 ]
 
 container_opts = [
@@ -20,21 +20,31 @@ Imported from ironic-lib's disk_utils as of the following commit:
 https://opendev.org/openstack/ironic-lib/commit/42fa5d63861ba0f04b9a4f67212173d7013a1332
 """
 
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import logging
+import mmap
 import os
 import re
+import select
 import stat
+import struct
 import time
 
 from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_utils import excutils
 from oslo_utils.imageutils import format_inspector
+from oslo_utils import units
 import tenacity
 
 from ironic_python_agent import disk_partitioner
 from ironic_python_agent import errors
 from ironic_python_agent import qemu_img
+from ironic_python_agent import timeline
 from ironic_python_agent import utils
 
 CONF = cfg.CONF
@@ -55,6 +65,47 @@ MAX_DISK_SIZE_MB_SUPPORTED_BY_MBR = 2097152
 # NOTE(JayF): Image types we write bit-perfect to disk, no conversion
 RAW_LIKE_IMAGETYPES = ['gpt', 'raw']
 
+# inotify definitions from linux/inotify.h
+_IN_CLOSE_WRITE = 0x00000008
+_IN_CLOSE_NOWRITE = 0x00000010
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+# Whether "udevadm trigger --settle" is available, reset when it turns out
+# it is not.
+_UDEV_TRIGGER_SETTLE_SUPPORTED = True
+
+# ioctl definitions from linux/fs.h
+_BLKSSZGET = 0x1268
+_BLKGETSIZE64 = 0x80081272
+_BLKFLSBUF = 0x1261
+_BLKRRPART = 0x125f
+
+# Size of the regions zeroed at the start and at the end of a device. Covers
+# the primary and the backup GPT with any sector size, the MBR and the
+# superblocks of the common file systems, LVM, MD RAID (all metadata
+# versions) and ZFS labels.
+_METADATA_REGION_SIZE = units.Mi
+# Btrfs keeps copies of its superblock at these offsets.
+_BTRFS_MIRROR_OFFSETS = (64 * units.Mi, 256 * units.Gi, units.Pi)
+
+# Request queue attributes in sysfs used to tune writes
+_QUEUE_LIMITS = ('optimal_io_size', 'minimum_io_size', 'logical_block_size',
+                 'max_sectors_kb', 'nr_requests', 'rotational')
+_MIN_WRITE_BLOCK_SIZE = 128 * units.Ki
+_MAX_WRITE_BLOCK_SIZE = 64 * units.Mi
+# qemu-img convert accepts 1 to 16 coroutines with -m
+_QEMU_IMG_DEFAULT_COROUTINES = 8
+_QEMU_IMG_MAX_COROUTINES = 16
+
+# Results of the inspections of image files, see _inspection_cache_key
+_INSPECTION_CACHE = collections.OrderedDict()
+
+# Block sizes found by timing direct writes, maps the real paths of devices
+# to the fastest block size or None if they cannot be calibrated.
+_CALIBRATED_BLOCK_SIZES = {}
+_INSPECTION_CACHE_SIZE = 8
+
 
 def list_partitions(device):
     """Get partitions information from given device.
@@ -230,6 +281,7 @@ def partition_index_to_path(device, index):
     return part_template % (device, index)
 
 
+@timeline.phase('partitioning')
 def make_partitions(dev, root_mb, swap_mb, ephemeral_mb,
                     configdrive_mb, node_uuid, commit=True,
                     boot_option="netboot", boot_mode="bios",
@@ -369,9 +421,205 @@ def is_block_device(dev):
     raise errors.DeploymentError(msg)
 
 
+def _read_queue_limits(device):
+    """Read the request queue limits of a block device from sysfs.
+
+    Partitions share the request queue of their disk.
+
+    :param device: The path to the device.
+    :returns: a dict with the integer values of the limits (0 when not
+        available) or None if the device is not a block device.
+    """
+    try:
+        st = os.stat(device)
+    except OSError:
+        return
+    if not stat.S_ISBLK(st.st_mode):
+        return
+
+    path = os.path.realpath('/sys/dev/block/%d:%d' % (os.major(st.st_rdev),
+                                                      os.minor(st.st_rdev)))
+    if os.path.exists(os.path.join(path, 'partition')):
+        path = os.path.dirname(path)
+    limits = {}
+    for name in _QUEUE_LIMITS:
+        try:
+            with open(os.path.join(path, 'queue', name)) as f:
+                limits[name] = int(f.read().strip())
+        except (OSError, ValueError):
+            limits[name] = 0
+    return limits
+
+
+def _align_block_size(block_size, limits):
+    """Align a block size to the I/O sizes of a device and clamp it."""
+    alignment = max(limits['optimal_io_size'], limits['minimum_io_size'],
+                    limits['logical_block_size'], 4096)
+    block_size = max(_MIN_WRITE_BLOCK_SIZE,
+                     min(block_size, _MAX_WRITE_BLOCK_SIZE))
+    return max(alignment, (block_size + alignment - 1)
+               // alignment * alignment)
+
+
+def _tune_from_limits(limits):
+    """Derive the write parameters from the request queue limits."""
+    request_size = limits['max_sectors_kb'] * units.Ki or units.Mi
+    if limits['rotational']:
+        # dd writes synchronously, one large request keeps a spinning disk
+        # streaming while out of order writes would make it seek.
+        in_flight = 1
+        coroutines = _QEMU_IMG_DEFAULT_COROUTINES
+    else:
+        in_flight = max(1, min(limits['nr_requests'] // 8, 8))
+        coroutines = max(_QEMU_IMG_DEFAULT_COROUTINES,
+                         min(limits['nr_requests'] // 16,
+                             _QEMU_IMG_MAX_COROUTINES))
+    return {'block_size': _align_block_size(request_size * in_flight,
+                                            limits),
+            'coroutines': coroutines,
+            'out_of_order': not limits['rotational'],
+            'source': 'sysfs'}
+
+
+def _calibrate_block_size(device, candidates, size):
+    """Find the fastest block size for direct writes to a device.
+
+    Zeroes are written to the beginning of the device, which is about to be
+    overwritten with an image.
+
+    :param device: The path to the device.
+    :param candidates: block sizes to try.
+    :param size: number of bytes to write with each block size.
+    :raises: OSError on failure.
+    :returns: a tuple (block size, throughput in bytes per second) or None
+        if the device is smaller than the requested size.
+    """
+    flags = os.O_WRONLY | os.O_CLOEXEC
+    if not stat.S_ISREG(os.stat(device).st_mode):
+        flags |= os.O_DIRECT
+    fd = os.open(device, flags)
+    try:
+        if _get_open_device_size(fd)[0] < size:
+            return
+        results = []
+        for block_size in candidates:
+            count = max(1, size // block_size)
+            # mmap gives a page aligned buffer as required by O_DIRECT
+            with mmap.mmap(-1, block_size) as buf, \
+                    memoryview(buf) as zeroes:
+                start = time.monotonic()
+                for index in range(count):
+                    os.pwritev(fd, [zeroes], index * block_size)
+                os.fsync(fd)
+                elapsed = max(time.monotonic() - start, 1e-9)
+            results.append((count * block_size / elapsed, -block_size))
+            LOG.debug('Writing %(size)d bytes to %(dev)s with block size '
+                      '%(bs)d took %(time).3f seconds',
+                      {'size': count * block_size, 'dev': device,
+                       'bs': block_size, 'time': elapsed})
+    finally:
+        os.close(fd)
+    # The smallest block size wins a tie
+    throughput, block_size = max(results)
+    return -block_size, throughput
+
+
+def _get_calibrated_block_size(device, limits, block_size, size):
+    """Get the fastest block size for writing data to a device.
+
+    The device is calibrated once. Calibration is skipped for writes smaller
+    than ``[disk_utils]write_calibration_threshold`` MiB and for writes not
+    covering all the zeroes written while calibrating, so that only data
+    which is about to be overwritten anyway is destroyed.
+
+    :param device: The path to the device.
+    :param limits: The request queue limits of the device.
+    :param block_size: The block size derived from the limits.
+    :param size: The number of bytes about to be written to the device.
+    :returns: the block size or None if the device is not calibrated.
+    """
+    candidates = sorted({_align_block_size(candidate, limits)
+                         for candidate in (block_size // 4, block_size,
+                                           block_size * 4)})
+    calibration_size = CONF.disk_utils.write_calibration_size * units.Mi
+    threshold = CONF.disk_utils.write_calibration_threshold * units.Mi
+    if size < max(threshold, calibration_size, candidates[-1]):
+        LOG.debug('Not calibrating writes of %(size)d bytes to %(dev)s',
+                  {'size': size, 'dev': device})
+        return
+
+    key = os.path.realpath(device)
+    if key in _CALIBRATED_BLOCK_SIZES:
+        return _CALIBRATED_BLOCK_SIZES[key]
+
+    try:
+        result = _calibrate_block_size(device, candidates, calibration_size)
+    except OSError as e:
+        LOG.warning('Unable to calibrate writes to %(dev)s, using the '
+                    'request queue limits only. Error: %(err)s',
+                    {'dev': device, 'err': e})
+        result = None
+    _CALIBRATED_BLOCK_SIZES[key] = result[0] if result else None
+    return _CALIBRATED_BLOCK_SIZES[key]
+
+
+def get_write_tuning(device, size=None):
+    """Get the parameters for writing an image to a block device.
+
+    Depends on the ``[disk_utils]write_tuning`` option.
+
+    :param device: The path to the device.
+    :param size: The number of bytes about to be written with the returned
+        block size, if it is going to be used. Required for calibration.
+    :returns: a dict with the dd block size in bytes (``block_size``), the
+        number of qemu-img coroutines (``coroutines``), whether qemu-img may
+        write out of order (``out_of_order``) and how they were determined
+        (``source``), or None if tuning is disabled or not possible.
+    """
+    mode = CONF.disk_utils.write_tuning
+    if mode == 'disabled':
+        return
+
+    limits = _read_queue_limits(device)
+    if limits is None:
+        LOG.debug('Not tuning writes to %s, not a block device', device)
+        return
+
+    tuning = _tune_from_limits(limits)
+    if mode == 'calibrate' and size is not None:
+        block_size = _get_calibrated_block_size(device, limits,
+                                                tuning['block_size'], size)
+        if block_size is not None:
+            tuning['block_size'] = block_size
+            tuning['source'] = 'calibration'
+
+    LOG.info('Tuned writes to %(dev)s based on %(source)s: block size '
+             '%(block_size)d, %(coroutines)d qemu-img coroutines, out of '
+             'order writes %(out_of_order)s',
+             dict(tuning, dev=device))
+    return tuning
+
+
+def _get_data_size(path):
+    """Get the size of a file or a block device, None if unknown."""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    except OSError:
+        return
+    try:
+        return _get_open_device_size(fd)[0]
+    except OSError:
+        return
+    finally:
+        os.close(fd)
+
+
 def dd(src, dst, conv_flags=None):
     """Execute dd from src to dst."""
-    args = ['bs=%s' % CONF.disk_utils.dd_block_size, 'oflag=direct']
+    tuning = get_write_tuning(dst, size=_get_data_size(src))
+    block_size = (tuning['block_size'] if tuning
+                  else CONF.disk_utils.dd_block_size)
+    args = ['bs=%s' % block_size, 'oflag=direct']
     if conv_flags:
         args.append('conv=%s' % conv_flags)
 
@@ -380,8 +628,13 @@ def dd(src, dst, conv_flags=None):
 
 
 def _image_inspection(filename):
+    return _check_image_format(
+        lambda: format_inspector.detect_file_format(filename))
+
+
+def _check_image_format(detect):
     try:
-        inspector_cls = format_inspector.detect_file_format(filename)
+        inspector_cls = detect()
         if not inspector_cls:
             msg = "Security: Unable to safety check image"
             LOG.error(msg)
@@ -401,7 +654,129 @@ def _image_inspection(filename):
     return inspector_cls
 
 
-def get_and_validate_image_format(filename, ironic_disk_format):
+class _ChunkSource(object):
+    """File-like object returning the chunk given to the inspectors."""
+
+    chunk = b''
+
+    def read(self, size):
+        chunk, self.chunk = self.chunk, b''
+        return chunk
+
+
+class StreamingInspection(object):
+    """Format inspection of an image performed while it is downloaded.
+
+    The chunks of the image are given to the format inspectors until they
+    have all reached a decision, usually within its first megabytes. Once
+    the image has been downloaded and verified, :func:`cache_inspection`
+    records the result for :func:`get_and_validate_image_format`.
+    """
+
+    def __init__(self):
+        self._source = _ChunkSource()
+        self._wrapper = format_inspector.InspectWrapper(self._source)
+        self.complete = False
+
+    def update(self, chunk):
+        """Inspect the next chunk of the image."""
+        if self.complete:
+            return
+        self._source.chunk = chunk
+        self._wrapper.read(len(chunk))
+        self.complete = self._wrapper.formats is not None
+
+    def result(self):
+        """Finish the inspection.
+
+        :returns: the matching inspector, or the InvalidImage exception if
+            the image is not acceptable.
+        """
+        self._wrapper.close()
+        self.complete = True
+        try:
+            return _check_image_format(lambda: self._wrapper.format)
+        except errors.InvalidImage as e:
+            return e
+
+
+def _inspection_cache_key(filename, checksum):
+    """Identify an image file for the inspection cache.
+
+    :returns: the key, or None if the file is not a regular file.
+    """
+    try:
+        st = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (os.path.realpath(filename), st.st_dev, st.st_ino, st.st_size,
+            st.st_mtime_ns, checksum, CONF.disable_deep_image_inspection)
+
+
+def _store_inspection(key, result):
+    _INSPECTION_CACHE[key] = result
+    _INSPECTION_CACHE.move_to_end(key)
+    while len(_INSPECTION_CACHE) > _INSPECTION_CACHE_SIZE:
+        _INSPECTION_CACHE.popitem(last=False)
+
+
+def _cached_inspection(filename, checksum, inspect):
+    """Inspect an image file unless it has already been inspected.
+
+    Inspections rejecting the image are cached as well, other errors are
+    not.
+    """
+    key = _inspection_cache_key(filename, checksum)
+    result = _INSPECTION_CACHE.get(key) if key is not None else None
+    if result is None:
+        try:
+            result = inspect()
+        except errors.InvalidImage as e:
+            result = e
+        if key is not None:
+            _store_inspection(key, result)
+    else:
+        LOG.debug('Using the cached inspection of image %s', filename)
+    if isinstance(result, errors.InvalidImage):
+        raise result
+    return result
+
+
+def cache_inspection(filename, inspection, checksum=None):
+    """Record the inspection of an image performed while downloading it.
+
+    :param filename: The name of the downloaded image file.
+    :param inspection: A :class:`StreamingInspection` given all the chunks
+        written to the file.
+    :param checksum: The checksum the image has been verified against.
+    """
+    if CONF.disable_deep_image_inspection:
+        return
+    key = _inspection_cache_key(filename, checksum)
+    if key is not None:
+        _store_inspection(key, inspection.result())
+
+
+@timeline.phase('format_inspection')
+def _get_raw_image_size(filename):
+    """Get the size of a raw image file or of a block device holding it.
+
+    The size of a block device (e.g. a loop device) reported by stat is 0,
+    it is read with BLKGETSIZE64 instead.
+    """
+    if not stat.S_ISBLK(os.stat(filename).st_mode):
+        return os.path.getsize(filename)
+    fd = os.open(filename, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        return _get_open_device_size(fd)[0]
+    finally:
+        os.close(fd)
+
+
+def get_and_validate_image_format(filename, ironic_disk_format,
+                                  checksum=None):
     """Get the format of a given image file and ensure it's allowed.
 
     This method uses the format inspector originally written for glance to
@@ -420,12 +795,18 @@ def get_and_validate_image_format(filename, ironic_disk_format):
     See https://bugs.launchpad.net/ironic/+bug/2071740 for full details on
     why this must always happen.
 
+    The results of the inspection are cached as long as the file does not
+    change.
+
     :param filename: The name of the image file to validate.
     :param ironic_disk_format: The ironic-provided expected format of the image
+    :param checksum: The checksum the image has been verified against, if
+        any.
     :returns: tuple of validated img_format (str) and size (int)
     """
     if CONF.disable_deep_image_inspection:
-        data = qemu_img.image_info(filename)
+        data = _cached_inspection(filename, checksum,
+                                  lambda: qemu_img.image_info(filename))
         img_format = data.file_format
         size = data.virtual_size
     else:
@@ -434,9 +815,10 @@ def get_and_validate_image_format(filename, ironic_disk_format):
             #             type that doesn't need conversion. This negates any
             #             security risk the image file could pose.
             img_format = ironic_disk_format
-            size = os.path.getsize(filename)
+            size = _get_raw_image_size(filename)
         else:
-            img_format_cls = _image_inspection(filename)
+            img_format_cls = _cached_inspection(
+                filename, checksum, lambda: _image_inspection(filename))
             img_format = str(img_format_cls)
             size = img_format_cls.virtual_size
             if img_format not in CONF.permitted_image_formats:
@@ -458,6 +840,7 @@ def get_and_validate_image_format(filename, ironic_disk_format):
     return img_format, size
 
 
+@timeline.phase('write_image')
 def populate_image(src, dst, conv_flags=None, source_format=None, is_raw=False,
                    sparse_size='0', out_format='raw', **convert_args):
     """Populate a provided destination device with the image
@@ -482,6 +865,10 @@ def populate_image(src, dst, conv_flags=None, source_format=None, is_raw=False,
             LOG.info('Writing raw image %s to device %s', src, dst)
             dd(src, dst, conv_flags=conv_flags)
         else:
+            tuning = get_write_tuning(dst)
+            if tuning:
+                convert_args['coroutines'] = tuning['coroutines']
+                convert_args['out_of_order'] = tuning['out_of_order']
             qemu_img.convert_image(src, dst,
                                    out_format=out_format,
                                    sparse_size=sparse_size,
@@ -518,11 +905,184 @@ def get_dev_sector_size(dev):
     return int(sect_sz)
 
 
+def _get_metadata_regions(dev_size):
+    """Get the regions of a device holding metadata structures.
+
+    :param dev_size: size of the device in bytes.
+    :returns: a list of (offset, length) tuples aligned to 4 KiB.
+    """
+    if dev_size <= 2 * _METADATA_REGION_SIZE:
+        return [(0, dev_size)]
+
+    # NOTE: round the end region down to 4 KiB, the tail of a device with
+    # an odd size is zeroed separately.
+    tail = (dev_size - _METADATA_REGION_SIZE) // 4096 * 4096
+    regions = [(0, _METADATA_REGION_SIZE), (tail, dev_size - tail)]
+    for offset in _BTRFS_MIRROR_OFFSETS:
+        if offset + 4096 <= tail:
+            regions.append((offset, 4096))
+    return regions
+
+
+def get_scratch_region(dev_size, length):
+    """Find a region at the end of a device to temporarily store data in.
+
+    The region does not overlap with any of the metadata structures zeroed
+    by destroy_disk_metadata, so its content survives wiping the device.
+
+    :param dev_size: size of the device in bytes.
+    :param length: minimum length of the region in bytes.
+    :returns: an (offset, length) tuple aligned to 1 MiB or None if the
+        device is too small.
+    """
+    length = (length + units.Mi - 1) // units.Mi * units.Mi
+    metadata = _get_metadata_regions(dev_size)
+    end = (dev_size - _METADATA_REGION_SIZE) // units.Mi * units.Mi
+    while end - length >= _METADATA_REGION_SIZE:
+        start = end - length
+        overlapping = [offset for offset, size in metadata
+                       if offset < end and offset + size > start]
+        if not overlapping:
+            return start, length
+        end = min(overlapping) // units.Mi * units.Mi
+    return None
+
+
+def _get_open_device_size(fd):
+    """Get the size and the logical sector size of an open device.
+
+    Regular files are supported as well for testing purposes.
+
+    :returns: a tuple (size in bytes, sector size in bytes).
+    """
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        return os.fstat(fd).st_size, 512
+    buf = fcntl.ioctl(fd, _BLKGETSIZE64, b'\0' * 8)
+    dev_size = struct.unpack('Q', buf)[0]
+    buf = fcntl.ioctl(fd, _BLKSSZGET, b'\0' * 4)
+    sector_size = struct.unpack('i', buf)[0]
+    return dev_size, sector_size
+
+
+def _zero_metadata_regions(dev):
+    """Zero the metadata regions of a device using direct writes.
+
+    :param dev: Path for the device to work on.
+    :raises: OSError on failure.
+    :returns: a tuple (size, number of bytes written).
+    """
+    is_file = stat.S_ISREG(os.stat(dev).st_mode)
+    flags = os.O_WRONLY | os.O_CLOEXEC
+    if not is_file:
+        # Bypass the page cache, the kernel must not serve stale metadata
+        flags |= os.O_DIRECT
+    fd = os.open(dev, flags)
+    try:
+        dev_size, sector_size = _get_open_device_size(fd)
+        regions = _get_metadata_regions(dev_size)
+        if not dev_size:
+            return dev_size, 0
+        written = 0
+        # mmap gives a page aligned buffer as required by O_DIRECT
+        with mmap.mmap(-1, max(length for _, length in regions)) as buf, \
+                memoryview(buf) as zeroes:
+            for offset, length in regions:
+                aligned = length // sector_size * sector_size
+                if aligned:
+                    written += os.pwritev(fd, [zeroes[:aligned]], offset)
+                if aligned != length:
+                    # Not a multiple of the sector size, only possible for
+                    # regular files.
+                    written += os.pwrite(fd, b'\0' * (length - aligned),
+                                         offset + aligned)
+        os.fsync(fd)
+        if not is_file:
+            fcntl.ioctl(fd, _BLKFLSBUF)
+    finally:
+        os.close(fd)
+    return dev_size, written
+
+
+def _reread_partition_table(dev):
+    """Make the kernel re-read the partition table of a block device.
+
+    Falls back to partprobe if the partitions are in use, since it only
+    updates the partitions that are not.
+
+    :param dev: Path for the device to work on.
+    :raises: OSError on failure.
+    """
+    if not stat.S_ISBLK(os.stat(dev).st_mode):
+        return
+    fd = os.open(dev, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        fcntl.ioctl(fd, _BLKRRPART)
+        return
+    except OSError as e:
+        if e.errno == errno.EINVAL:
+            LOG.debug('Device %s does not support partitions', dev)
+            return
+        if e.errno != errno.EBUSY:
+            raise
+        LOG.debug('Partitions of %s are in use, using partprobe to '
+                  're-read its partition table', dev)
+    finally:
+        os.close(fd)
+    partprobe(dev)
+
+
+def _wipe_remaining_signatures(dev):
+    """Let wipefs erase the signatures not covered by the native wipe."""
+    out, _err = utils.execute('wipefs', '--noheadings', '--output',
+                              'OFFSET,TYPE', dev, use_standard_locale=True)
+    if not out.strip():
+        return
+    LOG.debug('Signatures remaining on %(dev)s after zeroing the metadata '
+              'regions: %(sigs)s', {'dev': dev, 'sigs': out.strip()})
+    try:
+        utils.execute('wipefs', '--force', '--all', dev,
+                      use_standard_locale=True)
+    except processutils.ProcessExecutionError as e:
+        with excutils.save_and_reraise_exception() as ctxt:
+            if '--force' in str(e):
+                ctxt.reraise = False
+                utils.execute('wipefs', '--all', dev,
+                              use_standard_locale=True)
+
+
+def _destroy_disk_metadata_natively(dev):
+    """Destroy metadata structures with direct writes.
+
+    :param dev: Path for the device to work on.
+    :returns: False if the device cannot be handled natively, True otherwise.
+    """
+    start = time.monotonic()
+    try:
+        dev_size, written = _zero_metadata_regions(dev)
+        _reread_partition_table(dev)
+    except OSError as e:
+        LOG.warning('Unable to zero the metadata regions of %(dev)s, falling '
+                    'back to wipefs, dd and sgdisk. Error: %(err)s',
+                    {'dev': dev, 'err': e})
+        return False
+
+    _wipe_remaining_signatures(dev)
+    LOG.debug('Zeroed %(written)d bytes of metadata on %(dev)s of size '
+              '%(size)d in %(time).2f seconds',
+              {'written': written, 'dev': dev, 'size': dev_size,
+               'time': time.monotonic() - start})
+    return True
+
+
+@timeline.phase('destroy_metadata')
 def destroy_disk_metadata(dev, node_uuid):
     """Destroy metadata structures on node's disk.
 
     Ensure that node's disk magic strings are wiped without zeroing the
-    entire drive. To do this we use the wipefs tool from util-linux.
+    entire drive. Unless ``[disk_utils]native_metadata_wipe`` is disabled,
+    the regions holding partition tables and the known superblocks are
+    zeroed directly and the wipefs tool from util-linux is only used for
+    the signatures that remain. Otherwise wipefs, dd and sgdisk are used.
 
     :param dev: Path for the device to work on.
     :param node_uuid: Node's uuid. Used for logging.
@@ -531,6 +1091,22 @@ def destroy_disk_metadata(dev, node_uuid):
     # https://bugs.launchpad.net/ironic/+bug/1317647
     LOG.debug("Start destroy disk metadata for node %(node)s.",
               {'node': node_uuid})
+    if (not CONF.disk_utils.native_metadata_wipe
+            or not _destroy_disk_metadata_natively(dev)):
+        _destroy_disk_metadata_with_tools(dev)
+
+    try:
+        wait_for_disk_to_become_available(dev)
+    except errors.RESTError as e:
+        raise errors.DeploymentError(
+            f'Destroying metadata failed on device {dev}s. Error: {e}')
+
+    LOG.info("Disk metadata on %s successfully destroyed for node "
+             "%s", dev, node_uuid)
+
+
+def _destroy_disk_metadata_with_tools(dev):
+    """Destroy metadata structures using wipefs, dd and sgdisk."""
     try:
         utils.execute('wipefs', '--force', '--all', dev,
                       use_standard_locale=True)
@@ -580,15 +1156,6 @@ def destroy_disk_metadata(dev, node_uuid):
     # Go ahead and let sgdisk run as well.
     utils.execute('sgdisk', '-Z', dev, use_standard_locale=True)
 
-    try:
-        wait_for_disk_to_become_available(dev)
-    except errors.RESTError as e:
-        raise errors.DeploymentError(
-            f'Destroying metadata failed on device {dev}s. Error: {e}')
-
-    LOG.info("Disk metadata on %s successfully destroyed for node "
-             "%s", dev, node_uuid)
-
 
 def _fix_gpt_structs(device, node_uuid):
     """Checks backup GPT data structures and moves them to end of the device
@@ -613,6 +1180,7 @@ def _fix_gpt_structs(device, node_uuid):
         raise errors.DeploymentError(msg)
 
 
+@timeline.phase('fix_gpt_partition')
 def fix_gpt_partition(device, node_uuid):
     """Fix GPT partition
 
@@ -635,14 +1203,54 @@ def fix_gpt_partition(device, node_uuid):
         raise errors.DeploymentError(msg)
 
 
-def udev_settle():
+@timeline.phase('udev_settle_device')
+def _udev_settle_device(device):
+    """Wait for udev to process the queued events of a device.
+
+    A synthetic change event is triggered for the device and waited for.
+    udev processes an event only after all the events queued before it for
+    the same device, its parents and its children (e.g. new partitions), so
+    once it is handled these are handled too.
+
+    :return: True on success, False if the targeted wait is not possible.
+    """
+    global _UDEV_TRIGGER_SETTLE_SUPPORTED
+    if not _UDEV_TRIGGER_SETTLE_SUPPORTED:
+        return False
+
+    LOG.debug('Waiting until udev has processed the events of %s', device)
+    try:
+        utils.execute('udevadm', 'trigger', '--settle', '--action=change',
+                      device)
+    except (processutils.ProcessExecutionError, OSError) as e:
+        if 'unrecognized option' in str(getattr(e, 'stderr', '')):
+            LOG.info('udevadm does not support waiting for triggered '
+                     'events, waiting for the whole udev queue instead')
+            _UDEV_TRIGGER_SETTLE_SUPPORTED = False
+        else:
+            LOG.warning('Failed to wait for udev to process the events of '
+                        '%(dev)s, waiting for the whole udev queue. '
+                        'Error: %(err)s', {'dev': device, 'err': e})
+        return False
+    return True
+
+
+@timeline.phase('udev_settle')
+def udev_settle(device=None):
     """Wait for the udev event queue to settle.
 
     Wait for the udev event queue to settle to make sure all devices
     are detected once the machine boots up.
 
+    :param device: If provided and ``[disk_utils]udev_targeted_settle`` is
+        enabled, only wait for the events of this device and its partitions,
+        falling back to waiting for the whole queue.
     :return: True on success, False otherwise.
     """
+    if (device and CONF.disk_utils.udev_targeted_settle
+            and _udev_settle_device(device)):
+        return True
+
     LOG.debug('Waiting until udev event queue is empty')
     try:
         utils.execute('udevadm', 'settle')
@@ -678,6 +1286,7 @@ def partprobe(device, attempts=None):
         return True
 
 
+@timeline.phase('rescan')
 def trigger_device_rescan(device, attempts=None):
     """Sync and trigger device rescan.
 
@@ -704,9 +1313,9 @@ def trigger_device_rescan(device, attempts=None):
     utils.execute('sync')
     # Make sure any additions to the partitioning are reflected in the
     # kernel.
-    udev_settle()
+    udev_settle(device)
     partprobe(device, attempts=attempts)
-    udev_settle()
+    udev_settle(device)
     try:
         # Also verify that the partitioning is correct now.
         utils.execute('sgdisk', '-v', device)
@@ -718,6 +1327,166 @@ def trigger_device_rescan(device, attempts=None):
         return True
 
 
+def _get_device_numbers(device):
+    """Get the device numbers of a block device and of all its holders.
+
+    Holders (e.g. device mapper or software RAID devices) are looked up
+    recursively in sysfs, a process using one of them uses the device too.
+
+    :param device: The path to the device.
+    :returns: a set of device numbers or None if the device is not a block
+        device.
+    """
+    try:
+        st = os.stat(device)
+    except OSError:
+        return
+    if not stat.S_ISBLK(st.st_mode):
+        return
+
+    numbers = set()
+    pending = [st.st_rdev]
+    while pending:
+        number = pending.pop()
+        if number in numbers:
+            continue
+        numbers.add(number)
+        holders = '/sys/dev/block/%d:%d/holders' % (os.major(number),
+                                                    os.minor(number))
+        try:
+            names = os.listdir(holders)
+        except OSError:
+            continue
+        for name in names:
+            try:
+                with open(os.path.join('/sys/class/block', name, 'dev')) as f:
+                    major, minor = f.read().strip().split(':')
+            except (OSError, ValueError):
+                continue
+            pending.append(os.makedev(int(major), int(minor)))
+    return numbers
+
+
+def _get_holding_pids(numbers):
+    """Find processes which have any of the given block devices open.
+
+    A native replacement for fuser, which scans the file descriptors of all
+    processes in /proc, including the agent itself.
+
+    :param numbers: a set of device numbers.
+    :returns: a sorted list of PIDs (as strings).
+    """
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # The process has exited or is not accessible
+            continue
+        for fd in fds:
+            try:
+                st = os.stat(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if stat.S_ISBLK(st.st_mode) and st.st_rdev in numbers:
+                pids.append(pid)
+                break
+    return sorted(pids, key=int)
+
+
+class _DeviceCloseWatcher(object):
+    """Wait for a device to be closed using inotify.
+
+    If inotify is not available, waiting simply sleeps for the timeout.
+    """
+
+    def __init__(self, device):
+        self._fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(
+                    fd, os.fsencode(device),
+                    _IN_CLOSE_WRITE | _IN_CLOSE_NOWRITE) < 0:
+                err = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(err, 'inotify_add_watch failed')
+        except (OSError, AttributeError, TypeError) as e:
+            LOG.debug('Cannot watch device %(device)s with inotify, falling '
+                      'back to polling: %(err)s', {'device': device, 'err': e})
+        else:
+            self._fd = fd
+
+    def wait(self, timeout):
+        """Wait until the device is closed by any process or the timeout.
+
+        :param timeout: timeout in seconds.
+        """
+        if self._fd is None:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            # Drain the pending events, only the wake-up matters.
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _wait_for_disk_natively(device, numbers):
+    """Wait for a disk device to be released without using fuser.
+
+    Waits up to ``check_device_interval`` * ``check_device_max_retries``
+    seconds. The holders of the device are checked again as soon as any
+    process closes the device, and at least every ``check_device_interval``
+    seconds. Wake-ups caused by unrelated processes (e.g. udev probing the
+    device) do not shorten the timeout.
+
+    :param device: The path to the device.
+    :param numbers: a set of device numbers from _get_device_numbers.
+    :raises: DeviceNotFound If the disk fails to become available.
+    """
+    interval = CONF.disk_partitioner.check_device_interval
+    max_retries = CONF.disk_partitioner.check_device_max_retries
+    deadline = time.monotonic() + interval * max_retries
+    watcher = _DeviceCloseWatcher(device)
+    previous = None
+    try:
+        while True:
+            pids = _get_holding_pids(numbers)
+            if not pids:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if pids != previous:
+                LOG.debug('Device %(device)s is held by processes %(pids)s, '
+                          'waiting for them to release it',
+                          {'device': device, 'pids': ', '.join(pids)})
+                previous = pids
+            watcher.wait(min(interval, remaining))
+    finally:
+        watcher.close()
+
+    raise errors.DeviceNotFound(
+        ('Processes with the following PIDs are holding '
+         'device %(device)s: %(pids)s. '
+         'Timed out waiting for completion.')
+        % {'device': device, 'pids': ', '.join(pids)})
+
+
 def wait_for_disk_to_become_available(device):
     """Wait for a disk device to become available.
 
@@ -728,11 +1497,21 @@ def wait_for_disk_to_become_available(device):
     Timeout and iteration settings come from the configuration
     options used by the in-library disk_partitioner:
     ``check_device_interval`` and ``check_device_max_retries``.
+    Unless ``check_device_method`` is ``fuser``, processes holding the
+    device are found by scanning /proc directly, falling back to fuser if
+    the device cannot be inspected.
 
     :params device: The path to the device.
     :raises: IronicException If the disk fails to become
         available.
     """
+    if CONF.disk_partitioner.check_device_method == 'native':
+        numbers = _get_device_numbers(device)
+        if numbers is not None:
+            return _wait_for_disk_natively(device, numbers)
+        LOG.debug('Cannot inspect %s natively, falling back to fuser',
+                  device)
+
     pids = ['']
     stderr = ['']
     interval = CONF.disk_partitioner.check_device_interval
@@ -0,0 +1,393 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import math
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import re
+import threading
+import time
+
+from oslo_concurrency import processutils
+from oslo_config import cfg
+from oslo_log import log
+from oslo_utils import units
+
+from ironic_python_agent import errors
+from ironic_python_agent.metrics_lib import metrics_utils
+from ironic_python_agent import utils
+
+
+LOG = log.getLogger(__name__)
+CONF = cfg.CONF
+
+# Patterns an erased device is expected to read back as. ``zero`` is what
+# shred --zero leaves behind, ``uniform`` accepts any block consisting of a
+# single repeated byte (e.g. 0x00 or 0xff), which is what firmware driven
+# erase commands typically produce.
+VERIFY_PATTERNS = frozenset(['zero', 'uniform'])
+
+# Maximum number of non-erased block offsets to carry in a report.
+_MAX_REPORTED_OFFSETS = 10
+
+_PCI_ADDRESS_RE = re.compile(
+    r'pci-([0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-9a-f])', re.IGNORECASE)
+_HDPARM_ERASE_TIME_RE = re.compile(
+    r'(\d+)min for (?:ENHANCED )?SECURITY ERASE UNIT')
+# Rough erase throughput used to estimate erase times when the drive does not
+# report one. Only the relative order of the estimates matters.
+_ROTATIONAL_ERASE_THROUGHPUT = 150 * units.Mi
+_SOLID_STATE_ERASE_THROUGHPUT = 500 * units.Mi
+
+
+def get_sample_count(confidence, tolerance):
+    """Calculate how many random blocks have to be read.
+
+    The number of samples is chosen so that, if at least ``tolerance`` of
+    the blocks of a device were not erased, at least one of them is read
+    with a probability of ``confidence``.
+
+    :param confidence: required detection probability, 0 < confidence < 1.
+    :param tolerance: fraction of non-erased blocks which must be detected,
+        0 < tolerance < 1.
+    :returns: number of blocks to sample.
+    """
+    if not 0 < confidence < 1 or not 0 < tolerance < 1:
+        raise ValueError('Confidence and tolerance must be between 0 and 1, '
+                         'got %s and %s' % (confidence, tolerance))
+    return int(math.ceil(math.log(1 - confidence) / math.log(1 - tolerance)))
+
+
+def _is_erased(data, pattern):
+    if pattern == 'zero':
+        return not data.strip(b'\0')
+    return not data.strip(data[:1])
+
+
+def _verify_blocks(fd, offsets, block_size, pattern):
+    # NOTE: anonymous mmap is page aligned, which O_DIRECT needs.
+    buf = mmap.mmap(-1, block_size)
+    unerased = []
+    bytes_read = 0
+    try:
+        for offset in offsets:
+            length = os.preadv(fd, [buf], offset)
+            bytes_read += length
+            if length and not _is_erased(buf[:length], pattern):
+                unerased.append(offset)
+    finally:
+        buf.close()
+    return bytes_read, unerased
+
+
+def verify_erased_device(device, pattern='zero', confidence=None,
+                         tolerance=None, block_size=None, threads=None):
+    """Verify that a device reads back as erased.
+
+    Reads a random sample of aligned blocks concurrently and checks that each
+    of them is filled according to ``pattern``. The first and the last block
+    of the device, where partition tables and most metadata live, are always
+    included in the sample.
+
+    :param device: path to the block device.
+    :param pattern: one of VERIFY_PATTERNS.
+    :param confidence: probability of detecting a failed erase, defaults to
+        the ``erase_verification_confidence`` option.
+    :param tolerance: fraction of non-erased blocks that must be detected,
+        defaults to the ``erase_verification_tolerance`` option.
+    :param block_size: size of each sampled block in bytes, defaults to the
+        ``erase_verification_block_size`` option.
+    :param threads: number of concurrent readers, defaults to the
+        ``erase_verification_threads`` option.
+    :raises: BlockDeviceEraseError if the device cannot be read or any of the
+        sampled blocks was not erased.
+    :returns: a dictionary with the verification report.
+    """
+    if pattern not in VERIFY_PATTERNS:
+        raise errors.BlockDeviceEraseError(
+            'Unknown erase verification pattern %s, expected one of %s'
+            % (pattern, ', '.join(sorted(VERIFY_PATTERNS))))
+
+    confidence = confidence or CONF.erase_verification_confidence
+    tolerance = tolerance or CONF.erase_verification_tolerance
+    block_size = block_size or CONF.erase_verification_block_size
+    threads = threads or CONF.erase_verification_threads
+
+    start = time.monotonic()
+    try:
+        fd, direct = utils.open_for_direct_read(device)
+    except OSError as e:
+        raise errors.BlockDeviceEraseError(
+            'Unable to open device %s for erase verification: %s'
+            % (device, e))
+
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        total_blocks = size // block_size
+        samples = get_sample_count(confidence, tolerance)
+        if samples >= total_blocks:
+            blocks = range(total_blocks)
+        else:
+            blocks = set(random.SystemRandom().sample(range(total_blocks),
+                                                      samples))
+            blocks.update((0, total_blocks - 1))
+        offsets = sorted(block * block_size for block in blocks)
+
+        threads = max(1, min(threads, len(offsets)))
+        chunk = int(math.ceil(len(offsets) / threads)) if offsets else 1
+        pool = ThreadPool(threads)
+        try:
+            results = pool.starmap(
+                _verify_blocks,
+                [(fd, offsets[i:i + chunk], block_size, pattern)
+                 for i in range(0, len(offsets), chunk)])
+        finally:
+            pool.close()
+            pool.join()
+    except OSError as e:
+        raise errors.BlockDeviceEraseError(
+            'Failed to read device %s during erase verification: %s'
+            % (device, e))
+    finally:
+        os.close(fd)
+
+    bytes_read = sum(result[0] for result in results)
+    unerased = sorted(offset for result in results for offset in result[1])
+    report = {
+        'device': device,
+        'pattern': pattern,
+        'direct_io': direct,
+        'block_size': block_size,
+        'samples': len(offsets),
+        'bytes_read': bytes_read,
+        'coverage': (bytes_read / size) if size else 1.0,
+        'confidence': confidence,
+        'tolerance': tolerance,
+        'duration': round(time.monotonic() - start, 3),
+        'unerased_blocks': len(unerased),
+        'unerased_offsets': unerased[:_MAX_REPORTED_OFFSETS],
+    }
+
+    if unerased:
+        msg = ('Erase verification of device %(dev)s failed: %(bad)d of '
+               '%(samples)d sampled blocks are not %(pattern)s filled, '
+               'first at offset %(offset)d' %
+               {'dev': device, 'bad': len(unerased),
+                'samples': len(offsets), 'pattern': pattern,
+                'offset': unerased[0]})
+        LOG.error(msg)
+        raise errors.BlockDeviceEraseError(msg)
+
+    LOG.info('Erase verification of device %(dev)s succeeded: read '
+             '%(samples)d blocks of %(bs)d bytes (%(coverage).4f%% of the '
+             'device) in %(duration)s seconds',
+             {'dev': device, 'samples': len(offsets), 'bs': block_size,
+              'coverage': report['coverage'] * 100,
+              'duration': report['duration']})
+    return report
+
+
+def get_device_controller(block_device):
+    """Determine the storage controller a block device is attached to.
+
+    :param block_device: a BlockDevice object.
+    :returns: a string identifying the controller: the PCI address from the
+        by-path link, the SCSI host from the HCTL or, if neither is known,
+        the device name itself.
+    """
+    if block_device.by_path:
+        addresses = _PCI_ADDRESS_RE.findall(
+            os.path.basename(block_device.by_path))
+        if addresses:
+            return 'pci-%s' % addresses[-1]
+    if block_device.hctl:
+        return 'host%s' % block_device.hctl.split(':')[0]
+    return block_device.name
+
+
+def parse_hdparm_erase_time(hdparm_output):
+    """Parse the security erase time estimate from ``hdparm -I`` output.
+
+    :param hdparm_output: the output of ``hdparm -I``.
+    :returns: the estimate in seconds (the longer one if both the normal and
+        the enhanced erase are reported) or None.
+    """
+    estimates = [int(minutes) * 60 for minutes in
+                 _HDPARM_ERASE_TIME_RE.findall(hdparm_output)]
+    return max(estimates) if estimates else None
+
+
+def estimate_erase_time(block_device, hdparm_output=None):
+    """Estimate how long erasing a block device is going to take.
+
+    The estimate reported by the drive via ``hdparm -I`` is used when
+    available, otherwise it is derived from the device size.
+
+    :param block_device: a BlockDevice object.
+    :param hdparm_output: the output of ``hdparm -I`` if already known, an
+        empty string to only use the device size. By default hdparm is
+        called.
+    :returns: the estimate in seconds.
+    """
+    if hdparm_output is None and not block_device.name.startswith(
+            '/dev/nvme'):
+        try:
+            hdparm_output, _e = utils.execute('hdparm', '-I',
+                                              block_device.name)
+        except (processutils.ProcessExecutionError, OSError) as e:
+            LOG.debug('Unable to get the erase time estimate of %(dev)s '
+                      'from hdparm: %(err)s',
+                      {'dev': block_device.name, 'err': e})
+    if hdparm_output:
+        estimate = parse_hdparm_erase_time(hdparm_output)
+        if estimate:
+            return estimate
+
+    throughput = (_ROTATIONAL_ERASE_THROUGHPUT if block_device.rotational
+                  else _SOLID_STATE_ERASE_THROUGHPUT)
+    return (block_device.size or 0) / throughput
+
+
+class EraseScheduler(object):
+    """Runs device erasures concurrently, balancing them across controllers.
+
+    Devices with the longest estimated erase time are started first. Each
+    free worker picks the longest pending erasure among the controllers
+    running the fewest erasures, and never more than controller_concurrency
+    erasures run on the same controller at once.
+    """
+
+    def __init__(self, block_devices, concurrency, controller_concurrency=0,
+                 estimates=None):
+        """Create a scheduler.
+
+        :param block_devices: BlockDevice objects to erase.
+        :param concurrency: maximum total number of concurrent erasures.
+        :param controller_concurrency: maximum number of concurrent erasures
+            per controller, 0 for no limit.
+        :param estimates: optional dictionary mapping device names to the
+            estimated erase time in seconds, devices are started in the
+            original order if it is not provided.
+        """
+        self.block_devices = list(block_devices)
+        self.concurrency = max(1, min(concurrency, len(self.block_devices)))
+        self.controller_concurrency = controller_concurrency
+        self.estimates = estimates or {}
+        self.controllers = {dev.name: get_device_controller(dev)
+                            for dev in self.block_devices}
+        self.report = None
+        self._pending = sorted(
+            self.block_devices,
+            key=lambda dev: -self.estimates.get(dev.name, 0))
+        self._running = collections.Counter()
+        self._outcomes = {}
+        self._condition = threading.Condition()
+
+    def _next_device(self):
+        candidates = [
+            dev for dev in self._pending
+            if (not self.controller_concurrency
+                or self._running[self.controllers[dev.name]]
+                < self.controller_concurrency)
+        ]
+        if not candidates:
+            return
+        # NOTE: min() returns the first of the equal items, i.e. the one with
+        # the longest estimate since the pending list is sorted.
+        device = min(candidates,
+                     key=lambda dev: self._running[self.controllers[dev.name]])
+        self._pending.remove(device)
+        self._running[self.controllers[device.name]] += 1
+        return device
+
+    def _worker(self, erase):
+        while True:
+            with self._condition:
+                device = self._next_device()
+                while device is None and self._pending:
+                    self._condition.wait()
+                    device = self._next_device()
+                if device is None:
+                    return
+
+            start = time.monotonic()
+            try:
+                outcome = (True, erase(device))
+            except Exception as e:
+                outcome = (False, e)
+            duration = time.monotonic() - start
+
+            with self._condition:
+                self._outcomes[device.name] = outcome + (duration,)
+                self._running[self.controllers[device.name]] -= 1
+                self._condition.notify_all()
+
+    def run(self, erase):
+        """Erase all devices.
+
+        :param erase: a callable accepting a BlockDevice and returning the
+            erasure result.
+        :raises: the exception raised by the erasure of the first failed
+            device (in the original device order) after all erasures finish.
+        :returns: a dictionary in the form {device.name: erasure result}.
+        """
+        LOG.info('Erasing %(count)d device(s) with concurrency %(conc)d '
+                 'across controllers %(ctrl)s',
+                 {'count': len(self.block_devices), 'conc': self.concurrency,
+                  'ctrl': ', '.join(sorted(set(self.controllers.values())))})
+        start = time.monotonic()
+        pool = ThreadPool(self.concurrency)
+        workers = [pool.apply_async(self._worker, (erase,))
+                   for _ in range(self.concurrency)]
+        pool.close()
+        pool.join()
+        for worker in workers:
+            worker.get()
+        duration = time.monotonic() - start
+
+        self.report = self._build_report(duration)
+        LOG.info('Erased %(bytes)d bytes on %(count)d device(s) in '
+                 '%(duration).1f seconds, aggregate throughput %(tput).1f '
+                 'MiB/s', {'bytes': self.report['bytes'],
+                           'count': len(self.block_devices),
+                           'duration': duration,
+                           'tput': self.report['throughput'] / units.Mi})
+        metrics_utils.get_metrics_logger(__name__).send_gauge(
+            'erase_throughput', self.report['throughput'])
+
+        results = {}
+        for dev in self.block_devices:
+            success, value, _duration = self._outcomes[dev.name]
+            if not success:
+                raise value
+            results[dev.name] = value
+        return results
+
+    def _build_report(self, duration):
+        per_controller = {}
+        for dev in self.block_devices:
+            ctrl = per_controller.setdefault(
+                self.controllers[dev.name],
+                {'devices': [], 'bytes': 0, 'busy_time': 0.0})
+            ctrl['devices'].append(dev.name)
+            ctrl['bytes'] += dev.size or 0
+            ctrl['busy_time'] += self._outcomes[dev.name][2]
+        total = sum(ctrl['bytes'] for ctrl in per_controller.values())
+        return {
+            'duration': round(duration, 3),
+            'bytes': total,
+            'throughput': total / duration if duration else 0.0,
+            'controllers': per_controller,
+        }
@@ -206,6 +206,17 @@ class ImageWriteError(RESTError):
         super(ImageWriteError, self).__init__(details)
 
 
+class ImageVerificationError(RESTError):
+    """Error raised when a written image does not match the source image."""
+
+    message = 'Error verifying the image written to device'
+
+    def __init__(self, device, details):
+        details = 'Verifying the image written to device {} failed: {}'.format(
+            device, details)
+        super(ImageVerificationError, self).__init__(details)
+
+
 class SystemRebootError(RESTError):
     """Error raised when a system cannot reboot."""
 
@@ -14,10 +14,16 @@
 
 import collections
 import functools
+import gzip
 import inspect
+import json
+import os
+import tempfile
 import threading
 
+from oslo_config import cfg
 from oslo_log import log
+from oslo_utils import units
 from oslo_utils import uuidutils
 from stevedore import extension
 
@@ -27,6 +33,7 @@ from ironic_python_agent import utils
 
 
 LOG = log.getLogger(__name__)
+CONF = cfg.CONF
 
 
 class AgentCommandStatus(object):
@@ -58,6 +65,8 @@ class BaseCommandResult(encoding.SerializableComparable):
         self.command_status = AgentCommandStatus.RUNNING
         self.command_error = None
         self.command_result = None
+        # Incremented every time the serialized result changes
+        self.version = 0
 
     def __str__(self):
         return ("Command name: %(name)s, "
@@ -68,6 +77,15 @@ class BaseCommandResult(encoding.SerializableComparable):
                  "status": self.command_status,
                  "result": utils.remove_large_keys(self.command_result)})
 
+    def serialize(self, fields=None):
+        """Turn this result into a dict.
+
+        :param fields: optional list of the fields to include, defaults to
+            all serializable fields.
+        """
+        return dict((f, getattr(self, f))
+                    for f in fields or self.serializable_fields)
+
     def is_done(self):
         """Checks to see if command is still RUNNING.
 
@@ -79,6 +97,15 @@ class BaseCommandResult(encoding.SerializableComparable):
         """:returns: result of completed command."""
         return self
 
+    def wait_until_done(self, timeout=None):
+        """Wait for the command to complete.
+
+        :param timeout: float indicating max seconds to wait for command
+                        to complete. Defaults to None.
+        :returns: True if command is done, False if still RUNNING
+        """
+        return self.is_done()
+
     def wait(self):
         """Join the result and extract its value.
 
@@ -133,18 +160,22 @@ class AsyncCommandResult(BaseCommandResult):
         self.agent = agent
         self.execute_method = execute_method
         self.command_state_lock = threading.Lock()
+        # Notified once the command is done
+        self.command_done = threading.Condition(self.command_state_lock)
 
         thread_name = 'agent-command-{}'.format(self.id)
         self.execution_thread = threading.Thread(target=self.run,
                                                  name=thread_name)
 
-    def serialize(self):
+    def serialize(self, fields=None):
         """Serializes the AsyncCommandResult into a dict.
 
+        :param fields: optional list of the fields to include, defaults to
+            all serializable fields.
         :returns: dict containing serializable fields in AsyncCommandResult
         """
         with self.command_state_lock:
-            return super(AsyncCommandResult, self).serialize()
+            return super(AsyncCommandResult, self).serialize(fields)
 
     def start(self):
         """Begin background execution of command."""
@@ -160,6 +191,20 @@ class AsyncCommandResult(BaseCommandResult):
         self.execution_thread.join(timeout)
         return self
 
+    def wait_until_done(self, timeout=None):
+        """Wait for the command to complete.
+
+        Unlike join, returns as soon as the result of the command is
+        available.
+
+        :param timeout: float indicating max seconds to wait for command
+                        to complete. Defaults to None.
+        :returns: True if command is done, False if still RUNNING
+        """
+        with self.command_done:
+            return self.command_done.wait_for(
+                super(AsyncCommandResult, self).is_done, timeout)
+
     def is_done(self):
         """Checks to see if command is still RUNNING.
 
@@ -181,11 +226,13 @@ class AsyncCommandResult(BaseCommandResult):
             with self.command_state_lock:
                 self.command_result = result
                 self.command_status = AgentCommandStatus.SUCCEEDED
+                self.version += 1
         except errors.VersionMismatch as e:
             with self.command_state_lock:
                 self.command_error = e
                 self.command_status = AgentCommandStatus.VERSION_MISMATCH
                 self.command_result = None
+                self.version += 1
             LOG.error('Clean version mismatch for command %s',
                       self.command_name)
         except Exception as e:
@@ -197,11 +244,167 @@ class AsyncCommandResult(BaseCommandResult):
             with self.command_state_lock:
                 self.command_error = e
                 self.command_status = AgentCommandStatus.FAILED
+                self.version += 1
         finally:
+            with self.command_done:
+                self.command_done.notify_all()
             if self.agent:
                 self.agent.force_heartbeat()
 
 
+class StoredCommandResult(BaseCommandResult):
+    """Summary of a completed command whose result is stored on disk.
+
+    The result is read back from the compressed file every time it is
+    accessed, so that it does not stay in memory.
+    """
+
+    def __init__(self, result, path):
+        """Construct an instance of StoredCommandResult.
+
+        :param result: the completed command result being stored.
+        :param path: path to the file with the serialized command result.
+        """
+        # NOTE: not calling the parent constructor, command_result is a
+        # property and the parameters are not kept.
+        self.id = result.id
+        self.command_name = result.command_name
+        self.command_params = {}
+        self.command_status = result.command_status
+        self.command_error = result.command_error
+        self.version = result.version
+        self.path = path
+
+    @property
+    def command_result(self):
+        try:
+            with gzip.open(self.path, 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            LOG.error('Unable to read the stored result of command '
+                      '%(id)s: %(err)s', {'id': self.id, 'err': e})
+            return None
+
+
+class CommandResultHistory(object):
+    """Results of the commands executed by the agent, in order.
+
+    At most ``command_results_max_count`` results are kept, the oldest ones
+    are dropped first. Once the completed results take more than
+    ``command_results_max_memory`` MiB, the oldest of them are compressed to
+    disk and replaced by :class:`StoredCommandResult` summaries. The most
+    recent result always stays in memory.
+    """
+
+    def __init__(self):
+        self._results = collections.OrderedDict()
+        # Serialized sizes of the completed results kept in memory
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._directory = None
+        # Incremented every time a result is added or removed
+        self._version = 0
+        self._instance = uuidutils.generate_uuid()
+
+    @property
+    def version(self):
+        """A string which changes every time the results change."""
+        with self._lock:
+            results = list(self._results.values())
+            version = self._version
+        # NOTE: results only change when they complete, which increments
+        # their version.
+        return '%s-%d-%d' % (self._instance, version,
+                             sum(result.version for result in results))
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self, result_id):
+        return result_id in self._results
+
+    def __getitem__(self, result_id):
+        with self._lock:
+            return self._results[result_id]
+
+    def __setitem__(self, result_id, result):
+        with self._lock:
+            self._results[result_id] = result
+            self._results.move_to_end(result_id)
+            self._version += 1
+            self._enforce_retention()
+
+    def values(self):
+        with self._lock:
+            self._enforce_retention()
+            return list(self._results.values())
+
+    def _drop(self, result_id):
+        result = self._results.pop(result_id)
+        self._sizes.pop(result_id, None)
+        self._version += 1
+        if isinstance(result, StoredCommandResult):
+            try:
+                os.unlink(result.path)
+            except OSError as e:
+                LOG.warning('Unable to remove the stored result of command '
+                            '%(id)s: %(err)s', {'id': result_id, 'err': e})
+
+    def _store(self, result_id, result):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='ipa-command-results-')
+        path = os.path.join(self._directory, '%s.json.gz' % result_id)
+        try:
+            with gzip.open(path, 'wt') as f:
+                json.dump(result.command_result, f,
+                          cls=encoding.RESTJSONEncoder)
+        except (OSError, TypeError, ValueError) as e:
+            LOG.warning('Unable to store the result of command %(id)s on '
+                        'disk, keeping it in memory: %(err)s',
+                        {'id': result_id, 'err': e})
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return False
+        self._results[result_id] = StoredCommandResult(result, path)
+        LOG.debug('Stored the result of command %(id)s (%(name)s) of '
+                  '%(size)d bytes on disk', {'id': result_id,
+                                             'name': result.command_name,
+                                             'size': self._sizes[result_id]})
+        return True
+
+    def _enforce_retention(self):
+        while len(self._results) > CONF.command_results_max_count:
+            self._drop(next(iter(self._results)))
+
+        for result_id, result in self._results.items():
+            if (result_id not in self._sizes
+                    and not isinstance(result, StoredCommandResult)
+                    and result.is_done()):
+                try:
+                    self._sizes[result_id] = len(json.dumps(
+                        result.command_result, cls=encoding.RESTJSONEncoder))
+                except (TypeError, ValueError):
+                    # Cannot be stored, not counted either
+                    self._sizes[result_id] = 0
+
+        budget = CONF.command_results_max_memory * units.Mi
+        total = sum(self._sizes.values())
+        latest = next(reversed(self._results), None)
+        for result_id in [r for r in self._results if self._sizes.get(r)]:
+            if total <= budget:
+                break
+            if result_id == latest:
+                continue
+            if self._store(result_id, self._results[result_id]):
+                total -= self._sizes.pop(result_id)
+            else:
+                # Not trying again, the result is not counted anymore
+                total -= self._sizes[result_id]
+                self._sizes[result_id] = 0
+
+
 class BaseAgentExtension(object):
     def __init__(self, agent=None):
         super(BaseAgentExtension, self).__init__()
@@ -229,7 +432,7 @@ class BaseAgentExtension(object):
 class ExecuteCommandMixin(object):
     def __init__(self):
         self.command_lock = threading.Lock()
-        self.command_results = collections.OrderedDict()
+        self.command_results = CommandResultHistory()
         self.ext_mgr = None
 
     def get_extension(self, extension_name):
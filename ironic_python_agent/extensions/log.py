@@ -13,22 +13,55 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
 from ironic_python_agent import utils
 
 
+def _validate_upload(ext, url=None, **kwargs):
+    if not url:
+        raise errors.InvalidCommandParamsError(
+            'A URL is required to upload the system logs')
+
+
 class LogExtension(base.BaseAgentExtension):
 
     @base.sync_command('collect_system_logs')
-    def collect_system_logs(self):
+    def collect_system_logs(self, consumer=None):
         """Collect system logs.
 
         Collect and package diagnostic and support data from the ramdisk.
 
+        :param consumer: If provided, only the journal entries added since
+                         the previous collection for this consumer are
+                         returned. The journal cursor of the consumer moves
+                         when the command completes, the entries are not
+                         returned again if its result is lost.
         :raises: CommandExecutionError if failed to collect the system logs.
         :returns: A dictionary with the key `system_logs` and the value
                   of a gzipped and base64 encoded string of the file with
                   the logs.
         """
-        logs = utils.collect_system_logs()
+        logs = utils.collect_system_logs(consumer=consumer)
         return {'system_logs': logs}
+
+    @base.async_command('upload_system_logs', _validate_upload)
+    def upload_system_logs(self, url, journald_max_lines=None,
+                           consumer=None):
+        """Collect system logs and upload them.
+
+        The logs are compressed while they are being uploaded, with a PUT
+        request to the URL.
+
+        :param url: URL to upload the gzipped tarball with the logs to.
+        :param journald_max_lines: Maximum number of lines to retrieve from
+                                   the journald. If None, upload everything.
+        :param consumer: If provided, only the journal entries added since
+                         the previous upload for this consumer are uploaded.
+        :raises: CommandExecutionError if failed to upload the system logs.
+        :returns: A dictionary with the key `size` and the value of the
+                  number of bytes uploaded.
+        """
+        size = utils.upload_system_logs(
+            url, journald_max_lines=journald_max_lines, consumer=consumer)
+        return {'size': size}
@@ -19,12 +19,15 @@ import json
 import os
 import re
 import tempfile
+import threading
 import time
 from urllib import parse as urlparse
 
 from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log
+from oslo_utils import excutils
+from oslo_utils.imageutils import format_inspector
 from oslo_utils import units
 import requests
 
@@ -32,13 +35,25 @@ from ironic_python_agent import disk_utils
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
 from ironic_python_agent import hardware
+from ironic_python_agent import image_peers
+from ironic_python_agent import image_stream
+from ironic_python_agent import image_verification
 from ironic_python_agent import partition_utils
+from ironic_python_agent import timeline
 from ironic_python_agent import utils
 
 CONF = cfg.CONF
 LOG = log.getLogger(__name__)
 
 IMAGE_CHUNK_SIZE = 1024 * 1024  # 1MB
+# Amount of data to download before validating the image header when
+# writing an image while downloading it.
+PIPELINE_HEADER_SIZE = 512
+
+# Loop devices exposing the downloaded images stored on the target disk
+# rather than in the ramdisk, maps image IDs to (loop device, offset, size)
+# tuples.
+_SCRATCH_DEVICES = {}
 
 
 def _image_location(image_info):
@@ -47,9 +62,126 @@ def _image_location(image_info):
     :param image_info: Image information dictionary.
     :returns: The full, absolute path to the image as a string.
     """
+    scratch = _SCRATCH_DEVICES.get(image_info['id'])
+    if scratch is not None:
+        return scratch[0]
     return os.path.join(tempfile.gettempdir(), image_info['id'])
 
 
+def _image_checksum(image_info):
+    """Get the checksum identifying the content of an image."""
+    return image_info.get('os_hash_value') or image_info.get('checksum')
+
+
+def _get_ramdisk_free_space():
+    """Get the free space for images in the ramdisk in bytes."""
+    stat = os.statvfs(tempfile.gettempdir())
+    return stat.f_bavail * stat.f_frsize
+
+
+def _select_image_location(image_info, device, image_size):
+    """Choose where to store an image before writing it to a device.
+
+    Images are stored in the ramdisk if it has enough free space. Otherwise
+    whole disk images are stored at the end of the device they are going to
+    be written to, exposed as a loop device, since the device is overwritten
+    anyway. The image must then be small enough to be written in front of
+    its own copy, which is verified by _check_scratch_overlap.
+
+    :param image_info: Image information dictionary.
+    :param device: The disk name, as a string, the image will be written to.
+    :param image_size: The size of the image as reported by the server.
+    :raises: ImageDownloadOutofSpaceError if the image fits neither in the
+        ramdisk nor on the device.
+    """
+    _release_scratch_space(image_info)
+    try:
+        image_size = int(image_size)
+    except (TypeError, ValueError):
+        return
+    if (CONF.image_download_scratch != 'auto'
+            or image_info.get('image_type') == 'partition'):
+        return
+
+    free = _get_ramdisk_free_space()
+    try:
+        # An existing copy is overwritten
+        free += os.path.getsize(_image_location(image_info))
+    except OSError:
+        pass
+    if image_size + CONF.image_download_ramdisk_reserve * units.Mi <= free:
+        return
+
+    region = disk_utils.get_scratch_region(
+        disk_utils.get_dev_byte_size(device), image_size)
+    if region is None:
+        if image_size <= free:
+            return
+        msg = ('Image of {} bytes does not fit in the ramdisk ({} bytes '
+               'free) nor on device {}'.format(image_size, free, device))
+        raise errors.ImageDownloadOutofSpaceError(image_info['id'], msg)
+
+    offset = region[0]
+    # NOTE: the size of loop devices is a multiple of 512 bytes
+    size_limit = (image_size + 511) // 512 * 512
+    try:
+        loop, _err = utils.execute('losetup', '--find', '--show',
+                                   '--offset', str(offset),
+                                   '--sizelimit', str(size_limit), device)
+    except processutils.ProcessExecutionError as e:
+        if image_size <= free:
+            LOG.warning('Unable to create a loop device on %(dev)s, storing '
+                        'image %(image)s in the ramdisk: %(err)s',
+                        {'dev': device, 'image': image_info['id'], 'err': e})
+            return
+        msg = ('Image of {} bytes does not fit in the ramdisk ({} bytes '
+               'free) and a loop device cannot be created on device {}: '
+               '{}'.format(image_size, free, device, e))
+        raise errors.ImageDownloadOutofSpaceError(image_info['id'], msg)
+
+    _SCRATCH_DEVICES[image_info['id']] = (loop.strip(), offset, image_size)
+    LOG.info('The ramdisk has %(free)d bytes free, storing image %(image)s '
+             'of %(size)d bytes at offset %(offset)d of %(dev)s, exposed as '
+             '%(loop)s', {'free': free, 'image': image_info['id'],
+                          'size': image_size, 'offset': offset,
+                          'dev': device, 'loop': loop.strip()})
+
+
+def _check_scratch_overlap(image_info, device, source_format, virtual_size):
+    """Check that an image can be written in front of its stored copy.
+
+    :param image_info: Image information dictionary.
+    :param device: The disk name, as a string, the image will be written to.
+    :param source_format: The format of the image.
+    :param virtual_size: The virtual size of the image in bytes.
+    :raises: DeploymentError if writing the image would overwrite its copy.
+    """
+    scratch = _SCRATCH_DEVICES.get(image_info['id'])
+    if scratch is None:
+        return
+    if source_format in disk_utils.RAW_LIKE_IMAGETYPES:
+        # NOTE: the size of the loop device is not the size of the image
+        virtual_size = scratch[2]
+    if virtual_size > scratch[1]:
+        raise errors.DeploymentError(
+            'Image {} with a virtual size of {} bytes cannot be written to '
+            'device {} since its downloaded copy is stored at offset {} of '
+            'the device. Increase the ramdisk size.'.format(
+                image_info['id'], virtual_size, device, scratch[1]))
+
+
+def _release_scratch_space(image_info):
+    """Remove the loop device exposing an image stored on a disk, if any."""
+    scratch = _SCRATCH_DEVICES.pop(image_info['id'], None)
+    if scratch is None:
+        return
+    try:
+        utils.execute('losetup', '--detach', scratch[0])
+    except processutils.ProcessExecutionError as e:
+        LOG.warning('Unable to detach loop device %(loop)s: %(err)s',
+                    {'loop': scratch[0], 'err': e})
+
+
 def _verify_basic_auth_creds(user, password, image_id):
     """Verify the basic auth credentials used for image download are present.
 
@@ -167,12 +299,18 @@ def _gen_auth_from_oslo_conf_user_pass(image_id):
                                        image_server_password)
 
 
-def _download_with_proxy(image_info, url, image_id):
+def _download_with_proxy(image_info, url, image_id, headers=None,
+                         session=None):
     """Opens a download stream for the given URL.
 
     :param image_info: Image information dictionary.
     :param url: The URL string to request the image from.
     :param image_id: Image ID or URL for logging.
+    :param headers: Optional additional request headers. If provided, a
+        304 (Not Modified) response to a conditional request and a 206
+        (Partial Content) response to a range request are accepted.
+    :param session: Optional requests Session to use, defaults to the one
+        shared by the current thread.
 
     :raises: ImageDownloadError if the download stream was not started
              properly.
@@ -200,9 +338,12 @@ def _download_with_proxy(image_info, url, image_id):
         auth_object = _gen_auth_from_oslo_conf_user_pass(image_id)
     if auth_object is not None:
         image_download_attributes['auth'] = auth_object
+    if headers:
+        image_download_attributes['headers'] = headers
 
-    # Create TLS-enforcing session for image downloads
-    session = utils.get_requests_session()
+    # Reuse the connections to the image server for image downloads
+    if session is None:
+        session = utils.get_shared_requests_session()
 
     for attempt in range(CONF.image_download_connection_retries + 1):
         try:
@@ -221,6 +362,8 @@ def _download_with_proxy(image_info, url, image_id):
             # processing the incoming data.
             # B113 issue is covered is the image_download_attributs list
             resp = session.get(url, **image_download_attributes)  # nosec
+            if headers and resp.status_code in (206, 304):
+                break
             if resp.status_code != 200:
                 msg = ('Received status code {} from {}, expected 200. '
                        'Response body: {} Response headers: {}').format(
@@ -266,6 +409,102 @@ CHECKSUM_MATCHERS = (MD5_MATCH, MD5_MATCH_END, SHA256_MATCH, SHA256_MATCH_END,
                      SHA512_MATCH, SHA512_MATCH_END)
 CHECKSUM_ONLY_MATCHERS = (MD5_MATCH_ONLY, SHA256_MATCH_ONLY, SHA512_MATCH_ONLY)
 FILENAME_MATCHERS = (FILENAME_MATCH_END, FILENAME_MATCH_PARENTHESES)
+# File name in parentheses, e.g. "SHA256 (image.qcow2) = <checksum>"
+FILENAME_PARENTHESES = re.compile(r"\s\(([^()]+)\)\s")
+
+# Parsed checksum files which can be revalidated, keyed by URL.
+_CHECKSUM_FILES = {}
+
+
+def _find_line_checksum(line):
+    for matcher in CHECKSUM_MATCHERS:
+        checksum = re.findall(matcher, line)
+        if checksum:
+            return checksum[0]
+
+
+class _ChecksumFile(object):
+    """A checksum file indexed by file name."""
+
+    def __init__(self, text, etag=None, last_modified=None):
+        self.lines = [line.strip() for line in text.split('\n')
+                      if line.strip()]
+        self.etag = etag
+        self.last_modified = last_modified
+        self._index = None
+
+    def _build_index(self):
+        index = {}
+        for line in self.lines:
+            if line.startswith("#"):
+                continue
+            checksum = _find_line_checksum(line)
+            if not checksum:
+                continue
+            names = FILENAME_PARENTHESES.findall(line)
+            parts = line.split()
+            if len(parts) > 1:
+                names.append(parts[-1].lstrip('*'))
+            for name in names:
+                # The first matching line wins
+                index.setdefault(name, checksum)
+        return index
+
+    def find(self, filename):
+        """Find the checksum of a file.
+
+        :returns: the checksum or None if the file is not listed.
+        """
+        if self._index is None:
+            self._index = self._build_index()
+        try:
+            return self._index[filename]
+        except KeyError:
+            pass
+
+        # NOTE: file names are matched as regular expressions, keep doing
+        # it for names which are not found literally.
+        for line in self.lines:
+            # Ignore comment lines
+            if line.startswith("#"):
+                continue
+
+            # Ignore checksums for other files
+            for matcher in FILENAME_MATCHERS:
+                if re.findall(matcher.format(filename=filename), line):
+                    break
+            else:
+                continue
+
+            checksum = _find_line_checksum(line)
+            if checksum:
+                return checksum
+
+
+def _get_checksum_file(url, image_info):
+    """Download a checksum file, reusing the cached copy if not modified."""
+    cached = _CHECKSUM_FILES.get(url)
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
+    LOG.debug('Downloading checksums file from %s', url)
+    resp = _download_with_proxy(image_info, url, url, headers=headers)
+    if cached is not None and resp.status_code == 304:
+        LOG.debug('Checksums file %s has not been modified', url)
+        return cached
+
+    checksum_file = _ChecksumFile(
+        resp.text, etag=resp.headers.get('ETag'),
+        last_modified=resp.headers.get('Last-Modified'))
+    if checksum_file.etag or checksum_file.last_modified:
+        _CHECKSUM_FILES[url] = checksum_file
+    else:
+        _CHECKSUM_FILES.pop(url, None)
+    return checksum_file
 
 
 def _fetch_checksum(checksum, image_info):
@@ -274,9 +513,8 @@ def _fetch_checksum(checksum, image_info):
         # Not a remote checksum, return as it is.
         return checksum
 
-    LOG.debug('Downloading checksums file from %s', checksum)
-    resp = _download_with_proxy(image_info, checksum, checksum).text
-    lines = [line.strip() for line in resp.split('\n') if line.strip()]
+    checksum_file = _get_checksum_file(checksum, image_info)
+    lines = checksum_file.lines
     if not lines:
         raise errors.ImageDownloadError(checksum, "Empty checksum file")
     elif len(lines) == 1:
@@ -293,22 +531,9 @@ def _fetch_checksum(checksum, image_info):
     # FIXME(dtantsur): can we assume the same name for all images?
     expected_fname = os.path.basename(urlparse.urlparse(
         image_info['urls'][0]).path)
-    for line in lines:
-        # Ignore comment lines
-        if line.startswith("#"):
-            continue
-
-        # Ignore checksums for other files
-        for matcher in FILENAME_MATCHERS:
-            if re.findall(matcher.format(filename=expected_fname), line):
-                break
-        else:
-            continue
-
-        for matcher in CHECKSUM_MATCHERS:
-            checksum = re.findall(matcher, line)
-            if checksum:
-                return checksum[0]
+    found = checksum_file.find(expected_fname)
+    if found:
+        return found
 
     raise errors.ImageDownloadError(
         checksum, "Checksum file does not contain name %s" % expected_fname)
@@ -390,7 +615,7 @@ def _write_whole_disk_image(image, image_info, device, source_format=None,
     """
     # FIXME(dtantsur): pass the real node UUID for logging
     disk_utils.destroy_disk_metadata(device, '')
-    disk_utils.udev_settle()
+    disk_utils.udev_settle(device)
     disk_utils.populate_image(image, device,
                               is_raw=is_raw,
                               source_format=source_format,
@@ -400,6 +625,7 @@ def _write_whole_disk_image(image, image_info, device, source_format=None,
     disk_utils.trigger_device_rescan(device)
 
 
+@timeline.phase('write')
 def _write_image(image_info, device, configdrive=None):
     """Writes an image to the specified device.
 
@@ -420,7 +646,9 @@ def _write_image(image_info, device, configdrive=None):
     # NOTE(JayF): The below method call performs a required security check
     #             and must remain in place. See bug #2071740
     source_format, size = disk_utils.get_and_validate_image_format(
-        image, ironic_disk_format)
+        image, ironic_disk_format, checksum=_image_checksum(image_info))
+    _check_scratch_overlap(image_info, device, source_format, size)
+    timeline.record_bytes(size)
     size_mb = int((size + units.Mi - 1) / units.Mi)
 
     uuids = {}
@@ -433,6 +661,13 @@ def _write_image(image_info, device, configdrive=None):
         _write_whole_disk_image(image, image_info, device,
                                 source_format=source_format,
                                 is_raw=is_raw)
+    if CONF.image_write_verification:
+        if image_info.get('image_type') == 'partition':
+            written_to = uuids['partitions']['root']
+        else:
+            written_to = device
+        image_verification.verify_image_file(written_to, image,
+                                             source_format, is_raw=is_raw)
     totaltime = time.time() - starttime
     LOG.info('Image %(image)s written to device %(device)s in %(totaltime)s '
              'seconds', {'image': image, 'device': device,
@@ -535,6 +770,9 @@ class ImageDownload(object):
         """
         self._time = time_obj or time.time()
         self._image_info = image_info
+        # NOTE: the image may be downloaded in another thread, keep using
+        # the session of the thread which started the download.
+        self._session = utils.get_shared_requests_session()
         self._request = None
         self._bytes_transferred = 0
         self._expected_size = None
@@ -615,12 +853,30 @@ class ImageDownload(object):
                                 {'provided': algo,
                                  'detected': detected_algo.name})
 
+        self._inspection = None
+        if (not CONF.disable_deep_image_inspection
+                and image_info.get('disk_format')
+                not in disk_utils.RAW_LIKE_IMAGETYPES):
+            self._inspection = disk_utils.StreamingInspection()
+
+        self._peers = None
+        self._chunk_digests = None
+        if CONF.image_peer_distribution:
+            self._chunk_digests = image_verification.ChunkDigests(
+                image_peers.CHUNK_SIZE)
+            self._peers = image_peers.PeerDownload.find(
+                image_info, self._expected_hash_value)
+            if self._peers is not None:
+                self._expected_size = self._peers.size
+                return
+
         details = []
         for url in image_info['urls']:
             try:
                 LOG.info("Attempting to download image from %s", url)
                 self._request = _download_with_proxy(image_info, url,
-                                                     image_info['id'])
+                                                     image_info['id'],
+                                                     session=self._session)
                 self._expected_size = self._request.headers.get(
                     'Content-Length')
             except errors.ImageDownloadFatalError:
@@ -648,7 +904,12 @@ class ImageDownload(object):
         self._last_chunk_time = None
         start_time = self._time
 
-        for chunk in self._request.iter_content(IMAGE_CHUNK_SIZE):
+        if self._peers is not None:
+            content = self._iter_peer_chunks()
+        else:
+            content = self._request.iter_content(IMAGE_CHUNK_SIZE)
+
+        for chunk in content:
 
             max_download_duration = CONF.image_download_max_duration
             if max_download_duration:
@@ -673,11 +934,14 @@ class ImageDownload(object):
                 self._last_chunk_time = time.time()
                 if isinstance(chunk, str):
                     encoded_data = chunk.encode()
-                    self._hash_algo.update(encoded_data)
-                    self._bytes_transferred += len(encoded_data)
                 else:
-                    self._hash_algo.update(chunk)
-                    self._bytes_transferred += len(chunk)
+                    encoded_data = chunk
+                self._hash_algo.update(encoded_data)
+                self._bytes_transferred += len(encoded_data)
+                if self._chunk_digests is not None:
+                    self._chunk_digests.update(encoded_data)
+                if self._inspection is not None:
+                    self._inspection.update(encoded_data)
                 yield chunk
             elif (time.time() - self._last_chunk_time
                   > CONF.image_download_connection_timeout):
@@ -687,6 +951,58 @@ class ImageDownload(object):
                     self._image_info['id'],
                     'Timed out reading next chunk from webserver')
 
+    def _iter_peer_chunks(self):
+        """Fetch the chunks of the image from the peers or the origin."""
+        count = len(self._peers.chunks)
+        for index in range(count):
+            data = self._peers.fetch(index)
+            if data is None:
+                data = self._download_chunk(index)
+            yield data
+        LOG.info('Downloaded %(peers)d of %(count)d chunks of image '
+                 '%(image)s from peers',
+                 {'peers': self._peers.from_peers, 'count': count,
+                  'image': self.image_id})
+
+    def _download_chunk(self, index):
+        """Download a chunk of the image shared by peers from its origin.
+
+        :raises: ImageDownloadError if the chunk cannot be downloaded or does
+            not match the manifest of the peers, in which case peers are not
+            used for the following attempts.
+        """
+        offset = index * image_peers.CHUNK_SIZE
+        end = min(offset + image_peers.CHUNK_SIZE, self._peers.size) - 1
+        headers = {'Range': 'bytes={}-{}'.format(offset, end)}
+        details = []
+        for url in self._image_info['urls']:
+            try:
+                resp = _download_with_proxy(self._image_info, url,
+                                            self.image_id, headers=headers,
+                                            session=self._session)
+                if resp.status_code != 206:
+                    # NOTE: the whole image may be streamed in response,
+                    # release the connection instead of reading it.
+                    resp.close()
+                    details.append('{}: range requests are not '
+                                   'supported'.format(url))
+                    continue
+                data = resp.content
+            except (errors.ImageDownloadError,
+                    requests.RequestException) as e:
+                details.append('{}: {}'.format(url, e))
+                continue
+            if self._peers.verify(index, data):
+                return data
+            details.append('{}: the chunk does not match the manifest of '
+                           'the peers'.format(url))
+
+        image_peers.disable(self.image_id)
+        raise errors.ImageDownloadError(
+            self.image_id,
+            'Unable to download chunk {} shared by peers from the image '
+            'URLs: {}'.format(index, '; '.join(details)))
+
     def verify_image(self, image_location):
         """Verifies the checksum of the local images matches expectations.
 
@@ -705,6 +1021,8 @@ class ImageDownload(object):
                    'algo_name': self._hash_algo.name,
                    'checksum': checksum})
         if checksum != self._expected_hash_value:
+            if self._peers is not None:
+                image_peers.disable(self.image_id)
             error_msg = errors.ImageChecksumError.details_str.format(
                 image_location, self._image_info['id'],
                 self._expected_hash_value, checksum)
@@ -714,6 +1032,39 @@ class ImageDownload(object):
                                             self._expected_hash_value,
                                             checksum)
 
+    @property
+    def image_id(self):
+        """Property value to return the ID of the image."""
+        return self._image_info['id']
+
+    @property
+    def checksum(self):
+        """Property value to return the expected checksum of the image."""
+        return self._expected_hash_value
+
+    @property
+    def chunk_digests(self):
+        """Property value to return the digests of the image chunks.
+
+        Only computed when image_peer_distribution is enabled.
+        """
+        return self._chunk_digests
+
+    @property
+    def inspection(self):
+        """Property value to return the format inspection of the image.
+
+        None if the image is not inspected while it is downloaded.
+        """
+        return self._inspection
+
+    def cache_inspection(self, image_location):
+        """Record the inspection of the downloaded and verified image."""
+        if self._inspection is not None:
+            disk_utils.cache_inspection(
+                image_location, self._inspection,
+                checksum=_image_checksum(self._image_info))
+
     @property
     def bytes_transferred(self):
         """Property value to return the number of bytes transferred."""
@@ -727,10 +1078,37 @@ class ImageDownload(object):
         return self._expected_size
 
 
-def _download_image(image_info):
+class _DownloadCancelled(Exception):
+    """The image download has been cancelled."""
+
+
+def _staging_location(image_location):
+    """Get the location a cancellable download is staged at."""
+    return image_location + '.part'
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        LOG.warning('Unable to remove %(path)s: %(err)s',
+                    {'path': path, 'err': e})
+
+
+@timeline.phase('download')
+def _download_image(image_info, device=None, cancelled=None):
     """Downloads the specified image to the local file system.
 
     :param image_info: Image information dictionary.
+    :param device: The disk name, as a string, the image will be written to.
+        If provided, the image may be stored at its end when it does not fit
+        in the ramdisk.
+    :param cancelled: An optional threading.Event, the download is aborted
+        once it is set. The image is then downloaded to a staging file which
+        is only moved to the image location after it has been verified.
+    :raises: _DownloadCancelled if the download has been cancelled.
     :raises: ImageDownloadError if the image download fails for any reason.
     :raises: ImageDownloadOutofSpaceError if the image download fails
              due to insufficient storage space.
@@ -739,31 +1117,54 @@ def _download_image(image_info):
     """
     starttime = time.time()
     image_location = _image_location(image_info)
+    location_selected = device is None
     for attempt in range(CONF.image_download_connection_retries + 1):
         try:
             image_download = ImageDownload(image_info, time_obj=starttime)
-
-            with open(image_location, 'wb') as f:
-                try:
-                    for chunk in image_download:
-                        try:
-                            f.write(chunk)
-                        except OSError as e:
-                            if e.errno == errno.ENOSPC:
-                                msg = ('Unable to write image to {}. Error: {}'
-                                       ).format(image_location, e)
-                                raise errors.ImageDownloadOutofSpaceError(
-                                    image_info['id'], msg)
-                            raise
-                except errors.ImageDownloadOutofSpaceError:
-                    raise
-                except Exception as e:
-                    msg = 'Unable to write image to {}. Error: {}'.format(
-                        image_location, str(e))
-                    raise errors.ImageDownloadError(image_info['id'], msg)
-            image_download.verify_image(image_location)
+            if not location_selected:
+                _select_image_location(image_info, device,
+                                       image_download.content_length)
+                image_location = _image_location(image_info)
+                location_selected = True
+
+            if cancelled is None:
+                download_location = image_location
+            else:
+                download_location = _staging_location(image_location)
+            try:
+                with open(download_location, 'wb') as f:
+                    try:
+                        for chunk in image_download:
+                            if cancelled is not None and cancelled.is_set():
+                                raise _DownloadCancelled()
+                            try:
+                                f.write(chunk)
+                            except OSError as e:
+                                if e.errno == errno.ENOSPC:
+                                    msg = ('Unable to write image to {}. '
+                                           'Error: {}').format(
+                                               download_location, e)
+                                    raise errors.ImageDownloadOutofSpaceError(
+                                        image_info['id'], msg)
+                                raise
+                    except (errors.ImageDownloadOutofSpaceError,
+                            _DownloadCancelled):
+                        raise
+                    except Exception as e:
+                        msg = 'Unable to write image to {}. Error: {}'.format(
+                            download_location, str(e))
+                        raise errors.ImageDownloadError(image_info['id'], msg)
+                image_download.verify_image(download_location)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    if download_location != image_location:
+                        _remove_file(download_location)
+            if download_location != image_location:
+                os.replace(download_location, image_location)
+            image_download.cache_inspection(image_location)
         except (errors.ImageDownloadOutofSpaceError,
-                errors.ImageDownloadFatalError):
+                errors.ImageDownloadFatalError,
+                _DownloadCancelled):
             raise
         except (errors.ImageDownloadError,
                 errors.ImageChecksumError) as e:
@@ -787,6 +1188,208 @@ def _download_image(image_info):
               'totaltime': totaltime,
               'size': image_download.bytes_transferred,
               'reported': image_download.content_length})
+    timeline.record_bytes(image_download.bytes_transferred)
+    _log_connection_reuse()
+    if (image_download.chunk_digests is not None
+            and image_info['id'] not in _SCRATCH_DEVICES):
+        image_peers.share_image(image_info['id'], image_location,
+                                image_download.checksum,
+                                image_download.chunk_digests,
+                                image_peers.get_secret(image_info))
+
+
+def _log_connection_reuse():
+    """Log how many connections image related downloads have reused."""
+    stats = utils.get_requests_session_stats(
+        utils.get_shared_requests_session())
+    LOG.info('Image related downloads made %(requests)d requests over '
+             '%(connections)d connections so far, %(resumed_tls_sessions)d '
+             'of %(tls_sessions)d TLS sessions were resumed', stats)
+
+
+class _PipelineUnavailable(Exception):
+    """The image cannot be written while it is being downloaded."""
+
+
+def _download_to_growing_file(image_download, growing_file, failures):
+    """Download an image, recording the progress in a GrowingFile.
+
+    :param failures: a list the download error, if any, is appended to.
+    """
+    try:
+        with open(growing_file.path, 'wb') as f:
+            for chunk in image_download:
+                if growing_file.error is not None:
+                    # The consumer has given up
+                    return
+                try:
+                    f.write(chunk)
+                    # Make the data visible to the readers
+                    f.flush()
+                except OSError as e:
+                    msg = 'Unable to write image to {}. Error: {}'.format(
+                        growing_file.path, e)
+                    if e.errno == errno.ENOSPC:
+                        raise errors.ImageDownloadOutofSpaceError(
+                            image_download.image_id, msg)
+                    raise errors.ImageDownloadError(
+                        image_download.image_id, msg)
+                growing_file.advance(len(chunk))
+    except Exception as e:
+        failures.append(e)
+        growing_file.fail(e)
+    else:
+        growing_file.finish()
+
+
+def _check_image_header(image_location):
+    """Run the safety checks on the header of a partially downloaded image.
+
+    :raises: _PipelineUnavailable if the image is not a QCOW2 image.
+    :raises: InvalidImage if the image fails the safety checks.
+    :returns: the virtual size of the image.
+    """
+    inspector = format_inspector.QcowInspector()
+    with open(image_location, 'rb') as f:
+        inspector.eat_chunk(f.read(PIPELINE_HEADER_SIZE))
+    if not inspector.format_match:
+        raise _PipelineUnavailable('the image is not a qcow2 image')
+    try:
+        inspector.safety_check()
+    except format_inspector.SafetyCheckFailed:
+        msg = "Security: Image failed safety check"
+        LOG.exception(msg)
+        raise errors.InvalidImage(details=msg)
+    return inspector.virtual_size
+
+
+def _destroy_written_image(device):
+    """Destroy an image written to a device which failed verification.
+
+    The disk metadata is wiped and the data is discarded if the device
+    supports it, so that the unverified image cannot be booted.
+    """
+    LOG.error('Destroying the unverified image written to device %s',
+              device)
+    try:
+        disk_utils.destroy_disk_metadata(device, '')
+    except Exception:
+        LOG.exception('Failed to destroy the disk metadata on device %s',
+                      device)
+    try:
+        utils.execute('blkdiscard', device)
+    except (processutils.ProcessExecutionError, OSError) as e:
+        LOG.warning('Unable to discard the data on device %(dev)s: %(err)s',
+                    {'dev': device, 'err': e})
+
+
+@timeline.phase('download_and_write')
+def _download_and_write_image(image_info, device):
+    """Write a QCOW2 whole disk image while it is still being downloaded.
+
+    The image is downloaded to the same location as by _download_image. As
+    soon as its header is available and has passed the safety checks,
+    qemu-img starts converting it to the device, reading it through a local
+    NBD server which blocks until the requested data has been downloaded.
+    Once both are done, the checksum and the full image inspection are
+    verified like for a completely downloaded image.
+
+    Only the header of the image is checked before it is written, so
+    content which fails the checksum or the complete inspection ends up on
+    the device. In this case the written image is destroyed before the
+    error is raised.
+
+    :param image_info: Image information dictionary.
+    :param device: The disk name, as a string, on which to store the image.
+    :raises: _PipelineUnavailable if the image cannot be written this way.
+    :raises: ImageDownloadError, ImageChecksumError, ImageWriteError or
+        InvalidImage.
+    :returns: an empty dictionary of partition UUIDs.
+    """
+    ironic_disk_format = image_info.get('disk_format')
+    if (CONF.disable_deep_image_inspection
+            or image_info.get('image_type') == 'partition'
+            or ironic_disk_format not in (None, 'unknown', 'qcow2')
+            or 'qcow2' not in CONF.permitted_image_formats):
+        raise _PipelineUnavailable('only qcow2 whole disk images are '
+                                   'supported')
+
+    starttime = time.time()
+    image_download = ImageDownload(image_info, time_obj=starttime)
+    if not image_download.content_length:
+        raise _PipelineUnavailable('the image size is not known')
+    _select_image_location(image_info, device, image_download.content_length)
+    image_location = _image_location(image_info)
+
+    growing_file = image_stream.GrowingFile(
+        image_location, int(image_download.content_length))
+    # The file must exist before the NBD server opens it
+    open(image_location, 'wb').close()
+    failures = []
+    downloader = threading.Thread(
+        target=_download_to_growing_file,
+        args=(image_download, growing_file, failures),
+        name='image-download', daemon=True)
+    downloader.start()
+    try:
+        try:
+            growing_file.wait_for(PIPELINE_HEADER_SIZE)
+        except OSError:
+            raise _PipelineUnavailable('the image header was not downloaded')
+        virtual_size = _check_image_header(image_location)
+        _check_scratch_overlap(image_info, device, 'qcow2', virtual_size)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            server = image_stream.NbdServer(
+                growing_file, os.path.join(tmpdir, 'image.sock'))
+            server.start()
+            try:
+                _write_whole_disk_image(server.uri, image_info, device,
+                                        source_format='qcow2', is_raw=False)
+            except Exception:
+                # Unblock the pending reads before stopping the server
+                growing_file.fail('aborted')
+                raise
+            finally:
+                server.stop()
+        # qemu-img does not necessarily read the whole image
+        growing_file.wait_for(growing_file.size)
+    except Exception:
+        growing_file.fail('aborted')
+        downloader.join()
+        # A failed download is the most likely reason for other failures
+        if failures and isinstance(failures[0], errors.RESTError):
+            raise failures[0]
+        raise
+    downloader.join()
+
+    try:
+        image_download.verify_image(image_location)
+        image_download.cache_inspection(image_location)
+        # NOTE: the header has been checked before writing the image,
+        # perform the complete check as well.
+        disk_utils.get_and_validate_image_format(
+            image_location, ironic_disk_format,
+            checksum=_image_checksum(image_info))
+        if CONF.image_write_verification:
+            image_verification.verify_image_file(device, image_location,
+                                                 'qcow2')
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            _destroy_written_image(device)
+    totaltime = time.time() - starttime
+    LOG.info('Image %(image)s downloaded and written to device %(device)s '
+             'in %(totaltime)s seconds. Transferred %(size)s bytes.',
+             {'image': image_location, 'device': device,
+              'totaltime': totaltime,
+              'size': image_download.bytes_transferred})
+    timeline.record_bytes(image_download.bytes_transferred)
+    _log_connection_reuse()
+    try:
+        disk_utils.fix_gpt_partition(device, node_uuid=None)
+    except errors.DeploymentError:
+        # Note: the catch internal to the helper method logs any errors.
+        pass
+    return {}
 
 
 def _validate_image_info(ext, image_info=None, **kwargs):
@@ -850,6 +1453,7 @@ def _validate_image_info(ext, image_info=None, **kwargs):
             'be set for image verification.')
 
 
+@timeline.phase('validate_partitioning')
 def _validate_partitioning(device):
     """Validate the final partition table.
 
@@ -875,6 +1479,67 @@ def _validate_partitioning(device):
         raise errors.DeploymentError(msg)
 
 
+class _ImagePrefetch(object):
+    """An image download running in the background."""
+
+    # Fields which must match for a prefetched image to be used
+    _IDENTITY = ('id', 'urls', 'checksum', 'os_hash_algo', 'os_hash_value',
+                 'disk_format')
+
+    def __init__(self, image_info):
+        self.image_info = image_info
+        self.error = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='image-prefetch', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            # NOTE: the ramdisk is always used, the target disk may still
+            # be modified before prepare_image is called.
+            with utils.sharing_requests_session():
+                _download_image(self.image_info, cancelled=self._cancelled)
+        except _DownloadCancelled as e:
+            LOG.info('Prefetching image %s has been cancelled',
+                     self.image_info['id'])
+            self.error = e
+        except Exception as e:
+            LOG.warning('Prefetching image %(image)s failed: %(err)s',
+                        {'image': self.image_info['id'], 'err': e})
+            self.error = e
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def matches(self, image_info):
+        """Check if the prefetched image is the requested one."""
+        return all(self.image_info.get(key) == image_info.get(key)
+                   for key in self._IDENTITY)
+
+    def wait(self):
+        """Wait for the download to finish.
+
+        :returns: True if the image was downloaded and verified.
+        """
+        self._thread.join()
+        return self.error is None
+
+    def cancel(self):
+        """Stop the download and remove the prefetched image.
+
+        Returns once the download thread has exited, so that the image
+        location can be safely reused.
+        """
+        self._cancelled.set()
+        if self.wait():
+            _remove_file(_image_location(self.image_info))
+
+
 class StandbyExtension(base.BaseAgentExtension):
     """Extension which adds stand-by related functionality to agent."""
     def __init__(self, agent=None):
@@ -886,6 +1551,48 @@ class StandbyExtension(base.BaseAgentExtension):
 
         self.cached_image_id = None
         self.partition_uuids = None
+        self._prefetch = None
+
+    def _discard_prefetch(self):
+        """Cancel the image prefetch, if any, and remove its image."""
+        prefetch = self._prefetch
+        if prefetch is None:
+            return
+        self._prefetch = None
+        LOG.info('Discarding prefetched image %s', prefetch.image_info['id'])
+        prefetch.cancel()
+
+    def _use_prefetched_image(self, image_info):
+        """Wait for the image to be prefetched if it was requested.
+
+        :returns: True if the image has been downloaded and verified by
+            prefetch_image, False if it has to be downloaded.
+        """
+        prefetch = self._prefetch
+        if prefetch is None:
+            return False
+        self._prefetch = None
+        if not prefetch.matches(image_info):
+            LOG.info('Prefetched image %(prefetched)s does not match '
+                     'the requested image %(image)s, discarding it',
+                     {'prefetched': prefetch.image_info['id'],
+                      'image': image_info['id']})
+            prefetch.cancel()
+            return False
+
+        if prefetch.running:
+            LOG.info('Waiting for the prefetch of image %s to finish',
+                     image_info['id'])
+        if not prefetch.wait():
+            LOG.warning('Prefetching image %s failed, downloading it again',
+                        image_info['id'])
+            return False
+        if not os.path.exists(_image_location(image_info)):
+            LOG.warning('Prefetched image %s has been removed, downloading '
+                        'it again', image_info['id'])
+            return False
+        LOG.info('Using prefetched image %s', image_info['id'])
+        return True
 
     def _cache_and_write_image(self, image_info, device, configdrive=None):
         """Cache an image and write it to a local device.
@@ -902,10 +1609,45 @@ class StandbyExtension(base.BaseAgentExtension):
                   match the one reported in image_info.
         :raises: ImageWriteError if writing the image fails.
         """
-        _download_image(image_info)
-        self.partition_uuids = _write_image(image_info, device, configdrive)
+        try:
+            with utils.sharing_requests_session():
+                self._download_and_write(image_info, device, configdrive)
+        finally:
+            _release_scratch_space(image_info)
         self.cached_image_id = image_info['id']
 
+    def _download_and_write(self, image_info, device, configdrive):
+        with timeline.phase('prefetch_wait'):
+            prefetched = self._use_prefetched_image(image_info)
+        if prefetched:
+            self.partition_uuids = _write_image(image_info, device,
+                                                configdrive)
+            return
+
+        if CONF.image_download_pipeline:
+            try:
+                self.partition_uuids = _download_and_write_image(image_info,
+                                                                 device)
+            except _PipelineUnavailable as e:
+                LOG.debug('Not writing image %(image)s while downloading '
+                          'it: %(reason)s',
+                          {'image': image_info['id'], 'reason': e})
+            except (errors.ImageDownloadOutofSpaceError,
+                    errors.ImageDownloadFatalError):
+                raise
+            except (errors.ImageDownloadError, errors.ImageChecksumError,
+                    errors.ImageWriteError) as e:
+                LOG.warning('Writing image %(image)s while downloading it '
+                            'failed, downloading it again before writing. '
+                            'Error: %(err)s',
+                            {'image': image_info['id'], 'err': e})
+            else:
+                return
+
+        _download_image(image_info, device)
+        self.partition_uuids = _write_image(image_info, device, configdrive)
+
+    @timeline.phase('stream_raw')
     def _stream_raw_image_onto_device(self, image_info, device):
         """Streams raw image data to specified local device.
 
@@ -922,11 +1664,16 @@ class StandbyExtension(base.BaseAgentExtension):
         for attempt in range(total_retries + 1):
             try:
                 image_download = ImageDownload(image_info, time_obj=starttime)
+                digests = None
+                if CONF.image_write_verification:
+                    digests = image_verification.ChunkDigests()
 
                 with open(device, 'wb+') as f:
                     try:
                         for chunk in image_download:
                             f.write(chunk)
+                            if digests is not None:
+                                digests.update(chunk)
                     except Exception as e:
                         msg = ('Unable to write image to device {}. '
                                'Error: {}').format(device, str(e))
@@ -958,6 +1705,10 @@ class StandbyExtension(base.BaseAgentExtension):
                  {'device': device, 'totaltime': totaltime,
                   'size': image_download.bytes_transferred,
                   'reported': image_download.content_length})
+        timeline.record_bytes(image_download.bytes_transferred)
+        if digests is not None:
+            image_verification.verify_written_image(device,
+                                                    digests.get_extents())
         # Fix any gpt partition
         try:
             disk_utils.fix_gpt_partition(device, node_uuid=None)
@@ -970,6 +1721,7 @@ class StandbyExtension(base.BaseAgentExtension):
                  {'device': device, 'root_uuid': root_uuid})
         self.partition_uuids['root uuid'] = root_uuid
 
+    @timeline.phase('fix_up_partition_uuids')
     def _fix_up_partition_uuids(self, image_info, device):
         if self.partition_uuids is None:
             self.partition_uuids = {}
@@ -1007,13 +1759,30 @@ class StandbyExtension(base.BaseAgentExtension):
         :raises: ImageWriteError if writing the image fails.
         :raises: InstanceDeployFailure if failed to create config drive.
              large to store on the given device.
+        :returns: a dictionary with the result message and the ``timeline``
+            of the deployment phases, see
+            :meth:`ironic_python_agent.timeline.Timeline.serialize`.
         """
+        with timeline.recording('prepare_image') as deploy_timeline:
+            try:
+                with utils.sharing_requests_session():
+                    result_msg = self._prepare_image(image_info, configdrive)
+            finally:
+                LOG.info('Deployment phases of image %(image)s: %(phases)s',
+                         {'image': image_info['id'],
+                          'phases': deploy_timeline.summary()})
+                deploy_timeline.send_metrics()
+        return {'result': 'prepare_image: %s' % result_msg,
+                'timeline': deploy_timeline.serialize()}
+
+    def _prepare_image(self, image_info, configdrive=None):
         LOG.debug('Preparing image %s', image_info['id'])
         # NOTE(dtantsur): backward compatibility
         if configdrive is None:
             configdrive = image_info.pop('configdrive', None)
-        device = hardware.dispatch_to_managers('get_os_install_device',
-                                               permit_refresh=True)
+        with timeline.phase('select_device'):
+            device = hardware.dispatch_to_managers('get_os_install_device',
+                                                   permit_refresh=True)
 
         requested_disk_format = image_info.get('disk_format')
 
@@ -1026,6 +1795,9 @@ class StandbyExtension(base.BaseAgentExtension):
                           self.cached_image_id)
 
             if stream_raw_images and requested_disk_format == 'raw':
+                # A prefetched image is not used for streaming, stop
+                # downloading it and release the space it takes.
+                self._discard_prefetch()
                 if image_info.get('image_type') == 'partition':
                     # NOTE(JayF): This only creates partitions due to image
                     #             being None
@@ -1132,6 +1904,49 @@ class StandbyExtension(base.BaseAgentExtension):
         """
         hardware.dispatch_to_all_managers('full_sync')
 
+    @base.sync_command('prefetch_image', _validate_image_info)
+    def prefetch_image(self, image_info=None):
+        """Start downloading an image in the background.
+
+        Intended for fast-track deployments, where the agent can download
+        the image while the conductor is preparing the deployment. The image
+        is downloaded to the ramdisk and verified, a following prepare_image
+        call with the same image waits for the download to finish instead of
+        starting a new one.
+
+        :param image_info: Image information dictionary.
+        :raises: CommandExecutionError if another image is being prefetched.
+        :returns: a dictionary with the image ID and the prefetch status.
+        """
+        result = {'image': image_info['id']}
+        if (image_info.get('stream_raw_images', False)
+                and image_info.get('disk_format') == 'raw'):
+            LOG.info('Not prefetching image %s, it will be streamed to the '
+                     'disk', image_info['id'])
+            result['status'] = 'skipped'
+            return result
+
+        prefetch = self._prefetch
+        if prefetch is not None and prefetch.matches(image_info):
+            if prefetch.running:
+                result['status'] = 'downloading'
+                return result
+            elif prefetch.error is None:
+                result['status'] = 'downloaded'
+                return result
+        elif prefetch is not None and prefetch.running:
+            raise errors.CommandExecutionError(
+                'Image {} is already being prefetched'.format(
+                    prefetch.image_info['id']))
+
+        if prefetch is not None:
+            prefetch.cancel()
+
+        LOG.info('Prefetching image %s', image_info['id'])
+        self._prefetch = _ImagePrefetch(image_info).start()
+        result['status'] = 'downloading'
+        return result
+
     @base.sync_command('get_partition_uuids')
     def get_partition_uuids(self):
         """Return partition UUIDs."""
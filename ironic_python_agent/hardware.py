@@ -45,6 +45,7 @@ from ironic_python_agent import device_hints
 from ironic_python_agent import disk_utils
 from ironic_python_agent import efi_utils
 from ironic_python_agent import encoding
+from ironic_python_agent import erase_utils
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base as ext_base
 from ironic_python_agent import inject_files
@@ -73,6 +74,18 @@ API_LOOKUP_INTERVAL = None
 SUPPORTED_SOFTWARE_RAID_LEVELS = frozenset(['0', '1', '1+0', '5', '6'])
 NVME_CLI_FORMAT_SUPPORTED_FLAG = 0b10
 NVME_CLI_CRYPTO_FORMAT_SUPPORTED_FLAG = 0b100
+NVME_CLI_SANITIZE_CRYPTO_SUPPORTED_FLAG = 0b1
+NVME_CLI_SANITIZE_BLOCK_SUPPORTED_FLAG = 0b10
+NVME_SANITIZE_ACTION_BLOCK = 2
+NVME_SANITIZE_ACTION_CRYPTO = 4
+NVME_SANITIZE_STATUS_MASK = 0b111
+NVME_SANITIZE_STATUS_IN_PROGRESS = 2
+# Completed successfully, with or without the no-deallocate modifier
+NVME_SANITIZE_STATUS_COMPLETED = frozenset([1, 4])
+NVME_SANITIZE_PROGRESS_DONE = 65536
+_NVME_NAMESPACE_RE = re.compile(r'^(nvme\d+)n\d+$')
+# Maximum number of devices to query concurrently before erasing them.
+_CLASSIFICATION_CONCURRENCY = 16
 
 RAID_APPLY_CONFIGURATION_ARGSINFO = {
     "raid_config": {
@@ -107,6 +120,17 @@ DEPLOY_CLEAN_UEFI_NVRAM_ARGSINFO = {
     }
 }
 
+VERIFY_ERASED_DEVICES_ARGSINFO = {
+    "pattern": {
+        "description": (
+            "The pattern the erased devices are expected to contain: "
+            "'zero' for zero-filled blocks or 'uniform' for blocks filled "
+            "with any single repeated byte. Default value is 'uniform'."
+        ),
+        "required": False,
+    }
+}
+
 MULTIPATH_ENABLED = None
 
 
@@ -1082,27 +1106,48 @@ class HardwareManager(object, metaclass=abc.ABCMeta):
                  of an environmental misconfiguration.
         :returns: a dictionary in the form {device.name: erasure output}
         """
-        erase_results = {}
         block_devices = self.list_block_devices_check_skip_list(node)
+        return self._erase_block_devices(node, block_devices)
+
+    def _erase_block_devices(self, node, block_devices):
+        """Erase the provided block devices, possibly in parallel.
+
+        :param node: Ironic node object
+        :param block_devices: a list of BlockDevice objects to erase.
+        :raises: ProtectedDeviceError if any of the devices must not be
+                 erased.
+        :returns: a dictionary in the form {device.name: erasure output}
+        """
         if not len(block_devices):
             return {}
 
-        info = node.get('driver_internal_info', {})
-        max_pool_size = info.get('disk_erasure_concurrency', 1)
-
-        thread_pool = ThreadPool(min(max_pool_size, len(block_devices)))
         for block_device in block_devices:
-            params = {'node': node, 'block_device': block_device}
             safety_check_block_device(node, block_device.name)
-            erase_results[block_device.name] = thread_pool.apply_async(
-                dispatch_to_managers, ('erase_block_device',), params)
-        thread_pool.close()
-        thread_pool.join()
-
-        for device_name, result in erase_results.items():
-            erase_results[device_name] = result.get()
 
-        return erase_results
+        info = node.get('driver_internal_info', {})
+        max_pool_size = info.get('disk_erasure_concurrency', 1)
+        controller_concurrency = info.get(
+            'disk_erasure_controller_concurrency',
+            CONF.disk_erasure_controller_concurrency)
+
+        estimates = None
+        if max_pool_size > 1 and len(block_devices) > 1:
+            # NOTE: the order only matters when erasing in parallel, so
+            # avoid calling hdparm otherwise.
+            estimates = {dev.name: self._estimate_erase_time(dev)
+                         for dev in block_devices}
+
+        scheduler = erase_utils.EraseScheduler(
+            block_devices, max_pool_size,
+            controller_concurrency=controller_concurrency,
+            estimates=estimates)
+        return scheduler.run(
+            lambda dev: dispatch_to_managers('erase_block_device',
+                                             node=node, block_device=dev))
+
+    def _estimate_erase_time(self, block_device):
+        """Estimate how long erasing a block device takes in seconds."""
+        return erase_utils.estimate_erase_time(block_device)
 
     def wait_for_disks(self):
         """Wait for the root disk to appear.
@@ -1440,6 +1485,10 @@ class GenericHardwareManager(HardwareManager):
         self.lldp_data = {}
         self._lshw_cache = None
         self._raid_root_device_mapping = {}
+        self._nvme_sanitize_started = set()
+        # Devices erased by a method which may leave non-uniform data
+        self._crypto_erased = set()
+        self._device_classification = {}
 
     def evaluate_hardware_support(self):
         return HardwareSupport.GENERIC
@@ -1991,16 +2040,19 @@ class GenericHardwareManager(HardwareManager):
 
     def erase_block_device(self, node, block_device):
         # Check if the block device is virtual media and skip the device.
-        if self._is_virtual_media_device(block_device):
+        if self._get_classification(block_device, 'virtual_media',
+                                    self._is_virtual_media_device):
             LOG.info("Skipping erase of virtual media device %s",
                      block_device.name)
             return
-        if self._is_linux_raid_member(block_device):
+        if self._get_classification(block_device, 'raid_member',
+                                    self._is_linux_raid_member):
             LOG.info("Skipping erase of RAID member device %s",
                      block_device.name)
             return
         info = node.get('driver_internal_info', {})
-        if self._is_read_only_device(block_device):
+        if self._get_classification(block_device, 'read_only',
+                                    self._is_read_only_device):
             if info.get('agent_erase_skip_read_only', False):
                 LOG.info("Skipping erase of read-only device %s",
                          block_device.name)
@@ -2020,12 +2072,14 @@ class GenericHardwareManager(HardwareManager):
                 execute_nvme_erase = info.get(
                     'agent_enable_nvme_secure_erase', True)
                 if execute_nvme_erase and self._nvme_erase(block_device):
-                    return
+                    return self._verify_erased_device(node, block_device,
+                                                      'uniform')
             else:
                 execute_secure_erase = info.get(
                     'agent_enable_ata_secure_erase', True)
                 if execute_secure_erase and self._ata_erase(block_device):
-                    return
+                    return self._verify_erased_device(node, block_device,
+                                                      'uniform')
         except errors.BlockDeviceEraseError as e:
             execute_shred = info.get('agent_continue_if_secure_erase_failed')
 
@@ -2056,6 +2110,10 @@ class GenericHardwareManager(HardwareManager):
                 raise errors.IncompatibleHardwareMethodError(msg)
 
         if self._shred_block_device(node, block_device):
+            # NOTE: without the final zeroing pass the device
+            # contains random data which cannot be verified.
+            if info.get('agent_erase_devices_zeroize', True):
+                return self._verify_erased_device(node, block_device, 'zero')
             return
 
         msg = ('Unable to erase block device {}: device is unsupported.'
@@ -2063,6 +2121,189 @@ class GenericHardwareManager(HardwareManager):
         LOG.error(msg)
         raise errors.IncompatibleHardwareMethodError(msg)
 
+    def _verify_erased_device(self, node, block_device, pattern):
+        """Verify an erased device if requested by the node or the config.
+
+        A failed verification of a secure erase results in the same
+        fallback behavior as a failed secure erase.
+
+        :param node: Ironic node object
+        :param block_device: a BlockDevice that has just been erased.
+        :param pattern: pattern the device is expected to contain, one of
+            erase_utils.VERIFY_PATTERNS.
+        :raises BlockDeviceEraseError: when the verification fails.
+        :returns: the verification report or None if verification is
+            disabled or not possible.
+        """
+        crypto_erased = block_device.name in self._crypto_erased
+        self._crypto_erased.discard(block_device.name)
+        info = node.get('driver_internal_info', {})
+        if not info.get('agent_erase_verification', CONF.erase_verification):
+            return
+        if pattern == 'uniform' and crypto_erased:
+            # NOTE: crypto and enhanced erase may leave ciphertext or vendor
+            # specific patterns on the device.
+            LOG.info('Skipping verification of device %s since the erase '
+                     'method used does not leave a known pattern',
+                     block_device.name)
+            return
+        return erase_utils.verify_erased_device(block_device.name, pattern)
+
+    def verify_erased_devices(self, node, ports, pattern='uniform'):
+        """Verify that all erasable devices read back as erased.
+
+        :param node: Ironic node object
+        :param ports: list of Ironic port objects
+        :param pattern: pattern the devices are expected to contain, one of
+            erase_utils.VERIFY_PATTERNS.
+        :raises BlockDeviceEraseError: when any of the devices contains
+            non-erased blocks or cannot be read.
+        :returns: a dictionary in the form {device.name: verification report}
+        """
+        reports = {}
+        verify_errors = {}
+        for dev in self.list_block_devices_check_skip_list(node):
+            if (self._is_virtual_media_device(dev)
+                    or self._is_read_only_device(dev)):
+                LOG.info("Skipping erase verification of device %s",
+                         dev.name)
+                continue
+            try:
+                reports[dev.name] = erase_utils.verify_erased_device(
+                    dev.name, pattern)
+            except errors.BlockDeviceEraseError as e:
+                verify_errors[dev.name] = e
+
+        if verify_errors:
+            excpt_msg = ('Erase verification failed on the device(s): %s' %
+                         '; '.join(['"%s": %s' % (k, v)
+                                    for k, v in verify_errors.items()]))
+            raise errors.BlockDeviceEraseError(excpt_msg)
+        return reports
+
+    def erase_devices(self, node, ports):
+        block_devices = self.list_block_devices_check_skip_list(node)
+        info = node.get('driver_internal_info', {})
+        self._device_classification = self._classify_devices(
+            block_devices,
+            ata_security=info.get('agent_enable_ata_secure_erase', True))
+        try:
+            if CONF.enable_nvme_sanitize:
+                self._start_nvme_sanitize_all(node, block_devices)
+            return self._erase_block_devices(node, block_devices)
+        finally:
+            self._nvme_sanitize_started.clear()
+            self._crypto_erased.clear()
+            self._device_classification = {}
+
+    def _get_linux_raid_membership(self):
+        """Check which block devices hold Linux RAID members.
+
+        Uses a single lsblk call for all devices. Like _is_linux_raid_member,
+        a device is considered a RAID member if it or any of its children
+        (e.g. partitions) is one.
+
+        :returns: a dictionary mapping device names to booleans or None if
+            lsblk failed.
+        """
+        try:
+            out, _ = utils.execute('lsblk', '--fs', '--json', '--paths')
+            tree = json.loads(out)['blockdevices']
+        except (processutils.ProcessExecutionError, OSError, ValueError,
+                KeyError) as e:
+            LOG.warning("Could not list RAID members: %s", e)
+            return
+
+        membership = {}
+
+        def _walk(device):
+            is_member = device.get('fstype') == 'linux_raid_member'
+            for child in device.get('children') or ():
+                is_member = _walk(child) or is_member
+            membership[device['name']] = is_member
+            return is_member
+
+        for device in tree:
+            _walk(device)
+        return membership
+
+    def _estimate_erase_time(self, block_device):
+        """Estimate the erase time reusing the classification if any."""
+        entry = self._device_classification.get(block_device.name)
+        hdparm_output = None
+        if entry is not None:
+            # NOTE: only the ATA devices which may be securely erased have
+            # the hdparm output cached, the size based estimate is good
+            # enough for the others.
+            hdparm_output = entry.get('hdparm_output', '')
+        return erase_utils.estimate_erase_time(block_device,
+                                               hdparm_output=hdparm_output)
+
+    def _get_ata_security_state(self, block_device):
+        try:
+            return (self._get_hdparm_info(block_device),
+                    self._smartctl_security_check(block_device))
+        except (processutils.ProcessExecutionError, OSError) as e:
+            LOG.debug("Could not fetch the ATA security state of %(dev)s: "
+                      "%(err)s", {'dev': block_device.name, 'err': e})
+
+    def _classify_devices(self, block_devices, ata_security=False):
+        """Classify block devices before erasing them in one pass.
+
+        Runs a single lsblk call for all devices instead of one per device
+        and, if requested, fetches the ATA security state of the devices
+        concurrently.
+
+        :param block_devices: a list of BlockDevice objects.
+        :param ata_security: whether to fetch the ATA security state.
+        :returns: a dictionary mapping device names to dictionaries with the
+            ``virtual_media``, ``raid_member`` and ``read_only`` flags and,
+            if fetched, the ``hdparm_output`` and the ``smartctl_security``
+            check result.
+        """
+        if not block_devices:
+            return {}
+
+        raid_membership = self._get_linux_raid_membership() or {}
+        table = {}
+        for dev in block_devices:
+            entry = table[dev.name] = {
+                'virtual_media': self._is_virtual_media_device(dev)}
+            # NOTE: devices can be missing from the lsblk output under the
+            # same name (e.g. device mapper ones), check them separately.
+            if dev.name in raid_membership:
+                entry['raid_member'] = raid_membership[dev.name]
+            else:
+                entry['raid_member'] = self._is_linux_raid_member(dev)
+            entry['read_only'] = self._is_read_only_device(dev)
+
+        if ata_security:
+            ata_devices = [dev for dev in block_devices
+                           if not self._is_nvme(dev)
+                           and not any(table[dev.name].values())]
+            if ata_devices:
+                pool = ThreadPool(min(len(ata_devices),
+                                      _CLASSIFICATION_CONCURRENCY))
+                try:
+                    states = pool.map(self._get_ata_security_state,
+                                      ata_devices)
+                finally:
+                    pool.close()
+                    pool.join()
+                for dev, state in zip(ata_devices, states):
+                    if state is not None:
+                        (table[dev.name]['hdparm_output'],
+                         table[dev.name]['smartctl_security']) = state
+
+        return table
+
+    def _get_classification(self, block_device, key, fallback):
+        """Get a cached classification value or calculate it."""
+        entry = self._device_classification.get(block_device.name, {})
+        if key in entry:
+            return entry[key]
+        return fallback(block_device)
+
     def _list_erasable_devices(self, node):
         block_devices = self.list_block_devices_check_skip_list(
             node, include_partitions=True, include_wipe=True)
@@ -2070,17 +2311,18 @@ class GenericHardwareManager(HardwareManager):
         # sda1) is processed before it disappears when its associated disk (eg
         # sda) has its partition table erased and the kernel notified.
         block_devices.sort(key=lambda dev: dev.name, reverse=True)
+        classification = self._classify_devices(block_devices)
         erasable_devices = []
         for dev in block_devices:
-            if self._is_virtual_media_device(dev):
+            if classification[dev.name]['virtual_media']:
                 LOG.info("Skipping erasure of virtual media device %s",
                          dev.name)
                 continue
-            if self._is_linux_raid_member(dev):
+            if classification[dev.name]['raid_member']:
                 LOG.info("Skipping erasure of RAID member device %s",
                          dev.name)
                 continue
-            if self._is_read_only_device(dev):
+            if classification[dev.name]['read_only']:
                 LOG.info("Skipping erasure of read-only device %s",
                          dev.name)
                 continue
@@ -2131,12 +2373,21 @@ class GenericHardwareManager(HardwareManager):
                  operational risk which exists as it could also be a sign
                  of an environmental misconfiguration.
         """
-        erase_errors = {}
-        info = node.get('driver_internal_info', {})
         erasable_devices = self._list_erasable_devices(node)
         if not erasable_devices:
             LOG.debug("No erasable devices have been found.")
             return
+        if CONF.enable_nvme_sanitize:
+            self._start_nvme_sanitize_all(node, erasable_devices)
+        try:
+            self._erase_devices_express(node, erasable_devices)
+        finally:
+            self._nvme_sanitize_started.clear()
+            self._crypto_erased.clear()
+
+    def _erase_devices_express(self, node, erasable_devices):
+        erase_errors = {}
+        info = node.get('driver_internal_info', {})
         for dev in erasable_devices:
             safety_check_block_device(node, dev.name)
             secure_erase_error = None
@@ -2334,8 +2585,11 @@ class GenericHardwareManager(HardwareManager):
                         {'name': block_device.name, 'err': e})
         return False
 
+    def _get_hdparm_info(self, block_device):
+        return utils.execute('hdparm', '-I', block_device.name)[0]
+
     def _get_ata_security_lines(self, block_device):
-        output = utils.execute('hdparm', '-I', block_device.name)[0]
+        output = self._get_hdparm_info(block_device)
 
         if '\nSecurity: ' not in output:
             return []
@@ -2416,13 +2670,16 @@ class GenericHardwareManager(HardwareManager):
                 security_lines = self._get_ata_security_lines(block_device)
             return security_lines
 
+        # NOTE: the security state may have changed since the devices were
+        # classified, e.g. by a concurrent erasure, always read it again.
         security_lines = self._get_ata_security_lines(block_device)
 
         # If secure erase isn't supported return False so erase_block_device
         # can try another mechanism. Below here, if secure erase is supported
         # but fails in some way, error out (operators of hardware that supports
         # secure erase presumably expect this to work).
-        if (not self._smartctl_security_check(block_device)
+        if (not self._get_classification(block_device, 'smartctl_security',
+                                         self._smartctl_security_check)
                 or 'supported' not in security_lines):
             return False
 
@@ -2463,7 +2720,8 @@ class GenericHardwareManager(HardwareManager):
 
         # Use the 'enhanced' security erase option if it's supported.
         erase_option = '--security-erase'
-        if 'not supported: enhanced erase' not in security_lines:
+        enhanced = 'not supported: enhanced erase' not in security_lines
+        if enhanced:
             erase_option += '-enhanced'
 
         try:
@@ -2488,6 +2746,8 @@ class GenericHardwareManager(HardwareManager):
                  ).format(block_device.name))
 
         # In SEC1 security state
+        if enhanced:
+            self._crypto_erased.add(block_device.name)
         return True
 
     def _is_nvme(self, block_device):
@@ -2501,15 +2761,13 @@ class GenericHardwareManager(HardwareManager):
 
         return block_device.name.startswith("/dev/nvme")
 
-    def _nvme_erase(self, block_device):
-        """Attempt to clean the NVMe using the most secure supported method
+    def _get_nvme_info(self, block_device):
+        """Fetch the identify controller data of an NVMe device.
 
         :param block_device: a BlockDevice object
-        :returns: True if cleaning operation succeeded, False if it failed
+        :returns: the parsed JSON output of ``nvme id-ctrl``.
         :raises: BlockDeviceEraseError
         """
-
-        # check if crypto format is supported
         try:
             LOG.debug("Attempting to fetch NVMe capabilities for device %s",
                       block_device.name)
@@ -2523,33 +2781,225 @@ class GenericHardwareManager(HardwareManager):
             LOG.error(msg)
             raise errors.BlockDeviceEraseError(msg)
 
+        if not nvme_info:
+            # If nvme-cli output is empty, raise an exception
+            msg = ('nvme-cli did not return any information '
+                   'for device: {device}').format(device=block_device.name)
+            LOG.error(msg)
+            raise errors.BlockDeviceEraseError(msg)
+
+        return nvme_info
+
+    def _get_nvme_sanitize_action(self, nvme_info):
+        """Pick the sanitize action to use based on the sanicap field.
+
+        :param nvme_info: the parsed output of ``nvme id-ctrl``.
+        :returns: the sanitize action (crypto erase is preferred over block
+            erase) or None if neither is supported.
+        """
+        sanitize_caps = nvme_info.get('sanicap', 0)
+        if sanitize_caps & NVME_CLI_SANITIZE_CRYPTO_SUPPORTED_FLAG:
+            return NVME_SANITIZE_ACTION_CRYPTO
+        if sanitize_caps & NVME_CLI_SANITIZE_BLOCK_SUPPORTED_FLAG:
+            return NVME_SANITIZE_ACTION_BLOCK
+
+    def _get_nvme_namespaces(self, block_device):
+        """List all namespaces attached to the controller of a device.
+
+        :param block_device: a BlockDevice object
+        :returns: a list of device paths, empty if the controller cannot be
+            determined from the device name.
+        """
+        match = _NVME_NAMESPACE_RE.match(os.path.basename(block_device.name))
+        if not match:
+            return []
+        return sorted('/dev/%s' % os.path.basename(path) for path in
+                      glob.glob('/sys/block/%sn*' % match.group(1)))
+
+    def _start_nvme_sanitize(self, block_device, action):
+        """Start a sanitize operation without waiting for it to complete.
+
+        :param block_device: a BlockDevice object
+        :param action: the sanitize action to request.
+        :raises: BlockDeviceEraseError
+        """
+        try:
+            LOG.debug("Starting NVMe sanitize of %s using action (sanact) %s",
+                      block_device.name, action)
+            utils.execute('nvme', 'sanitize', block_device.name, '-a', action)
+        except processutils.ProcessExecutionError as e:
+            msg = ("Failed to start NVMe sanitize of device {}: {}"
+                   ).format(block_device.name, e)
+            LOG.error(msg)
+            raise errors.BlockDeviceEraseError(msg)
+
+    def _get_nvme_sanitize_status(self, block_device):
+        """Read the sanitize log page of an NVMe device.
+
+        :param block_device: a BlockDevice object
+        :returns: a tuple (status, progress in percent).
+        :raises: BlockDeviceEraseError
+        """
+        try:
+            out, _e = utils.execute('nvme', 'sanitize-log',
+                                    block_device.name, '-o', 'json')
+            log_page = json.loads(out)
+        except (processutils.ProcessExecutionError, ValueError) as e:
+            msg = ("Failed to read the NVMe sanitize log of device {}: {}"
+                   ).format(block_device.name, e)
+            LOG.error(msg)
+            raise errors.BlockDeviceEraseError(msg)
+
+        # NOTE: newer versions of nvme-cli nest the log page under
+        # the device name.
+        if 'sstat' not in log_page:
+            log_page = next((value for value in log_page.values()
+                             if isinstance(value, dict) and 'sstat' in value),
+                            {})
+        try:
+            status = int(log_page['sstat']) & NVME_SANITIZE_STATUS_MASK
+            progress = int(log_page.get('sprog', 0))
+        except (KeyError, TypeError, ValueError):
+            msg = ("Unexpected NVMe sanitize log output for device {}: {}"
+                   ).format(block_device.name, out)
+            LOG.error(msg)
+            raise errors.BlockDeviceEraseError(msg)
+
+        if status != NVME_SANITIZE_STATUS_IN_PROGRESS:
+            progress = NVME_SANITIZE_PROGRESS_DONE
+        return status, round(progress * 100.0 / NVME_SANITIZE_PROGRESS_DONE,
+                             1)
+
+    def _wait_for_nvme_sanitize(self, block_device):
+        """Poll the sanitize log until the operation finishes.
+
+        :param block_device: a BlockDevice object
+        :returns: True when the sanitize operation completed successfully.
+        :raises: BlockDeviceEraseError if the operation failed or timed out.
+        """
+        deadline = time.monotonic() + CONF.nvme_sanitize_timeout
+        while True:
+            status, progress = self._get_nvme_sanitize_status(block_device)
+            if status in NVME_SANITIZE_STATUS_COMPLETED:
+                LOG.info("NVMe sanitize of device %s completed successfully",
+                         block_device.name)
+                return True
+            if status != NVME_SANITIZE_STATUS_IN_PROGRESS:
+                msg = ("NVMe sanitize of device {} failed with status {}"
+                       ).format(block_device.name, status)
+                LOG.error(msg)
+                raise errors.BlockDeviceEraseError(msg)
+            if time.monotonic() >= deadline:
+                msg = ("NVMe sanitize of device {} did not complete in {} "
+                       "seconds, progress {}%"
+                       ).format(block_device.name,
+                                CONF.nvme_sanitize_timeout, progress)
+                LOG.error(msg)
+                raise errors.BlockDeviceEraseError(msg)
+            LOG.debug("NVMe sanitize of device %(dev)s is in progress: "
+                      "%(progress)s%%",
+                      {'dev': block_device.name, 'progress': progress})
+            time.sleep(CONF.nvme_sanitize_poll_interval)
+
+    def _start_nvme_sanitize_all(self, node, block_devices):
+        """Start NVMe sanitize on all eligible controllers at once.
+
+        The devices whose controller is being sanitized are recorded, so that
+        a subsequent call to _nvme_erase only waits for the completion.
+
+        :param node: Ironic node object
+        :param block_devices: BlockDevice objects that are going to be erased.
+        :raises: ProtectedDeviceError if a device has been identified which
+                 may require manual intervention.
+        """
+        info = node.get('driver_internal_info', {})
+        if not info.get('agent_enable_nvme_secure_erase', True):
+            return
+
+        names = {dev.name for dev in block_devices}
+        for dev in block_devices:
+            if (not self._is_nvme(dev)
+                    or dev.name in self._nvme_sanitize_started
+                    or self._get_classification(
+                        dev, 'virtual_media', self._is_virtual_media_device)
+                    or self._get_classification(
+                        dev, 'raid_member', self._is_linux_raid_member)
+                    or self._get_classification(
+                        dev, 'read_only', self._is_read_only_device)):
+                continue
+            namespaces = self._get_nvme_namespaces(dev)
+            if not namespaces or not names.issuperset(namespaces):
+                LOG.info("Not sanitizing the controller of device %s since "
+                         "not all of its namespaces are being erased",
+                         dev.name)
+                continue
+            safety_check_block_device(node, dev.name)
+            try:
+                action = self._get_nvme_sanitize_action(
+                    self._get_nvme_info(dev))
+                if action is None:
+                    continue
+                self._start_nvme_sanitize(dev, action)
+            except errors.BlockDeviceEraseError as e:
+                LOG.warning("Unable to start NVMe sanitize of device %s, "
+                            "it will be erased individually: %s", dev.name, e)
+                continue
+            self._nvme_sanitize_started.update(namespaces)
+            if action == NVME_SANITIZE_ACTION_CRYPTO:
+                self._crypto_erased.update(namespaces)
+
+    def _nvme_erase(self, block_device):
+        """Attempt to clean the NVMe using the most secure supported method
+
+        :param block_device: a BlockDevice object
+        :returns: True if cleaning operation succeeded, False if it failed
+        :raises: BlockDeviceEraseError
+        """
+        if block_device.name in self._nvme_sanitize_started:
+            return self._wait_for_nvme_sanitize(block_device)
+
+        nvme_info = self._get_nvme_info(block_device)
+
+        if CONF.enable_nvme_sanitize:
+            action = self._get_nvme_sanitize_action(nvme_info)
+            # NOTE: sanitize affects all namespaces of the
+            # controller, only use it when it is the only one.
+            if (action is not None
+                    and self._get_nvme_namespaces(block_device)
+                    == [block_device.name]):
+                try:
+                    self._start_nvme_sanitize(block_device, action)
+                except errors.BlockDeviceEraseError:
+                    LOG.warning("Falling back to NVMe format for device %s",
+                                block_device.name)
+                else:
+                    if action == NVME_SANITIZE_ACTION_CRYPTO:
+                        self._crypto_erased.add(block_device.name)
+                    return self._wait_for_nvme_sanitize(block_device)
+            else:
+                LOG.debug("NVMe sanitize cannot be used for device %s, "
+                          "falling back to format", block_device.name)
+
         # execute format with crypto option (ses=2) if supported
         # if crypto is unsupported use user-data erase (ses=1)
-        if nvme_info:
-            # Check if the device supports NVMe format at all. This info
-            # is in "oacs" section of nvme-cli id-ctrl output. If it does,
-            # set format mode to 1 (this is passed as -s <mode> parameter
-            # to nvme-cli later)
-            fmt_caps = nvme_info['oacs']
-            if fmt_caps & NVME_CLI_FORMAT_SUPPORTED_FLAG:
-                # Given the device supports format, check if crypto
-                # erase format mode is supported and pass it to nvme-cli
-                # instead
-                crypto_caps = nvme_info['fna']
-                if crypto_caps & NVME_CLI_CRYPTO_FORMAT_SUPPORTED_FLAG:
-                    format_mode = 2     # crypto erase
-                else:
-                    format_mode = 1     # user-data erase
+        # Check if the device supports NVMe format at all. This info
+        # is in "oacs" section of nvme-cli id-ctrl output. If it does,
+        # set format mode to 1 (this is passed as -s <mode> parameter
+        # to nvme-cli later)
+        fmt_caps = nvme_info['oacs']
+        if fmt_caps & NVME_CLI_FORMAT_SUPPORTED_FLAG:
+            # Given the device supports format, check if crypto
+            # erase format mode is supported and pass it to nvme-cli
+            # instead
+            crypto_caps = nvme_info['fna']
+            if crypto_caps & NVME_CLI_CRYPTO_FORMAT_SUPPORTED_FLAG:
+                format_mode = 2     # crypto erase
             else:
-                msg = ('nvme-cli did not return any supported format modes '
-                       'for device: {device}').format(
-                    device=block_device.name)
-                LOG.error(msg)
-                raise errors.BlockDeviceEraseError(msg)
+                format_mode = 1     # user-data erase
         else:
-            # If nvme-cli output is empty, raise an exception
-            msg = ('nvme-cli did not return any information '
-                   'for device: {device}').format(device=block_device.name)
+            msg = ('nvme-cli did not return any supported format modes '
+                   'for device: {device}').format(
+                device=block_device.name)
             LOG.error(msg)
             raise errors.BlockDeviceEraseError(msg)
 
@@ -2560,6 +3010,8 @@ class GenericHardwareManager(HardwareManager):
                           format_mode, '-f')
             LOG.info("nvme-cli format for device %s (ses= %s ) completed "
                      "successfully.", block_device.name, format_mode)
+            if format_mode == 2:
+                self._crypto_erased.add(block_device.name)
             return True
 
         except processutils.ProcessExecutionError as e:
@@ -2783,6 +3235,14 @@ class GenericHardwareManager(HardwareManager):
                 'reboot_requested': False,
                 'abortable': True
             },
+            {
+                'step': 'verify_erased_devices',
+                'priority': 0,
+                'interface': 'deploy',
+                'reboot_requested': False,
+                'abortable': True,
+                'argsinfo': VERIFY_ERASED_DEVICES_ARGSINFO,
+            },
             {
                 'step': 'clean_uefi_nvram',
                 'priority': 0,
@@ -0,0 +1,296 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Sharing downloaded images between agents.
+
+An agent which has downloaded and verified an image serves it to other
+agents deploying the same image through its API, split in chunks of
+:data:`CHUNK_SIZE` bytes. The manifest of a shared image lists the digests
+of its chunks, computed while the image was downloaded from its origin, so
+that agents fetching the chunks from several peers can verify each of them.
+Chunks no peer can provide are downloaded from the origin, and the whole
+image is still verified against its checksum.
+
+Peers only serve an image to agents presenting its checksum and the secret
+shared by the agents deploying it in the :data:`SECRET_HEADER` header. The
+secret is provided by ironic in the ``image_peers_secret`` field of the
+image information or configured with the ``image_peers_secret`` option,
+images are not shared without it.
+"""
+
+import hashlib
+import hmac
+import os
+import threading
+
+from oslo_config import cfg
+from oslo_log import log
+from oslo_utils import units
+import requests
+
+from ironic_python_agent import utils
+
+LOG = log.getLogger(__name__)
+CONF = cfg.CONF
+
+CHUNK_SIZE = 4 * units.Mi
+# Size of the pieces chunks are read and sent in
+_READ_SIZE = units.Mi
+_DIGEST = 'sha256'
+# Request header carrying the secret shared between peers
+SECRET_HEADER = 'X-Image-Peers-Secret'
+
+_SHARED_IMAGES = {}
+# Images for which the data provided by peers turned out to be invalid
+_DISABLED_IMAGES = set()
+_LOCK = threading.Lock()
+
+
+def get_secret(image_info):
+    """Get the secret peers deploying an image must present."""
+    return image_info.get('image_peers_secret') or CONF.image_peers_secret
+
+
+def share_image(image_id, path, checksum, digests, secret):
+    """Start serving a downloaded and verified image to peers.
+
+    :param image_id: ID of the image.
+    :param path: location of the image in the local file system.
+    :param checksum: the checksum the image has been verified against.
+    :param digests: an :class:`ironic_python_agent.image_verification.
+        ChunkDigests` instance computed with :data:`CHUNK_SIZE` while the
+        image was downloaded.
+    :param secret: the secret peers must present, the image is not shared
+        if it is empty.
+    """
+    if not secret:
+        LOG.warning('Not sharing image %s with peers, no secret has been '
+                    'provided for it', image_id)
+        return
+    extents = digests.get_extents()
+    with _LOCK:
+        _SHARED_IMAGES[image_id] = {
+            'path': path,
+            'checksum': checksum,
+            'secret': secret,
+            'size': digests.size,
+            'chunks': [digest.hex() for _, _, digest in extents],
+        }
+    LOG.info('Sharing image %(image)s of %(size)d bytes with peers in '
+             '%(count)d chunks', {'image': image_id, 'size': digests.size,
+                                  'count': len(extents)})
+
+
+def _get_shared_image(image_id, checksum, secret):
+    with _LOCK:
+        shared = _SHARED_IMAGES.get(image_id)
+    if (shared is None or not checksum or not secret
+            or not hmac.compare_digest(str(secret), shared['secret'])
+            or not hmac.compare_digest(str(checksum), shared['checksum'])):
+        return None
+    try:
+        if os.path.getsize(shared['path']) != shared['size']:
+            raise OSError('size changed')
+    except OSError as e:
+        LOG.warning('Image %(image)s is no longer available for peers: '
+                    '%(err)s', {'image': image_id, 'err': e})
+        with _LOCK:
+            _SHARED_IMAGES.pop(image_id, None)
+        return None
+    return shared
+
+
+def get_manifest(image_id, checksum, secret):
+    """Get the manifest of a shared image.
+
+    :param image_id: ID of the image.
+    :param checksum: checksum of the image presented by the peer.
+    :param secret: secret presented by the peer.
+    :returns: a dictionary with the ``size``, ``chunk_size`` and the hex
+        digests of the ``chunks`` of the image, or None if the image is not
+        shared or the checksum or the secret does not match.
+    """
+    shared = _get_shared_image(image_id, checksum, secret)
+    if shared is None:
+        return None
+    return {'size': shared['size'], 'chunk_size': CHUNK_SIZE,
+            'digest': _DIGEST, 'chunks': shared['chunks']}
+
+
+def open_chunk(image_id, checksum, secret, index):
+    """Open a chunk of a shared image.
+
+    :param image_id: ID of the image.
+    :param checksum: checksum of the image presented by the peer.
+    :param secret: secret presented by the peer.
+    :param index: index of the chunk.
+    :returns: a tuple (length of the chunk, iterator over its data), or None
+        if the chunk is not available.
+    """
+    shared = _get_shared_image(image_id, checksum, secret)
+    if shared is None or not 0 <= index < len(shared['chunks']):
+        return None
+    offset = index * CHUNK_SIZE
+    length = min(CHUNK_SIZE, shared['size'] - offset)
+    try:
+        f = open(shared['path'], 'rb')
+    except OSError as e:
+        LOG.warning('Cannot open shared image %(image)s: %(err)s',
+                    {'image': image_id, 'err': e})
+        return None
+    return length, _read_chunk(f, offset, length)
+
+
+def _read_chunk(f, offset, length):
+    with f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(_READ_SIZE, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+
+
+def disable(image_id):
+    """Stop using peers to download an image."""
+    with _LOCK:
+        _DISABLED_IMAGES.add(image_id)
+
+
+def get_peers(image_info):
+    """Get the URLs of the agents which may share an image.
+
+    The peers are provided by the conductor in the ``image_peers`` field of
+    the image information, or configured with the ``image_peers`` option.
+    """
+    peers = image_info.get('image_peers') or CONF.image_peers or []
+    return [peer.rstrip('/') for peer in peers]
+
+
+class PeerDownload(object):
+    """Chunks of an image fetched from peers.
+
+    Consecutive chunks are requested from different peers. Peers returning
+    invalid or no data are not used any more.
+    """
+
+    def __init__(self, image_id, checksum, secret, peers, manifest):
+        self.image_id = image_id
+        self._checksum = checksum
+        self._headers = {SECRET_HEADER: secret}
+        self.peers = list(peers)
+        self.size = manifest['size']
+        self.chunks = manifest['chunks']
+        self.from_peers = 0
+        self._session = utils.get_shared_requests_session()
+
+    @classmethod
+    def find(cls, image_info, checksum):
+        """Find peers sharing an image.
+
+        :param image_info: Image information dictionary.
+        :param checksum: expected checksum of the image.
+        :returns: a PeerDownload, or None if no peer shares the image.
+        """
+        image_id = image_info['id']
+        peers = get_peers(image_info)
+        with _LOCK:
+            if not peers or image_id in _DISABLED_IMAGES:
+                return None
+        secret = get_secret(image_info)
+        if not secret:
+            LOG.warning('Not downloading image %s from peers, no secret has '
+                        'been provided for it', image_id)
+            return None
+
+        session = utils.get_shared_requests_session()
+        timeout = CONF.image_download_connection_timeout
+        manifest = None
+        sharing = []
+        for peer in peers:
+            url = '%s/v1/images/%s/manifest' % (peer, image_id)
+            try:
+                resp = session.get(url, params={'checksum': checksum},
+                                   headers={SECRET_HEADER: secret},
+                                   timeout=timeout)
+                if resp.status_code != 200:
+                    LOG.debug('Peer %(peer)s does not share image %(image)s: '
+                              'status %(code)s', {'peer': peer,
+                                                  'image': image_id,
+                                                  'code': resp.status_code})
+                    continue
+                found = resp.json()
+                if (found['chunk_size'] != CHUNK_SIZE
+                        or found['digest'] != _DIGEST):
+                    LOG.debug('Peer %s uses different chunks, ignoring it',
+                              peer)
+                    continue
+                found = {'size': int(found['size']),
+                         'chunks': list(found['chunks'])}
+            except (requests.RequestException, ValueError, KeyError,
+                    TypeError) as e:
+                LOG.debug('Cannot get the manifest of image %(image)s from '
+                          'peer %(peer)s: %(err)s',
+                          {'peer': peer, 'image': image_id, 'err': e})
+                continue
+            if manifest is None:
+                manifest = found
+            elif found != manifest:
+                LOG.warning('Peer %(peer)s has a different manifest for '
+                            'image %(image)s, ignoring it',
+                            {'peer': peer, 'image': image_id})
+                continue
+            sharing.append(peer)
+
+        if manifest is None:
+            LOG.info('No peer shares image %s', image_id)
+            return None
+        LOG.info('Downloading image %(image)s from peers %(peers)s',
+                 {'image': image_id, 'peers': ', '.join(sharing)})
+        return cls(image_id, checksum, secret, sharing, manifest)
+
+    def verify(self, index, data):
+        """Check a chunk against the manifest."""
+        return hashlib.new(_DIGEST, data).hexdigest() == self.chunks[index]
+
+    def fetch(self, index):
+        """Fetch a chunk from the peers.
+
+        :param index: index of the chunk.
+        :returns: the verified data of the chunk, or None if no peer could
+            provide it.
+        """
+        while self.peers:
+            peer = self.peers[index % len(self.peers)]
+            url = '%s/v1/images/%s/chunks/%d' % (peer, self.image_id, index)
+            try:
+                resp = self._session.get(
+                    url, params={'checksum': self._checksum},
+                    headers=self._headers,
+                    timeout=CONF.image_download_connection_timeout)
+                data = resp.content if resp.status_code == 200 else None
+            except requests.RequestException as e:
+                LOG.warning('Cannot fetch chunk %(index)d of image %(image)s '
+                            'from peer %(peer)s: %(err)s',
+                            {'index': index, 'image': self.image_id,
+                             'peer': peer, 'err': e})
+                data = None
+            if data is not None and self.verify(index, data):
+                self.from_peers += 1
+                return data
+            LOG.warning('Peer %(peer)s did not provide a valid chunk '
+                        '%(index)d of image %(image)s, not using it anymore',
+                        {'peer': peer, 'index': index,
+                         'image': self.image_id})
+            self.peers.remove(peer)
+        return None
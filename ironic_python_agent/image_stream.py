@@ -0,0 +1,301 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Serving images to qemu-img while they are still being downloaded.
+
+A :class:`GrowingFile` tracks how much of a local file has been written by
+a downloader. An :class:`NbdServer` exports such a file read-only over the
+NBD protocol on a UNIX socket, blocking read requests until the requested
+range is available. This way ``qemu-img convert`` can start writing an
+image to a device before the download is finished.
+"""
+
+import errno
+import os
+import socket
+import struct
+import threading
+
+from oslo_log import log
+
+LOG = log.getLogger(__name__)
+
+# Constants from the NBD protocol specification:
+# https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
+NBD_MAGIC = b'NBDMAGIC'
+NBD_IHAVEOPT = 0x49484156454F5054
+NBD_REP_MAGIC = 0x3e889045565a9
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_SIMPLE_REPLY_MAGIC = 0x67446698
+
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_C_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+NBD_FLAG_SEND_FLUSH = 1 << 2
+
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+
+NBD_REP_ACK = 1
+NBD_REP_INFO = 3
+NBD_REP_ERR_UNSUP = (1 << 31) + 1
+NBD_INFO_EXPORT = 0
+
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+
+_REQUEST = struct.Struct('>IHHQQI')
+_SIMPLE_REPLY = struct.Struct('>IIQ')
+_OPTION = struct.Struct('>QII')
+_OPTION_REPLY = struct.Struct('>QIII')
+# Maximum payload of a single read request, matches the NBD reference
+# implementation.
+_MAX_REQUEST_SIZE = 32 * 1024 * 1024
+_TRANSMISSION_FLAGS = (NBD_FLAG_HAS_FLAGS | NBD_FLAG_READ_ONLY
+                       | NBD_FLAG_SEND_FLUSH)
+
+
+class GrowingFile(object):
+    """A file which is being written sequentially by another thread."""
+
+    def __init__(self, path, size):
+        """Initialize the tracker.
+
+        :param path: path to the file.
+        :param size: final size of the file in bytes.
+        """
+        self.path = path
+        self.size = size
+        self._available = 0
+        self._error = None
+        self._finished = False
+        self._condition = threading.Condition()
+
+    @property
+    def available(self):
+        """Number of bytes written so far."""
+        return self._available
+
+    @property
+    def error(self):
+        """The error writing the file failed with, if any."""
+        return self._error
+
+    def advance(self, length):
+        """Record that the next length bytes have been written."""
+        with self._condition:
+            self._available += length
+            self._condition.notify_all()
+
+    def finish(self):
+        """Record that the file is complete."""
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+
+    def fail(self, error):
+        """Record that writing the file failed, waking up all readers.
+
+        Only the first error is kept.
+        """
+        with self._condition:
+            if self._error is None:
+                self._error = error
+            self._condition.notify_all()
+
+    def wait_for(self, end):
+        """Wait until the file is written up to the given offset.
+
+        :param end: the offset to wait for, capped by the final size.
+        :raises: IOError if writing the file failed or if it finished before
+            reaching the offset.
+        """
+        end = min(end, self.size)
+        with self._condition:
+            while self._available < end:
+                if self._error is not None:
+                    raise IOError(errno.EIO, 'Download failed: %s'
+                                  % self._error)
+                if self._finished:
+                    raise IOError(errno.EIO, 'Download finished at %d bytes '
+                                  'instead of %d' % (self._available, end))
+                self._condition.wait()
+
+
+class _Disconnect(Exception):
+    """The client disconnected or the protocol cannot continue."""
+
+
+class NbdServer(object):
+    """A read-only NBD server for a single GrowingFile.
+
+    Only the fixed newstyle handshake and simple replies are supported, which
+    is enough for qemu and other common clients.
+    """
+
+    def __init__(self, growing_file, socket_path):
+        self._file = growing_file
+        self.socket_path = socket_path
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(socket_path)
+        self._listener.listen(1)
+        self._thread = None
+        self._conn = None
+        self._stopped = False
+
+    @property
+    def uri(self):
+        """The NBD URI of the export, as understood by qemu."""
+        return 'nbd+unix:///?socket=%s' % self.socket_path
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve,
+                                        name='nbd-server', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listener.close()
+        conn = self._conn
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def _serve(self):
+        fd = os.open(self._file.path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            while not self._stopped:
+                try:
+                    conn, _ = self._listener.accept()
+                except OSError:
+                    break
+                self._conn = conn
+                with conn:
+                    try:
+                        if self._handshake(conn):
+                            self._transmission(conn, fd)
+                    except (_Disconnect, OSError) as e:
+                        LOG.debug('NBD client disconnected: %s', e)
+                self._conn = None
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _recv(conn, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                raise _Disconnect('connection closed')
+            data += chunk
+        return bytes(data)
+
+    def _reply_option(self, conn, option, reply, data=b''):
+        conn.sendall(_OPTION_REPLY.pack(NBD_REP_MAGIC, option, reply,
+                                        len(data)) + data)
+
+    def _handshake(self, conn):
+        """Negotiate the export, returns True to start the transmission."""
+        conn.sendall(NBD_MAGIC + struct.pack(
+            '>QH', NBD_IHAVEOPT, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        (client_flags,) = struct.unpack('>I', self._recv(conn, 4))
+        if not client_flags & NBD_FLAG_C_FIXED_NEWSTYLE:
+            raise _Disconnect('client does not support fixed newstyle')
+
+        while True:
+            magic, option, length = _OPTION.unpack(
+                self._recv(conn, _OPTION.size))
+            if magic != NBD_IHAVEOPT:
+                raise _Disconnect('invalid option magic')
+            data = self._recv(conn, length)
+
+            if option == NBD_OPT_EXPORT_NAME:
+                reply = struct.pack('>QH', self._file.size,
+                                    _TRANSMISSION_FLAGS)
+                if not client_flags & NBD_FLAG_C_NO_ZEROES:
+                    reply += b'\0' * 124
+                conn.sendall(reply)
+                return True
+            elif option in (NBD_OPT_INFO, NBD_OPT_GO):
+                self._reply_option(conn, option, NBD_REP_INFO, struct.pack(
+                    '>HQH', NBD_INFO_EXPORT, self._file.size,
+                    _TRANSMISSION_FLAGS))
+                self._reply_option(conn, option, NBD_REP_ACK)
+                if option == NBD_OPT_GO:
+                    return True
+            elif option == NBD_OPT_ABORT:
+                self._reply_option(conn, option, NBD_REP_ACK)
+                return False
+            else:
+                LOG.debug('Unsupported NBD option %(opt)d with %(len)d bytes '
+                          'of data', {'opt': option, 'len': len(data)})
+                self._reply_option(conn, option, NBD_REP_ERR_UNSUP)
+
+    def _transmission(self, conn, fd):
+        while True:
+            magic, _flags, cmd, handle, offset, length = _REQUEST.unpack(
+                self._recv(conn, _REQUEST.size))
+            if magic != NBD_REQUEST_MAGIC:
+                raise _Disconnect('invalid request magic')
+
+            if cmd == NBD_CMD_DISC:
+                return
+            elif cmd == NBD_CMD_READ:
+                error, data = self._read(fd, offset, length)
+                conn.sendall(_SIMPLE_REPLY.pack(NBD_SIMPLE_REPLY_MAGIC,
+                                                error, handle) + data)
+            elif cmd == NBD_CMD_FLUSH:
+                conn.sendall(_SIMPLE_REPLY.pack(NBD_SIMPLE_REPLY_MAGIC, 0,
+                                                handle))
+            else:
+                if cmd == NBD_CMD_WRITE:
+                    # Skip the payload to keep the stream in sync
+                    self._recv(conn, length)
+                error = errno.EPERM if cmd == NBD_CMD_WRITE else errno.EINVAL
+                conn.sendall(_SIMPLE_REPLY.pack(NBD_SIMPLE_REPLY_MAGIC,
+                                                error, handle))
+
+    def _read(self, fd, offset, length):
+        if length > _MAX_REQUEST_SIZE or offset + length > self._file.size:
+            return errno.EINVAL, b''
+        try:
+            self._file.wait_for(offset + length)
+            data = os.pread(fd, length, offset)
+        except OSError as e:
+            LOG.error('Unable to serve %(len)d bytes at offset %(off)d of '
+                      '%(path)s: %(err)s', {'len': length, 'off': offset,
+                                            'path': self._file.path,
+                                            'err': e})
+            return errno.EIO, b''
+        if len(data) != length:
+            return errno.EIO, b''
+        return 0, data
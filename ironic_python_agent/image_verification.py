@@ -0,0 +1,279 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Verifying images written to devices by reading them back.
+
+The written extents are read back from the device, bypassing the page
+cache, and compared with the image by digests of chunks of at most
+:data:`CHUNK_SIZE` bytes, which are computed by several threads in parallel.
+The expected digests are either computed from the image file, using
+``qemu-img map`` to find where the data of each extent is stored in it, or
+while the image is being streamed to the device with :class:`ChunkDigests`.
+Extents known to read as zeroes are skipped.
+"""
+
+import errno
+import hashlib
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+from oslo_concurrency import processutils
+from oslo_config import cfg
+from oslo_log import log
+from oslo_utils import units
+
+from ironic_python_agent import errors
+from ironic_python_agent.metrics_lib import metrics_utils
+from ironic_python_agent import qemu_img
+from ironic_python_agent import timeline
+from ironic_python_agent import utils
+
+LOG = log.getLogger(__name__)
+CONF = cfg.CONF
+
+CHUNK_SIZE = 4 * units.Mi
+# Reads are aligned to this size as required by O_DIRECT
+_ALIGNMENT = 4096
+_DIGEST = 'sha256'
+
+
+class ChunkDigests(object):
+    """Digests of the chunks of an image computed while it is streamed."""
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.size = 0
+        self._digests = []
+        self._hash = None
+        self._filled = 0
+
+    def update(self, data):
+        """Add the next piece of the image."""
+        view = memoryview(data)
+        while view:
+            if self._hash is None:
+                self._hash = hashlib.new(_DIGEST)
+                self._filled = 0
+            length = min(len(view), self.chunk_size - self._filled)
+            self._hash.update(view[:length])
+            self._filled += length
+            self.size += length
+            view = view[length:]
+            if self._filled == self.chunk_size:
+                self._digests.append(self._hash.digest())
+                self._hash = None
+
+    def get_extents(self):
+        """Get the extents to verify once the whole image has been added.
+
+        :returns: a list of (offset, length, digest) tuples for
+            :func:`verify_written_image`.
+        """
+        if self._hash is not None:
+            self._digests.append(self._hash.digest())
+            self._hash = None
+        return [(index * self.chunk_size,
+                 min(self.chunk_size, self.size - index * self.chunk_size),
+                 digest)
+                for index, digest in enumerate(self._digests)]
+
+
+def get_image_extents(image, source_format, is_raw=False):
+    """Find the extents of an image file to verify.
+
+    :param image: path to the image file, already validated as safe.
+    :param source_format: format of the image.
+    :param is_raw: whether the image is written as it is, in which case
+        qemu-img is not used.
+    :returns: a tuple (extents, number of bytes known to read as zeroes,
+        number of bytes which cannot be verified), extents being a list of
+        (offset on the device, length, offset in the image file) tuples.
+    """
+    if is_raw:
+        with open(image, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+        return [(0, size, 0)], 0, 0
+
+    extents = []
+    zero_bytes = unverified_bytes = 0
+    for entry in qemu_img.image_map(image, source_format):
+        if entry.get('zero') or not entry.get('data'):
+            zero_bytes += entry['length']
+        elif entry.get('offset') is None or entry.get('compressed'):
+            # NOTE: compressed clusters cannot be read from the image file
+            unverified_bytes += entry['length']
+        elif (extents
+              and sum(extents[-1][:2]) == entry['start']
+              and extents[-1][1] + extents[-1][2] == entry['offset']):
+            last = extents.pop()
+            extents.append((last[0], last[1] + entry['length'], last[2]))
+        else:
+            extents.append((entry['start'], entry['length'],
+                            entry['offset']))
+    return extents, zero_bytes, unverified_bytes
+
+
+def _split_extents(extents):
+    for offset, length, expected in extents:
+        if isinstance(expected, bytes):
+            yield offset, length, expected
+            continue
+        for position in range(0, length, CHUNK_SIZE):
+            yield (offset + position, min(CHUNK_SIZE, length - position),
+                   expected + position)
+
+
+def _digest(fd, view, offset, length):
+    """Read a range with aligned I/O and return its digest."""
+    start = offset - offset % _ALIGNMENT
+    end = -(-(offset + length) // _ALIGNMENT) * _ALIGNMENT
+    with view[:end - start] as target:
+        count = os.preadv(fd, [target], start)
+    if count < offset + length - start:
+        raise OSError(errno.EIO, 'Read only %d bytes at offset %d'
+                      % (count, start))
+    with view[offset - start:offset - start + length] as data:
+        return hashlib.new(_DIGEST, data).digest()
+
+
+def _verify_chunks(device_fd, image_fd, chunks):
+    # NOTE: anonymous mmap is page aligned, which O_DIRECT needs.
+    buf = mmap.mmap(-1, max(length for _, length, _ in chunks)
+                    + 2 * _ALIGNMENT)
+    view = memoryview(buf)
+    mismatched = []
+    try:
+        for offset, length, expected in chunks:
+            actual = _digest(device_fd, view, offset, length)
+            if not isinstance(expected, bytes):
+                expected = _digest(image_fd, view, expected, length)
+            if actual != expected:
+                mismatched.append(offset)
+    finally:
+        view.release()
+        buf.close()
+    return mismatched
+
+
+@timeline.phase('verify_write')
+def verify_written_image(device, extents, image=None, zero_bytes=0,
+                         unverified_bytes=0, threads=None):
+    """Verify that an image has been written correctly to a device.
+
+    :param device: path to the device the image was written to.
+    :param extents: a list of (offset on the device, length, expected)
+        tuples, expected being either the offset of the data in the image
+        file or the digest of a chunk computed by :class:`ChunkDigests`.
+    :param image: path to the image file, required for image file offsets.
+    :param zero_bytes: number of bytes skipped since they read as zeroes,
+        for the report.
+    :param unverified_bytes: number of bytes which cannot be verified, for
+        the report.
+    :param threads: number of concurrent readers, defaults to the
+        ``image_write_verification_threads`` option.
+    :raises: ImageVerificationError if the device cannot be read or does not
+        contain the image.
+    :returns: a dictionary with the verification report.
+    """
+    threads = threads or CONF.image_write_verification_threads
+    chunks = list(_split_extents(extents))
+    start = time.monotonic()
+    image_fd = None
+    try:
+        device_fd, direct = utils.open_for_direct_read(device)
+        try:
+            if image is not None:
+                image_fd = os.open(image, os.O_RDONLY)
+            threads = max(1, min(threads, len(chunks)))
+            results = []
+            if chunks:
+                pool = ThreadPool(threads)
+                try:
+                    # NOTE: interleave the chunks, so that the readers
+                    # progress through the device together.
+                    results = pool.starmap(
+                        _verify_chunks,
+                        [(device_fd, image_fd, chunks[i::threads])
+                         for i in range(threads)])
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            os.close(device_fd)
+            if image_fd is not None:
+                os.close(image_fd)
+    except OSError as e:
+        raise errors.ImageVerificationError(
+            device, 'failed to read the written image: %s' % e)
+
+    duration = time.monotonic() - start
+    verified = sum(length for _, length, _ in chunks)
+    mismatched = sorted(offset for result in results for offset in result)
+    report = {
+        'device': device,
+        'direct_io': direct,
+        'threads': threads,
+        'chunks': len(chunks),
+        'bytes_verified': verified,
+        'zero_bytes': zero_bytes,
+        'unverified_bytes': unverified_bytes,
+        'duration': round(duration, 3),
+        'throughput': verified / duration if duration else 0,
+        'mismatched_chunks': len(mismatched),
+    }
+    timeline.record_bytes(verified)
+
+    if mismatched:
+        msg = ('%(bad)d of %(total)d chunks differ from the image, first '
+               'at offset %(offset)d' % {'bad': len(mismatched),
+                                         'total': len(chunks),
+                                         'offset': mismatched[0]})
+        LOG.error('Verification of the image written to %(dev)s failed: '
+                  '%(msg)s', {'dev': device, 'msg': msg})
+        raise errors.ImageVerificationError(device, msg)
+
+    LOG.info('Verified %(bytes)d bytes of the image written to %(dev)s in '
+             '%(duration).1f seconds (%(tput).1f MiB/s), skipped '
+             '%(zero)d zero bytes, %(unverified)d bytes could not be '
+             'verified', {'bytes': verified, 'dev': device,
+                          'duration': duration,
+                          'tput': report['throughput'] / units.Mi,
+                          'zero': zero_bytes,
+                          'unverified': unverified_bytes})
+    metrics_utils.get_metrics_logger(__name__).send_gauge(
+        'image_verification_throughput', report['throughput'])
+    return report
+
+
+def verify_image_file(device, image, source_format, is_raw=False):
+    """Verify that an image file has been written correctly to a device.
+
+    :param device: path to the device the image was written to.
+    :param image: path to the image file, already validated as safe.
+    :param source_format: format of the image.
+    :param is_raw: whether the image has been written as it is.
+    :raises: ImageVerificationError if the device does not contain the image.
+    :returns: a dictionary with the verification report.
+    """
+    try:
+        extents, zero_bytes, unverified_bytes = get_image_extents(
+            image, source_format, is_raw=is_raw)
+    except (OSError, ValueError, KeyError,
+            processutils.ProcessExecutionError) as e:
+        raise errors.ImageVerificationError(
+            device, 'unable to map the extents of image %s: %s'
+            % (image, e))
+    return verify_written_image(device, extents, image=image,
+                                zero_bytes=zero_bytes,
+                                unverified_bytes=unverified_bytes)
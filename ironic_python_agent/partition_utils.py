@@ -18,13 +18,15 @@ https://opendev.org/openstack/ironic-lib/commit/9fb5be348202f4854a455cd08f400ae1
 """
 
 import base64
-import gzip
-import io
+import binascii
+import itertools
 import math
 import os
+import re
 import shutil
 import stat
 import tempfile
+import zlib
 
 from oslo_concurrency import processutils
 from oslo_config import cfg
@@ -37,6 +39,7 @@ import requests
 from ironic_python_agent import disk_utils
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
+from ironic_python_agent import timeline
 from ironic_python_agent import utils
 
 
@@ -48,12 +51,21 @@ MAX_CONFIG_DRIVE_SIZE_MB = 64
 # Maximum disk size supported by MBR is 2TB (2 * 1024 * 1024 MB)
 MAX_DISK_SIZE_MB_SUPPORTED_BY_MBR = 2097152
 
+# Size of the chunks a configdrive is downloaded, decoded and decompressed in
+CONFIGDRIVE_CHUNK_SIZE = 64 * units.Ki
+
+# Characters ignored by base64.b64decode in its default (non-strict) mode
+_NOT_BASE64 = re.compile(rb'[^A-Za-z0-9+/=]')
+# Characters which cannot appear in a base64 encoded configdrive
+_NOT_BASE64_OR_SPACE = re.compile(rb'[^A-Za-z0-9+/=\s]')
+
 
 def _is_http_url(url):
     url = url.lower()
     return url.startswith('http://') or url.startswith('https://')
 
 
+@timeline.phase('configdrive_download')
 def get_configdrive(configdrive, node_uuid, tempdir=None):
     """Get the information about size and location of the configdrive.
 
@@ -72,10 +84,10 @@ def get_configdrive(configdrive, node_uuid, tempdir=None):
     if is_url:
         timeout = CONF.image_download_connection_timeout
         # TODO(dtantsur): support proxy parameters from instance_info
-        # Create TLS-enforcing session
-        session = utils.get_requests_session()
+        # Reuse the connections opened for the image download
+        session = utils.get_shared_requests_session()
         try:
-            resp = session.get(configdrive, timeout=timeout)
+            resp = session.get(configdrive, timeout=timeout, stream=True)
         except requests.exceptions.RequestException as e:
             raise errors.DeploymentError(
                 "Can't download the configdrive content for node %(node)s "
@@ -90,58 +102,155 @@ def get_configdrive(configdrive, node_uuid, tempdir=None):
                 {'node': node_uuid, 'url': configdrive,
                  'code': resp.status_code, 'body': resp.text})
 
-        data = resp.content
+        chunks = resp.iter_content(chunk_size=CONFIGDRIVE_CHUNK_SIZE)
     else:
-        data = configdrive
+        chunks = _split_configdrive(configdrive)
 
+    # NOTE: the configdrive is never loaded into memory as a whole, so the
+    # peak RSS is only reported to be able to spot regressions.
+    peak_rss_reset = utils.reset_peak_rss()
     configdrive_file = tempfile.NamedTemporaryFile(delete=False,
                                                    prefix='configdrive',
                                                    dir=tempdir)
-
     try:
-        data = io.BytesIO(base64.b64decode(data))
-    except Exception as exc:
-        if isinstance(data, bytes):
-            LOG.debug('Config drive for node %(node)s is not base64 encoded '
-                      '(%(error)s), assuming binary',
-                      {'node': node_uuid, 'error': exc})
-            configdrive_mb = int(math.ceil(len(data) / units.Mi))
-            configdrive_file.write(data)
-            configdrive_file.close()
-            return (configdrive_mb, configdrive_file.name)
-        else:
-            configdrive_file.close()
-            utils.unlink_without_raise(configdrive_file.name)
-
-            error_msg = ('Config drive for node %(node)s is not base64 '
-                         'encoded or the content is malformed. '
-                         '%(cls)s: %(err)s.'
-                         % {'node': node_uuid, 'err': exc,
-                            'cls': type(exc).__name__})
-            if is_url:
-                error_msg += ' Downloaded from "%s".' % configdrive
-            raise errors.DeploymentError(error_msg)
-
-    configdrive_mb = 0
-    with gzip.GzipFile('configdrive', 'rb', fileobj=data) as gunzipped:
-        try:
-            shutil.copyfileobj(gunzipped, configdrive_file)
-        except EnvironmentError as e:
-            # Delete the created file
-            utils.unlink_without_raise(configdrive_file.name)
-            raise errors.DeploymentError(
-                'Encountered error while decompressing and writing '
-                'config drive for node %(node)s. Error: %(exc)s' %
-                {'node': node_uuid, 'exc': e})
+        bytes_ = _write_configdrive(chunks, configdrive_file, node_uuid,
+                                    configdrive if is_url else None)
+    except BaseException:
+        configdrive_file.close()
+        utils.unlink_without_raise(configdrive_file.name)
+        raise
+    finally:
+        if is_url:
+            resp.close()
+    configdrive_file.close()
+
+    peak_rss = utils.get_peak_rss()
+    if peak_rss is not None:
+        LOG.debug('Processed the %(size)d bytes config drive of node '
+                  '%(node)s, peak RSS %(since)s: %(rss).1f MiB',
+                  {'size': bytes_, 'node': node_uuid,
+                   'since': 'meanwhile' if peak_rss_reset
+                   else 'since the agent start',
+                   'rss': peak_rss / units.Mi})
+
+    timeline.record_bytes(bytes_)
+    configdrive_mb = int(math.ceil(float(bytes_) / units.Mi))
+    return (configdrive_mb, configdrive_file.name)
+
+
+def _split_configdrive(configdrive):
+    """Split an inline configdrive into chunks of bytes."""
+    for start in range(0, len(configdrive), CONFIGDRIVE_CHUNK_SIZE):
+        chunk = configdrive[start:start + CONFIGDRIVE_CHUNK_SIZE]
+        if isinstance(chunk, str):
+            # Same as base64.b64decode, only ASCII strings are accepted
+            chunk = chunk.encode('ascii')
+        yield chunk
+
+
+def _write_configdrive(chunks, configdrive_file, node_uuid, url=None):
+    """Decode and write a configdrive chunk by chunk.
+
+    :param chunks: iterable of bytes of the configdrive, which is either
+        base64 encoded gzipped data or, only if downloaded, a binary image.
+    :param configdrive_file: the file object to write the result into.
+    :param node_uuid: Node's uuid. Used for logging.
+    :param url: the URL the configdrive is downloaded from, if any.
+    :raises: DeploymentError if the configdrive cannot be decoded or
+        written.
+    :returns: the size of the written configdrive in bytes.
+    """
+    try:
+        chunks = iter(chunks)
+        first = next((chunk for chunk in chunks if chunk), b'')
+        chunks = itertools.chain([first], chunks)
+        if url and _NOT_BASE64_OR_SPACE.search(first):
+            LOG.debug('Config drive for node %s is not base64 encoded, '
+                      'assuming binary', node_uuid)
+            decoded = None
         else:
-            # Get the file size and convert to MiB
-            configdrive_file.seek(0, os.SEEK_END)
-            bytes_ = configdrive_file.tell()
-            configdrive_mb = int(math.ceil(float(bytes_) / units.Mi))
-        finally:
-            configdrive_file.close()
+            decoded = _gunzip(_b64decode(chunks))
 
-        return (configdrive_mb, configdrive_file.name)
+        size = 0
+        for data in chunks if decoded is None else decoded:
+            configdrive_file.write(data)
+            size += len(data)
+    except (binascii.Error, UnicodeEncodeError) as exc:
+        error_msg = ('Config drive for node %(node)s is not base64 '
+                     'encoded or the content is malformed. '
+                     '%(cls)s: %(err)s.'
+                     % {'node': node_uuid, 'err': exc,
+                        'cls': type(exc).__name__})
+        if url:
+            error_msg += ' Downloaded from "%s".' % url
+        raise errors.DeploymentError(error_msg)
+    except requests.exceptions.RequestException as exc:
+        raise errors.DeploymentError(
+            "Can't download the configdrive content for node %(node)s "
+            "from '%(url)s'. Reason: %(reason)s" %
+            {'node': node_uuid, 'url': url, 'reason': exc})
+    except (EnvironmentError, EOFError, zlib.error) as exc:
+        raise errors.DeploymentError(
+            'Encountered error while decompressing and writing '
+            'config drive for node %(node)s. Error: %(exc)s' %
+            {'node': node_uuid, 'exc': exc})
+    return size
+
+
+def _b64decode(chunks):
+    """Decode base64 encoded data chunk by chunk.
+
+    Behaves like base64.b64decode in its default mode, i.e. characters
+    outside of the base64 alphabet (such as new lines) are ignored.
+
+    :raises: binascii.Error if the data is not correctly padded.
+    """
+    remainder = b''
+    for chunk in chunks:
+        data = remainder + _NOT_BASE64.sub(b'', chunk)
+        end = len(data) - len(data) % 4
+        remainder = data[end:]
+        if end:
+            yield base64.b64decode(data[:end])
+    if remainder:
+        raise binascii.Error('Incorrect padding')
+
+
+def _gunzip(chunks):
+    """Decompress gzipped data chunk by chunk.
+
+    Like gzip.GzipFile, concatenated members and zero padding are accepted.
+    Each returned piece is at most CONFIGDRIVE_CHUNK_SIZE bytes long, so that
+    highly compressed data does not inflate in memory.
+
+    :raises: zlib.error if the data is not gzipped, EOFError if it is
+        truncated.
+    """
+    decompressor = None
+    for data in chunks:
+        while data:
+            if decompressor is None or decompressor.eof:
+                if decompressor is not None:
+                    data = data.lstrip(b'\0')
+                    if not data:
+                        break
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            result = decompressor.decompress(data, CONFIGDRIVE_CHUNK_SIZE)
+            if result:
+                yield result
+            if decompressor.eof:
+                data = decompressor.unused_data
+            else:
+                data = decompressor.unconsumed_tail
+    while decompressor is not None and not decompressor.eof:
+        # Output held back because of the length limit
+        result = decompressor.decompress(b'', CONFIGDRIVE_CHUNK_SIZE)
+        if not result:
+            break
+        yield result
+    if decompressor is not None and not decompressor.eof:
+        raise EOFError('Compressed file ended before the end-of-stream '
+                       'marker was reached')
 
 
 def get_labelled_partition(device_path, label, node_uuid):
@@ -187,6 +296,7 @@ def get_labelled_partition(device_path, label, node_uuid):
     return found_part
 
 
+@timeline.phase('work_on_disk')
 def work_on_disk(dev, root_mb, swap_mb, ephemeral_mb, ephemeral_format,
                  image_path, node_uuid, preserve_ephemeral=False,
                  configdrive=None, boot_mode="bios",
@@ -285,12 +395,15 @@ def work_on_disk(dev, root_mb, swap_mb, ephemeral_mb, ephemeral_format,
         # partition.  Create a fat filesystem on it.
         if boot_mode == "uefi":
             efi_system_part = part_dict.get('efi system partition')
-            utils.mkfs(fs='vfat', path=efi_system_part, label='efi-part')
+            with timeline.phase('mkfs_efi'):
+                utils.mkfs(fs='vfat', path=efi_system_part,
+                           label='efi-part')
 
         if configdrive_part:
             # Copy the configdrive content to the configdrive partition
-            disk_utils.dd(configdrive_file, configdrive_part,
-                          conv_flags=conv_flags)
+            with timeline.phase('configdrive_write'):
+                disk_utils.dd(configdrive_file, configdrive_part,
+                              conv_flags=conv_flags)
             LOG.info("Configdrive for node %(node)s successfully copied "
                      "onto partition %(partition)s",
                      {'node': node_uuid, 'partition': configdrive_part})
@@ -311,14 +424,16 @@ def work_on_disk(dev, root_mb, swap_mb, ephemeral_mb, ephemeral_format,
                   node_uuid)
 
     if swap_part:
-        utils.mkfs(fs='swap', path=swap_part, label='swap1')
+        with timeline.phase('mkfs_swap'):
+            utils.mkfs(fs='swap', path=swap_part, label='swap1')
         LOG.info("Swap partition %(swap)s successfully formatted "
                  "for node %(node)s",
                  {'swap': swap_part, 'node': node_uuid})
 
     if ephemeral_part and not preserve_ephemeral:
-        utils.mkfs(fs=ephemeral_format, path=ephemeral_part,
-                   label="ephemeral0")
+        with timeline.phase('mkfs_ephemeral'):
+            utils.mkfs(fs=ephemeral_format, path=ephemeral_part,
+                       label="ephemeral0")
         LOG.info("Ephemeral partition %(ephemeral)s successfully "
                  "formatted for node %(node)s",
                  {'ephemeral': ephemeral_part, 'node': node_uuid})
@@ -340,9 +455,10 @@ def work_on_disk(dev, root_mb, swap_mb, ephemeral_mb, ephemeral_format,
         ] = part_dict.get('PReP Boot partition')
 
     try:
-        for part, part_dev in uuids_to_return.items():
-            if part_dev:
-                uuids_to_return[part] = disk_utils.block_uuid(part_dev)
+        with timeline.phase('partition_uuids'):
+            for part, part_dev in uuids_to_return.items():
+                if part_dev:
+                    uuids_to_return[part] = disk_utils.block_uuid(part_dev)
 
     except processutils.ProcessExecutionError:
         with excutils.save_and_reraise_exception():
@@ -351,6 +467,7 @@ def work_on_disk(dev, root_mb, swap_mb, ephemeral_mb, ephemeral_format,
     return dict(partitions=part_dict, **uuids_to_return)
 
 
+@timeline.phase('configdrive')
 def create_config_drive_partition(node_uuid, device, configdrive):
     """Create a partition for config drive
 
@@ -463,7 +580,7 @@ def create_config_drive_partition(node_uuid, device, configdrive):
                     LOG.error(msg)
                     raise errors.DeploymentError(msg)
 
-            disk_utils.udev_settle()
+            disk_utils.udev_settle(device)
 
             # NOTE(vsaienko): check that devise actually exists,
             # it is not handled by udevadm when using ISCSI, for more info see:
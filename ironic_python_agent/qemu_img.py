@@ -10,6 +10,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
 import logging
 import os
 
@@ -93,12 +94,34 @@ def image_info(path, source_format=None):
     return imageutils.QemuImgInfo(out, format='json')
 
 
+def image_map(path, source_format):
+    """Return the mapping of the guest visible extents of an image.
+
+    This must only be called on images already validated as safe by the
+    format inspector.
+
+    :param path: The path to the image.
+    :param source_format: The format of the image.
+    :returns: a list of dictionaries as reported by qemu-img map, each with
+        ``start``, ``length``, ``data`` and ``zero`` keys and, for data
+        stored uncompressed in the image file, its ``offset`` there.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError("File %s does not exist" % path)
+
+    out, err = utils.execute('env', 'LC_ALL=C', 'LANG=C',
+                             'qemu-img', 'map', '--output=json',
+                             '-f', source_format, path,
+                             prlimit=_qemu_img_limits())
+    return json.loads(out)
+
+
 @tenacity.retry(
     retry=tenacity.retry_if_exception(_retry_on_res_temp_unavailable),
     stop=tenacity.stop_after_attempt(CONF.disk_utils.image_convert_attempts),
     reraise=True)
 def convert_image(source, dest, out_format, cache=None, out_of_order=False,
-                  sparse_size=None, source_format=None):
+                  sparse_size=None, source_format=None, coroutines=None):
     """Convert image to other format.
 
     This method is only to be run against images who have passed
@@ -124,6 +147,8 @@ def convert_image(source, dest, out_format, cache=None, out_of_order=False,
         LOG.error(msg)
         raise errors.InvalidImage(details=msg)
 
+    if coroutines is not None:
+        cmd += ['-m', str(coroutines)]
     if out_of_order:
         cmd.append('-W')
     cmd += [source, dest]
@@ -24,8 +24,11 @@ from oslo_log import log
 from oslotest import base as test_base
 
 from ironic_python_agent import config
+from ironic_python_agent import disk_utils
 from ironic_python_agent.extensions import base as ext_base
+from ironic_python_agent.extensions import standby
 from ironic_python_agent import hardware
+from ironic_python_agent import image_peers
 from ironic_python_agent import utils
 
 CONF = cfg.CONF
@@ -64,6 +67,12 @@ class IronicAgentTest(test_base.BaseTestCase):
         ext_base._EXT_MANAGER = None
         hardware._CACHED_HW_INFO = None
         hardware._global_managers = None
+        standby._CHECKSUM_FILES.clear()
+        image_peers._SHARED_IMAGES.clear()
+        image_peers._DISABLED_IMAGES.clear()
+        disk_utils._INSPECTION_CACHE.clear()
+        disk_utils._CALIBRATED_BLOCK_SIZES.clear()
+        disk_utils._UDEV_TRIGGER_SETTLE_SUPPORTED = True
 
     def _set_config(self):
         self.cfg_fixture = self.useFixture(config_fixture.Config(CONF))
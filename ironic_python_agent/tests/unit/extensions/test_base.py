@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 from unittest import mock
 
+import fixtures
+from oslo_utils import units
 from stevedore import extension
 
 from ironic_python_agent import errors
@@ -149,6 +152,11 @@ class TestExtensionDecorators(test_base.IronicAgentTest):
                          result.command_result)
         self.agent.force_heartbeat.assert_called_once_with()
 
+    def test_async_command_version(self):
+        result = self.extension.execute('fake_async_command', param='v1')
+        result.join()
+        self.assertEqual(1, result.version)
+
     def test_wait_async_command_success(self):
         result = self.extension.execute('fake_async_command', param='v1')
         self.assertIsInstance(result, base.AsyncCommandResult)
@@ -239,3 +247,114 @@ class TestExtensionDecorators(test_base.IronicAgentTest):
             'other_sync_name': self.extension.second_sync_command,
         }
         self.assertEqual(expected_map, self.extension.command_map)
+
+
+class TestCommandResultHistory(test_base.IronicAgentTest):
+    def setUp(self):
+        super(TestCommandResultHistory, self).setUp()
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.mock_mkdtemp = self.useFixture(fixtures.MockPatchObject(
+            base.tempfile, 'mkdtemp', autospec=True,
+            return_value=self.tmpdir)).mock
+        self.history = base.CommandResultHistory()
+
+    def _add(self, name, result):
+        cmd_result = base.SyncCommandResult(name, {'param': name}, True,
+                                            result)
+        self.history[cmd_result.id] = cmd_result
+        return cmd_result
+
+    def test_max_count(self):
+        self.config(command_results_max_count=2)
+        results = [self._add('cmd%d' % i, {'value': i}) for i in range(3)]
+        self.assertEqual(results[1:], self.history.values())
+        self.assertNotIn(results[0].id, self.history)
+        self.assertIs(results[2], self.history[results[2].id])
+        self.mock_mkdtemp.assert_not_called()
+
+    def test_spill_to_disk(self):
+        self.config(command_results_max_memory=1)
+        large = {'logs': 'x' * units.Mi}
+        first = self._add('log.collect_system_logs', large)
+        self.assertIs(first, self.history[first.id])
+
+        second = self._add('standby.get_partition_uuids', {'value': 1})
+        stored = self.history[first.id]
+        self.assertIsInstance(stored, base.StoredCommandResult)
+        self.assertEqual(first.serialize(), stored.serialize())
+        self.assertEqual({}, stored.command_params)
+        self.assertEqual(['id', 'command_name'], list(
+            stored.serialize(['id', 'command_name'])))
+        self.assertTrue(stored.is_done())
+        self.assertEqual(os.path.join(self.tmpdir,
+                                      '%s.json.gz' % first.id), stored.path)
+        self.assertLess(os.path.getsize(stored.path), 10 * units.Ki)
+        self.assertIs(second, self.history[second.id])
+        self.assertEqual([first.id, second.id],
+                         [r.id for r in self.history.values()])
+
+    def test_latest_kept_in_memory(self):
+        self.config(command_results_max_memory=0)
+        only = self._add('cmd', {'value': 'x' * 100})
+        self.assertIs(only, self.history[only.id])
+        self.mock_mkdtemp.assert_not_called()
+
+    def test_running_not_stored(self):
+        self.config(command_results_max_memory=0)
+        running = base.BaseCommandResult('cmd', {})
+        self.history[running.id] = running
+        self._add('other', {'value': 1})
+        self.assertIs(running, self.history[running.id])
+
+    def test_stored_removed(self):
+        self.config(command_results_max_memory=0,
+                    command_results_max_count=2)
+        first = self._add('cmd1', {'value': 1})
+        self._add('cmd2', {'value': 2})
+        path = self.history[first.id].path
+        self.assertTrue(os.path.exists(path))
+        self._add('cmd3', {'value': 3})
+        self.assertNotIn(first.id, self.history)
+        self.assertFalse(os.path.exists(path))
+
+    @mock.patch.object(base.gzip, 'open', autospec=True)
+    def test_store_fails(self, mock_open):
+        mock_open.side_effect = OSError('no space left')
+        self.config(command_results_max_memory=0)
+        first = self._add('cmd1', {'value': 1})
+        self._add('cmd2', {'value': 2})
+        self.assertIs(first, self.history[first.id])
+        self._add('cmd3', {'value': 3})
+        # Not retried for the first result
+        self.assertEqual(2, mock_open.call_count)
+
+    def test_version(self):
+        self.config(command_results_max_count=2,
+                    command_results_max_memory=0)
+        versions = {self.history.version}
+        self._add('cmd1', {'value': 1})
+        versions.add(self.history.version)
+        running = base.BaseCommandResult('cmd2', {})
+        self.history[running.id] = running
+        versions.add(self.history.version)
+        # Storing results on disk does not change them
+        self.assertIsInstance(list(self.history.values())[0],
+                              base.StoredCommandResult)
+        self.assertIn(self.history.version, versions)
+        running.command_status = base.AgentCommandStatus.SUCCEEDED
+        running.version += 1
+        versions.add(self.history.version)
+        # Removing the first result
+        self._add('cmd3', {'value': 3})
+        versions.add(self.history.version)
+        self.assertEqual(5, len(versions))
+        self.assertNotEqual(self.history.version,
+                            base.CommandResultHistory().version)
+
+    def test_stored_unreadable(self):
+        self.config(command_results_max_memory=0)
+        first = self._add('cmd1', {'value': 1})
+        self._add('cmd2', {'value': 2})
+        stored = self.history[first.id]
+        os.unlink(stored.path)
+        self.assertIsNone(stored.command_result)
@@ -15,6 +15,7 @@
 
 from unittest import mock
 
+from ironic_python_agent import errors
 from ironic_python_agent.extensions import log
 from ironic_python_agent.tests.unit import base
 from ironic_python_agent import utils
@@ -35,3 +36,29 @@ class TestLogExtension(base.IronicAgentTest):
         serialized_cmd_result = cmd_result.serialize()
         expected_ret = {'system_logs': ret}
         self.assertEqual(expected_ret, serialized_cmd_result['command_result'])
+        mock_collect.assert_called_once_with(consumer=None)
+
+    @mock.patch.object(utils, 'collect_system_logs', autospec=True)
+    def test_collect_system_logs_consumer(self, mock_collect):
+        cmd_result = self.agent_extension.collect_system_logs(
+            consumer='conductor')
+        self.assertEqual({'system_logs': mock_collect.return_value},
+                         cmd_result.command_result)
+        mock_collect.assert_called_once_with(consumer='conductor')
+
+    @mock.patch.object(utils, 'upload_system_logs', autospec=True)
+    def test_upload_system_logs(self, mock_upload):
+        mock_upload.return_value = 42
+
+        cmd_result = self.agent_extension.upload_system_logs(
+            url='http://example.com/logs', journald_max_lines=100,
+            consumer='conductor')
+        cmd_result.join()
+        self.assertEqual({'size': 42}, cmd_result.command_result)
+        mock_upload.assert_called_once_with('http://example.com/logs',
+                                            journald_max_lines=100,
+                                            consumer='conductor')
+
+    def test_upload_system_logs_no_url(self):
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          self.agent_extension.upload_system_logs)
@@ -13,8 +13,11 @@
 # limitations under the License.
 
 import errno
+import hashlib
 import os
+import struct
 import tempfile
+import threading
 import time
 from unittest import mock
 
@@ -27,6 +30,7 @@ from ironic_python_agent import disk_utils
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import standby
 from ironic_python_agent import hardware
+from ironic_python_agent import image_peers
 from ironic_python_agent import partition_utils
 from ironic_python_agent.tests.unit import base
 from ironic_python_agent import utils
@@ -327,12 +331,94 @@ class TestStandbyExtension(base.IronicAgentTest):
                                              source_format=source_format,
                                              cache='directsync',
                                              out_of_order=True)
-        validate_mock.assert_called_once_with(location, source_format)
+        validate_mock.assert_called_once_with(location, source_format,
+                                              checksum='fake-checksum')
         wipe_mock.assert_called_once_with(device, '')
-        udev_mock.assert_called_once_with()
+        udev_mock.assert_called_once_with(device)
         rescan_mock.assert_called_once_with(device)
         fix_gpt_mock.assert_called_once_with(device, node_uuid=None)
 
+    @mock.patch('ironic_python_agent.image_verification.verify_image_file',
+                autospec=True)
+    @mock.patch(
+        'ironic_python_agent.disk_utils.get_and_validate_image_format',
+        autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.fix_gpt_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.trigger_device_rescan',
+                autospec=True)
+    @mock.patch('ironic_python_agent.qemu_img.convert_image', autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.udev_settle', autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.destroy_disk_metadata',
+                autospec=True)
+    def test_write_image_verification(self, wipe_mock, udev_mock,
+                                      convert_mock, rescan_mock, fix_gpt_mock,
+                                      validate_mock, verify_mock):
+        self.config(image_write_verification=True)
+        image_info = _build_fake_image_info()
+        validate_mock.return_value = ('qcow2', 0)
+        location = standby._image_location(image_info)
+        verify_mock.side_effect = (
+            lambda *args, **kwargs: fix_gpt_mock.assert_not_called())
+
+        standby._write_image(image_info, '/dev/sda')
+
+        verify_mock.assert_called_once_with('/dev/sda', location, 'qcow2',
+                                            is_raw=False)
+        fix_gpt_mock.assert_called_once_with('/dev/sda', node_uuid=None)
+
+    @mock.patch('ironic_python_agent.image_verification.verify_image_file',
+                autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.fix_gpt_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._write_partition_image', autospec=True)
+    @mock.patch(
+        'ironic_python_agent.disk_utils.get_and_validate_image_format',
+        autospec=True)
+    def test_write_image_verification_partition(self, validate_mock,
+                                                write_mock, fix_gpt_mock,
+                                                verify_mock):
+        self.config(image_write_verification=True)
+        image_info = _build_fake_image_info()
+        image_info['image_type'] = 'partition'
+        image_info['disk_format'] = 'raw'
+        validate_mock.return_value = ('raw', units.Mi)
+        write_mock.return_value = {'root uuid': 'ROOT',
+                                   'partitions': {'root': '/dev/sda2'}}
+        location = standby._image_location(image_info)
+
+        standby._write_image(image_info, '/dev/sda')
+
+        verify_mock.assert_called_once_with('/dev/sda2', location, 'raw',
+                                            is_raw=True)
+
+    @mock.patch('ironic_python_agent.image_verification.verify_image_file',
+                autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.fix_gpt_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.trigger_device_rescan',
+                autospec=True)
+    @mock.patch('ironic_python_agent.qemu_img.convert_image', autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.udev_settle', autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.destroy_disk_metadata',
+                autospec=True)
+    @mock.patch(
+        'ironic_python_agent.disk_utils.get_and_validate_image_format',
+        autospec=True)
+    def test_write_image_verification_fails(self, validate_mock, wipe_mock,
+                                            udev_mock, convert_mock,
+                                            rescan_mock, fix_gpt_mock,
+                                            verify_mock):
+        self.config(image_write_verification=True)
+        image_info = _build_fake_image_info()
+        validate_mock.return_value = ('qcow2', 0)
+        verify_mock.side_effect = errors.ImageVerificationError('/dev/sda',
+                                                                'boom')
+        self.assertRaises(errors.ImageVerificationError,
+                          standby._write_image, image_info, '/dev/sda')
+        fix_gpt_mock.assert_not_called()
+
     @mock.patch('ironic_python_agent.disk_utils.fix_gpt_partition',
                 autospec=True)
     @mock.patch('ironic_python_agent.disk_utils.trigger_device_rescan',
@@ -408,7 +494,8 @@ class TestStandbyExtension(base.IronicAgentTest):
 
         self.assertRaises(exc, standby._write_image, image_info,
                           device, 'configdrive')
-        validate_mock.assert_called_once_with(image_path, source_format)
+        validate_mock.assert_called_once_with(image_path, source_format,
+                                              checksum='fake-checksum')
         work_on_disk_mock.assert_called_once_with(device, root_mb, swap_mb,
                                                   ephemeral_mb,
                                                   ephemeral_format,
@@ -457,7 +544,8 @@ class TestStandbyExtension(base.IronicAgentTest):
         work_on_disk_mock.return_value = uuids
 
         standby._write_image(image_info, device, 'configdrive')
-        validate_mock.assert_called_once_with(image_path, source_format)
+        validate_mock.assert_called_once_with(image_path, source_format,
+                                              checksum='fake-checksum')
         work_on_disk_mock.assert_called_once_with(device, root_mb, swap_mb,
                                                   ephemeral_mb,
                                                   ephemeral_format,
@@ -499,7 +587,8 @@ class TestStandbyExtension(base.IronicAgentTest):
 
         self.assertRaises(exc, standby._write_image, image_info,
                           device)
-        validate_mock.assert_called_once_with(image_path, source_format)
+        validate_mock.assert_called_once_with(image_path, source_format,
+                                              checksum='fake-checksum')
         self.assertFalse(work_on_disk_mock.called)
 
     @mock.patch.object(utils, 'get_node_boot_mode', lambda self: 'bios')
@@ -533,7 +622,8 @@ class TestStandbyExtension(base.IronicAgentTest):
         work_on_disk_mock.return_value = uuids
 
         standby._write_image(image_info, device, 'configdrive')
-        validate_mock.assert_called_once_with(image_path, source_format)
+        validate_mock.assert_called_once_with(image_path, source_format,
+                                              checksum='fake-checksum')
         work_on_disk_mock.assert_called_once_with(device, root_mb, swap_mb,
                                                   ephemeral_mb,
                                                   ephemeral_format,
@@ -633,6 +723,57 @@ class TestStandbyExtension(base.IronicAgentTest):
             mock.call().update(b'content'),
             mock.call().hexdigest()])
 
+    @mock.patch.object(os, 'replace', autospec=True)
+    @mock.patch('hashlib.new', autospec=True)
+    @mock.patch('builtins.open', autospec=True)
+    @mock.patch('ironic_python_agent.utils.get_requests_session',
+                autospec=True)
+    def test_download_image_staged(self, session_mock, open_mock, hash_mock,
+                                   replace_mock):
+        image_info = _build_fake_image_info()
+        response = mock.MagicMock()
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = ['some', 'content']
+        session_mock.return_value.get.return_value = response
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        hash_mock.return_value.hexdigest.return_value = (
+            image_info['os_hash_value'])
+        location = standby._image_location(image_info)
+
+        standby._download_image(image_info, cancelled=threading.Event())
+        open_mock.assert_called_once_with(location + '.part', 'wb')
+        self.assertEqual(2, file_mock.write.call_count)
+        replace_mock.assert_called_once_with(location + '.part', location)
+
+    @mock.patch.object(standby, '_remove_file', autospec=True)
+    @mock.patch.object(os, 'replace', autospec=True)
+    @mock.patch('hashlib.new', autospec=True)
+    @mock.patch('builtins.open', autospec=True)
+    @mock.patch('ironic_python_agent.utils.get_requests_session',
+                autospec=True)
+    def test_download_image_cancelled(self, session_mock, open_mock,
+                                      hash_mock, replace_mock, remove_mock):
+        image_info = _build_fake_image_info()
+        cancelled = threading.Event()
+        response = mock.MagicMock()
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = ['some', 'content']
+        session_mock.return_value.get.return_value = response
+        file_mock = mock.Mock()
+        file_mock.write.side_effect = lambda chunk: cancelled.set()
+        open_mock.return_value.__enter__.return_value = file_mock
+        location = standby._image_location(image_info)
+
+        self.assertRaises(standby._DownloadCancelled,
+                          standby._download_image, image_info,
+                          cancelled=cancelled)
+        file_mock.write.assert_called_once_with('some')
+        remove_mock.assert_called_once_with(location + '.part')
+        replace_mock.assert_not_called()
+
     @mock.patch('ironic_python_agent.utils.get_requests_session',
                 autospec=True)
     def test_download_image_bad_status(self, session_mock):
@@ -797,6 +938,53 @@ class TestStandbyExtension(base.IronicAgentTest):
                           standby._download_image,
                           image_info)
 
+    @mock.patch('ironic_python_agent.disk_utils.cache_inspection',
+                autospec=True)
+    @mock.patch('hashlib.new', autospec=True)
+    @mock.patch('builtins.open', autospec=True)
+    @mock.patch('ironic_python_agent.utils.get_requests_session',
+                autospec=True)
+    def test_download_image_inspection(self, session_mock, open_mock,
+                                       hash_mock, cache_mock):
+        image_info = _build_fake_image_info()
+        header = struct.pack('>4sIQIIQ', b'QFI\xfb', 3, 0, 0, 16, units.Gi)
+        response = mock.MagicMock()
+        response.status_code = 200
+        response.iter_content.return_value = [
+            header, b'\0' * (units.Mi - len(header))]
+        session_mock.return_value.get.return_value = response
+        hash_mock.return_value.hexdigest.return_value = image_info[
+            'os_hash_value']
+
+        standby._download_image(image_info)
+
+        cache_mock.assert_called_once_with(
+            standby._image_location(image_info), mock.ANY,
+            checksum='fake-checksum')
+        inspection = cache_mock.call_args[0][1]
+        self.assertTrue(inspection.complete)
+        self.assertEqual(units.Gi, inspection.result().virtual_size)
+
+    @mock.patch('ironic_python_agent.disk_utils.cache_inspection',
+                autospec=True)
+    @mock.patch('hashlib.new', autospec=True)
+    @mock.patch('builtins.open', autospec=True)
+    @mock.patch('ironic_python_agent.utils.get_requests_session',
+                autospec=True)
+    def test_download_image_no_inspection_raw(self, session_mock, open_mock,
+                                              hash_mock, cache_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        response = mock.MagicMock()
+        response.status_code = 200
+        response.iter_content.return_value = [b'data']
+        session_mock.return_value.get.return_value = response
+        hash_mock.return_value.hexdigest.return_value = image_info[
+            'os_hash_value']
+
+        standby._download_image(image_info)
+        cache_mock.assert_not_called()
+
     @mock.patch('hashlib.new', autospec=True)
     @mock.patch('builtins.open', autospec=True)
     @mock.patch('ironic_python_agent.utils.get_requests_session',
@@ -993,7 +1181,7 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
+        download_mock.assert_called_once_with(image_info, 'manager')
         write_mock.assert_called_once_with(image_info, 'manager',
                                            'configdrive_data')
         dispatch_mock.assert_called_once_with('get_os_install_device',
@@ -1007,6 +1195,13 @@ class TestStandbyExtension(base.IronicAgentTest):
         cmd_result = ('prepare_image: image ({}) written to device {} '
                       'root_uuid=ROOT').format(image_info['id'], 'manager')
         self.assertEqual(cmd_result, async_result.command_result['result'])
+        phases = async_result.command_result['timeline']
+        self.assertEqual(['select_device', 'prefetch_wait',
+                          'validate_partitioning', 'fix_up_partition_uuids'],
+                         [phase['name'] for phase in phases])
+        for phase in phases:
+            self.assertLessEqual(phase['start'], phase['end'])
+            self.assertEqual(0, phase['depth'])
         list_part_mock.assert_called_with('manager')
         execute_mock.assert_called_with('partprobe', 'manager',
                                         attempts=mock.ANY)
@@ -1044,7 +1239,7 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
+        download_mock.assert_called_once_with(image_info, 'manager')
         write_mock.assert_called_once_with(image_info, 'manager',
                                            'configdrive_data')
         dispatch_mock.assert_called_once_with('get_os_install_device',
@@ -1117,7 +1312,7 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
+        download_mock.assert_called_once_with(image_info, 'manager')
         write_mock.assert_called_once_with(image_info, 'manager', None)
         dispatch_mock.assert_called_once_with('get_os_install_device',
                                               permit_refresh=True)
@@ -1168,7 +1363,7 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
+        download_mock.assert_called_once_with(image_info, 'manager')
         write_mock.assert_called_once_with(image_info, 'manager', None)
         dispatch_mock.assert_called_once_with('get_os_install_device',
                                               permit_refresh=True)
@@ -1211,7 +1406,7 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
+        download_mock.assert_called_once_with(image_info, 'manager')
         write_mock.assert_called_once_with(image_info, 'manager',
                                            'configdrive_data')
         dispatch_mock.assert_called_once_with('get_os_install_device',
@@ -1458,7 +1653,7 @@ class TestStandbyExtension(base.IronicAgentTest):
         image_info = _build_fake_image_info()
         device = '/dev/foo'
         self.agent_extension._cache_and_write_image(image_info, device)
-        download_mock.assert_called_once_with(image_info)
+        download_mock.assert_called_once_with(image_info, device)
         write_mock.assert_called_once_with(image_info, device, None)
 
     @mock.patch('ironic_python_agent.extensions.standby._write_image',
@@ -1471,10 +1666,68 @@ class TestStandbyExtension(base.IronicAgentTest):
         device = '/dev/foo'
         self.agent_extension._cache_and_write_image(image_info, device,
                                                     'configdrive_data')
-        download_mock.assert_called_once_with(image_info)
+        download_mock.assert_called_once_with(image_info, device)
         write_mock.assert_called_once_with(image_info, device,
                                            'configdrive_data')
 
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._download_and_write_image', autospec=True)
+    def test_cache_and_write_image_pipeline(self, pipeline_mock,
+                                            download_mock, write_mock):
+        self.config(image_download_pipeline=True)
+        pipeline_mock.return_value = {}
+        image_info = _build_fake_image_info()
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
+        pipeline_mock.assert_called_once_with(image_info, '/dev/foo')
+        download_mock.assert_not_called()
+        write_mock.assert_not_called()
+        self.assertEqual({}, self.agent_extension.partition_uuids)
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._download_and_write_image', autospec=True)
+    def test_cache_and_write_image_pipeline_fallback(self, pipeline_mock,
+                                                     download_mock,
+                                                     write_mock):
+        self.config(image_download_pipeline=True)
+        image_info = _build_fake_image_info()
+        for error in (standby._PipelineUnavailable('not qcow2'),
+                      errors.ImageWriteError('/dev/foo', 1, '', 'boom'),
+                      errors.ImageChecksumError('fake_id', '/tmp/x', 'a',
+                                                'b')):
+            pipeline_mock.side_effect = error
+            self.agent_extension._cache_and_write_image(image_info,
+                                                        '/dev/foo')
+        self.assertEqual(3, download_mock.call_count)
+        self.assertEqual(3, write_mock.call_count)
+
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._download_and_write_image', autospec=True)
+    def test_cache_and_write_image_pipeline_fatal(self, pipeline_mock,
+                                                  download_mock, write_mock):
+        self.config(image_download_pipeline=True)
+        image_info = _build_fake_image_info()
+        for error in (errors.InvalidImage(details='bad'),
+                      errors.ImageDownloadOutofSpaceError('fake_id', 'full')):
+            pipeline_mock.side_effect = error
+            self.assertRaises(type(error),
+                              self.agent_extension._cache_and_write_image,
+                              image_info, '/dev/foo')
+        download_mock.assert_not_called()
+        write_mock.assert_not_called()
+
     @mock.patch('ironic_python_agent.extensions.standby.LOG', autospec=True)
     @mock.patch('ironic_python_agent.disk_utils.block_uuid', autospec=True)
     @mock.patch('ironic_python_agent.disk_utils.fix_gpt_partition',
@@ -1540,6 +1793,40 @@ class TestStandbyExtension(base.IronicAgentTest):
         ]
         mock_log.assert_has_calls(mock_log_calls)
 
+    @mock.patch('ironic_python_agent.image_verification'
+                '.verify_written_image', autospec=True)
+    @mock.patch('ironic_python_agent.image_verification.ChunkDigests',
+                autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.block_uuid', autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.fix_gpt_partition',
+                autospec=True)
+    @mock.patch('hashlib.new', autospec=True)
+    @mock.patch('builtins.open', autospec=True)
+    @mock.patch('ironic_python_agent.utils.get_requests_session',
+                autospec=True)
+    def test_stream_raw_image_onto_device_verification(
+            self, session_mock, open_mock, hash_mock, fix_gpt_mock,
+            block_uuid_mock, digests_mock, verify_mock):
+        self.config(image_write_verification=True)
+        image_info = _build_fake_image_info()
+        response = mock.MagicMock()
+        response.headers = {'Content-Length': 11}
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
+        session_mock.return_value.get.return_value = response
+        open_mock.return_value.__enter__.return_value.read.return_value = None
+        hexdigest_mock = hash_mock.return_value.hexdigest
+        hexdigest_mock.return_value = image_info['os_hash_value']
+        self.agent_extension.partition_uuids = {}
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+        digests_mock.return_value.update.assert_has_calls(
+            [mock.call(b'some'), mock.call(b'content')])
+        verify_mock.assert_called_once_with(
+            '/dev/foo', digests_mock.return_value.get_extents.return_value)
+        fix_gpt_mock.assert_called_once_with('/dev/foo', node_uuid=None)
+
     @mock.patch('hashlib.new', autospec=True)
     @mock.patch('builtins.open', autospec=True)
     @mock.patch('ironic_python_agent.utils.get_requests_session',
@@ -1736,7 +2023,8 @@ class TestStandbyExtension(base.IronicAgentTest):
         work_on_disk_mock.return_value = uuids
 
         standby._write_image(image_info, device, 'configdrive')
-        validate_mock.assert_called_once_with(image_path, source_format)
+        validate_mock.assert_called_once_with(image_path, source_format,
+                                              checksum='fake-checksum')
         work_on_disk_mock.assert_called_once_with(device, root_mb, swap_mb,
                                                   ephemeral_mb,
                                                   ephemeral_format,
@@ -2201,6 +2489,670 @@ class TestStandbyExtension(base.IronicAgentTest):
         mock_close.assert_called_once()
 
 
+@mock.patch.object(os.path, 'exists', autospec=True)
+@mock.patch.object(standby, '_write_image', autospec=True)
+@mock.patch.object(standby, '_download_image', autospec=True)
+class TestPrefetchImage(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestPrefetchImage, self).setUp()
+        self.agent_extension = standby.StandbyExtension()
+        self.image_info = _build_fake_image_info()
+
+    def _prefetch(self, image_info=None):
+        result = self.agent_extension.prefetch_image(
+            image_info=image_info or self.image_info)
+        return result.serialize()['command_result']
+
+    def test_prefetch_and_write(self, download_mock, write_mock,
+                                exists_mock):
+        self.assertEqual({'image': 'fake_id', 'status': 'downloading'},
+                         self._prefetch())
+        self.agent_extension._prefetch.wait()
+        self.assertEqual({'image': 'fake_id', 'status': 'downloaded'},
+                         self._prefetch())
+        download_mock.assert_called_once_with(self.image_info,
+                                              cancelled=mock.ANY)
+
+        self.agent_extension._cache_and_write_image(dict(self.image_info),
+                                                    '/dev/foo')
+        download_mock.assert_called_once_with(self.image_info,
+                                              cancelled=mock.ANY)
+        write_mock.assert_called_once_with(self.image_info, '/dev/foo', None)
+        exists_mock.assert_called_once_with(
+            standby._image_location(self.image_info))
+        self.assertIsNone(self.agent_extension._prefetch)
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+
+    def test_write_waits_for_prefetch(self, download_mock, write_mock,
+                                      exists_mock):
+        started = threading.Event()
+        release = threading.Event()
+
+        def _download(image_info, device=None, cancelled=None):
+            started.set()
+            release.wait(10)
+
+        download_mock.side_effect = _download
+        self._prefetch()
+        started.wait(10)
+        self.assertEqual({'image': 'fake_id', 'status': 'downloading'},
+                         self._prefetch())
+        other_image = dict(self.image_info, id='other')
+        self.assertRaisesRegex(errors.CommandExecutionError,
+                               'fake_id is already being prefetched',
+                               self._prefetch, other_image)
+        threading.Timer(0.1, release.set).start()
+        self.agent_extension._cache_and_write_image(self.image_info,
+                                                    '/dev/foo')
+        download_mock.assert_called_once_with(self.image_info,
+                                              cancelled=mock.ANY)
+        write_mock.assert_called_once_with(self.image_info, '/dev/foo', None)
+
+    def test_prefetch_failed(self, download_mock, write_mock, exists_mock):
+        download_mock.side_effect = [
+            errors.ImageDownloadError('fake_id', 'boom'), None]
+        self._prefetch()
+        self.agent_extension._prefetch.wait()
+        self.agent_extension._cache_and_write_image(self.image_info,
+                                                    '/dev/foo')
+        download_mock.assert_has_calls([mock.call(self.image_info,
+                                                  cancelled=mock.ANY),
+                                        mock.call(self.image_info,
+                                                  '/dev/foo')])
+        write_mock.assert_called_once_with(self.image_info, '/dev/foo', None)
+
+    def test_cache_and_write_shares_session(self, download_mock, write_mock,
+                                            exists_mock):
+        sessions = []
+        download_mock.side_effect = lambda *args, **kwargs: sessions.append(
+            utils.get_shared_requests_session())
+        write_mock.side_effect = lambda *args: sessions.append(
+            utils.get_shared_requests_session())
+
+        self.agent_extension._cache_and_write_image(self.image_info,
+                                                    '/dev/foo')
+
+        self.assertEqual(2, len(sessions))
+        self.assertIs(sessions[0], sessions[1])
+
+    def test_prefetched_image_removed(self, download_mock, write_mock,
+                                      exists_mock):
+        exists_mock.return_value = False
+        self._prefetch()
+        self.agent_extension._prefetch.wait()
+        self.agent_extension._cache_and_write_image(self.image_info,
+                                                    '/dev/foo')
+        self.assertEqual(2, download_mock.call_count)
+
+    @mock.patch.object(standby, '_remove_file', autospec=True)
+    def test_different_image(self, remove_mock, download_mock, write_mock,
+                             exists_mock):
+        self._prefetch()
+        self.agent_extension._prefetch.wait()
+        other_image = dict(self.image_info, os_hash_value='other')
+        self.agent_extension._cache_and_write_image(other_image, '/dev/foo')
+        download_mock.assert_called_with(other_image, '/dev/foo')
+        write_mock.assert_called_once_with(other_image, '/dev/foo', None)
+        # The stale download is removed before downloading the image again
+        remove_mock.assert_called_once_with(
+            standby._image_location(self.image_info))
+        self.assertIsNone(self.agent_extension._prefetch)
+
+    @mock.patch.object(standby, '_remove_file', autospec=True)
+    def test_different_image_cancels_prefetch(self, remove_mock,
+                                              download_mock, write_mock,
+                                              exists_mock):
+        started = threading.Event()
+
+        def _download(image_info, device=None, cancelled=None):
+            if cancelled is None:
+                return
+            started.set()
+            if not cancelled.wait(10):
+                self.fail('prefetch has not been cancelled')
+            raise standby._DownloadCancelled()
+
+        download_mock.side_effect = _download
+        self._prefetch()
+        prefetch = self.agent_extension._prefetch
+        started.wait(10)
+        other_image = dict(self.image_info, id='other')
+        self.agent_extension._cache_and_write_image(other_image, '/dev/foo')
+        # The prefetch has exited before the image was downloaded again
+        self.assertFalse(prefetch.running)
+        self.assertIsInstance(prefetch.error, standby._DownloadCancelled)
+        download_mock.assert_called_with(other_image, '/dev/foo')
+        write_mock.assert_called_once_with(other_image, '/dev/foo', None)
+        remove_mock.assert_not_called()
+        self.assertIsNone(self.agent_extension._prefetch)
+
+    @mock.patch.object(standby, '_remove_file', autospec=True)
+    def test_prefetch_replaces_finished(self, remove_mock, download_mock,
+                                        write_mock, exists_mock):
+        self._prefetch()
+        self.agent_extension._prefetch.wait()
+        other_image = dict(self.image_info, id='other')
+        self.assertEqual({'image': 'other', 'status': 'downloading'},
+                         self._prefetch(other_image))
+        self.agent_extension._prefetch.wait()
+        remove_mock.assert_called_once_with(
+            standby._image_location(self.image_info))
+        download_mock.assert_called_with(other_image, cancelled=mock.ANY)
+
+    def test_stream_raw_image(self, download_mock, write_mock, exists_mock):
+        self.image_info.update(stream_raw_images=True, disk_format='raw')
+        self.assertEqual({'image': 'fake_id', 'status': 'skipped'},
+                         self._prefetch())
+        self.assertIsNone(self.agent_extension._prefetch)
+        download_mock.assert_not_called()
+
+    @mock.patch.object(standby.StandbyExtension, '_fix_up_partition_uuids',
+                       autospec=True)
+    @mock.patch.object(standby.StandbyExtension,
+                       '_stream_raw_image_onto_device', autospec=True)
+    @mock.patch.object(standby, '_validate_partitioning', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    @mock.patch.object(standby, '_remove_file', autospec=True)
+    def test_stream_raw_image_discards_prefetch(self, remove_mock,
+                                                dispatch_mock,
+                                                validate_mock, stream_mock,
+                                                fix_uuids_mock,
+                                                download_mock, write_mock,
+                                                exists_mock):
+        dispatch_mock.return_value = '/dev/foo'
+        self._prefetch()
+        prefetch = self.agent_extension._prefetch
+        prefetch.wait()
+        self.image_info.update(stream_raw_images=True, disk_format='raw')
+
+        self.agent_extension._prepare_image(self.image_info)
+
+        stream_mock.assert_called_once_with(self.agent_extension,
+                                            self.image_info, '/dev/foo')
+        write_mock.assert_not_called()
+        download_mock.assert_called_once_with(self.image_info,
+                                              cancelled=mock.ANY)
+        self.assertTrue(prefetch._cancelled.is_set())
+        remove_mock.assert_called_once_with(
+            standby._image_location(self.image_info))
+        self.assertIsNone(self.agent_extension._prefetch)
+
+    def test_invalid_image_info(self, download_mock, write_mock,
+                                exists_mock):
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          self.agent_extension.prefetch_image,
+                          image_info={'id': 'fake_id'})
+
+
+@mock.patch.object(utils, 'execute', autospec=True)
+@mock.patch.object(disk_utils, 'get_dev_byte_size', autospec=True)
+@mock.patch.object(standby, '_get_ramdisk_free_space', autospec=True)
+class TestScratchSpace(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestScratchSpace, self).setUp()
+        self.image_info = _build_fake_image_info()
+        self.addCleanup(standby._SCRATCH_DEVICES.clear)
+        self.ramdisk_path = standby._image_location(self.image_info)
+
+    def test_ramdisk(self, free_mock, size_mock, execute_mock):
+        free_mock.return_value = 2 * units.Gi
+        standby._select_image_location(self.image_info, '/dev/sda',
+                                       str(units.Gi))
+        self.assertEqual(self.ramdisk_path,
+                         standby._image_location(self.image_info))
+        execute_mock.assert_not_called()
+
+    def test_disabled(self, free_mock, size_mock, execute_mock):
+        self.config(image_download_scratch='ramdisk')
+        free_mock.return_value = units.Gi
+        standby._select_image_location(self.image_info, '/dev/sda',
+                                       str(2 * units.Gi))
+        self.assertEqual(self.ramdisk_path,
+                         standby._image_location(self.image_info))
+        execute_mock.assert_not_called()
+
+    def test_unknown_size(self, free_mock, size_mock, execute_mock):
+        standby._select_image_location(self.image_info, '/dev/sda', None)
+        self.assertEqual(self.ramdisk_path,
+                         standby._image_location(self.image_info))
+        free_mock.assert_not_called()
+
+    def test_partition_image(self, free_mock, size_mock, execute_mock):
+        free_mock.return_value = units.Gi
+        image_info = _build_fake_partition_image_info()
+        standby._select_image_location(image_info, '/dev/sda',
+                                       str(2 * units.Gi))
+        execute_mock.assert_not_called()
+
+    def test_target_disk(self, free_mock, size_mock, execute_mock):
+        # Fits, but not with the reserve
+        free_mock.return_value = units.Gi + units.Mi
+        size_mock.return_value = 8 * units.Gi
+        execute_mock.return_value = ('/dev/loop3\n', '')
+        standby._select_image_location(self.image_info, '/dev/sda',
+                                       str(units.Gi - 1000))
+        self.assertEqual('/dev/loop3',
+                         standby._image_location(self.image_info))
+        execute_mock.assert_called_once_with(
+            'losetup', '--find', '--show', '--offset',
+            str(7 * units.Gi - units.Mi), '--sizelimit', str(units.Gi - 512),
+            '/dev/sda')
+        size_mock.assert_called_once_with('/dev/sda')
+
+        standby._check_scratch_overlap(self.image_info, '/dev/sda', 'qcow2',
+                                       7 * units.Gi - units.Mi)
+        self.assertRaisesRegex(errors.DeploymentError, 'at offset',
+                               standby._check_scratch_overlap,
+                               self.image_info, '/dev/sda', 'qcow2',
+                               7 * units.Gi)
+        # The size of raw images is the downloaded size
+        standby._check_scratch_overlap(self.image_info, '/dev/sda', 'raw',
+                                       8 * units.Gi)
+
+        execute_mock.reset_mock()
+        standby._release_scratch_space(self.image_info)
+        execute_mock.assert_called_once_with('losetup', '--detach',
+                                             '/dev/loop3')
+        self.assertEqual(self.ramdisk_path,
+                         standby._image_location(self.image_info))
+
+    def test_target_disk_too_small(self, free_mock, size_mock, execute_mock):
+        free_mock.return_value = units.Gi
+        size_mock.return_value = 2 * units.Gi
+        self.assertRaises(errors.ImageDownloadOutofSpaceError,
+                          standby._select_image_location,
+                          self.image_info, '/dev/sda', str(2 * units.Gi))
+        execute_mock.assert_not_called()
+
+    def test_target_disk_too_small_ramdisk_fits(self, free_mock, size_mock,
+                                                execute_mock):
+        free_mock.return_value = units.Gi
+        size_mock.return_value = units.Gi
+        standby._select_image_location(self.image_info, '/dev/sda',
+                                       str(units.Gi - units.Mi))
+        self.assertEqual(self.ramdisk_path,
+                         standby._image_location(self.image_info))
+        execute_mock.assert_not_called()
+
+    def test_losetup_failure(self, free_mock, size_mock, execute_mock):
+        free_mock.return_value = units.Gi
+        size_mock.return_value = 8 * units.Gi
+        execute_mock.side_effect = processutils.ProcessExecutionError()
+        self.assertRaises(errors.ImageDownloadOutofSpaceError,
+                          standby._select_image_location,
+                          self.image_info, '/dev/sda', str(2 * units.Gi))
+
+    @mock.patch.object(standby, '_write_image', autospec=True)
+    @mock.patch.object(standby, 'ImageDownload', autospec=True)
+    @mock.patch('builtins.open', autospec=True)
+    def test_cache_and_write_image(self, open_mock, download_mock,
+                                   write_mock, free_mock, size_mock,
+                                   execute_mock):
+        free_mock.return_value = units.Gi
+        size_mock.return_value = 8 * units.Gi
+        execute_mock.return_value = ('/dev/loop0\n', '')
+        download_mock.return_value.content_length = str(2 * units.Gi)
+        download_mock.return_value.__iter__.return_value = []
+
+        def _write(image_info, device, configdrive):
+            self.assertEqual('/dev/loop0', standby._image_location(image_info))
+
+        write_mock.side_effect = _write
+        extension = standby.StandbyExtension()
+        extension._cache_and_write_image(self.image_info, '/dev/sda')
+        open_mock.assert_called_once_with('/dev/loop0', 'wb')
+        write_mock.assert_called_once_with(self.image_info, '/dev/sda', None)
+        execute_mock.assert_called_with('losetup', '--detach', '/dev/loop0')
+        self.assertEqual({}, standby._SCRATCH_DEVICES)
+
+
+@mock.patch('ironic_python_agent.disk_utils.fix_gpt_partition', autospec=True)
+@mock.patch('ironic_python_agent.disk_utils.get_and_validate_image_format',
+            autospec=True)
+@mock.patch('ironic_python_agent.extensions.standby._write_whole_disk_image',
+            autospec=True)
+@mock.patch('ironic_python_agent.extensions.standby.ImageDownload',
+            autospec=True)
+class TestDownloadAndWriteImage(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDownloadAndWriteImage, self).setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.config(image_download_pipeline=True)
+        self.image_info = _build_fake_image_info()
+        self.location = os.path.join(tmpdir.name, 'image')
+        location_patch = mock.patch.object(standby, '_image_location',
+                                           autospec=True,
+                                           return_value=self.location)
+        location_patch.start()
+        self.addCleanup(location_patch.stop)
+        self.header = struct.pack('>4sIQIIQ', b'QFI\xfb', 3, 0, 0, 16,
+                                  units.Gi).ljust(512, b'\0')
+        self.data = self.header + b'x' * 4096
+
+    def _set_content(self, download_mock, chunks):
+        download_mock.return_value.content_length = str(len(self.data))
+        download_mock.return_value.image_id = 'fake_id'
+        download_mock.return_value.__iter__.return_value = iter(chunks)
+
+    def test_write(self, download_mock, write_mock, validate_mock,
+                   fix_gpt_mock):
+        self._set_content(download_mock,
+                          [self.data[:1024], self.data[1024:]])
+
+        def _write(uri, image_info, device, source_format, is_raw):
+            self.assertTrue(uri.startswith('nbd+unix:///?socket='))
+            with open(self.location, 'rb') as f:
+                self.assertEqual(self.header, f.read(512))
+
+        write_mock.side_effect = _write
+        self.assertEqual({}, standby._download_and_write_image(
+            self.image_info, '/dev/foo'))
+        write_mock.assert_called_once_with(mock.ANY, self.image_info,
+                                           '/dev/foo', source_format='qcow2',
+                                           is_raw=False)
+        download_mock.return_value.verify_image.assert_called_once_with(
+            self.location)
+        validate_mock.assert_called_once_with(self.location, 'qcow2',
+                                              checksum='fake-checksum')
+        fix_gpt_mock.assert_called_once_with('/dev/foo', node_uuid=None)
+        with open(self.location, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+
+    def test_unsupported(self, download_mock, write_mock, validate_mock,
+                         fix_gpt_mock):
+        self.image_info['disk_format'] = 'raw'
+        self.assertRaises(standby._PipelineUnavailable,
+                          standby._download_and_write_image,
+                          self.image_info, '/dev/foo')
+        self.image_info['disk_format'] = 'qcow2'
+        self.config(disable_deep_image_inspection=True)
+        self.assertRaises(standby._PipelineUnavailable,
+                          standby._download_and_write_image,
+                          self.image_info, '/dev/foo')
+        download_mock.assert_not_called()
+
+    def test_no_content_length(self, download_mock, write_mock,
+                               validate_mock, fix_gpt_mock):
+        download_mock.return_value.content_length = None
+        self.assertRaises(standby._PipelineUnavailable,
+                          standby._download_and_write_image,
+                          self.image_info, '/dev/foo')
+        write_mock.assert_not_called()
+
+    def test_not_qcow2(self, download_mock, write_mock, validate_mock,
+                       fix_gpt_mock):
+        self.data = b'\0' * len(self.data)
+        self._set_content(download_mock, [self.data])
+        self.assertRaises(standby._PipelineUnavailable,
+                          standby._download_and_write_image,
+                          self.image_info, '/dev/foo')
+        write_mock.assert_not_called()
+
+    def test_unsafe_header(self, download_mock, write_mock, validate_mock,
+                           fix_gpt_mock):
+        self.data = struct.pack('>4sIQIIQ', b'QFI\xfb', 3, 0x200, 5, 16,
+                                units.Gi).ljust(len(self.data), b'\0')
+        self._set_content(download_mock, [self.data])
+        self.assertRaises(errors.InvalidImage,
+                          standby._download_and_write_image,
+                          self.image_info, '/dev/foo')
+        write_mock.assert_not_called()
+
+    def test_download_failure(self, download_mock, write_mock,
+                              validate_mock, fix_gpt_mock):
+        error = errors.ImageDownloadError('fake_id', 'connection reset')
+
+        def _chunks():
+            yield self.data[:1024]
+            raise error
+
+        self._set_content(download_mock, _chunks())
+        write_mock.side_effect = errors.ImageWriteError('/dev/foo', 1, '',
+                                                        'read error')
+        self.assertRaisesRegex(errors.ImageDownloadError, 'connection reset',
+                               standby._download_and_write_image,
+                               self.image_info, '/dev/foo')
+        download_mock.return_value.verify_image.assert_not_called()
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.destroy_disk_metadata',
+                autospec=True)
+    def test_checksum_failure_destroys_image(self, destroy_mock,
+                                             execute_mock, download_mock,
+                                             write_mock, validate_mock,
+                                             fix_gpt_mock):
+        self._set_content(download_mock, [self.data])
+        download_mock.return_value.verify_image.side_effect = (
+            errors.ImageChecksumError('fake_id', self.location, 'a', 'b'))
+        self.assertRaises(errors.ImageChecksumError,
+                          standby._download_and_write_image,
+                          self.image_info, '/dev/foo')
+        write_mock.assert_called_once_with(mock.ANY, self.image_info,
+                                           '/dev/foo', source_format='qcow2',
+                                           is_raw=False)
+        destroy_mock.assert_called_once_with('/dev/foo', '')
+        execute_mock.assert_called_once_with('blkdiscard', '/dev/foo')
+        validate_mock.assert_not_called()
+        fix_gpt_mock.assert_not_called()
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    @mock.patch('ironic_python_agent.disk_utils.destroy_disk_metadata',
+                autospec=True)
+    def test_invalid_image_destroys_image(self, destroy_mock, execute_mock,
+                                          download_mock, write_mock,
+                                          validate_mock, fix_gpt_mock):
+        self._set_content(download_mock, [self.data])
+        validate_mock.side_effect = errors.InvalidImage(details='backing')
+        execute_mock.side_effect = processutils.ProcessExecutionError(
+            stderr='Operation not supported')
+        self.assertRaises(errors.InvalidImage,
+                          standby._download_and_write_image,
+                          self.image_info, '/dev/foo')
+        destroy_mock.assert_called_once_with('/dev/foo', '')
+        execute_mock.assert_called_once_with('blkdiscard', '/dev/foo')
+
+
+class TestChecksumFile(base.IronicAgentTest):
+
+    sha256 = 'a' * 64
+    sha512 = 'b' * 128
+
+    def test_find(self):
+        checksums = standby._ChecksumFile("""
+# comment  image.img
+%(sha256)s  image.img
+%(sha256)s *binary.img
+SHA512 (centos.qcow2) = %(sha512)s
+%(sha512)s  image.img
+not-a-checksum  other.img
+""" % {'sha256': self.sha256, 'sha512': self.sha512})
+        self.assertEqual(self.sha256, checksums.find('image.img'))
+        self.assertEqual(self.sha256, checksums.find('binary.img'))
+        self.assertEqual(self.sha512, checksums.find('centos.qcow2'))
+        self.assertIsNone(checksums.find('other.img'))
+        self.assertIsNone(checksums.find('missing.img'))
+
+    def test_find_regex_fallback(self):
+        checksums = standby._ChecksumFile('%s  image v2.img\n'
+                                          % self.sha256)
+        self.assertEqual(self.sha256, checksums.find('image v2.img'))
+
+
+@mock.patch('ironic_python_agent.utils.get_requests_session', autospec=True)
+class TestFetchChecksum(base.IronicAgentTest):
+
+    url = 'http://example.com/SHA256SUMS'
+    checksum = 'a' * 64
+
+    def setUp(self):
+        super(TestFetchChecksum, self).setUp()
+        self.image_info = _build_fake_image_info(
+            'http://example.com/image.img')
+
+    def _response(self, status_code=200, headers=None):
+        response = mock.Mock(status_code=status_code, headers=headers or {})
+        response.text = '%s  image.img\n%s  other.img\n' % (
+            self.checksum, 'b' * 64)
+        return response
+
+    def test_conditional(self, session_mock):
+        first = self._response(headers={'ETag': '"v1"',
+                                        'Last-Modified': 'yesterday'})
+        second = self._response(status_code=304)
+        session_mock.return_value.get.side_effect = [first, second]
+
+        for _ in range(2):
+            self.assertEqual(self.checksum, standby._fetch_checksum(
+                self.url, self.image_info))
+        session_mock.return_value.get.assert_has_calls([
+            mock.call(self.url, stream=True, proxies={}, timeout=60),
+            mock.call(self.url, stream=True, proxies={}, timeout=60,
+                      headers={'If-None-Match': '"v1"',
+                               'If-Modified-Since': 'yesterday'}),
+        ])
+
+    def test_modified(self, session_mock):
+        first = self._response(headers={'ETag': '"v1"'})
+        second = self._response(headers={'ETag': '"v2"'})
+        second.text = '%s  image.img\n' % ('c' * 64)
+        session_mock.return_value.get.side_effect = [first, second]
+
+        self.assertEqual(self.checksum, standby._fetch_checksum(
+            self.url, self.image_info))
+        self.assertEqual('c' * 64, standby._fetch_checksum(
+            self.url, self.image_info))
+        self.assertEqual('"v2"', standby._CHECKSUM_FILES[self.url].etag)
+
+    def test_not_cached_without_validators(self, session_mock):
+        session_mock.return_value.get.side_effect = [self._response(),
+                                                     self._response()]
+        for _ in range(2):
+            self.assertEqual(self.checksum, standby._fetch_checksum(
+                self.url, self.image_info))
+        session_mock.return_value.get.assert_has_calls([
+            mock.call(self.url, stream=True, proxies={}, timeout=60),
+            mock.call(self.url, stream=True, proxies={}, timeout=60),
+        ])
+        self.assertEqual({}, standby._CHECKSUM_FILES)
+
+    def test_unexpected_not_modified(self, session_mock):
+        session_mock.return_value.get.return_value = self._response(
+            status_code=304)
+        self.assertRaises(errors.ImageDownloadFatalError,
+                          standby._fetch_checksum, self.url, self.image_info)
+
+
+@mock.patch.object(image_peers, 'CHUNK_SIZE', 4)
+@mock.patch('ironic_python_agent.utils.get_requests_session', autospec=True)
+class TestPeerImageDownload(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestPeerImageDownload, self).setUp()
+        self.config(image_peer_distribution=True)
+        self.data = b'0123456789'
+        self.image_info = _build_fake_image_info()
+        self.image_info['os_hash_value'] = hashlib.sha256(
+            self.data).hexdigest()
+        self.image_info['image_peers'] = ['http://peer1']
+        self.image_info['image_peers_secret'] = 'secret'
+        self.manifest = {
+            'size': 10, 'chunk_size': 4, 'digest': 'sha256',
+            'chunks': [hashlib.sha256(self.data[i:i + 4]).hexdigest()
+                       for i in (0, 4, 8)]}
+        self.peer_chunks = {0: b'0123', 2: b'89'}
+        self.origin_status = 206
+        self.requests = []
+        self.responses = []
+        self.secret_header = {image_peers.SECRET_HEADER: 'secret'}
+
+    def _get(self, url, **kwargs):
+        self.requests.append((url, kwargs.get('headers')))
+        response = mock.Mock()
+        self.responses.append(response)
+        response.status_code = 200
+        if url == 'http://peer1/v1/images/fake_id/manifest':
+            response.json.return_value = self.manifest
+        elif url.startswith('http://peer1/v1/images/fake_id/chunks/'):
+            chunk = self.peer_chunks.get(int(url.rsplit('/', 1)[1]))
+            response.content = chunk
+            if chunk is None:
+                response.status_code = 404
+        else:
+            self.assertEqual(self.image_info['urls'][0], url)
+            if kwargs.get('headers'):
+                response.status_code = self.origin_status
+                start, end = kwargs['headers']['Range'][6:].split('-')
+                response.content = self.data[int(start):int(end) + 1]
+        return response
+
+    def test_download(self, session_mock):
+        session_mock.return_value.get.side_effect = self._get
+        image_download = standby.ImageDownload(self.image_info)
+        self.assertEqual('10', str(image_download.content_length))
+
+        self.assertEqual([b'0123', b'4567', b'89'], list(image_download))
+        image_download.verify_image('/tmp/fake_id')
+        self.assertEqual(
+            [('http://peer1/v1/images/fake_id/manifest', self.secret_header),
+             ('http://peer1/v1/images/fake_id/chunks/0', self.secret_header),
+             ('http://peer1/v1/images/fake_id/chunks/1', self.secret_header),
+             ('http://example.org', {'Range': 'bytes=4-7'}),
+             # The peer failing to provide a chunk is not used anymore
+             ('http://example.org', {'Range': 'bytes=8-9'})],
+            self.requests)
+        self.assertEqual(10, image_download.chunk_digests.size)
+
+    def test_download_range_not_supported(self, session_mock):
+        session_mock.return_value.get.side_effect = self._get
+        self.origin_status = 200
+        image_download = standby.ImageDownload(self.image_info)
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'range requests are not supported',
+                               list, image_download)
+        self.assertIn('fake_id', image_peers._DISABLED_IMAGES)
+        # The full response of the origin is not read
+        self.responses[-1].close.assert_called_once_with()
+
+        # The next attempt does not use peers
+        self.requests = []
+        standby.ImageDownload(self.image_info)
+        self.assertEqual([('http://example.org', None)], self.requests)
+
+    def test_download_checksum_mismatch(self, session_mock):
+        session_mock.return_value.get.side_effect = self._get
+        self.image_info['os_hash_value'] = hashlib.sha256(b'x').hexdigest()
+        image_download = standby.ImageDownload(self.image_info)
+        list(image_download)
+        self.assertRaises(errors.ImageChecksumError,
+                          image_download.verify_image, '/tmp/fake_id')
+        self.assertIn('fake_id', image_peers._DISABLED_IMAGES)
+
+    @mock.patch.object(image_peers, 'share_image', autospec=True)
+    @mock.patch('builtins.open', autospec=True)
+    def test_download_image_shares(self, open_mock, share_mock,
+                                   session_mock):
+        del self.image_info['image_peers']
+        response = mock.Mock()
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'0123', b'456789']
+        session_mock.return_value.get.return_value = response
+
+        standby._download_image(self.image_info)
+
+        share_mock.assert_called_once_with(
+            'fake_id', standby._image_location(self.image_info),
+            self.image_info['os_hash_value'], mock.ANY, 'secret')
+        digests = share_mock.call_args[0][3]
+        self.assertEqual(self.manifest['chunks'],
+                         [digest.hex() for _, _, digest
+                          in digests.get_extents()])
+
+
 @mock.patch('hashlib.new', autospec=True)
 @mock.patch('ironic_python_agent.utils.get_requests_session', autospec=True)
 class TestImageDownload(base.IronicAgentTest):
@@ -1990,3 +1990,31 @@ NAME="md126" TYPE="raid0" FSTYPE=""
 NAME="sdb3" TYPE="part" FSTYPE="linux_raid_member"
 NAME="md125" TYPE="raid1" FSTYPE="vfat"
 """)
+
+LSBLK_FS_JSON_OUTPUT = ("""
+{
+   "blockdevices": [
+      {"name": "/dev/sda", "fstype": null,
+         "children": [
+            {"name": "/dev/sda1", "fstype": "vfat"},
+            {"name": "/dev/sda2", "fstype": "linux_raid_member",
+               "children": [
+                  {"name": "/dev/md0", "fstype": "ext4"}
+               ]
+            }
+         ]
+      },
+      {"name": "/dev/sdb", "fstype": null,
+         "children": [
+            {"name": "/dev/sdb2", "fstype": "linux_raid_member",
+               "children": [
+                  {"name": "/dev/md0", "fstype": "ext4"}
+               ]
+            }
+         ]
+      },
+      {"name": "/dev/sdc", "fstype": "xfs"},
+      {"name": "/dev/sr0", "fstype": "iso9660"}
+   ]
+}
+""")
@@ -16,6 +16,7 @@ import importlib.metadata
 import itertools
 import json
 import socket
+import threading
 import time
 from unittest import mock
 from unittest.mock import sentinel
@@ -75,22 +76,25 @@ class TestHeartbeater(ironic_agent_base.IronicAgentTest):
         self.heartbeater.api = mock.Mock()
         self.heartbeater.hardware = mock.create_autospec(
             hardware.HardwareManager)
-        self.heartbeater.stop_event = mock.Mock()
+        self.heartbeater.wakeup = mock.MagicMock()
 
+    @mock.patch.object(agent.metrics_utils, 'get_metrics_logger',
+                       autospec=True)
     @mock.patch('ironic_python_agent.agent._time', autospec=True)
     @mock.patch('random.uniform', autospec=True)
-    def test_heartbeat(self, mock_uniform, mock_time):
+    def test_heartbeat(self, mock_uniform, mock_time, mock_get_logger):
         clock = FakeClock()
         mock_time.side_effect = clock.get
-        self.heartbeater.stop_event.wait.side_effect = clock.wait
+        self.heartbeater.wakeup.wait.side_effect = clock.wait
+        mock_metrics = mock_get_logger.return_value
 
         heartbeat_mock = self.heartbeater.api.heartbeat
         self.mock_agent.heartbeat_timeout = 20
 
-        # First run right after start
+        # First run right after start, without waiting
         mock_uniform.return_value = 0.6
         self.assertTrue(self.heartbeater._run_next())
-        self.assertEqual(0, clock.last_wait)
+        self.heartbeater.wakeup.wait.assert_not_called()
         heartbeat_mock.assert_called_once_with(
             uuid=self.mock_agent.get_node_uuid.return_value,
             advertise_address=self.mock_agent.advertise_address,
@@ -99,60 +103,114 @@ class TestHeartbeater(ironic_agent_base.IronicAgentTest):
         heartbeat_mock.reset_mock()
         self.assertEqual(12, self.heartbeater.interval)  # 20*0.6
         self.assertEqual(0, self.heartbeater.previous_heartbeat)
+        mock_metrics.send_timer.assert_called_once_with(
+            'heartbeat.latency', 0)
+        mock_metrics.reset_mock()
 
-        # A few empty runs before reaching the next heartbeat
-        for ts in [5, 10]:
-            self.assertTrue(self.heartbeater._run_next())
-            self.assertEqual(5, clock.last_wait)
-            self.assertEqual(ts, clock.current)
-            heartbeat_mock.assert_not_called()
-            self.assertEqual(0, self.heartbeater.previous_heartbeat)
-
-        # Second run when the heartbeat is due
+        # Second run sleeps until the heartbeat is due
         mock_uniform.return_value = 0.4
         self.assertTrue(self.heartbeater._run_next())
-        self.assertEqual(2, clock.last_wait)  # 12-2*5
+        self.assertEqual(12, clock.last_wait)
         self.assertTrue(heartbeat_mock.called)
         heartbeat_mock.reset_mock()
         self.assertEqual(8, self.heartbeater.interval)  # 20*0.4
         self.assertEqual(12, self.heartbeater.previous_heartbeat)
 
-        # One empty run before reaching the next heartbeat
-        self.assertTrue(self.heartbeater._run_next())
-        self.assertEqual(5, clock.last_wait)
-        heartbeat_mock.assert_not_called()
-        self.assertEqual(12, self.heartbeater.previous_heartbeat)
-
         # Failed run resulting in a fast retry
         mock_uniform.return_value = 1.2
         heartbeat_mock.side_effect = Exception('uh oh!')
         self.assertTrue(self.heartbeater._run_next())
-        self.assertEqual(3, clock.last_wait)  # 8-5
+        self.assertEqual(8, clock.last_wait)
         self.assertTrue(heartbeat_mock.called)
         heartbeat_mock.reset_mock(side_effect=True)
         self.assertEqual(6, self.heartbeater.interval)  # 5*1.2
         self.assertEqual(20, self.heartbeater.previous_heartbeat)
+        mock_metrics.send_counter.assert_called_once_with(
+            'heartbeat.failures', 1)
 
-        # One empty run because 6>5
-        self.assertTrue(self.heartbeater._run_next())
-        self.assertEqual(5, clock.last_wait)
-        heartbeat_mock.assert_not_called()
-        self.assertEqual(20, self.heartbeater.previous_heartbeat)
-
-        # Retry after the remaining 1 second
+        # Retry after the interval
         mock_uniform.return_value = 0.5
         self.assertTrue(self.heartbeater._run_next())
-        self.assertEqual(1, clock.last_wait)
+        self.assertEqual(6, clock.last_wait)
         self.assertTrue(heartbeat_mock.called)
         heartbeat_mock.reset_mock()
         self.assertEqual(10, self.heartbeater.interval)  # 20*0.5
         self.assertEqual(26, self.heartbeater.previous_heartbeat)
 
-        # Stop on the next empty run
-        clock.wait_result = True
+        # A forced heartbeat is sent once the rate limit allows it
+        mock_metrics.reset_mock()
+        self.heartbeater.force_heartbeat()
+        self.heartbeater.wakeup.notify_all.assert_called_once_with()
+        self.assertTrue(self.heartbeater._run_next())
+        self.assertEqual(5, clock.last_wait)
+        self.assertTrue(heartbeat_mock.called)
+        heartbeat_mock.reset_mock()
+        self.assertFalse(self.heartbeater.heartbeat_forced)
+        self.assertIsNone(self.heartbeater.forced_at)
+        self.assertEqual(31, self.heartbeater.previous_heartbeat)
+        mock_metrics.send_timer.assert_has_calls([
+            mock.call('heartbeat.forced_delay', 5000),
+            mock.call('heartbeat.latency', 0),
+        ])
+
+        # Woken up early, the deadline is not reached yet
+        self.heartbeater.wakeup.wait.side_effect = lambda timeout: True
+        self.assertTrue(self.heartbeater._run_next())
+        self.assertEqual(31, clock.current)
+        heartbeat_mock.assert_not_called()
+
+        # Stop while waiting for the next heartbeat
+        def _stop(timeout):
+            self.heartbeater.stop_event.set()
+            return True
+
+        self.heartbeater.wakeup.wait.side_effect = _stop
         self.assertFalse(self.heartbeater._run_next())
         heartbeat_mock.assert_not_called()
-        self.assertEqual(26, self.heartbeater.previous_heartbeat)
+        self.assertEqual(31, self.heartbeater.previous_heartbeat)
+
+        # Do not wait at all once stopped
+        self.heartbeater.wakeup.wait.reset_mock()
+        self.assertFalse(self.heartbeater._run_next())
+        self.heartbeater.wakeup.wait.assert_not_called()
+
+    def test_force_heartbeat_during_heartbeat(self):
+        self.mock_agent.heartbeat_timeout = 20
+        self.heartbeater.api.heartbeat.side_effect = (
+            lambda **kwargs: self.heartbeater.force_heartbeat())
+        self.heartbeater.force_heartbeat()
+        self.heartbeater.do_heartbeat()
+        self.assertTrue(self.heartbeater.heartbeat_forced)
+        self.assertIsNotNone(self.heartbeater.forced_at)
+
+    def test_force_heartbeat_kept_on_failure(self):
+        self.heartbeater.api.heartbeat.side_effect = errors.HeartbeatError(
+            'boom')
+        self.heartbeater.force_heartbeat()
+        forced_at = self.heartbeater.forced_at
+        self.heartbeater.do_heartbeat()
+        self.assertTrue(self.heartbeater.heartbeat_forced)
+        self.assertEqual(forced_at, self.heartbeater.forced_at)
+
+    def test_force_heartbeat_wakes_up(self):
+        heartbeater = agent.IronicPythonAgentHeartbeater(self.mock_agent)
+        heartbeater.api = mock.Mock()
+        heartbeater.min_heartbeat_interval = 0
+        self.mock_agent.heartbeat_timeout = 300
+        sent = threading.Semaphore(0)
+        heartbeater.api.heartbeat.side_effect = (
+            lambda **kwargs: sent.release())
+
+        heartbeater.start()
+        try:
+            self.assertTrue(sent.acquire(timeout=10))
+            # The next scheduled heartbeat is at least 90 seconds away
+            heartbeater.force_heartbeat()
+            self.assertTrue(sent.acquire(timeout=10))
+        finally:
+            heartbeater.stop()
+        self.assertFalse(heartbeater.is_alive())
+        self.assertEqual(2, heartbeater.api.heartbeat.call_count)
 
     @mock.patch('ironic_python_agent.agent._time', autospec=True)
     def test__heartbeat_expected(self, mock_time):
@@ -191,7 +249,8 @@ class TestHeartbeater(ironic_agent_base.IronicAgentTest):
         self.assertFalse(self.heartbeater.is_alive())
         result = self.heartbeater.stop()
         self.assertIsNone(result)
-        self.assertTrue(self.heartbeater.stop_event.set.called)
+        self.assertTrue(self.heartbeater.stop_event.is_set())
+        self.heartbeater.wakeup.notify_all.assert_called_once_with()
 
     @mock.patch.object(agent.IronicPythonAgentHeartbeater, 'join',
                        autospec=True)
@@ -202,7 +261,7 @@ class TestHeartbeater(ironic_agent_base.IronicAgentTest):
                                autospec=True, return_value=True):
             self.heartbeater.stop()
             mock_join.assert_called_once_with(self.heartbeater)
-            self.assertTrue(self.heartbeater.stop_event.set.called)
+            self.assertTrue(self.heartbeater.stop_event.is_set())
 
 
 @mock.patch.object(hardware, '_md_scan_and_assemble', lambda: None)
@@ -906,6 +965,32 @@ class TestBaseAgent(ironic_agent_base.IronicAgentTest):
 
         self.assertEqualEncoded(expected_result, result)
 
+    def test_async_command_wait_until_done(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def _execute():
+            started.set()
+            release.wait()
+            return 'done'
+
+        result = base.AsyncCommandResult('foo_command', {}, _execute)
+        result.start()
+        started.wait()
+        self.assertFalse(result.wait_until_done(0.01))
+        self.assertEqual('RUNNING', result.command_status)
+
+        release.set()
+        self.assertTrue(result.wait_until_done(10))
+        self.assertEqual('SUCCEEDED', result.command_status)
+        # Already done
+        self.assertTrue(result.wait_until_done(0))
+        result.join()
+
+    def test_sync_command_wait_until_done(self):
+        result = base.SyncCommandResult('foo_command', {}, True, 'done')
+        self.assertTrue(result.wait_until_done(1))
+
     def test_get_node_uuid(self):
         self.agent.node = {'uuid': 'fake-node'}
         self.assertEqual('fake-node', self.agent.get_node_uuid())
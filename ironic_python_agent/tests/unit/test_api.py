@@ -14,6 +14,7 @@
 
 import ssl
 import tempfile
+import threading
 import time
 from unittest import mock
 
@@ -24,7 +25,9 @@ from werkzeug import wrappers
 from ironic_python_agent import agent
 from ironic_python_agent.api import app
 from ironic_python_agent.extensions import base
+from ironic_python_agent import image_peers
 from ironic_python_agent.tests.unit import base as ironic_agent_base
+from ironic_python_agent import utils
 
 
 PATH_PREFIX = '/v1'
@@ -127,6 +130,36 @@ class TestIronicAPI(ironic_agent_base.IronicAgentTest):
         data = response.json
         self.assertEqual('Client', data['faultcode'])
 
+    @mock.patch.object(image_peers, 'get_manifest', autospec=True)
+    def test_get_image_manifest(self, mock_manifest):
+        mock_manifest.return_value = {'size': 6, 'chunks': ['abc']}
+        response = self.get_json('/images/img/manifest?checksum=sum',
+                                 headers={'X-Image-Peers-Secret': 'secret'})
+        self.assertEqual({'size': 6, 'chunks': ['abc']}, response.json)
+        mock_manifest.assert_called_once_with('img', 'sum', 'secret')
+
+    @mock.patch.object(image_peers, 'get_manifest', autospec=True)
+    def test_get_image_manifest_not_shared(self, mock_manifest):
+        mock_manifest.return_value = None
+        response = self.get_json('/images/img/manifest', expect_errors=True)
+        self.assertEqual(404, response.status_code)
+        mock_manifest.assert_called_once_with('img', None, None)
+
+    @mock.patch.object(image_peers, 'open_chunk', autospec=True)
+    def test_get_image_chunk(self, mock_chunk):
+        mock_chunk.return_value = (6, iter([b'012', b'345']))
+        response = self.get_json('/images/img/chunks/2?checksum=sum',
+                                 headers={'X-Image-Peers-Secret': 'secret'})
+        self.assertEqual(b'012345', response.data)
+        self.assertEqual('6', response.headers['Content-Length'])
+        mock_chunk.assert_called_once_with('img', 'sum', 'secret', 2)
+
+    @mock.patch.object(image_peers, 'open_chunk', autospec=True)
+    def test_get_image_chunk_not_shared(self, mock_chunk):
+        mock_chunk.return_value = None
+        response = self.get_json('/images/img/chunks/2', expect_errors=True)
+        self.assertEqual(404, response.status_code)
+
     def test_get_agent_status(self):
         status = agent.IronicPythonAgentStatus(time.time(),
                                                'v72ac9')
@@ -140,6 +173,59 @@ class TestIronicAPI(ironic_agent_base.IronicAgentTest):
         self.assertEqual(status.started_at, data['started_at'])
         self.assertEqual(status.version, data['version'])
 
+    @mock.patch.object(utils, 'stream_system_logs', autospec=True)
+    def test_get_system_logs(self, mock_stream):
+        mock_stream.return_value = iter([b'chunk1', b'chunk2'])
+        response = self.get_json(
+            '/system_logs?journald_max_lines=100&consumer=conductor')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'chunk1chunk2', response.data)
+        self.assertEqual('application/gzip', response.content_type)
+        self.assertIn('system_logs.tar.gz',
+                      response.headers['Content-Disposition'])
+        self.assertNotIn('Content-Length', response.headers)
+        mock_stream.assert_called_once_with(journald_max_lines=100,
+                                            consumer='conductor')
+
+    @mock.patch.object(utils, 'stream_system_logs', autospec=True)
+    def test_get_system_logs_invalid_lines(self, mock_stream):
+        response = self.get_json('/system_logs?journald_max_lines=0',
+                                 expect_errors=True)
+        self.assertEqual(400, response.status_code)
+        mock_stream.assert_not_called()
+
+    def test_get_system_logs_invalid_consumer(self):
+        response = self.get_json('/system_logs?consumer=../etc',
+                                 expect_errors=True)
+        self.assertEqual(400, response.status_code)
+        self.assertIn('Invalid journal consumer',
+                      response.json['faultstring'])
+
+    def test_get_system_logs_with_token_invalid(self):
+        self.mock_agent.validate_agent_token.return_value = False
+        response = self.get_json('/system_logs?agent_token=invalid',
+                                 expect_errors=True)
+        self.assertEqual(401, response.status_code)
+
+    def test_get_agent_status_not_modified(self):
+        status = agent.IronicPythonAgentStatus(time.time(), 'v72ac9')
+        self.mock_agent.get_status.return_value = status
+
+        response = self.get_json('/status')
+        etag = response.headers['ETag']
+        self.assertTrue(etag)
+
+        response = self.get_json('/status',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.data)
+        self.assertEqual(etag, response.headers['ETag'])
+
+        response = self.get_json('/status',
+                                 headers={'If-None-Match': '"other"'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('v72ac9', response.json['version'])
+
     def test_execute_agent_command_success_no_wait(self):
         command = {
             'name': 'do_things',
@@ -262,6 +348,75 @@ class TestIronicAPI(ironic_agent_base.IronicAgentTest):
             ],
         }, response.json)
 
+    def _list_results(self):
+        results = [base.SyncCommandResult('cmd%d' % i, {}, True,
+                                          {'value': i})
+                   for i in range(3)]
+        self.mock_agent.list_command_results.return_value = results
+        return results
+
+    def test_list_command_results_fields(self):
+        results = self._list_results()
+        response = self.get_json('/commands?fields=id,command_status')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'commands': [
+            {'id': r.id, 'command_status': 'SUCCEEDED'} for r in results
+        ]}, response.json)
+
+    def test_list_command_results_invalid_fields(self):
+        self._list_results()
+        response = self.get_json('/commands?fields=id,command_params',
+                                 expect_errors=True)
+        self.assertEqual(400, response.status_code)
+        self.assertIn('command_params', response.json['faultstring'])
+
+    def test_list_command_results_paging(self):
+        results = self._list_results()
+        response = self.get_json('/commands?limit=2&fields=id')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'id': results[0].id}, {'id': results[1].id}],
+                         response.json['commands'])
+        self.assertEqual(
+            'http://localhost/v1/commands/?limit=2&fields=id&marker=%s'
+            % results[1].id, response.json['next'])
+
+        response = self.get_json('/commands?limit=2&fields=id&marker=%s'
+                                 % results[1].id)
+        self.assertEqual({'commands': [{'id': results[2].id}]},
+                         response.json)
+
+    def test_list_command_results_invalid_paging(self):
+        self._list_results()
+        for query in ('limit=0', 'limit=x', 'marker=unknown'):
+            response = self.get_json('/commands?%s' % query,
+                                     expect_errors=True)
+            self.assertEqual(400, response.status_code, query)
+
+    def test_list_command_results_not_modified(self):
+        self._list_results()
+        self.mock_agent.get_command_results_version.return_value = 'v1'
+        response = self.get_json('/commands?fields=id')
+        etag = response.headers['ETag']
+
+        self.mock_agent.list_command_results.reset_mock()
+        response = self.get_json('/commands?fields=id',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.mock_agent.list_command_results.assert_not_called()
+
+        # Other arguments give other representations
+        response = self.get_json('/commands?fields=command_name',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers['ETag'])
+
+        self.mock_agent.get_command_results_version.return_value = 'v2'
+        response = self.get_json('/commands?fields=id',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, len(response.json['commands']))
+        self.assertNotEqual(etag, response.headers['ETag'])
+
     def test_list_commands_with_token(self):
         agent_token = str('0123456789' * 10)
         cmd_result = base.SyncCommandResult('do_things',
@@ -302,6 +457,119 @@ class TestIronicAPI(ironic_agent_base.IronicAgentTest):
         data = response.json
         self.assertEqual(serialized_cmd_result, data)
 
+    def _mock_async_result(self):
+        cmd_result = mock.Mock(spec=base.AsyncCommandResult)
+        cmd_result.id = 'abc123'
+        cmd_result.version = 0
+        return cmd_result
+
+    def test_get_command_result_wait_seconds(self):
+        cmd_result = self._mock_async_result()
+        cmd_result.serialize.return_value = {'command_status': 'RUNNING'}
+        cmd_result.wait_until_done.return_value = False
+        self.mock_agent.get_command_result.return_value = cmd_result
+
+        response = self.get_json('/commands/abc123?wait=2.5')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'command_status': 'RUNNING'}, response.json)
+        cmd_result.wait_until_done.assert_called_once_with(2.5)
+        cmd_result.join.assert_not_called()
+
+    def test_get_command_result_wait_capped(self):
+        self.config(max_command_wait=30)
+        cmd_result = self._mock_async_result()
+        cmd_result.serialize.return_value = {}
+        self.mock_agent.get_command_result.return_value = cmd_result
+
+        self.get_json('/commands/abc123?wait=3600')
+        cmd_result.wait_until_done.assert_called_once_with(30)
+
+    def test_get_command_result_wait_too_many(self):
+        cmd_result = self._mock_async_result()
+        cmd_result.serialize.return_value = {'command_status': 'RUNNING'}
+        self.mock_agent.get_command_result.return_value = cmd_result
+        long_polls = self.app._long_polls
+        # Half of the default 32 threads may wait
+        for _ in range(16):
+            self.assertTrue(long_polls.acquire(blocking=False))
+
+        response = self.get_json('/commands/abc123?wait=30')
+        self.assertEqual({'command_status': 'RUNNING'}, response.json)
+        cmd_result.wait_until_done.assert_not_called()
+
+        long_polls.release()
+        self.get_json('/commands/abc123?wait=30')
+        cmd_result.wait_until_done.assert_called_once_with(30)
+        # The slot is released after waiting
+        self.assertTrue(long_polls.acquire(blocking=False))
+
+    def test_get_command_result_wait_true(self):
+        cmd_result = self._mock_async_result()
+        cmd_result.serialize.return_value = {}
+        self.mock_agent.get_command_result.return_value = cmd_result
+
+        self.get_json('/commands/abc123?wait=true')
+        cmd_result.join.assert_called_once_with()
+        cmd_result.wait_until_done.assert_not_called()
+
+    def test_get_command_result_no_wait(self):
+        cmd_result = self._mock_async_result()
+        cmd_result.serialize.return_value = {}
+        self.mock_agent.get_command_result.return_value = cmd_result
+
+        for wait in ('false', '0'):
+            self.get_json('/commands/abc123?wait=%s' % wait)
+        cmd_result.join.assert_not_called()
+        cmd_result.wait_until_done.assert_not_called()
+
+    def test_get_command_result_wait_invalid(self):
+        for wait in ('-1', 'inf', 'nan'):
+            response = self.get_json('/commands/abc123?wait=%s' % wait,
+                                     expect_errors=True)
+            self.assertEqual(400, response.status_code)
+
+    def test_get_command_result_long_poll(self):
+        release = threading.Event()
+
+        def _execute():
+            release.wait()
+            return 'done'
+
+        cmd_result = base.AsyncCommandResult('do_things', {}, _execute)
+        cmd_result.start()
+        self.addCleanup(release.set)
+        self.mock_agent.get_command_result.return_value = cmd_result
+
+        response = self.get_json('/commands/abc123?wait=0.01')
+        self.assertEqual('RUNNING', response.json['command_status'])
+
+        threading.Timer(0.1, release.set).start()
+        start = time.monotonic()
+        response = self.get_json('/commands/abc123?wait=10')
+        self.assertEqual('SUCCEEDED', response.json['command_status'])
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_get_command_result_not_modified(self):
+        release = threading.Event()
+        cmd_result = base.AsyncCommandResult('do_things', {}, release.wait)
+        cmd_result.start()
+        self.addCleanup(release.set)
+        self.mock_agent.get_command_result.return_value = cmd_result
+
+        response = self.get_json('/commands/abc123')
+        etag = response.headers['ETag']
+        # The token and the wait do not change the result
+        response = self.get_json('/commands/abc123?wait=0.01&agent_token=x',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+
+        release.set()
+        response = self.get_json('/commands/abc123?wait=true',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('SUCCEEDED', response.json['command_status'])
+        self.assertNotEqual(etag, response.headers['ETag'])
+
     def test_get_command_with_token(self):
         agent_token = str('0123456789' * 10)
         cmd_result = base.SyncCommandResult('do_things',
@@ -516,6 +784,9 @@ class TestApplicationStart(ironic_agent_base.IronicAgentTest):
 
         # Verify server was started without SSL adapter
         self.assertIsNotNone(self.app.server)
+        mock_server_cls.assert_called_once_with(
+            bind_addr=('0.0.0.0', 9999), wsgi_app=mock.ANY,
+            server_name='ironic-python-agent', numthreads=32)
         # The mock server won't have ssl_adapter attribute set
         # since we don't assign it in the non-TLS path
         mock_server.prepare.assert_called_once()
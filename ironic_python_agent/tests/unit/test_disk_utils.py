@@ -13,9 +13,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
+import fcntl
 import json
 import os
 import stat
+import struct
+import tempfile
+import time
 from unittest import mock
 
 from oslo_concurrency import processutils
@@ -226,9 +231,11 @@ class MakePartitionsTestCase(base.IronicAgentTest):
         fuser_call = mock.call(*fuser_cmd, check_exit_code=[0, 1])
 
         sync_calls = [mock.call('sync'),
-                      mock.call('udevadm', 'settle'),
+                      mock.call('udevadm', 'trigger', '--settle',
+                                '--action=change', self.dev),
                       mock.call('partprobe', self.dev, attempts=10),
-                      mock.call('udevadm', 'settle'),
+                      mock.call('udevadm', 'trigger', '--settle',
+                                '--action=change', self.dev),
                       mock.call('sgdisk', '-v', self.dev)]
 
         mock_exc.assert_has_calls([parted_call, fuser_call] + sync_calls)
@@ -345,6 +352,7 @@ class DestroyMetaDataTestCase(base.IronicAgentTest):
 
     def setUp(self):
         super(DestroyMetaDataTestCase, self).setUp()
+        self.config(native_metadata_wipe=False, group='disk_utils')
         self.dev = 'fake-dev'
         self.node_uuid = "12345678-1234-1234-1234-1234567890abcxyz"
 
@@ -504,6 +512,194 @@ class DestroyMetaDataTestCase(base.IronicAgentTest):
         mock_exec.assert_has_calls(expected_calls)
 
 
+class GetScratchRegionTestCase(base.IronicAgentTest):
+
+    def test_end_of_device(self):
+        self.assertEqual((8 * units.Gi - 3 * units.Mi, 2 * units.Mi),
+                         disk_utils.get_scratch_region(8 * units.Gi,
+                                                       units.Mi + 1))
+
+    def test_odd_device_size(self):
+        self.assertEqual((8 * units.Gi - 2 * units.Mi, units.Mi),
+                         disk_utils.get_scratch_region(8 * units.Gi + 4095,
+                                                       units.Mi))
+
+    def test_skips_btrfs_mirror(self):
+        self.assertEqual((206 * units.Gi, 50 * units.Gi),
+                         disk_utils.get_scratch_region(300 * units.Gi,
+                                                       50 * units.Gi))
+
+    def test_after_first_mib(self):
+        self.assertEqual((units.Mi, 38 * units.Mi),
+                         disk_utils.get_scratch_region(40 * units.Mi,
+                                                       38 * units.Mi))
+
+    def test_too_small(self):
+        self.assertIsNone(disk_utils.get_scratch_region(40 * units.Mi,
+                                                        39 * units.Mi))
+        self.assertIsNone(disk_utils.get_scratch_region(units.Mi, 4096))
+
+
+@mock.patch.object(disk_utils, 'wait_for_disk_to_become_available',
+                   autospec=True)
+@mock.patch.object(utils, 'execute', autospec=True)
+class NativeDestroyMetaDataTestCase(base.IronicAgentTest):
+
+    def setUp(self):
+        super(NativeDestroyMetaDataTestCase, self).setUp()
+        self.node_uuid = "12345678-1234-1234-1234-1234567890abcxyz"
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        tmp.close()
+        self.addCleanup(os.unlink, tmp.name)
+        self.dev = tmp.name
+
+    def _create(self, size, data):
+        with open(self.dev, 'wb') as f:
+            f.truncate(size)
+            for offset, value in data.items():
+                f.seek(offset)
+                f.write(value)
+
+    def _read(self, offset, length):
+        with open(self.dev, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def test_destroy(self, mock_exec, mock_wait):
+        size = 100 * units.Mi
+        self._create(size, {
+            0x1fe: b'\x55\xaa',  # MBR
+            512: b'EFI PART',  # Primary GPT
+            1080: b'\x53\xef',  # ext4
+            65536 + 64: b'_BHRfS_M',  # Btrfs
+            64 * units.Mi + 64: b'_BHRfS_M',  # Btrfs mirror
+            size - 512: b'EFI PART',  # Backup GPT
+            size - 64 * units.Ki: b'\xfc\x4e\x2b\xa9',  # MD RAID 0.90
+            10 * units.Mi: b'data',
+        })
+        mock_exec.return_value = ('', '')
+
+        disk_utils.destroy_disk_metadata(self.dev, self.node_uuid)
+
+        self.assertEqual(b'\0' * units.Mi, self._read(0, units.Mi))
+        self.assertEqual(b'\0' * units.Mi,
+                         self._read(size - units.Mi, units.Mi))
+        self.assertEqual(b'\0' * 4096, self._read(64 * units.Mi, 4096))
+        self.assertEqual(b'data', self._read(10 * units.Mi, 4))
+        mock_exec.assert_called_once_with(
+            'wipefs', '--noheadings', '--output', 'OFFSET,TYPE', self.dev,
+            use_standard_locale=True)
+        mock_wait.assert_called_once_with(self.dev)
+
+    @mock.patch.object(disk_utils, '_reread_partition_table', autospec=True)
+    def test_destroy_rereads_partitions(self, mock_reread, mock_exec,
+                                        mock_wait):
+        self._create(10 * units.Mi, {0x1fe: b'\x55\xaa'})
+        mock_exec.return_value = ('', '')
+
+        disk_utils.destroy_disk_metadata(self.dev, self.node_uuid)
+
+        mock_reread.assert_called_once_with(self.dev)
+
+    def test_destroy_small_odd_size(self, mock_exec, mock_wait):
+        size = units.Mi + 1234
+        self._create(size, {0: b'\xff' * size})
+        mock_exec.return_value = ('', '')
+
+        disk_utils.destroy_disk_metadata(self.dev, self.node_uuid)
+
+        self.assertEqual(b'\0' * size, self._read(0, size))
+        self.assertEqual(size, os.path.getsize(self.dev))
+
+    def test_destroy_remaining_signatures(self, mock_exec, mock_wait):
+        self._create(10 * units.Mi, {})
+        mock_exec.side_effect = [('0x7fe000 zfs_member', ''), ('', '')]
+
+        disk_utils.destroy_disk_metadata(self.dev, self.node_uuid)
+
+        mock_exec.assert_has_calls([
+            mock.call('wipefs', '--noheadings', '--output', 'OFFSET,TYPE',
+                      self.dev, use_standard_locale=True),
+            mock.call('wipefs', '--force', '--all', self.dev,
+                      use_standard_locale=True),
+        ])
+
+    @mock.patch.object(disk_utils, '_destroy_disk_metadata_with_tools',
+                       autospec=True)
+    def test_destroy_fallback(self, mock_tools, mock_exec, mock_wait):
+        disk_utils.destroy_disk_metadata('/dev/does-not-exist',
+                                         self.node_uuid)
+        mock_tools.assert_called_once_with('/dev/does-not-exist')
+        mock_exec.assert_not_called()
+        mock_wait.assert_called_once_with('/dev/does-not-exist')
+
+    def test_get_metadata_regions(self, mock_exec, mock_wait):
+        self.assertEqual([(0, 4096)],
+                         disk_utils._get_metadata_regions(4096))
+        self.assertEqual(
+            [(0, units.Mi), (299 * units.Mi, units.Mi + 512),
+             (64 * units.Mi, 4096)],
+            disk_utils._get_metadata_regions(300 * units.Mi + 512))
+
+
+@mock.patch.object(disk_utils, 'partprobe', autospec=True)
+@mock.patch.object(fcntl, 'ioctl', autospec=True)
+@mock.patch.object(os, 'close', autospec=True)
+@mock.patch.object(os, 'open', autospec=True, return_value=42)
+@mock.patch.object(os, 'stat', autospec=True)
+class RereadPartitionTableTestCase(base.IronicAgentTest):
+
+    def test_reread(self, mock_stat, mock_open, mock_close, mock_ioctl,
+                    mock_partprobe):
+        mock_stat.return_value.st_mode = stat.S_IFBLK
+
+        disk_utils._reread_partition_table('/dev/sda')
+
+        mock_ioctl.assert_called_once_with(42, disk_utils._BLKRRPART)
+        mock_close.assert_called_once_with(42)
+        mock_partprobe.assert_not_called()
+
+    def test_busy(self, mock_stat, mock_open, mock_close, mock_ioctl,
+                  mock_partprobe):
+        mock_stat.return_value.st_mode = stat.S_IFBLK
+        mock_ioctl.side_effect = OSError(errno.EBUSY, 'busy')
+
+        disk_utils._reread_partition_table('/dev/sda')
+
+        mock_ioctl.assert_called_once_with(42, disk_utils._BLKRRPART)
+        mock_close.assert_called_once_with(42)
+        mock_partprobe.assert_called_once_with('/dev/sda')
+
+    def test_not_partitionable(self, mock_stat, mock_open, mock_close,
+                               mock_ioctl, mock_partprobe):
+        mock_stat.return_value.st_mode = stat.S_IFBLK
+        mock_ioctl.side_effect = OSError(errno.EINVAL, 'invalid')
+
+        disk_utils._reread_partition_table('/dev/loop0')
+
+        mock_close.assert_called_once_with(42)
+        mock_partprobe.assert_not_called()
+
+    def test_fails(self, mock_stat, mock_open, mock_close, mock_ioctl,
+                   mock_partprobe):
+        mock_stat.return_value.st_mode = stat.S_IFBLK
+        mock_ioctl.side_effect = OSError(errno.EIO, 'I/O error')
+
+        self.assertRaises(OSError, disk_utils._reread_partition_table,
+                          '/dev/sda')
+        mock_close.assert_called_once_with(42)
+        mock_partprobe.assert_not_called()
+
+    def test_regular_file(self, mock_stat, mock_open, mock_close, mock_ioctl,
+                          mock_partprobe):
+        mock_stat.return_value.st_mode = stat.S_IFREG
+
+        disk_utils._reread_partition_table('/tmp/image')
+
+        mock_open.assert_not_called()
+        mock_ioctl.assert_not_called()
+
+
 @mock.patch.object(utils, 'execute', autospec=True)
 class GetDeviceByteSizeTestCase(base.IronicAgentTest):
 
@@ -541,6 +737,220 @@ class PopulateImageTestCase(base.IronicAgentTest):
                                         source_format=source_format)
         self.assertFalse(mock_dd.called)
 
+    @mock.patch.object(disk_utils, 'get_write_tuning', autospec=True)
+    def test_populate_qcow2_image_tuned(self, mock_tuning, mock_cg, mock_dd):
+        mock_tuning.return_value = {'block_size': units.Mi, 'coroutines': 16,
+                                    'out_of_order': False,
+                                    'source': 'sysfs'}
+        disk_utils.populate_image('src', 'dst', source_format='qcow2',
+                                  out_format='host_device',
+                                  out_of_order=True)
+        mock_cg.assert_called_once_with('src', 'dst',
+                                        out_format='host_device',
+                                        sparse_size='0',
+                                        source_format='qcow2',
+                                        coroutines=16,
+                                        out_of_order=False)
+        mock_tuning.assert_called_once_with('dst')
+
+
+class WriteTuningTestCase(base.IronicAgentTest):
+
+    def _limits(self, **kwargs):
+        limits = {'optimal_io_size': 0, 'minimum_io_size': 512,
+                  'logical_block_size': 512, 'max_sectors_kb': 1280,
+                  'nr_requests': 1023, 'rotational': 0}
+        limits.update(kwargs)
+        return limits
+
+    def test_tune_nvme(self):
+        self.assertEqual({'block_size': 10 * units.Mi, 'coroutines': 16,
+                          'out_of_order': True, 'source': 'sysfs'},
+                         disk_utils._tune_from_limits(self._limits()))
+
+    def test_tune_ssd(self):
+        tuning = disk_utils._tune_from_limits(
+            self._limits(nr_requests=32, max_sectors_kb=512))
+        self.assertEqual({'block_size': 2 * units.Mi, 'coroutines': 8,
+                          'out_of_order': True, 'source': 'sysfs'}, tuning)
+
+    def test_tune_hdd(self):
+        tuning = disk_utils._tune_from_limits(
+            self._limits(nr_requests=64, rotational=1,
+                         minimum_io_size=4096, logical_block_size=4096))
+        self.assertEqual({'block_size': 1280 * units.Ki, 'coroutines': 8,
+                          'out_of_order': False, 'source': 'sysfs'}, tuning)
+
+    def test_tune_raid(self):
+        # 3 data disks with a 512 KiB chunk size
+        tuning = disk_utils._tune_from_limits(
+            self._limits(optimal_io_size=1536 * units.Ki,
+                         minimum_io_size=512 * units.Ki, rotational=1))
+        self.assertEqual(1536 * units.Ki, tuning['block_size'])
+
+    def test_tune_unknown_limits(self):
+        tuning = disk_utils._tune_from_limits(
+            dict.fromkeys(disk_utils._QUEUE_LIMITS, 0))
+        self.assertEqual({'block_size': units.Mi, 'coroutines': 8,
+                          'out_of_order': True, 'source': 'sysfs'}, tuning)
+
+    def test_align_block_size(self):
+        limits = self._limits()
+        self.assertEqual(128 * units.Ki,
+                         disk_utils._align_block_size(1, limits))
+        self.assertEqual(64 * units.Mi,
+                         disk_utils._align_block_size(units.Gi, limits))
+        self.assertEqual(
+            3 * units.Mi,
+            disk_utils._align_block_size(
+                2 * units.Mi, self._limits(optimal_io_size=3 * units.Mi)))
+
+    @mock.patch.object(os, 'stat', autospec=True)
+    @mock.patch.object(os.path, 'realpath', autospec=True)
+    @mock.patch.object(os.path, 'exists', autospec=True)
+    def test_read_queue_limits_partition(self, mock_exists, mock_realpath,
+                                         mock_stat):
+        mock_stat.return_value.st_mode = stat.S_IFBLK
+        mock_stat.return_value.st_rdev = os.makedev(259, 1)
+        mock_realpath.return_value = '/sys/devices/nvme0n1/nvme0n1p1'
+        mock_exists.return_value = True
+        files = {'/sys/devices/nvme0n1/queue/max_sectors_kb': '128\n',
+                 '/sys/devices/nvme0n1/queue/nr_requests': '1023\n',
+                 '/sys/devices/nvme0n1/queue/rotational': 'invalid\n'}
+
+        def fake_open(path, *args):
+            if path not in files:
+                raise FileNotFoundError(path)
+            return mock.mock_open(read_data=files[path])()
+
+        with mock.patch('builtins.open', fake_open):
+            limits = disk_utils._read_queue_limits('/dev/nvme0n1p1')
+        self.assertEqual({'optimal_io_size': 0, 'minimum_io_size': 0,
+                          'logical_block_size': 0, 'max_sectors_kb': 128,
+                          'nr_requests': 1023, 'rotational': 0}, limits)
+        mock_realpath.assert_called_once_with('/sys/dev/block/259:1')
+        mock_exists.assert_called_once_with(
+            '/sys/devices/nvme0n1/nvme0n1p1/partition')
+
+    def test_read_queue_limits_not_block_device(self):
+        self.assertIsNone(disk_utils._read_queue_limits('/dev/null'))
+        self.assertIsNone(disk_utils._read_queue_limits('/nonexistent'))
+
+    @mock.patch.object(disk_utils, '_read_queue_limits', autospec=True)
+    def test_get_write_tuning_disabled(self, mock_limits):
+        self.assertIsNone(disk_utils.get_write_tuning('/dev/sda'))
+        mock_limits.assert_not_called()
+
+    @mock.patch.object(disk_utils, '_calibrate_block_size', autospec=True)
+    @mock.patch.object(disk_utils, '_read_queue_limits', autospec=True)
+    def test_get_write_tuning_sysfs(self, mock_limits, mock_calibrate):
+        self.config(write_tuning='sysfs', group='disk_utils')
+        mock_limits.return_value = self._limits()
+        self.assertEqual(disk_utils._tune_from_limits(self._limits()),
+                         disk_utils.get_write_tuning('/dev/sda'))
+        mock_limits.assert_called_once_with('/dev/sda')
+        mock_calibrate.assert_not_called()
+
+    @mock.patch.object(disk_utils, '_read_queue_limits', autospec=True)
+    def test_get_write_tuning_not_block_device(self, mock_limits):
+        self.config(write_tuning='calibrate', group='disk_utils')
+        mock_limits.return_value = None
+        self.assertIsNone(disk_utils.get_write_tuning('/tmp/file'))
+
+    @mock.patch.object(disk_utils, '_calibrate_block_size', autospec=True)
+    @mock.patch.object(disk_utils, '_read_queue_limits', autospec=True)
+    def test_get_write_tuning_calibrate(self, mock_limits, mock_calibrate):
+        self.config(write_tuning='calibrate', write_calibration_size=8,
+                    group='disk_utils')
+        mock_limits.return_value = self._limits(nr_requests=8,
+                                                max_sectors_kb=1024)
+        mock_calibrate.return_value = (4 * units.Mi, 1e9)
+        for _ in range(2):
+            self.assertEqual({'block_size': 4 * units.Mi, 'coroutines': 8,
+                              'out_of_order': True, 'source': 'calibration'},
+                             disk_utils.get_write_tuning('/dev/sda',
+                                                         size=units.Gi))
+        # The device is only calibrated once
+        mock_calibrate.assert_called_once_with(
+            '/dev/sda', [256 * units.Ki, units.Mi, 4 * units.Mi],
+            8 * units.Mi)
+
+    @mock.patch.object(disk_utils, '_calibrate_block_size', autospec=True)
+    @mock.patch.object(disk_utils, '_read_queue_limits', autospec=True)
+    def test_get_write_tuning_calibrate_small_write(self, mock_limits,
+                                                    mock_calibrate):
+        self.config(write_tuning='calibrate', write_calibration_size=64,
+                    write_calibration_threshold=1, group='disk_utils')
+        mock_limits.return_value = self._limits()
+        for size in (None, 4 * units.Mi, 63 * units.Mi):
+            tuning = disk_utils.get_write_tuning('/dev/sda', size=size)
+            self.assertEqual('sysfs', tuning['source'])
+        self.config(write_calibration_size=1, group='disk_utils')
+        # The largest block size tried is 40 MiB
+        tuning = disk_utils.get_write_tuning('/dev/sda', size=32 * units.Mi)
+        self.assertEqual('sysfs', tuning['source'])
+        mock_calibrate.assert_not_called()
+
+    @mock.patch.object(disk_utils, '_calibrate_block_size', autospec=True)
+    @mock.patch.object(disk_utils, '_read_queue_limits', autospec=True)
+    def test_get_write_tuning_calibrate_fails(self, mock_limits,
+                                              mock_calibrate):
+        self.config(write_tuning='calibrate', group='disk_utils')
+        mock_limits.return_value = self._limits()
+        for result in (None, OSError('boom')):
+            disk_utils._CALIBRATED_BLOCK_SIZES.clear()
+            mock_calibrate.side_effect = [result]
+            for _ in range(2):
+                tuning = disk_utils.get_write_tuning('/dev/sda',
+                                                     size=units.Gi)
+                self.assertEqual('sysfs', tuning['source'])
+                self.assertEqual(10 * units.Mi, tuning['block_size'])
+
+    def test_calibrate_block_size(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 4 * units.Mi)
+            f.flush()
+            block_size, throughput = disk_utils._calibrate_block_size(
+                f.name, [units.Mi, 2 * units.Mi], 2 * units.Mi)
+            self.assertIn(block_size, (units.Mi, 2 * units.Mi))
+            self.assertGreater(throughput, 0)
+            f.seek(0)
+            content = f.read()
+        self.assertEqual(b'\0' * 2 * units.Mi + b'x' * 2 * units.Mi,
+                         content)
+
+    def test_calibrate_block_size_small_device(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * units.Mi)
+            f.flush()
+            self.assertIsNone(disk_utils._calibrate_block_size(
+                f.name, [units.Mi], 2 * units.Mi))
+
+
+@mock.patch.object(utils, 'execute', autospec=True)
+class DdTestCase(base.IronicAgentTest):
+
+    def test_dd(self, mock_exec):
+        disk_utils.dd('src', 'dst', conv_flags='sparse')
+        mock_exec.assert_called_once_with('dd', 'if=src', 'of=dst', 'bs=1M',
+                                          'oflag=direct', 'conv=sparse',
+                                          use_standard_locale=True)
+
+    @mock.patch.object(disk_utils, 'get_write_tuning', autospec=True)
+    def test_dd_tuned(self, mock_tuning, mock_exec):
+        mock_tuning.return_value = {'block_size': 4 * units.Mi,
+                                    'coroutines': 8, 'out_of_order': False,
+                                    'source': 'sysfs'}
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 4096)
+            f.flush()
+            disk_utils.dd(f.name, '/dev/sda')
+            mock_exec.assert_called_once_with('dd', 'if=%s' % f.name,
+                                              'of=/dev/sda', 'bs=4194304',
+                                              'oflag=direct',
+                                              use_standard_locale=True)
+        mock_tuning.assert_called_once_with('/dev/sda', size=4096)
+
 
 @mock.patch('time.sleep', lambda sec: None)
 class OtherFunctionTestCase(base.IronicAgentTest):
@@ -669,9 +1079,11 @@ class TriggerDeviceRescanTestCase(base.IronicAgentTest):
         self.assertTrue(disk_utils.trigger_device_rescan('/dev/fake'))
         mock_execute.assert_has_calls([
             mock.call('sync'),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', '/dev/fake'),
             mock.call('partprobe', '/dev/fake', attempts=10),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', '/dev/fake'),
             mock.call('sgdisk', '-v', '/dev/fake'),
         ])
 
@@ -680,9 +1092,11 @@ class TriggerDeviceRescanTestCase(base.IronicAgentTest):
             disk_utils.trigger_device_rescan('/dev/fake', attempts=1))
         mock_execute.assert_has_calls([
             mock.call('sync'),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', '/dev/fake'),
             mock.call('partprobe', '/dev/fake', attempts=1),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', '/dev/fake'),
             mock.call('sgdisk', '-v', '/dev/fake'),
         ])
 
@@ -693,13 +1107,68 @@ class TriggerDeviceRescanTestCase(base.IronicAgentTest):
         self.assertFalse(disk_utils.trigger_device_rescan('/dev/fake'))
         mock_execute.assert_has_calls([
             mock.call('sync'),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', '/dev/fake'),
             mock.call('partprobe', '/dev/fake', attempts=10),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', '/dev/fake'),
             mock.call('sgdisk', '-v', '/dev/fake'),
         ])
 
 
+@mock.patch.object(utils, 'execute', autospec=True)
+class UdevSettleTestCase(base.IronicAgentTest):
+
+    trigger_call = mock.call('udevadm', 'trigger', '--settle',
+                             '--action=change', '/dev/sda')
+
+    def test_full(self, mock_execute):
+        self.assertTrue(disk_utils.udev_settle())
+        mock_execute.assert_called_once_with('udevadm', 'settle')
+
+    def test_full_fails(self, mock_execute):
+        mock_execute.side_effect = processutils.ProcessExecutionError()
+        self.assertFalse(disk_utils.udev_settle())
+
+    def test_targeted(self, mock_execute):
+        self.assertTrue(disk_utils.udev_settle('/dev/sda'))
+        self.assertEqual([self.trigger_call], mock_execute.call_args_list)
+
+    def test_targeted_disabled(self, mock_execute):
+        self.config(udev_targeted_settle=False, group='disk_utils')
+        self.assertTrue(disk_utils.udev_settle('/dev/sda'))
+        mock_execute.assert_called_once_with('udevadm', 'settle')
+
+    def test_targeted_unsupported(self, mock_execute):
+        mock_execute.side_effect = [
+            processutils.ProcessExecutionError(
+                stderr="udevadm: unrecognized option '--settle'"),
+            ('', ''),
+            ('', ''),
+        ]
+        self.assertTrue(disk_utils.udev_settle('/dev/sda'))
+        self.assertTrue(disk_utils.udev_settle('/dev/sda'))
+        self.assertEqual([
+            self.trigger_call,
+            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'settle'),
+        ], mock_execute.call_args_list)
+
+    def test_targeted_fails(self, mock_execute):
+        mock_execute.side_effect = [
+            processutils.ProcessExecutionError(stderr='No such device'),
+            ('', ''),
+            ('', ''),
+        ]
+        self.assertTrue(disk_utils.udev_settle('/dev/sda'))
+        self.assertTrue(disk_utils.udev_settle('/dev/sda'))
+        self.assertEqual([
+            self.trigger_call,
+            mock.call('udevadm', 'settle'),
+            self.trigger_call,
+        ], mock_execute.call_args_list)
+
+
 BLKID_PROBE = ("""
 /dev/disk/by-path/ip-10.1.0.52:3260-iscsi-iqn.2008-10.org.openstack: """
                """PTUUID="123456" PTTYPE="gpt"
@@ -839,6 +1308,8 @@ class WaitForDisk(base.IronicAgentTest):
                           group='disk_partitioner')
         CONF.set_override('check_device_max_retries', 2,
                           group='disk_partitioner')
+        CONF.set_override('check_device_method', 'fuser',
+                          group='disk_partitioner')
 
     @mock.patch.object(utils, 'execute', autospec=True)
     def test_wait_for_disk_to_become_available(self, mock_exc):
@@ -966,12 +1437,192 @@ class WaitForDisk(base.IronicAgentTest):
         mock_exc.assert_has_calls([fuser_call, fuser_call])
 
 
+def _fake_stat(mode, rdev=0):
+    return mock.Mock(st_mode=mode, st_rdev=rdev)
+
+
+class WaitForDiskNatively(base.IronicAgentTest):
+
+    def setUp(self):
+        super(WaitForDiskNatively, self).setUp()
+        CONF.set_override('check_device_interval', 1,
+                          group='disk_partitioner')
+        CONF.set_override('check_device_max_retries', 3,
+                          group='disk_partitioner')
+        self.numbers = {os.makedev(8, 0), os.makedev(253, 0)}
+
+    @mock.patch.object(disk_utils, '_DeviceCloseWatcher', autospec=True)
+    @mock.patch.object(disk_utils, '_get_holding_pids', autospec=True)
+    @mock.patch.object(disk_utils, '_get_device_numbers', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_available(self, mock_exc, mock_numbers, mock_pids,
+                       mock_watcher):
+        mock_numbers.return_value = self.numbers
+        mock_pids.return_value = []
+        disk_utils.wait_for_disk_to_become_available('/dev/sda')
+        mock_pids.assert_called_once_with(self.numbers)
+        mock_watcher.return_value.wait.assert_not_called()
+        mock_watcher.return_value.close.assert_called_once_with()
+        mock_exc.assert_not_called()
+
+    @mock.patch.object(disk_utils, '_DeviceCloseWatcher', autospec=True)
+    @mock.patch.object(disk_utils, '_get_holding_pids', autospec=True)
+    @mock.patch.object(disk_utils, '_get_device_numbers', autospec=True)
+    def test_becomes_available(self, mock_numbers, mock_pids, mock_watcher):
+        mock_numbers.return_value = self.numbers
+        mock_pids.side_effect = [['1234'], []]
+        disk_utils.wait_for_disk_to_become_available('/dev/sda')
+        self.assertEqual(2, mock_pids.call_count)
+        mock_watcher.assert_called_once_with('/dev/sda')
+        mock_watcher.return_value.wait.assert_called_once_with(1)
+
+    def _fake_clock(self, mock_watcher, step=None):
+        clock = [0]
+
+        def _wait(timeout):
+            clock[0] += timeout if step is None else step
+
+        mock_watcher.return_value.wait.side_effect = _wait
+        patcher = mock.patch.object(disk_utils.time, 'monotonic',
+                                    autospec=True,
+                                    side_effect=lambda: clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return clock
+
+    @mock.patch.object(disk_utils, '_DeviceCloseWatcher', autospec=True)
+    @mock.patch.object(disk_utils, '_get_holding_pids', autospec=True)
+    @mock.patch.object(disk_utils, '_get_device_numbers', autospec=True)
+    def test_in_use(self, mock_numbers, mock_pids, mock_watcher):
+        clock = self._fake_clock(mock_watcher)
+        mock_numbers.return_value = self.numbers
+        mock_pids.side_effect = [['1234'], ['1234'], ['1234'],
+                                 ['3919', '15503']]
+        expected_error = ('Processes with the following PIDs are '
+                          'holding device /dev/sda: 3919, 15503. '
+                          'Timed out waiting for completion.')
+        self.assertRaisesRegex(
+            errors.RESTError,
+            expected_error,
+            disk_utils.wait_for_disk_to_become_available,
+            '/dev/sda')
+        self.assertEqual(4, mock_pids.call_count)
+        mock_watcher.return_value.wait.assert_has_calls([mock.call(1)] * 3)
+        self.assertEqual(3, clock[0])
+        mock_watcher.return_value.close.assert_called_once_with()
+
+    @mock.patch.object(disk_utils, '_DeviceCloseWatcher', autospec=True)
+    @mock.patch.object(disk_utils, '_get_holding_pids', autospec=True)
+    @mock.patch.object(disk_utils, '_get_device_numbers', autospec=True)
+    def test_unrelated_wake_ups(self, mock_numbers, mock_pids,
+                                mock_watcher):
+        # Frequent close events of other processes do not use up the timeout
+        self._fake_clock(mock_watcher, step=0.01)
+        mock_numbers.return_value = self.numbers
+        mock_pids.side_effect = [['1234']] * 50 + [[]]
+        disk_utils.wait_for_disk_to_become_available('/dev/sda')
+        self.assertEqual(51, mock_pids.call_count)
+        self.assertEqual(50, mock_watcher.return_value.wait.call_count)
+
+    @mock.patch.object(disk_utils, '_DeviceCloseWatcher', autospec=True)
+    @mock.patch.object(disk_utils, '_get_holding_pids', autospec=True)
+    @mock.patch.object(disk_utils, '_get_device_numbers', autospec=True)
+    def test_wait_capped_by_deadline(self, mock_numbers, mock_pids,
+                                     mock_watcher):
+        clock = self._fake_clock(mock_watcher, step=0.5)
+        mock_numbers.return_value = self.numbers
+        mock_pids.return_value = ['1234']
+        self.assertRaises(errors.DeviceNotFound,
+                          disk_utils.wait_for_disk_to_become_available,
+                          '/dev/sda')
+        # The last wait is shortened to the remaining time
+        self.assertEqual(3, clock[0])
+        self.assertEqual(mock.call(0.5),
+                         mock_watcher.return_value.wait.call_args_list[-1])
+
+    @mock.patch.object(disk_utils, '_get_holding_pids', autospec=True)
+    @mock.patch.object(disk_utils, '_get_device_numbers', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_not_a_block_device(self, mock_exc, mock_numbers, mock_pids):
+        mock_numbers.return_value = None
+        mock_exc.return_value = ('', '')
+        disk_utils.wait_for_disk_to_become_available('fake-dev')
+        mock_exc.assert_called_once_with('fuser', 'fake-dev',
+                                         check_exit_code=[0, 1])
+        mock_pids.assert_not_called()
+
+    @mock.patch.object(os, 'stat', autospec=True)
+    @mock.patch.object(os, 'listdir', autospec=True)
+    def test__get_holding_pids(self, mock_listdir, mock_stat):
+        mock_listdir.side_effect = lambda path: {
+            '/proc': ['1', '100', '200', '300', 'self', 'mounts'],
+            '/proc/1/fd': ['0', '1'],
+            '/proc/100/fd': ['0', '5', '6'],
+            '/proc/200/fd': ['3'],
+        }.get(path) or self._raise_oserror()
+        mock_stat.side_effect = lambda path: {
+            '/proc/1/fd/0': _fake_stat(stat.S_IFCHR, os.makedev(8, 0)),
+            '/proc/1/fd/1': _fake_stat(stat.S_IFREG),
+            '/proc/100/fd/5': _fake_stat(stat.S_IFBLK, os.makedev(8, 1)),
+            '/proc/100/fd/6': _fake_stat(stat.S_IFBLK, os.makedev(253, 0)),
+            '/proc/200/fd/3': _fake_stat(stat.S_IFBLK, os.makedev(8, 0)),
+        }.get(path) or self._raise_oserror()
+
+        self.assertEqual(['100', '200'],
+                         disk_utils._get_holding_pids(self.numbers))
+
+    @staticmethod
+    def _raise_oserror():
+        raise OSError('No such file or directory')
+
+    @mock.patch('builtins.open', autospec=True)
+    @mock.patch.object(os, 'listdir', autospec=True)
+    @mock.patch.object(os, 'stat', autospec=True)
+    def test__get_device_numbers(self, mock_stat, mock_listdir, mock_open):
+        mock_stat.return_value = _fake_stat(stat.S_IFBLK, os.makedev(8, 0))
+        mock_listdir.side_effect = lambda path: {
+            '/sys/dev/block/8:0/holders': ['dm-0', 'md0'],
+            '/sys/dev/block/9:0/holders': ['dm-0'],
+            '/sys/dev/block/253:0/holders': [],
+        }[path]
+        devs = {'/sys/class/block/dm-0/dev': '253:0\n',
+                '/sys/class/block/md0/dev': '9:0\n'}
+        mock_open.side_effect = lambda path: mock.mock_open(
+            read_data=devs[path])()
+
+        self.assertEqual({os.makedev(8, 0), os.makedev(9, 0),
+                          os.makedev(253, 0)},
+                         disk_utils._get_device_numbers('/dev/sda'))
+        mock_stat.assert_called_once_with('/dev/sda')
+
+    @mock.patch.object(disk_utils.time, 'sleep', autospec=True)
+    def test_close_watcher(self, mock_sleep):
+        with tempfile.NamedTemporaryFile() as tmp:
+            watcher = disk_utils._DeviceCloseWatcher(tmp.name)
+            self.addCleanup(watcher.close)
+            with open(tmp.name, 'rb'):
+                pass
+            start = time.monotonic()
+            watcher.wait(30)
+            self.assertLess(time.monotonic() - start, 10)
+        mock_sleep.assert_not_called()
+
+    @mock.patch.object(os, 'stat', autospec=True)
+    def test__get_device_numbers_not_block(self, mock_stat):
+        mock_stat.return_value = _fake_stat(stat.S_IFREG)
+        self.assertIsNone(disk_utils._get_device_numbers('/tmp/file'))
+        mock_stat.side_effect = OSError()
+        self.assertIsNone(disk_utils._get_device_numbers('/dev/nope'))
+
+
 class GetAndValidateImageFormat(base.IronicAgentTest):
     @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
+    @mock.patch.object(os, 'stat', autospec=True)
     @mock.patch('os.path.getsize', autospec=True)
-    def test_happy_raw(self, mock_size, mock_ii):
+    def test_happy_raw(self, mock_size, mock_stat, mock_ii):
         """Valid raw image"""
         CONF.set_override('disable_deep_image_inspection', False)
+        mock_stat.return_value = _fake_stat(stat.S_IFREG)
         mock_size.return_value = 13
         fmt = 'raw'
         self.assertEqual(
@@ -980,6 +1631,27 @@ class GetAndValidateImageFormat(base.IronicAgentTest):
         mock_ii.assert_not_called()
         mock_size.assert_called_once_with('/fake/path')
 
+    @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
+    @mock.patch.object(disk_utils, '_get_open_device_size', autospec=True)
+    @mock.patch.object(os, 'close', autospec=True)
+    @mock.patch.object(os, 'open', autospec=True, return_value=42)
+    @mock.patch.object(os, 'stat', autospec=True)
+    @mock.patch('os.path.getsize', autospec=True)
+    def test_happy_raw_loop_device(self, mock_size, mock_stat, mock_open,
+                                   mock_close, mock_dev_size, mock_ii):
+        """Valid raw image attached to a loop device"""
+        CONF.set_override('disable_deep_image_inspection', False)
+        mock_stat.return_value = _fake_stat(stat.S_IFBLK)
+        mock_dev_size.return_value = (4 * units.Gi, 512)
+        fmt = 'raw'
+        self.assertEqual(
+            (fmt, 4 * units.Gi),
+            disk_utils.get_and_validate_image_format('/dev/loop0', fmt))
+        mock_ii.assert_not_called()
+        mock_size.assert_not_called()
+        mock_dev_size.assert_called_once_with(42)
+        mock_close.assert_called_once_with(42)
+
     @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
     def test_happy_qcow2(self, mock_ii):
         """Valid qcow2 image"""
@@ -1058,6 +1730,137 @@ class GetAndValidateImageFormat(base.IronicAgentTest):
         mock_info.assert_called_once()
 
 
+def _qcow2_image(backing_file_offset=0):
+    header = struct.pack('>4sIQIIQ', b'QFI\xfb', 3, backing_file_offset,
+                         8 if backing_file_offset else 0, 16, 10 * units.Mi)
+    return header + b'\0' * (units.Mi - len(header))
+
+
+class GetAndValidateImageFormatCache(base.IronicAgentTest):
+
+    def setUp(self):
+        super().setUp()
+        CONF.set_override('disable_deep_image_inspection', False)
+        fd, self.path = tempfile.mkstemp()
+        self.addCleanup(utils.unlink_without_raise, self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'image')
+
+    @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
+    def test_cached(self, mock_ii):
+        mock_ii.return_value = MockFormatInspectorCls('qcow2', 42, True)
+        for _ in range(2):
+            self.assertEqual(
+                ('qcow2', 42 * units.Mi + 1 - units.Mi),
+                disk_utils.get_and_validate_image_format(
+                    self.path, 'qcow2', checksum='sum'))
+        mock_ii.assert_called_once_with(self.path)
+
+        # A different checksum or format is validated without inspection
+        self.assertRaises(errors.InvalidImage,
+                          disk_utils.get_and_validate_image_format,
+                          self.path, 'vmdk', checksum='sum')
+        disk_utils.get_and_validate_image_format(self.path, 'qcow2',
+                                                 checksum='other')
+        self.assertEqual(2, mock_ii.call_count)
+
+    @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
+    def test_file_changed(self, mock_ii):
+        mock_ii.return_value = MockFormatInspectorCls('qcow2', 42, True)
+        disk_utils.get_and_validate_image_format(self.path, 'qcow2')
+        with open(self.path, 'ab') as f:
+            f.write(b'more')
+        disk_utils.get_and_validate_image_format(self.path, 'qcow2')
+        self.assertEqual(2, mock_ii.call_count)
+
+    @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
+    def test_invalid_cached(self, mock_ii):
+        mock_ii.side_effect = errors.InvalidImage(details='unsafe')
+        for _ in range(2):
+            self.assertRaises(errors.InvalidImage,
+                              disk_utils.get_and_validate_image_format,
+                              self.path, 'qcow2')
+        mock_ii.assert_called_once_with(self.path)
+
+    @mock.patch.object(qemu_img, 'image_info', autospec=True)
+    def test_cached_disabled_deep_inspection(self, mock_info):
+        CONF.set_override('disable_deep_image_inspection', True)
+        mock_info.return_value = _get_fake_qemu_image_info(
+            file_format='qcow2', virtual_size=42)
+        for _ in range(2):
+            self.assertEqual(
+                ('qcow2', 42),
+                disk_utils.get_and_validate_image_format(self.path, 'qcow2'))
+        mock_info.assert_called_once_with(self.path)
+
+    @mock.patch.object(qemu_img, 'image_info', autospec=True)
+    def test_errors_not_cached(self, mock_info):
+        CONF.set_override('disable_deep_image_inspection', True)
+        mock_info.side_effect = [
+            processutils.ProcessExecutionError(),
+            _get_fake_qemu_image_info(file_format='qcow2', virtual_size=42)]
+        self.assertRaises(processutils.ProcessExecutionError,
+                          disk_utils.get_and_validate_image_format,
+                          self.path, 'qcow2')
+        self.assertEqual(
+            ('qcow2', 42),
+            disk_utils.get_and_validate_image_format(self.path, 'qcow2'))
+
+    @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
+    def test_cache_size(self, mock_ii):
+        mock_ii.return_value = MockFormatInspectorCls('qcow2', 42, True)
+        for index in range(disk_utils._INSPECTION_CACHE_SIZE + 1):
+            disk_utils.get_and_validate_image_format(self.path, 'qcow2',
+                                                     checksum=index)
+        self.assertEqual(disk_utils._INSPECTION_CACHE_SIZE,
+                         len(disk_utils._INSPECTION_CACHE))
+        disk_utils.get_and_validate_image_format(self.path, 'qcow2',
+                                                 checksum=0)
+        self.assertEqual(disk_utils._INSPECTION_CACHE_SIZE + 2,
+                         mock_ii.call_count)
+
+    @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
+    def test_streaming_inspection(self, mock_ii):
+        data = _qcow2_image()
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        inspection = disk_utils.StreamingInspection()
+        for offset in range(0, len(data), 64 * units.Ki):
+            inspection.update(data[offset:offset + 64 * units.Ki])
+        self.assertTrue(inspection.complete)
+        disk_utils.cache_inspection(self.path, inspection, checksum='sum')
+
+        self.assertEqual(
+            ('qcow2', 10 * units.Mi),
+            disk_utils.get_and_validate_image_format(self.path, 'qcow2',
+                                                     checksum='sum'))
+        mock_ii.assert_not_called()
+
+    @mock.patch.object(disk_utils, '_image_inspection', autospec=True)
+    def test_streaming_inspection_unsafe(self, mock_ii):
+        data = _qcow2_image(backing_file_offset=512)
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        inspection = disk_utils.StreamingInspection()
+        inspection.update(data)
+        disk_utils.cache_inspection(self.path, inspection)
+
+        self.assertRaises(errors.InvalidImage,
+                          disk_utils.get_and_validate_image_format,
+                          self.path, 'qcow2')
+        mock_ii.assert_not_called()
+
+    def test_streaming_inspection_raw(self):
+        inspection = disk_utils.StreamingInspection()
+        inspection.update(os.urandom(units.Mi))
+        self.assertEqual('raw', str(inspection.result()))
+
+    def test_streaming_inspection_not_regular_file(self):
+        inspection = disk_utils.StreamingInspection()
+        disk_utils.cache_inspection('/dev/null', inspection)
+        self.assertEqual({}, disk_utils._INSPECTION_CACHE)
+
+
 class ImageInspectionTest(base.IronicAgentTest):
     @mock.patch.object(format_inspector, 'detect_file_format', autospec=True)
     def test_image_inspection_pass(self, mock_fi):
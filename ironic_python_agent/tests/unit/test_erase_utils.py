@@ -0,0 +1,296 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import threading
+from unittest import mock
+
+from oslo_concurrency import processutils
+
+from ironic_python_agent import erase_utils
+from ironic_python_agent import errors
+from ironic_python_agent import hardware
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent.tests.unit.samples import hardware_samples as hws
+from ironic_python_agent import utils
+
+
+class TestGetSampleCount(base.IronicAgentTest):
+
+    def test_defaults(self):
+        self.assertEqual(4603, erase_utils.get_sample_count(0.99, 0.001))
+
+    def test_higher_tolerance(self):
+        self.assertEqual(44, erase_utils.get_sample_count(0.99, 0.1))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, erase_utils.get_sample_count, 1, 0.1)
+        self.assertRaises(ValueError, erase_utils.get_sample_count, 0.9, 0)
+
+
+class TestVerifyErasedDevice(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestVerifyErasedDevice, self).setUp()
+        self.block_size = 4096
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.unlink, tmp.name)
+        self.device = tmp.name
+        self._fill(b'\0', 256)
+
+    def _fill(self, byte, blocks):
+        with open(self.device, 'wb') as f:
+            f.write(byte * self.block_size * blocks)
+
+    def _write_block(self, block, data):
+        with open(self.device, 'r+b') as f:
+            f.seek(block * self.block_size)
+            f.write(data)
+
+    def test_zero_full_coverage(self):
+        report = erase_utils.verify_erased_device(
+            self.device, 'zero', confidence=0.99, tolerance=0.001,
+            block_size=self.block_size, threads=4)
+        self.assertEqual(256, report['samples'])
+        self.assertEqual(256 * self.block_size, report['bytes_read'])
+        self.assertEqual(1.0, report['coverage'])
+        self.assertEqual(0, report['unerased_blocks'])
+        self.assertEqual(self.device, report['device'])
+
+    def test_sampled(self):
+        self._fill(b'\0', 1024)
+        report = erase_utils.verify_erased_device(
+            self.device, 'zero', confidence=0.9, tolerance=0.1,
+            block_size=self.block_size, threads=2)
+        # 22 random blocks plus possibly the first and the last one
+        self.assertIn(report['samples'], (22, 23, 24))
+        self.assertLess(report['coverage'], 1.0)
+
+    def test_first_and_last_block_always_read(self):
+        self._fill(b'\0', 1024)
+        self._write_block(1023, b'data')
+        self.assertRaisesRegex(
+            errors.BlockDeviceEraseError, 'first at offset %d'
+            % (1023 * self.block_size),
+            erase_utils.verify_erased_device,
+            self.device, 'zero', confidence=0.5, tolerance=0.5,
+            block_size=self.block_size, threads=1)
+
+    def test_not_erased(self):
+        self._write_block(42, b'\0' * 100 + b'leftover')
+        self.assertRaisesRegex(
+            errors.BlockDeviceEraseError, '1 of 256 sampled blocks',
+            erase_utils.verify_erased_device,
+            self.device, 'zero', confidence=0.99, tolerance=0.001,
+            block_size=self.block_size, threads=3)
+
+    def test_uniform(self):
+        self._fill(b'\xff', 256)
+        self.assertRaises(errors.BlockDeviceEraseError,
+                          erase_utils.verify_erased_device,
+                          self.device, 'zero', block_size=self.block_size)
+        report = erase_utils.verify_erased_device(
+            self.device, 'uniform', block_size=self.block_size)
+        self.assertEqual(0, report['unerased_blocks'])
+
+    def test_uniform_mismatch(self):
+        self._fill(b'\xff', 256)
+        self._write_block(7, b'\x00')
+        self.assertRaises(errors.BlockDeviceEraseError,
+                          erase_utils.verify_erased_device,
+                          self.device, 'uniform', block_size=self.block_size)
+
+    def test_defaults_from_config(self):
+        self.config(erase_verification_block_size=8192,
+                    erase_verification_threads=1)
+        report = erase_utils.verify_erased_device(self.device)
+        self.assertEqual(8192, report['block_size'])
+        self.assertEqual(128, report['samples'])
+
+    def test_unknown_pattern(self):
+        self.assertRaises(errors.BlockDeviceEraseError,
+                          erase_utils.verify_erased_device,
+                          self.device, 'random')
+
+    def test_missing_device(self):
+        self.assertRaisesRegex(errors.BlockDeviceEraseError,
+                               'Unable to open',
+                               erase_utils.verify_erased_device,
+                               '/dev/does-not-exist')
+
+    @mock.patch.object(os, 'preadv', autospec=True)
+    def test_read_error(self, mock_preadv):
+        mock_preadv.side_effect = OSError('I/O error')
+        self.assertRaisesRegex(errors.BlockDeviceEraseError,
+                               'Failed to read',
+                               erase_utils.verify_erased_device,
+                               self.device, block_size=self.block_size)
+
+
+class TestGetDeviceController(base.IronicAgentTest):
+
+    def test_by_path(self):
+        dev = hardware.BlockDevice(
+            '/dev/sda', 'big', 1073741824, True, hctl='1:0:0:0',
+            by_path='/dev/disk/by-path/pci-0000:3b:00.0-sas-phy0-lun-0')
+        self.assertEqual('pci-0000:3b:00.0',
+                         erase_utils.get_device_controller(dev))
+
+    def test_by_path_nested(self):
+        dev = hardware.BlockDevice(
+            '/dev/sda', 'big', 1073741824, True,
+            by_path='/dev/disk/by-path/pci-0000:00:01.0-pci-0000:5E:00.1-'
+                    'ata-1')
+        self.assertEqual('pci-0000:5E:00.1',
+                         erase_utils.get_device_controller(dev))
+
+    def test_hctl(self):
+        dev = hardware.BlockDevice('/dev/sda', 'big', 1073741824, True,
+                                   hctl='3:0:2:0',
+                                   by_path='/dev/disk/by-path/virtio-blk')
+        self.assertEqual('host3', erase_utils.get_device_controller(dev))
+
+    def test_name(self):
+        dev = hardware.BlockDevice('/dev/vda', 'big', 1073741824, True)
+        self.assertEqual('/dev/vda', erase_utils.get_device_controller(dev))
+
+
+class TestEstimateEraseTime(base.IronicAgentTest):
+
+    def test_parse_hdparm_erase_time(self):
+        output = hws.HDPARM_INFO_TEMPLATE % {
+            'supported': 'supported', 'enabled': 'not enabled',
+            'locked': 'not locked', 'frozen': 'not frozen',
+            'enhanced_erase': 'supported: enhanced erase'}
+        self.assertEqual(24 * 60,
+                         erase_utils.parse_hdparm_erase_time(output))
+
+    def test_parse_hdparm_erase_time_missing(self):
+        self.assertIsNone(erase_utils.parse_hdparm_erase_time('Security:'))
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_hdparm(self, mock_execute):
+        mock_execute.return_value = (
+            '\t2min for SECURITY ERASE UNIT. '
+            'more than 508min for ENHANCED SECURITY ERASE UNIT.\n', '')
+        dev = hardware.BlockDevice('/dev/sda', 'big', 1073741824, True)
+        self.assertEqual(508 * 60, erase_utils.estimate_erase_time(dev))
+        mock_execute.assert_called_once_with('hdparm', '-I', '/dev/sda')
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_hdparm_output_known(self, mock_execute):
+        dev = hardware.BlockDevice('/dev/sda', 'big', 1500 * 1048576, True)
+        self.assertEqual(
+            120, erase_utils.estimate_erase_time(
+                dev, hdparm_output='\t2min for SECURITY ERASE UNIT.\n'))
+        self.assertEqual(
+            10, erase_utils.estimate_erase_time(dev, hdparm_output=''))
+        mock_execute.assert_not_called()
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_size_fallback(self, mock_execute):
+        mock_execute.side_effect = processutils.ProcessExecutionError()
+        rotational = hardware.BlockDevice('/dev/sda', 'big', 1500 * 1048576,
+                                          True)
+        solid = hardware.BlockDevice('/dev/sdb', 'big', 1500 * 1048576,
+                                     False)
+        self.assertEqual(10, erase_utils.estimate_erase_time(rotational))
+        self.assertEqual(3, erase_utils.estimate_erase_time(solid))
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_nvme(self, mock_execute):
+        dev = hardware.BlockDevice('/dev/nvme0n1', 'big', 5000 * 1048576,
+                                   False)
+        self.assertEqual(10, erase_utils.estimate_erase_time(dev))
+        mock_execute.assert_not_called()
+
+
+class TestEraseScheduler(base.IronicAgentTest):
+
+    def _device(self, name, size, host):
+        return hardware.BlockDevice(name, 'big', size, True,
+                                    hctl='%d:0:0:0' % host)
+
+    def test_longest_first(self):
+        devices = [self._device('/dev/sda', 1, 0),
+                   self._device('/dev/sdb', 2, 0),
+                   self._device('/dev/sdc', 3, 1)]
+        order = []
+        scheduler = erase_utils.EraseScheduler(
+            devices, 1, estimates={'/dev/sda': 10, '/dev/sdb': 30,
+                                   '/dev/sdc': 20})
+        result = scheduler.run(lambda dev: order.append(dev.name) or 'ok')
+        self.assertEqual(['/dev/sdb', '/dev/sdc', '/dev/sda'], order)
+        self.assertEqual({'/dev/sda': 'ok', '/dev/sdb': 'ok',
+                          '/dev/sdc': 'ok'}, result)
+        self.assertEqual(6, scheduler.report['bytes'])
+        self.assertEqual({'host0', 'host1'},
+                         set(scheduler.report['controllers']))
+        self.assertEqual(['/dev/sda', '/dev/sdb'],
+                         scheduler.report['controllers']['host0']['devices'])
+
+    def test_balance_across_controllers(self):
+        devices = [self._device('/dev/sda', 1, 0),
+                   self._device('/dev/sdb', 1, 0),
+                   self._device('/dev/sdc', 1, 1)]
+        started = []
+        scheduler = erase_utils.EraseScheduler(
+            devices, 2, estimates={'/dev/sda': 30, '/dev/sdb': 20,
+                                   '/dev/sdc': 10})
+        barrier = threading.Barrier(2, timeout=10)
+
+        def erase(dev):
+            started.append(dev.name)
+            if len(started) <= 2:
+                barrier.wait()
+
+        scheduler.run(erase)
+        # sdc goes second despite its short estimate since host0 is busy
+        self.assertEqual(['/dev/sda', '/dev/sdc'], sorted(started[:2]))
+        self.assertEqual('/dev/sdb', started[2])
+
+    def test_controller_concurrency(self):
+        devices = [self._device('/dev/sd%s' % letter, 1, 0)
+                   for letter in 'abcd']
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def erase(dev):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            threading.Event().wait(0.01)
+            with lock:
+                running[0] -= 1
+
+        scheduler = erase_utils.EraseScheduler(devices, 4,
+                                               controller_concurrency=2)
+        scheduler.run(erase)
+        self.assertEqual(2, peak[0])
+        self.assertEqual(4, scheduler.concurrency)
+
+    def test_failure(self):
+        devices = [self._device('/dev/sda', 1, 0),
+                   self._device('/dev/sdb', 1, 1)]
+        erased = []
+
+        def erase(dev):
+            erased.append(dev.name)
+            if dev.name == '/dev/sda':
+                raise errors.BlockDeviceEraseError('boom')
+
+        scheduler = erase_utils.EraseScheduler(devices, 2)
+        self.assertRaisesRegex(errors.BlockDeviceEraseError, 'boom',
+                               scheduler.run, erase)
+        self.assertEqual(['/dev/sda', '/dev/sdb'], sorted(erased))
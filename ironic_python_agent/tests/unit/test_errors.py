@@ -110,6 +110,8 @@ class TestErrors(base.IronicAgentTest):
                  (errors.ImageWriteError('device', 'exit_code', 'stdout',
                                          'stderr'),
                   DIFF_CL_DETAILS),
+                 (errors.ImageVerificationError('device', DETAILS),
+                  DIFF_CL_DETAILS),
                  (errors.SystemRebootError('exit_code', 'stdout', 'stderr'),
                   DIFF_CL_DETAILS),
                  (errors.BlockDeviceEraseError(DETAILS), SAME_DETAILS),
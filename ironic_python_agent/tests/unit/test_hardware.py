@@ -17,6 +17,7 @@ from collections import namedtuple
 import glob
 import json
 import logging
+from multiprocessing import pool
 import os
 import re
 import shutil
@@ -33,6 +34,7 @@ from stevedore import extension
 
 from ironic_python_agent import disk_utils
 from ironic_python_agent import efi_utils
+from ironic_python_agent import erase_utils
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base as ext_base
 from ironic_python_agent import hardware
@@ -238,6 +240,33 @@ class TestHardwareManagerLoading(base.IronicAgentTest):
                          self.expected_detail_response)
 
 
+class TestHardwareManagerEraseDevices(base.IronicAgentTest):
+
+    @mock.patch.object(erase_utils, 'estimate_erase_time', autospec=True)
+    @mock.patch.object(hardware, 'safety_check_block_device', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_erase_devices_concurrency(self, mocked_dispatch,
+                                       mock_safety_check, mock_estimate):
+        manager = _create_mock_hwm('fake_custom0',
+                                   hardware.HardwareSupport.MAINLINE)
+        blkdev1 = hardware.BlockDevice('/dev/sdj', 'big', 1073741824, True)
+        blkdev2 = hardware.BlockDevice('/dev/hdaa', 'small', 65535, False)
+        manager.list_block_devices_check_skip_list = mock.Mock(
+            return_value=[blkdev1, blkdev2])
+        mocked_dispatch.return_value = 'erased device'
+        mock_estimate.side_effect = lambda dev: dev.size
+        node = {'driver_internal_info': {'disk_erasure_concurrency': 2}}
+
+        self.assertEqual({'/dev/sdj': 'erased device',
+                          '/dev/hdaa': 'erased device'},
+                         manager.erase_devices(node, []))
+        mock_estimate.assert_has_calls([mock.call(blkdev1),
+                                        mock.call(blkdev2)])
+        mocked_dispatch.assert_has_calls(
+            [mock.call('erase_block_device', node=node, block_device=dev)
+             for dev in (blkdev1, blkdev2)], any_order=True)
+
+
 @mock.patch.object(disk_utils, 'udev_settle', lambda *_: None)
 class TestGenericHardwareManager(base.IronicAgentTest):
     def setUp(self):
@@ -283,6 +312,14 @@ class TestGenericHardwareManager(base.IronicAgentTest):
                 'reboot_requested': False,
                 'abortable': True
             },
+            {
+                'step': 'verify_erased_devices',
+                'priority': 0,
+                'interface': 'deploy',
+                'reboot_requested': False,
+                'abortable': True,
+                'argsinfo': mock.ANY
+            },
             {
                 'step': 'clean_uefi_nvram',
                 'priority': 0,
@@ -2311,12 +2348,17 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         mocked_listdir.assert_has_calls(expected_calls)
         mocked_mpath.assert_called_once_with()
 
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_classify_devices', autospec=True,
+                       return_value={})
     @mock.patch.object(hardware, 'safety_check_block_device', autospec=True)
-    @mock.patch.object(hardware, 'ThreadPool', autospec=True)
+    @mock.patch.object(erase_utils, 'ThreadPool', autospec=True,
+                       side_effect=pool.ThreadPool)
     @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
     def test_erase_devices_no_parallel_by_default(self, mocked_dispatch,
                                                   mock_threadpool,
-                                                  mock_safety_check):
+                                                  mock_safety_check,
+                                                  mock_classify):
 
         # NOTE(TheJulia): This test was previously more elaborate and
         # had a high failure rate on py37 and py38. So instead, lets just
@@ -2340,13 +2382,16 @@ class TestGenericHardwareManager(base.IronicAgentTest):
             mock.call({}, '/dev/hdaa')
         ])
 
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_classify_devices', autospec=True,
+                       return_value={})
     @mock.patch.object(hardware, 'safety_check_block_device', autospec=True)
-    @mock.patch.object(hardware, 'ThreadPool', autospec=True)
+    @mock.patch.object(erase_utils, 'ThreadPool', autospec=True)
     @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
     def test_erase_devices_no_parallel_by_default_protected_device(
             self, mocked_dispatch,
             mock_threadpool,
-            mock_safety_check):
+            mock_safety_check, mock_classify):
         mock_safety_check.side_effect = errors.ProtectedDeviceError(
             device='foo',
             what='bar')
@@ -2358,29 +2403,27 @@ class TestGenericHardwareManager(base.IronicAgentTest):
             hardware.BlockDevice('/dev/hdaa', 'small', 65535, False),
         ]
 
-        calls = [mock.call(1)]
         self.assertRaises(errors.ProtectedDeviceError,
                           self.hardware.erase_devices, {}, [])
-        mock_threadpool.assert_has_calls(calls)
         mock_safety_check.assert_has_calls([
             mock.call({}, '/dev/sdj'),
         ])
-        mock_threadpool.apply_async.assert_not_called()
+        mock_threadpool.assert_not_called()
+        mocked_dispatch.assert_not_called()
 
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_classify_devices', autospec=True,
+                       return_value={})
+    @mock.patch.object(erase_utils, 'estimate_erase_time', autospec=True)
     @mock.patch.object(hardware, 'safety_check_block_device', autospec=True)
-    @mock.patch('multiprocessing.pool.ThreadPool.apply_async', autospec=True)
     @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
-    def test_erase_devices_concurrency(self, mocked_dispatch, mocked_async,
-                                       mock_safety_check):
+    def test_erase_devices_concurrency(self, mocked_dispatch,
+                                       mock_safety_check, mock_estimate,
+                                       mock_classify):
         internal_info = self.node['driver_internal_info']
         internal_info['disk_erasure_concurrency'] = 10
         mocked_dispatch.return_value = 'erased device'
-
-        apply_result = mock.Mock()
-        apply_result._success = True
-        apply_result._ready = True
-        apply_result.get.return_value = 'erased device'
-        mocked_async.return_value = apply_result
+        mock_estimate.side_effect = lambda dev, hdparm_output: dev.size
 
         blkdev1 = hardware.BlockDevice('/dev/sdj', 'big', 1073741824, True)
         blkdev2 = hardware.BlockDevice('/dev/hdaa', 'small', 65535, False)
@@ -2391,20 +2434,45 @@ class TestGenericHardwareManager(base.IronicAgentTest):
 
         result = self.hardware.erase_devices(self.node, [])
 
-        calls = [mock.call(mock.ANY, mocked_dispatch, ('erase_block_device',),
-                           {'node': self.node, 'block_device': dev})
+        calls = [mock.call('erase_block_device', node=self.node,
+                           block_device=dev)
                  for dev in (blkdev1, blkdev2)]
-        mocked_async.assert_has_calls(calls)
+        mocked_dispatch.assert_has_calls(calls, any_order=True)
         self.assertEqual(expected, result)
+        mock_estimate.assert_has_calls([
+            mock.call(blkdev1, hdparm_output=None),
+            mock.call(blkdev2, hdparm_output=None)])
         mock_safety_check.assert_has_calls([
             mock.call(self.node, '/dev/sdj'),
             mock.call(self.node, '/dev/hdaa'),
         ])
 
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test__estimate_erase_time_classified(self, mocked_execute):
+        self.hardware._device_classification = {
+            '/dev/sda': {'hdparm_output': '\t2min for SECURITY ERASE UNIT.'},
+            '/dev/sdb': {'virtual_media': False},
+        }
+        sda = hardware.BlockDevice('/dev/sda', 'big', 1073741824, True)
+        sdb = hardware.BlockDevice('/dev/sdb', 'big', 1500 * 1048576, True)
+        self.assertEqual(120, self.hardware._estimate_erase_time(sda))
+        self.assertEqual(10, self.hardware._estimate_erase_time(sdb))
+        mocked_execute.assert_not_called()
+
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_classify_devices', autospec=True,
+                       return_value={})
+    @mock.patch.object(erase_utils, 'estimate_erase_time', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
     @mock.patch.object(hardware, 'safety_check_block_device', autospec=True)
-    @mock.patch.object(hardware, 'ThreadPool', autospec=True)
+    @mock.patch.object(erase_utils, 'ThreadPool', autospec=True,
+                       side_effect=pool.ThreadPool)
     def test_erase_devices_concurrency_pool_size(self, mocked_pool,
-                                                 mock_safety_check):
+                                                 mock_safety_check,
+                                                 mocked_dispatch,
+                                                 mock_estimate,
+                                                 mock_classify):
+        mock_estimate.return_value = 42
         self.hardware.list_block_devices = mock.Mock()
         self.hardware.list_block_devices.return_value = [
             hardware.BlockDevice('/dev/sdj', 'big', 1073741824, True),
@@ -2429,8 +2497,12 @@ class TestGenericHardwareManager(base.IronicAgentTest):
             mock.call(self.node, '/dev/hdaa'),
         ])
 
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_classify_devices', autospec=True,
+                       return_value={})
     @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
-    def test_erase_devices_without_disk(self, mocked_dispatch):
+    def test_erase_devices_without_disk(self, mocked_dispatch,
+                                        mock_classify):
         self.hardware.list_block_devices = mock.Mock()
         self.hardware.list_block_devices.return_value = []
 
@@ -2474,6 +2546,38 @@ class TestGenericHardwareManager(base.IronicAgentTest):
             mock.call('hdparm', '-I', '/dev/sda'),
         ])
 
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_erase_block_device_ata_classified(self, mocked_execute):
+        mocked_execute.side_effect = [
+            (create_hdparm_info(
+                supported=True, enabled=False, frozen=False,
+                enhanced_erase=False), ''),
+            ('', ''),
+            ('', ''),
+            (create_hdparm_info(
+                supported=True, enabled=False, frozen=False,
+                enhanced_erase=False), ''),
+        ]
+        # The cached hdparm output is outdated, the state is read again
+        self.hardware._device_classification = {
+            '/dev/sda': {
+                'virtual_media': False, 'raid_member': False,
+                'read_only': False, 'smartctl_security': True,
+                'hdparm_output': create_hdparm_info(
+                    supported=True, enabled=True, frozen=True,
+                    enhanced_erase=False)}}
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            True)
+        self.hardware.erase_block_device(self.node, block_device)
+        mocked_execute.assert_has_calls([
+            mock.call('hdparm', '-I', '/dev/sda'),
+            mock.call('hdparm', '--user-master', 'u', '--security-set-pass',
+                      'NULL', '/dev/sda'),
+            mock.call('hdparm', '--user-master', 'u', '--security-erase',
+                      'NULL', '/dev/sda'),
+            mock.call('hdparm', '-I', '/dev/sda'),
+        ])
+
     @mock.patch.object(hardware.GenericHardwareManager,
                        '_is_linux_raid_member', autospec=True)
     @mock.patch.object(hardware.GenericHardwareManager,
@@ -2704,6 +2808,172 @@ class TestGenericHardwareManager(base.IronicAgentTest):
                       '--iterations', '0', '/dev/sda')
         ])
 
+    @mock.patch.object(erase_utils, 'verify_erased_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_shred_block_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_ata_erase', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_linux_raid_member', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    def test_erase_block_device_verify_ata(self, mocked_ro_device,
+                                           mocked_raid_member, mocked_ata,
+                                           mocked_shred, mocked_verify):
+        self.config(erase_verification=True)
+        mocked_raid_member.return_value = False
+        mocked_ro_device.return_value = False
+        mocked_ata.return_value = True
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            True)
+        result = self.hardware.erase_block_device(self.node, block_device)
+        self.assertEqual(mocked_verify.return_value, result)
+        mocked_verify.assert_called_once_with('/dev/sda', 'uniform')
+        mocked_shred.assert_not_called()
+
+    @mock.patch.object(erase_utils, 'verify_erased_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_shred_block_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_ata_erase', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_linux_raid_member', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    def test_erase_block_device_verify_ata_fails_shred(self, mocked_ro_device,
+                                                       mocked_raid_member,
+                                                       mocked_ata,
+                                                       mocked_shred,
+                                                       mocked_verify):
+        info = self.node['driver_internal_info']
+        info['agent_erase_verification'] = True
+        info['agent_continue_if_secure_erase_failed'] = True
+        mocked_raid_member.return_value = False
+        mocked_ro_device.return_value = False
+        mocked_ata.return_value = True
+        mocked_shred.return_value = True
+        mocked_verify.side_effect = [
+            errors.BlockDeviceEraseError('not erased'),
+            {'device': '/dev/sda'},
+        ]
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            True)
+        result = self.hardware.erase_block_device(self.node, block_device)
+        self.assertEqual({'device': '/dev/sda'}, result)
+        mocked_verify.assert_has_calls([mock.call('/dev/sda', 'uniform'),
+                                        mock.call('/dev/sda', 'zero')])
+        mocked_shred.assert_called_once_with(self.hardware, self.node,
+                                             block_device)
+
+    @mock.patch.object(erase_utils, 'verify_erased_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_shred_block_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_ata_erase', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_linux_raid_member', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    def test_erase_block_device_verify_enhanced_skipped(self,
+                                                        mocked_ro_device,
+                                                        mocked_raid_member,
+                                                        mocked_ata,
+                                                        mocked_shred,
+                                                        mocked_verify):
+        def _enhanced_erase(hw, dev):
+            hw._crypto_erased.add(dev.name)
+            return True
+
+        self.config(erase_verification=True)
+        mocked_raid_member.return_value = False
+        mocked_ro_device.return_value = False
+        mocked_ata.side_effect = _enhanced_erase
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            True)
+        self.assertIsNone(
+            self.hardware.erase_block_device(self.node, block_device))
+        mocked_verify.assert_not_called()
+        mocked_shred.assert_not_called()
+        self.assertEqual(set(), self.hardware._crypto_erased)
+
+    @mock.patch.object(erase_utils, 'verify_erased_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_shred_block_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_ata_erase', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_linux_raid_member', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    def test_erase_block_device_verify_shred_no_zeroize(self,
+                                                        mocked_ro_device,
+                                                        mocked_raid_member,
+                                                        mocked_ata,
+                                                        mocked_shred,
+                                                        mocked_verify):
+        self.config(erase_verification=True)
+        self.node['driver_internal_info']['agent_erase_devices_zeroize'] = (
+            False)
+        mocked_raid_member.return_value = False
+        mocked_ro_device.return_value = False
+        mocked_ata.return_value = False
+        mocked_shred.return_value = True
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            True)
+        self.assertIsNone(
+            self.hardware.erase_block_device(self.node, block_device))
+        mocked_verify.assert_not_called()
+
+    @mock.patch.object(erase_utils, 'verify_erased_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_virtual_media_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       'list_block_devices_check_skip_list', autospec=True)
+    def test_verify_erased_devices(self, mock_list, mock_ro, mock_vm,
+                                   mock_verify):
+        devices = [
+            hardware.BlockDevice('/dev/sda', 'big', 1073741824, True),
+            hardware.BlockDevice('/dev/sdb', 'big', 1073741824, True),
+            hardware.BlockDevice('/dev/sr0', 'vmedia', 1024, True),
+        ]
+        mock_list.return_value = devices
+        mock_ro.return_value = False
+        mock_vm.side_effect = [False, False, True]
+        mock_verify.side_effect = lambda dev, pattern: {'device': dev}
+
+        result = self.hardware.verify_erased_devices(self.node, [], 'zero')
+        self.assertEqual({'/dev/sda': {'device': '/dev/sda'},
+                          '/dev/sdb': {'device': '/dev/sdb'}}, result)
+        mock_verify.assert_has_calls([mock.call('/dev/sda', 'zero'),
+                                      mock.call('/dev/sdb', 'zero')])
+
+    @mock.patch.object(erase_utils, 'verify_erased_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_virtual_media_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       'list_block_devices_check_skip_list', autospec=True)
+    def test_verify_erased_devices_fail(self, mock_list, mock_ro, mock_vm,
+                                        mock_verify):
+        mock_list.return_value = [
+            hardware.BlockDevice('/dev/sda', 'big', 1073741824, True),
+            hardware.BlockDevice('/dev/sdb', 'big', 1073741824, True),
+        ]
+        mock_ro.return_value = False
+        mock_vm.return_value = False
+        mock_verify.side_effect = [
+            errors.BlockDeviceEraseError('boom'), {'device': '/dev/sdb'}]
+
+        self.assertRaisesRegex(errors.BlockDeviceEraseError,
+                               '"/dev/sda": .*boom',
+                               self.hardware.verify_erased_devices,
+                               self.node, [])
+        mock_verify.assert_has_calls([mock.call('/dev/sda', 'uniform'),
+                                      mock.call('/dev/sdb', 'uniform')])
+
     @mock.patch.object(hardware.GenericHardwareManager,
                        '_is_virtual_media_device', autospec=True)
     def test_erase_block_device_virtual_media(self, vm_mock):
@@ -3131,10 +3401,13 @@ class TestGenericHardwareManager(base.IronicAgentTest):
 
             block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
                                                 True)
-            test_case.hardware.erase_block_device(self.node, block_device)
+            test_case.hardware._ata_erase(block_device)
             mocked_execute.assert_any_call('hdparm', '--user-master', 'u',
                                            expected_option,
                                            'NULL', '/dev/sda')
+            self.assertEqual(enhanced_erase,
+                             '/dev/sda' in test_case.hardware._crypto_erased)
+            test_case.hardware._crypto_erased.clear()
 
         test_security_erase_option(
             self, True, '--security-erase-enhanced')
@@ -3274,17 +3547,16 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         # verification, but the method under test sorts the list changing it.
         mock_list_devs.return_value = list(block_devices)
         mock__is_vmedia.side_effect = lambda _, dev: dev.name == '/dev/sr0'
-        mock_execute.side_effect = [
-            ('sdb2 linux_raid_member host:1 f9978968', ''),
-            ('sda2 linux_raid_member host:1 f9978969', ''),
-            ('sda1', ''), ('sda', ''), ('md0', '')]
+        mock_execute.return_value = (hws.LSBLK_FS_JSON_OUTPUT, '')
 
         self.hardware.erase_devices_metadata(self.node, [])
 
+        # /dev/sda is skipped since its partition is a RAID member
         self.assertEqual([mock.call('/dev/sda1', self.node['uuid']),
-                          mock.call('/dev/sda', self.node['uuid']),
                           mock.call('/dev/md0', self.node['uuid'])],
                          mock_metadata.call_args_list)
+        mock_execute.assert_called_once_with('lsblk', '--fs', '--json',
+                                             '--paths')
         mock_list_devs.assert_called_with(self.hardware,
                                           include_partitions=True,
                                           all_serial_and_wwn=False)
@@ -3297,7 +3569,6 @@ class TestGenericHardwareManager(base.IronicAgentTest):
                          mock__is_vmedia.call_args_list)
         mock_safety_check.assert_has_calls([
             mock.call(self.node, '/dev/sda1'),
-            mock.call(self.node, '/dev/sda'),
             # This is kind of redundant code/pattern behavior wise
             # but you never know what someone has done...
             mock.call(self.node, '/dev/md0')
@@ -3328,10 +3599,7 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         # verification, but the method under test sorts the list changing it.
         mock_list_devs.return_value = list(block_devices)
         mock__is_vmedia.side_effect = lambda _, dev: dev.name == '/dev/sr0'
-        mock_execute.side_effect = [
-            ('sdb2 linux_raid_member host:1 f9978968', ''),
-            ('sda2 linux_raid_member host:1 f9978969', ''),
-            ('sda1', ''), ('sda', ''), ('md0', '')]
+        mock_execute.return_value = (hws.LSBLK_FS_JSON_OUTPUT, '')
         mock_safety_check.side_effect = [
             None,
             errors.ProtectedDeviceError(
@@ -3350,7 +3618,7 @@ class TestGenericHardwareManager(base.IronicAgentTest):
                                           all_serial_and_wwn=False)
         mock_safety_check.assert_has_calls([
             mock.call(self.node, '/dev/sda1'),
-            mock.call(self.node, '/dev/sda'),
+            mock.call(self.node, '/dev/md0'),
         ])
 
     @mock.patch.object(hardware.GenericHardwareManager,
@@ -3360,12 +3628,16 @@ class TestGenericHardwareManager(base.IronicAgentTest):
     @mock.patch.object(hardware, 'safety_check_block_device', autospec=True)
     @mock.patch.object(hardware.GenericHardwareManager,
                        '_is_linux_raid_member', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_linux_raid_membership', autospec=True,
+                       return_value=None)
     @mock.patch.object(hardware.GenericHardwareManager,
                        'list_block_devices', autospec=True)
     @mock.patch.object(disk_utils, 'destroy_disk_metadata', autospec=True)
     def test_erase_devices_metadata_error(
-            self, mock_metadata, mock_list_devs, mock__is_raid_member,
-            mock_safety_check, mock__is_vmedia, mocked_ro_device):
+            self, mock_metadata, mock_list_devs, mock_membership,
+            mock__is_raid_member, mock_safety_check, mock__is_vmedia,
+            mocked_ro_device):
         block_devices = [
             hardware.BlockDevice('/dev/sda', 'small', 65535, False),
             hardware.BlockDevice('/dev/sdb', 'big', 10737418240, True),
@@ -3419,6 +3691,99 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         mocked_execute.return_value = 'md0', ''
         self.assertFalse(self.hardware._is_linux_raid_member(raid_member))
 
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test__get_linux_raid_membership(self, mocked_execute):
+        mocked_execute.return_value = (hws.LSBLK_FS_JSON_OUTPUT, '')
+        self.assertEqual({'/dev/sda': True, '/dev/sda1': False,
+                          '/dev/sda2': True, '/dev/md0': False,
+                          '/dev/sdb': True, '/dev/sdb2': True,
+                          '/dev/sdc': False, '/dev/sr0': False},
+                         self.hardware._get_linux_raid_membership())
+        mocked_execute.assert_called_once_with('lsblk', '--fs', '--json',
+                                               '--paths')
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test__get_linux_raid_membership_error(self, mocked_execute):
+        mocked_execute.side_effect = processutils.ProcessExecutionError()
+        self.assertIsNone(self.hardware._get_linux_raid_membership())
+
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_smartctl_security_check', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_hdparm_info', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_linux_raid_member', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_virtual_media_device', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test__classify_devices(self, mocked_execute, mocked_vm,
+                               mocked_ro_device, mocked_raid_member,
+                               mocked_hdparm, mocked_smartctl):
+        mocked_execute.return_value = (hws.LSBLK_FS_JSON_OUTPUT, '')
+        mocked_vm.side_effect = lambda _, dev: dev.name == '/dev/sr0'
+        mocked_ro_device.return_value = False
+        mocked_raid_member.return_value = False
+        mocked_hdparm.side_effect = [
+            'hdparm output', processutils.ProcessExecutionError()]
+        mocked_smartctl.return_value = True
+        devices = [
+            hardware.BlockDevice('/dev/sr0', 'vmedia', 12345, True),
+            hardware.BlockDevice('/dev/sda', 'raid', 65535, False),
+            hardware.BlockDevice('/dev/sdc', 'big', 65535, False),
+            hardware.BlockDevice('/dev/nvme0n1', 'nvme', 65535, False),
+            hardware.BlockDevice('/dev/dm-0', 'mpath', 65535, False),
+        ]
+
+        result = self.hardware._classify_devices(devices, ata_security=True)
+
+        self.assertEqual({
+            '/dev/sr0': {'virtual_media': True, 'raid_member': False,
+                         'read_only': False},
+            '/dev/sda': {'virtual_media': False, 'raid_member': True,
+                         'read_only': False},
+            '/dev/sdc': {'virtual_media': False, 'raid_member': False,
+                         'read_only': False, 'hdparm_output': 'hdparm output',
+                         'smartctl_security': True},
+            '/dev/nvme0n1': {'virtual_media': False, 'raid_member': False,
+                             'read_only': False},
+            '/dev/dm-0': {'virtual_media': False, 'raid_member': False,
+                          'read_only': False},
+        }, result)
+        mocked_execute.assert_called_once_with('lsblk', '--fs', '--json',
+                                               '--paths')
+        # Only the devices missing from the lsblk output are checked
+        self.assertEqual([mock.call(self.hardware, devices[3]),
+                          mock.call(self.hardware, devices[4])],
+                         mocked_raid_member.call_args_list)
+        # The security state is only fetched for erasable ATA devices
+        self.assertCountEqual([mock.call(self.hardware, devices[2]),
+                               mock.call(self.hardware, devices[4])],
+                              mocked_hdparm.call_args_list)
+
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_linux_raid_member', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_virtual_media_device', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_erase_block_device_classified(self, mocked_execute, mocked_vm,
+                                           mocked_ro_device,
+                                           mocked_raid_member):
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            True)
+        self.hardware._device_classification = {
+            '/dev/sda': {'virtual_media': False, 'raid_member': True,
+                         'read_only': False}}
+        self.assertIsNone(self.hardware.erase_block_device(self.node,
+                                                           block_device))
+        mocked_vm.assert_not_called()
+        mocked_raid_member.assert_not_called()
+        mocked_ro_device.assert_not_called()
+        mocked_execute.assert_not_called()
+
     def test__is_read_only_device(self):
         fileobj = mock.mock_open(read_data='1\n')
         device = hardware.BlockDevice('/dev/sdfake', 'fake', 1024, False)
@@ -7258,6 +7623,7 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         ])
 
         self.assertTrue(retval)
+        self.assertEqual({'/dev/nvme0n1'}, self.hardware._crypto_erased)
 
     @mock.patch.object(hardware.GenericHardwareManager,
                        '_is_linux_raid_member', autospec=True)
@@ -7282,6 +7648,7 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         ])
 
         self.assertTrue(retval)
+        self.assertEqual(set(), self.hardware._crypto_erased)
 
     @mock.patch.object(hardware.GenericHardwareManager,
                        '_is_linux_raid_member', autospec=True)
@@ -7318,6 +7685,229 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         self.assertRaises(errors.BlockDeviceEraseError,
                           self.hardware._nvme_erase, block_device)
 
+    @mock.patch.object(time, 'sleep', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_nvme_namespaces', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_nvme_erase_sanitize(self, mocked_execute, mocked_namespaces,
+                                 mocked_sleep):
+        self.config(enable_nvme_sanitize=True)
+        mocked_namespaces.return_value = ['/dev/nvme0n1']
+        mocked_execute.side_effect = [
+            (hws.NVME_CLI_INFO_TEMPLATE_CRYPTO_SUPPORTED, ''),
+            ('', ''),
+            ('{"sprog": 32768, "sstat": 2}', ''),
+            ('{"nvme0n1": {"sprog": 65535, "sstat": 257}}', ''),
+        ]
+
+        block_device = hardware.BlockDevice('/dev/nvme0n1', "testdisk",
+                                            1073741824, False)
+        self.assertTrue(self.hardware._nvme_erase(block_device))
+        mocked_execute.assert_has_calls([
+            mock.call('nvme', 'id-ctrl', '/dev/nvme0n1', '-o', 'json'),
+            mock.call('nvme', 'sanitize', '/dev/nvme0n1', '-a', 4),
+            mock.call('nvme', 'sanitize-log', '/dev/nvme0n1', '-o', 'json'),
+            mock.call('nvme', 'sanitize-log', '/dev/nvme0n1', '-o', 'json'),
+        ])
+        mocked_sleep.assert_called_once_with(5)
+
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_nvme_namespaces', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_nvme_erase_sanitize_unsupported(self, mocked_execute,
+                                             mocked_namespaces):
+        self.config(enable_nvme_sanitize=True)
+        mocked_namespaces.return_value = ['/dev/nvme0n1']
+        nvme_info = json.loads(hws.NVME_CLI_INFO_TEMPLATE_CRYPTO_SUPPORTED)
+        nvme_info['sanicap'] = 0
+        mocked_execute.side_effect = [
+            (json.dumps(nvme_info), ''),
+            ('', ''),
+        ]
+
+        block_device = hardware.BlockDevice('/dev/nvme0n1', "testdisk",
+                                            1073741824, False)
+        self.assertTrue(self.hardware._nvme_erase(block_device))
+        mocked_execute.assert_has_calls([
+            mock.call('nvme', 'id-ctrl', '/dev/nvme0n1', '-o', 'json'),
+            mock.call('nvme', 'format', '/dev/nvme0n1', '-s', 2, '-f'),
+        ])
+
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_nvme_namespaces', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_nvme_erase_sanitize_several_namespaces(self, mocked_execute,
+                                                    mocked_namespaces):
+        self.config(enable_nvme_sanitize=True)
+        mocked_namespaces.return_value = ['/dev/nvme0n1', '/dev/nvme0n2']
+        mocked_execute.side_effect = [
+            (hws.NVME_CLI_INFO_TEMPLATE_USERDATA_SUPPORTED, ''),
+            ('', ''),
+        ]
+
+        block_device = hardware.BlockDevice('/dev/nvme0n1', "testdisk",
+                                            1073741824, False)
+        self.assertTrue(self.hardware._nvme_erase(block_device))
+        mocked_execute.assert_has_calls([
+            mock.call('nvme', 'id-ctrl', '/dev/nvme0n1', '-o', 'json'),
+            mock.call('nvme', 'format', '/dev/nvme0n1', '-s', 1, '-f'),
+        ])
+
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_nvme_namespaces', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_nvme_erase_sanitize_start_fails(self, mocked_execute,
+                                             mocked_namespaces):
+        self.config(enable_nvme_sanitize=True)
+        mocked_namespaces.return_value = ['/dev/nvme0n1']
+        mocked_execute.side_effect = [
+            (hws.NVME_CLI_INFO_TEMPLATE_CRYPTO_SUPPORTED, ''),
+            processutils.ProcessExecutionError(),
+            ('', ''),
+        ]
+
+        block_device = hardware.BlockDevice('/dev/nvme0n1', "testdisk",
+                                            1073741824, False)
+        self.assertTrue(self.hardware._nvme_erase(block_device))
+        mocked_execute.assert_called_with('nvme', 'format', '/dev/nvme0n1',
+                                          '-s', 2, '-f')
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_wait_for_nvme_sanitize_failed(self, mocked_execute):
+        mocked_execute.return_value = ('{"sprog": 65535, "sstat": 3}', '')
+        block_device = hardware.BlockDevice('/dev/nvme0n1', "testdisk",
+                                            1073741824, False)
+        self.assertRaisesRegex(errors.BlockDeviceEraseError,
+                               'failed with status 3',
+                               self.hardware._wait_for_nvme_sanitize,
+                               block_device)
+
+    @mock.patch.object(time, 'monotonic', autospec=True)
+    @mock.patch.object(time, 'sleep', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_wait_for_nvme_sanitize_timeout(self, mocked_execute,
+                                            mocked_sleep, mocked_monotonic):
+        self.config(nvme_sanitize_timeout=60)
+        mocked_monotonic.side_effect = [0, 30, 61]
+        mocked_execute.return_value = ('{"sprog": 16384, "sstat": 2}', '')
+        block_device = hardware.BlockDevice('/dev/nvme0n1', "testdisk",
+                                            1073741824, False)
+        self.assertRaisesRegex(errors.BlockDeviceEraseError,
+                               'progress 25.0%',
+                               self.hardware._wait_for_nvme_sanitize,
+                               block_device)
+        mocked_sleep.assert_called_once_with(5)
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_get_nvme_sanitize_status_invalid(self, mocked_execute):
+        mocked_execute.return_value = ('{"nvme0n1": {}}', '')
+        block_device = hardware.BlockDevice('/dev/nvme0n1', "testdisk",
+                                            1073741824, False)
+        self.assertRaises(errors.BlockDeviceEraseError,
+                          self.hardware._get_nvme_sanitize_status,
+                          block_device)
+
+    @mock.patch.object(glob, 'glob', autospec=True)
+    def test_get_nvme_namespaces(self, mocked_glob):
+        mocked_glob.return_value = ['/sys/block/nvme1n2',
+                                    '/sys/block/nvme1n1']
+        block_device = hardware.BlockDevice('/dev/nvme1n1', "testdisk",
+                                            1073741824, False)
+        self.assertEqual(['/dev/nvme1n1', '/dev/nvme1n2'],
+                         self.hardware._get_nvme_namespaces(block_device))
+        mocked_glob.assert_called_once_with('/sys/block/nvme1n*')
+
+    def test_get_nvme_namespaces_partition(self):
+        block_device = hardware.BlockDevice('/dev/nvme1n1p1', "testdisk",
+                                            1073741824, False)
+        self.assertEqual([],
+                         self.hardware._get_nvme_namespaces(block_device))
+
+    @mock.patch.object(hardware, 'safety_check_block_device', autospec=True)
+    @mock.patch.object(time, 'sleep', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_nvme_namespaces', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_virtual_media_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_linux_raid_member', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       'list_block_devices_check_skip_list', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_linux_raid_membership', autospec=True,
+                       return_value={})
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_erase_devices_nvme_sanitize_all(self, mocked_execute,
+                                             mocked_membership,
+                                             mocked_list, mocked_raid_member,
+                                             mocked_ro_device, mocked_vm,
+                                             mocked_namespaces, mocked_sleep,
+                                             mocked_safety):
+        self.config(enable_nvme_sanitize=True)
+        devices = [
+            hardware.BlockDevice('/dev/nvme0n1', "testdisk", 1073741824,
+                                 False),
+            hardware.BlockDevice('/dev/nvme1n1', "testdisk", 1073741824,
+                                 False),
+        ]
+        mocked_list.return_value = devices
+        mocked_raid_member.return_value = False
+        mocked_ro_device.return_value = False
+        mocked_vm.return_value = False
+        mocked_namespaces.side_effect = lambda _self, dev: [dev.name]
+        mocked_execute.side_effect = [
+            (hws.NVME_CLI_INFO_TEMPLATE_CRYPTO_SUPPORTED, ''),
+            ('', ''),
+            (hws.NVME_CLI_INFO_TEMPLATE_CRYPTO_SUPPORTED, ''),
+            ('', ''),
+            ('{"sprog": 65535, "sstat": 1}', ''),
+            ('{"sprog": 65535, "sstat": 1}', ''),
+        ]
+
+        result = self.hardware.erase_devices(self.node, [])
+        self.assertEqual({'/dev/nvme0n1': None, '/dev/nvme1n1': None},
+                         result)
+        mocked_execute.assert_has_calls([
+            mock.call('nvme', 'id-ctrl', '/dev/nvme0n1', '-o', 'json'),
+            mock.call('nvme', 'sanitize', '/dev/nvme0n1', '-a', 4),
+            mock.call('nvme', 'id-ctrl', '/dev/nvme1n1', '-o', 'json'),
+            mock.call('nvme', 'sanitize', '/dev/nvme1n1', '-a', 4),
+            mock.call('nvme', 'sanitize-log', '/dev/nvme0n1', '-o', 'json'),
+            mock.call('nvme', 'sanitize-log', '/dev/nvme1n1', '-o', 'json'),
+        ])
+        mocked_sleep.assert_not_called()
+        self.assertEqual(set(), self.hardware._nvme_sanitize_started)
+
+    @mock.patch.object(hardware, 'safety_check_block_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_start_nvme_sanitize', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_get_nvme_namespaces', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_virtual_media_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_read_only_device', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_is_linux_raid_member', autospec=True)
+    def test_start_nvme_sanitize_all_partial_controller(
+            self, mocked_raid_member, mocked_ro_device, mocked_vm,
+            mocked_namespaces, mocked_start, mocked_safety):
+        mocked_raid_member.return_value = False
+        mocked_ro_device.return_value = False
+        mocked_vm.return_value = False
+        mocked_namespaces.return_value = ['/dev/nvme0n1', '/dev/nvme0n2']
+        devices = [
+            hardware.BlockDevice('/dev/nvme0n1', "testdisk", 1073741824,
+                                 False),
+            hardware.BlockDevice('/dev/sda', "testdisk", 1073741824, False),
+        ]
+        self.hardware._start_nvme_sanitize_all(self.node, devices)
+        mocked_start.assert_not_called()
+        mocked_safety.assert_not_called()
+        self.assertEqual(set(), self.hardware._nvme_sanitize_started)
+
 
 @mock.patch.object(hardware, '_enable_multipath', autospec=True)
 @mock.patch.object(hardware, '_load_ipmi_modules', autospec=True)
@@ -0,0 +1,245 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import os
+import tempfile
+from unittest import mock
+
+import requests
+
+from ironic_python_agent import image_peers
+from ironic_python_agent import image_verification
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent import utils
+
+
+CHECKSUM = 'a' * 64
+SECRET = 'secret'
+
+
+def _digests(data):
+    digests = image_verification.ChunkDigests(image_peers.CHUNK_SIZE)
+    digests.update(data)
+    return digests
+
+
+def _hexdigest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@mock.patch.object(image_peers, 'CHUNK_SIZE', 4)
+class SharedImageTestCase(base.IronicAgentTest):
+
+    def setUp(self):
+        super().setUp()
+        self.data = b'0123456789'
+        fd, self.path = tempfile.mkstemp()
+        self.addCleanup(utils.unlink_without_raise, self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def test_manifest(self):
+        image_peers.share_image('img', self.path, CHECKSUM,
+                                _digests(self.data), SECRET)
+        self.assertEqual({'size': 10, 'chunk_size': 4, 'digest': 'sha256',
+                          'chunks': [_hexdigest(b'0123'),
+                                     _hexdigest(b'4567'),
+                                     _hexdigest(b'89')]},
+                         image_peers.get_manifest('img', CHECKSUM, SECRET))
+
+    def test_manifest_wrong_secret(self):
+        image_peers.share_image('img', self.path, CHECKSUM,
+                                _digests(self.data), SECRET)
+        self.assertIsNone(image_peers.get_manifest('img', CHECKSUM, 'other'))
+        self.assertIsNone(image_peers.get_manifest('img', CHECKSUM, None))
+        self.assertIsNone(image_peers.open_chunk('img', CHECKSUM, None, 0))
+
+    def test_share_without_secret(self):
+        image_peers.share_image('img', self.path, CHECKSUM,
+                                _digests(self.data), None)
+        self.assertEqual({}, image_peers._SHARED_IMAGES)
+        self.assertIsNone(image_peers.get_manifest('img', CHECKSUM, None))
+
+    def test_manifest_not_shared(self):
+        self.assertIsNone(image_peers.get_manifest('img', CHECKSUM, SECRET))
+
+    def test_manifest_wrong_checksum(self):
+        image_peers.share_image('img', self.path, CHECKSUM,
+                                _digests(self.data), SECRET)
+        self.assertIsNone(image_peers.get_manifest('img', 'b' * 64, SECRET))
+        self.assertIsNone(image_peers.get_manifest('img', None, SECRET))
+
+    def test_manifest_image_removed(self):
+        image_peers.share_image('img', self.path, CHECKSUM,
+                                _digests(self.data), SECRET)
+        os.unlink(self.path)
+        self.assertIsNone(image_peers.get_manifest('img', CHECKSUM, SECRET))
+        self.assertEqual({}, image_peers._SHARED_IMAGES)
+
+    def test_open_chunk(self):
+        image_peers.share_image('img', self.path, CHECKSUM,
+                                _digests(self.data), SECRET)
+        length, data = image_peers.open_chunk('img', CHECKSUM, SECRET, 1)
+        self.assertEqual(4, length)
+        self.assertEqual(b'4567', b''.join(data))
+        length, data = image_peers.open_chunk('img', CHECKSUM, SECRET, 2)
+        self.assertEqual(2, length)
+        self.assertEqual(b'89', b''.join(data))
+
+    def test_open_chunk_out_of_range(self):
+        image_peers.share_image('img', self.path, CHECKSUM,
+                                _digests(self.data), SECRET)
+        self.assertIsNone(image_peers.open_chunk('img', CHECKSUM, SECRET, 3))
+        self.assertIsNone(image_peers.open_chunk('img', CHECKSUM, SECRET, -1))
+
+    def test_open_chunk_wrong_checksum(self):
+        image_peers.share_image('img', self.path, CHECKSUM,
+                                _digests(self.data), SECRET)
+        self.assertIsNone(image_peers.open_chunk('img', 'b' * 64, SECRET, 0))
+
+
+class GetPeersTestCase(base.IronicAgentTest):
+
+    def test_from_image_info(self):
+        self.config(image_peers=['http://192.0.2.1:9999'])
+        self.assertEqual(['http://192.0.2.2:9999'],
+                         image_peers.get_peers(
+                             {'image_peers': ['http://192.0.2.2:9999/']}))
+
+    def test_from_config(self):
+        self.config(image_peers=['http://192.0.2.1:9999'])
+        self.assertEqual(['http://192.0.2.1:9999'],
+                         image_peers.get_peers({}))
+
+    def test_none(self):
+        self.assertEqual([], image_peers.get_peers({}))
+
+
+def _response(status_code=200, json=None, content=None):
+    resp = mock.Mock(spec=['status_code', 'json', 'content'])
+    resp.status_code = status_code
+    resp.json.return_value = json
+    resp.content = content
+    return resp
+
+
+@mock.patch.object(image_peers, 'CHUNK_SIZE', 4)
+@mock.patch.object(utils, 'get_shared_requests_session', autospec=True)
+class PeerDownloadTestCase(base.IronicAgentTest):
+
+    def setUp(self):
+        super().setUp()
+        self.image_info = {'id': 'img',
+                           'image_peers': ['http://peer1', 'http://peer2',
+                                           'http://peer3'],
+                           'image_peers_secret': SECRET}
+        self.manifest = {'size': 6, 'chunk_size': 4, 'digest': 'sha256',
+                         'chunks': [_hexdigest(b'0123'), _hexdigest(b'45')]}
+
+    def test_find(self, mock_session):
+        mock_get = mock_session.return_value.get
+        mock_get.side_effect = [
+            _response(404),
+            _response(json=self.manifest),
+            _response(json=self.manifest),
+        ]
+        download = image_peers.PeerDownload.find(self.image_info, CHECKSUM)
+        self.assertEqual(['http://peer2', 'http://peer3'], download.peers)
+        self.assertEqual(6, download.size)
+        mock_get.assert_called_with('http://peer3/v1/images/img/manifest',
+                                    params={'checksum': CHECKSUM},
+                                    headers={'X-Image-Peers-Secret': SECRET},
+                                    timeout=60)
+
+    def test_find_ignores_different_manifests(self, mock_session):
+        other = dict(self.manifest, size=7)
+        mock_session.return_value.get.side_effect = [
+            requests.ConnectionError(),
+            _response(json=self.manifest),
+            _response(json=other),
+        ]
+        download = image_peers.PeerDownload.find(self.image_info, CHECKSUM)
+        self.assertEqual(['http://peer2'], download.peers)
+
+    def test_find_ignores_different_chunk_size(self, mock_session):
+        other = dict(self.manifest, chunk_size=8)
+        mock_session.return_value.get.return_value = _response(json=other)
+        self.assertIsNone(
+            image_peers.PeerDownload.find(self.image_info, CHECKSUM))
+
+    def test_find_no_peers(self, mock_session):
+        self.assertIsNone(image_peers.PeerDownload.find({'id': 'img'},
+                                                        CHECKSUM))
+        mock_session.return_value.get.assert_not_called()
+
+    def test_find_no_secret(self, mock_session):
+        del self.image_info['image_peers_secret']
+        self.assertIsNone(
+            image_peers.PeerDownload.find(self.image_info, CHECKSUM))
+        mock_session.return_value.get.assert_not_called()
+
+    def test_find_secret_from_config(self, mock_session):
+        del self.image_info['image_peers_secret']
+        self.config(image_peers_secret='configured')
+        mock_get = mock_session.return_value.get
+        mock_get.return_value = _response(json=self.manifest)
+        download = image_peers.PeerDownload.find(self.image_info, CHECKSUM)
+        self.assertEqual(3, len(download.peers))
+        self.assertEqual({'X-Image-Peers-Secret': 'configured'},
+                         mock_get.call_args.kwargs['headers'])
+
+    def test_find_disabled(self, mock_session):
+        image_peers.disable('img')
+        self.assertIsNone(
+            image_peers.PeerDownload.find(self.image_info, CHECKSUM))
+        mock_session.return_value.get.assert_not_called()
+
+    def test_fetch(self, mock_session):
+        mock_get = mock_session.return_value.get
+        download = image_peers.PeerDownload('img', CHECKSUM, SECRET,
+                                            ['http://peer1', 'http://peer2'],
+                                            self.manifest)
+        mock_get.side_effect = [_response(content=b'0123'),
+                                _response(content=b'45')]
+        self.assertEqual(b'0123', download.fetch(0))
+        self.assertEqual(b'45', download.fetch(1))
+        mock_get.assert_has_calls([
+            mock.call('http://peer1/v1/images/img/chunks/0',
+                      params={'checksum': CHECKSUM},
+                      headers={'X-Image-Peers-Secret': SECRET}, timeout=60),
+            mock.call('http://peer2/v1/images/img/chunks/1',
+                      params={'checksum': CHECKSUM},
+                      headers={'X-Image-Peers-Secret': SECRET}, timeout=60),
+        ])
+        self.assertEqual(2, download.from_peers)
+
+    def test_fetch_invalid(self, mock_session):
+        mock_get = mock_session.return_value.get
+        download = image_peers.PeerDownload('img', CHECKSUM, SECRET,
+                                            ['http://peer1', 'http://peer2'],
+                                            self.manifest)
+        mock_get.side_effect = [_response(content=b'bad!'),
+                                _response(content=b'0123')]
+        self.assertEqual(b'0123', download.fetch(0))
+        self.assertEqual(['http://peer2'], download.peers)
+
+    def test_fetch_unavailable(self, mock_session):
+        mock_get = mock_session.return_value.get
+        download = image_peers.PeerDownload('img', CHECKSUM, SECRET,
+                                            ['http://peer1', 'http://peer2'],
+                                            self.manifest)
+        mock_get.side_effect = [requests.Timeout(), _response(404)]
+        self.assertIsNone(download.fetch(1))
+        self.assertEqual([], download.peers)
+        self.assertIsNone(download.fetch(0))
+        self.assertEqual(2, mock_get.call_count)
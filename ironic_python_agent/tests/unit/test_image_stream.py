@@ -0,0 +1,195 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import os
+import socket
+import struct
+import tempfile
+import threading
+
+from ironic_python_agent import image_stream
+from ironic_python_agent.tests.unit import base
+
+
+class TestGrowingFile(base.IronicAgentTest):
+
+    def test_wait_for(self):
+        growing = image_stream.GrowingFile('/fake', 10)
+        growing.advance(4)
+        growing.wait_for(4)
+        thread = threading.Thread(target=growing.advance, args=(6,))
+        thread.start()
+        growing.wait_for(100)
+        thread.join()
+        self.assertEqual(10, growing.available)
+
+    def test_wait_for_failed(self):
+        growing = image_stream.GrowingFile('/fake', 10)
+        growing.fail('boom')
+        self.assertEqual('boom', growing.error)
+        self.assertRaisesRegex(IOError, 'boom', growing.wait_for, 1)
+
+    def test_wait_for_short(self):
+        growing = image_stream.GrowingFile('/fake', 10)
+        growing.advance(4)
+        growing.finish()
+        growing.wait_for(4)
+        self.assertRaisesRegex(IOError, 'finished at 4 bytes',
+                               growing.wait_for, 5)
+
+
+class NbdClient(object):
+    """A minimal NBD client speaking the fixed newstyle protocol."""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(10)
+        self.sock.connect(path)
+        self.handle = 0
+
+    def recv(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def option(self, option, data=b''):
+        self.sock.sendall(struct.pack('>QII', image_stream.NBD_IHAVEOPT,
+                                      option, len(data)) + data)
+
+    def option_reply(self):
+        magic, option, reply, length = struct.unpack('>QIII', self.recv(20))
+        assert magic == image_stream.NBD_REP_MAGIC
+        return option, reply, self.recv(length)
+
+    def handshake(self):
+        magic, ihaveopt, flags = struct.unpack('>8sQH', self.recv(18))
+        assert magic == image_stream.NBD_MAGIC
+        assert ihaveopt == image_stream.NBD_IHAVEOPT
+        self.sock.sendall(struct.pack('>I', flags))
+        self.option(image_stream.NBD_OPT_GO, struct.pack('>IH', 0, 0))
+        _, reply, data = self.option_reply()
+        assert reply == image_stream.NBD_REP_INFO
+        _, size, transmission_flags = struct.unpack('>HQH', data)
+        _, reply, _ = self.option_reply()
+        assert reply == image_stream.NBD_REP_ACK
+        return size, transmission_flags
+
+    def request(self, cmd, offset, length, data=b''):
+        self.handle += 1
+        self.sock.sendall(struct.pack('>IHHQQI',
+                                      image_stream.NBD_REQUEST_MAGIC, 0, cmd,
+                                      self.handle, offset, length) + data)
+
+    def reply(self, length=0):
+        magic, error, handle = struct.unpack('>IIQ', self.recv(16))
+        assert magic == image_stream.NBD_SIMPLE_REPLY_MAGIC
+        assert handle == self.handle
+        if error:
+            return error, b''
+        return error, self.recv(length)
+
+    def read(self, offset, length):
+        self.request(image_stream.NBD_CMD_READ, offset, length)
+        return self.reply(length)
+
+    def close(self):
+        self.request(image_stream.NBD_CMD_DISC, 0, 0)
+        self.sock.close()
+
+
+class TestNbdServer(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestNbdServer, self).setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'image')
+        self.data = bytes(range(256)) * 16
+        with open(self.path, 'wb') as f:
+            f.write(self.data[:1024])
+        self.growing = image_stream.GrowingFile(self.path, len(self.data))
+        self.growing.advance(1024)
+        self.server = image_stream.NbdServer(
+            self.growing, os.path.join(tmpdir.name, 'sock'))
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.client = NbdClient(self.server.socket_path)
+        self.addCleanup(self.client.sock.close)
+
+    def _append_rest(self):
+        with open(self.path, 'ab') as f:
+            f.write(self.data[1024:])
+        self.growing.advance(len(self.data) - 1024)
+
+    def test_uri(self):
+        self.assertEqual('nbd+unix:///?socket=%s' % self.server.socket_path,
+                         self.server.uri)
+
+    def test_read(self):
+        size, flags = self.client.handshake()
+        self.assertEqual(len(self.data), size)
+        self.assertTrue(flags & image_stream.NBD_FLAG_READ_ONLY)
+        self.assertEqual((0, self.data[100:612]),
+                         self.client.read(100, 512))
+        self.client.close()
+
+    def test_read_waits_for_download(self):
+        self.client.handshake()
+        self.client.request(image_stream.NBD_CMD_READ, 2048, 1024)
+        timer = threading.Timer(0.1, self._append_rest)
+        timer.start()
+        self.assertEqual((0, self.data[2048:3072]), self.client.reply(1024))
+        timer.join()
+        self.client.close()
+
+    def test_read_failed_download(self):
+        self.client.handshake()
+        self.client.request(image_stream.NBD_CMD_READ, 2048, 1024)
+        timer = threading.Timer(0.1, self.growing.fail, args=('boom',))
+        timer.start()
+        self.assertEqual((errno.EIO, b''), self.client.reply())
+        timer.join()
+        # The connection is still usable
+        self.assertEqual((0, self.data[:10]), self.client.read(0, 10))
+        self.client.close()
+
+    def test_read_out_of_range(self):
+        self.client.handshake()
+        self.assertEqual((errno.EINVAL, b''),
+                         self.client.read(len(self.data) - 1, 2))
+        self.client.close()
+
+    def test_write_refused(self):
+        self.client.handshake()
+        self.client.request(image_stream.NBD_CMD_WRITE, 0, 4, b'data')
+        self.assertEqual((errno.EPERM, b''), self.client.reply())
+        self.client.request(image_stream.NBD_CMD_FLUSH, 0, 0)
+        self.assertEqual((0, b''), self.client.reply())
+        self.client.close()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.data[:1024], f.read())
+
+    def test_unsupported_option(self):
+        self.client.recv(18)
+        self.client.sock.sendall(struct.pack('>I', 3))
+        self.client.option(42, b'abc')
+        self.assertEqual((42, image_stream.NBD_REP_ERR_UNSUP, b''),
+                         self.client.option_reply())
+        self.client.option(image_stream.NBD_OPT_ABORT)
+        self.assertEqual((image_stream.NBD_OPT_ABORT,
+                          image_stream.NBD_REP_ACK, b''),
+                         self.client.option_reply())
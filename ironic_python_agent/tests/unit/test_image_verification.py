@@ -0,0 +1,182 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import os
+import tempfile
+from unittest import mock
+
+from oslo_concurrency import processutils
+
+from ironic_python_agent import errors
+from ironic_python_agent import image_verification
+from ironic_python_agent.metrics_lib import metrics_utils
+from ironic_python_agent import qemu_img
+from ironic_python_agent.tests.unit import base
+
+
+def _sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+class ChunkDigestsTestCase(base.IronicAgentTest):
+
+    def test_digests(self):
+        digests = image_verification.ChunkDigests(chunk_size=4)
+        for piece in (b'abc', b'defghi', b'', b'jk'):
+            digests.update(piece)
+        self.assertEqual([(0, 4, _sha256(b'abcd')),
+                          (4, 4, _sha256(b'efgh')),
+                          (8, 3, _sha256(b'ijk'))],
+                         digests.get_extents())
+
+    def test_exact_chunks(self):
+        digests = image_verification.ChunkDigests(chunk_size=2)
+        digests.update(b'abcd')
+        self.assertEqual([(0, 2, _sha256(b'ab')), (2, 2, _sha256(b'cd'))],
+                         digests.get_extents())
+
+    def test_empty(self):
+        digests = image_verification.ChunkDigests()
+        self.assertEqual([], digests.get_extents())
+
+
+@mock.patch.object(qemu_img, 'image_map', autospec=True)
+class GetImageExtentsTestCase(base.IronicAgentTest):
+
+    def test_raw(self, mock_map):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 1000)
+            f.flush()
+            self.assertEqual(([(0, 1000, 0)], 0, 0),
+                             image_verification.get_image_extents(
+                                 f.name, 'raw', is_raw=True))
+        mock_map.assert_not_called()
+
+    def test_mapped(self, mock_map):
+        mock_map.return_value = [
+            {'start': 0, 'length': 100, 'data': True, 'zero': False,
+             'offset': 1000},
+            {'start': 100, 'length': 50, 'data': True, 'zero': False,
+             'offset': 1100},
+            {'start': 150, 'length': 50, 'data': True, 'zero': False,
+             'offset': 5000},
+            {'start': 200, 'length': 300, 'data': False, 'zero': True},
+            {'start': 500, 'length': 20, 'data': True, 'zero': True,
+             'offset': 6000},
+            {'start': 520, 'length': 30, 'data': True, 'zero': False,
+             'compressed': True},
+            {'start': 550, 'length': 10, 'data': True, 'zero': False,
+             'offset': 7000},
+        ]
+        self.assertEqual(
+            ([(0, 150, 1000), (150, 50, 5000), (550, 10, 7000)], 320, 30),
+            image_verification.get_image_extents('image', 'qcow2'))
+        mock_map.assert_called_once_with('image', 'qcow2')
+
+
+class VerifyWrittenImageTestCase(base.IronicAgentTest):
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(3 * 4096 + 100)
+        self.device = self._make_file(self.data)
+        patcher = mock.patch.object(metrics_utils, 'get_metrics_logger',
+                                    autospec=True)
+        self.mock_metrics = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def _make_file(self, data):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return path
+
+    @mock.patch.object(image_verification, 'CHUNK_SIZE', 4096)
+    def test_image_file(self):
+        # The data of the image is stored at another offset in the file
+        image = self._make_file(b'\0' * 512 + self.data[1000:])
+        report = image_verification.verify_written_image(
+            self.device, [(1000, len(self.data) - 1000, 512)], image=image,
+            zero_bytes=42, unverified_bytes=7, threads=2)
+        self.assertEqual(len(self.data) - 1000, report['bytes_verified'])
+        self.assertEqual(3, report['chunks'])
+        self.assertEqual(2, report['threads'])
+        self.assertEqual(42, report['zero_bytes'])
+        self.assertEqual(7, report['unverified_bytes'])
+        self.assertEqual(0, report['mismatched_chunks'])
+        self.mock_metrics.send_gauge.assert_called_once_with(
+            'image_verification_throughput', report['throughput'])
+
+    @mock.patch.object(image_verification, 'CHUNK_SIZE', 4096)
+    def test_image_file_mismatch(self):
+        corrupted = bytearray(self.data)
+        corrupted[5000] ^= 0xff
+        image = self._make_file(bytes(corrupted))
+        exc = self.assertRaises(
+            errors.ImageVerificationError,
+            image_verification.verify_written_image,
+            self.device, [(0, len(self.data), 0)], image=image)
+        self.assertIn('1 of 4 chunks differ from the image, first at offset '
+                      '4096', str(exc))
+
+    def test_digests(self):
+        digests = image_verification.ChunkDigests(chunk_size=5000)
+        digests.update(self.data)
+        report = image_verification.verify_written_image(
+            self.device, digests.get_extents(), threads=8)
+        self.assertEqual(len(self.data), report['bytes_verified'])
+        self.assertEqual(3, report['threads'])
+
+    def test_digests_mismatch(self):
+        digests = image_verification.ChunkDigests(chunk_size=5000)
+        digests.update(self.data[:-1] + b'!')
+        self.assertRaises(errors.ImageVerificationError,
+                          image_verification.verify_written_image,
+                          self.device, digests.get_extents())
+
+    def test_device_too_small(self):
+        digests = image_verification.ChunkDigests()
+        digests.update(self.data + b'more')
+        exc = self.assertRaises(errors.ImageVerificationError,
+                                image_verification.verify_written_image,
+                                self.device, digests.get_extents())
+        self.assertIn('failed to read the written image', str(exc))
+
+    def test_nothing_to_verify(self):
+        report = image_verification.verify_written_image(
+            self.device, [], zero_bytes=100)
+        self.assertEqual(0, report['chunks'])
+        self.assertEqual(100, report['zero_bytes'])
+
+
+@mock.patch.object(image_verification, 'verify_written_image', autospec=True)
+@mock.patch.object(image_verification, 'get_image_extents', autospec=True)
+class VerifyImageFileTestCase(base.IronicAgentTest):
+
+    def test_verify(self, mock_extents, mock_verify):
+        mock_extents.return_value = ([(0, 10, 20)], 30, 40)
+        result = image_verification.verify_image_file('/dev/sda', 'image',
+                                                      'qcow2')
+        self.assertIs(mock_verify.return_value, result)
+        mock_extents.assert_called_once_with('image', 'qcow2', is_raw=False)
+        mock_verify.assert_called_once_with('/dev/sda', [(0, 10, 20)],
+                                            image='image', zero_bytes=30,
+                                            unverified_bytes=40)
+
+    def test_map_fails(self, mock_extents, mock_verify):
+        mock_extents.side_effect = processutils.ProcessExecutionError()
+        self.assertRaises(errors.ImageVerificationError,
+                          image_verification.verify_image_file,
+                          '/dev/sda', 'image', 'qcow2')
+        mock_verify.assert_not_called()
@@ -10,13 +10,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import gzip
+import os
 import shutil
 import tempfile
 from unittest import mock
+import zlib
 
 from oslo_concurrency import processutils
 from oslo_config import cfg
+from oslo_utils import units
 import requests
 
 from ironic_python_agent import disk_partitioner
@@ -26,128 +30,195 @@ from ironic_python_agent import hardware
 from ironic_python_agent import partition_utils
 from ironic_python_agent import qemu_img
 from ironic_python_agent.tests.unit import base
+from ironic_python_agent import timeline
 from ironic_python_agent import utils
 
 
 CONF = cfg.CONF
 
 
-@mock.patch.object(shutil, 'copyfileobj', autospec=True)
+def _gzip_b64(data):
+    return base64.b64encode(gzip.compress(data))
+
+
 @mock.patch.object(utils, 'get_requests_session', autospec=True)
 class GetConfigdriveTestCase(base.IronicAgentTest):
 
-    @mock.patch.object(gzip, 'GzipFile', autospec=True)
-    def test_get_configdrive(self, mock_gzip, mock_session, mock_copy):
-        mock_get = mock.MagicMock(content='Zm9vYmFy',
-                                  status_code=200)
-        mock_session.return_value.get.return_value = mock_get
+    def _response(self, *chunks, status_code=200):
+        resp = mock.MagicMock(status_code=status_code)
+        resp.iter_content.return_value = iter(chunks)
+        return resp
+
+    def _get(self, configdrive='http://1.2.3.4/cd'):
         tempdir = tempfile.mkdtemp()
-        (size, path) = partition_utils.get_configdrive('http://1.2.3.4/cd',
-                                                       'fake-node-uuid',
-                                                       tempdir=tempdir)
+        self.addCleanup(shutil.rmtree, tempdir)
+        size, path = partition_utils.get_configdrive(configdrive,
+                                                     'fake-node-uuid',
+                                                     tempdir=tempdir)
         self.assertTrue(path.startswith(tempdir))
+        with open(path, 'rb') as fp:
+            return size, fp.read()
+
+    def test_get_configdrive(self, mock_session):
+        resp = self._response(_gzip_b64(b'foobar'))
+        mock_session.return_value.get.return_value = resp
+        self.assertEqual((1, b'foobar'), self._get())
         mock_session.return_value.get.assert_called_once_with(
-            'http://1.2.3.4/cd', timeout=60)
-        mock_gzip.assert_called_once_with('configdrive', 'rb',
-                                          fileobj=mock.ANY)
-        mock_copy.assert_called_once_with(mock.ANY, mock.ANY)
-
-    @mock.patch.object(gzip, 'GzipFile', autospec=True)
-    def test_get_configdrive_insecure(self, mock_gzip, mock_session,
-                                      mock_copy):
+            'http://1.2.3.4/cd', timeout=60, stream=True)
+        resp.iter_content.assert_called_once_with(
+            chunk_size=partition_utils.CONFIGDRIVE_CHUNK_SIZE)
+        resp.close.assert_called_once_with()
+
+    def test_get_configdrive_insecure(self, mock_session):
         self.config(insecure=True)
-        mock_get = mock.MagicMock(content='Zm9vYmFy',
-                                  status_code=200)
-        mock_session.return_value.get.return_value = mock_get
-        tempdir = tempfile.mkdtemp()
-        (size, path) = partition_utils.get_configdrive('http://1.2.3.4/cd',
-                                                       'fake-node-uuid',
-                                                       tempdir=tempdir)
-        self.assertTrue(path.startswith(tempdir))
+        mock_session.return_value.get.return_value = self._response(
+            _gzip_b64(b'foobar'))
+        self.assertEqual((1, b'foobar'), self._get())
         mock_session.return_value.get.assert_called_once_with(
-            'http://1.2.3.4/cd', timeout=60)
-        mock_gzip.assert_called_once_with('configdrive', 'rb',
-                                          fileobj=mock.ANY)
-        mock_copy.assert_called_once_with(mock.ANY, mock.ANY)
+            'http://1.2.3.4/cd', timeout=60, stream=True)
 
-    @mock.patch.object(gzip, 'GzipFile', autospec=True)
-    def test_get_configdrive_ssl(self, mock_gzip, mock_session, mock_copy):
+    def test_get_configdrive_ssl(self, mock_session):
         self.config(cafile='cafile', keyfile='keyfile', certfile='certfile')
-        mock_get = mock.MagicMock(content='Zm9vYmFy',
-                                  status_code=200)
-        mock_session.return_value.get.return_value = mock_get
-        tempdir = tempfile.mkdtemp()
-        (size, path) = partition_utils.get_configdrive('http://1.2.3.4/cd',
-                                                       'fake-node-uuid',
-                                                       tempdir=tempdir)
-        self.assertTrue(path.startswith(tempdir))
+        mock_session.return_value.get.return_value = self._response(
+            _gzip_b64(b'foobar'))
+        self.assertEqual((1, b'foobar'), self._get())
         mock_session.return_value.get.assert_called_once_with(
-            'http://1.2.3.4/cd', timeout=60)
-        mock_gzip.assert_called_once_with('configdrive', 'rb',
-                                          fileobj=mock.ANY)
-        mock_copy.assert_called_once_with(mock.ANY, mock.ANY)
-
-    def test_get_configdrive_binary(self, mock_session, mock_copy):
-        mock_get = mock.MagicMock(content=b'content',
-                                  status_code=200)
-        mock_session.return_value.get.return_value = mock_get
-        tempdir = tempfile.mkdtemp()
-        (size, path) = partition_utils.get_configdrive('http://1.2.3.4/cd',
-                                                       'fake-node-uuid',
-                                                       tempdir=tempdir)
-        self.assertTrue(path.startswith(tempdir))
-        self.assertEqual(b'content', open(path, 'rb').read())
+            'http://1.2.3.4/cd', timeout=60, stream=True)
+
+    def test_get_configdrive_chunked(self, mock_session):
+        content = os.urandom(3 * units.Mi // 2)
+        encoded = base64.encodebytes(gzip.compress(content))
+        # Chunk boundaries split base64 quadruples and new lines
+        chunks = [encoded[i:i + 4099] for i in range(0, len(encoded), 4099)]
+        mock_session.return_value.get.return_value = self._response(*chunks)
+        self.assertEqual((2, content), self._get())
+
+    def test_get_configdrive_highly_compressed(self, mock_session):
+        mock_session.return_value.get.return_value = self._response(
+            _gzip_b64(b'\0' * 5 * units.Mi))
+        with mock.patch.object(partition_utils.zlib, 'decompressobj',
+                               wraps=zlib.decompressobj) as mock_zlib:
+            size, content = self._get()
+        self.assertEqual(5, size)
+        self.assertEqual(b'\0' * 5 * units.Mi, content)
+        mock_zlib.assert_called_once_with(16 + zlib.MAX_WBITS)
+
+    def test_get_configdrive_concatenated_members(self, mock_session):
+        encoded = base64.b64encode(gzip.compress(b'foo') + b'\0' * 8
+                                   + gzip.compress(b'bar'))
+        mock_session.return_value.get.return_value = self._response(
+            encoded[:10], b'', encoded[10:])
+        self.assertEqual((1, b'foobar'), self._get())
+
+    def test_get_configdrive_binary(self, mock_session):
+        mock_session.return_value.get.return_value = self._response(
+            b'\0' * 100, b'content')
+        self.assertEqual((1, b'\0' * 100 + b'content'), self._get())
         mock_session.return_value.get.assert_called_once_with(
-            'http://1.2.3.4/cd', timeout=60)
-        self.assertFalse(mock_copy.called)
+            'http://1.2.3.4/cd', timeout=60, stream=True)
 
-    @mock.patch.object(gzip, 'GzipFile', autospec=True)
-    def test_get_configdrive_base64_string(self, mock_gzip, mock_session,
-                                           mock_copy):
-        partition_utils.get_configdrive('Zm9vYmFy', 'fake-node-uuid')
+    def test_get_configdrive_base64_string(self, mock_session):
+        self.assertEqual((1, b'foobar'),
+                         self._get(_gzip_b64(b'foobar').decode()))
         self.assertFalse(mock_session.called)
-        mock_gzip.assert_called_once_with('configdrive', 'rb',
-                                          fileobj=mock.ANY)
-        mock_copy.assert_called_once_with(mock.ANY, mock.ANY)
 
-    def test_get_configdrive_bad_url(self, mock_session, mock_copy):
+    @mock.patch.object(partition_utils, 'CONFIGDRIVE_CHUNK_SIZE', 5)
+    def test_get_configdrive_base64_string_chunked(self, mock_session):
+        encoded = base64.encodebytes(gzip.compress(b'foobar' * 10))
+        self.assertEqual((1, b'foobar' * 10), self._get(encoded.decode()))
+
+    def test_get_configdrive_bad_url(self, mock_session):
         mock_session.return_value.get.side_effect = (
             requests.exceptions.RequestException)
         self.assertRaises(errors.DeploymentError,
                           partition_utils.get_configdrive,
                           'http://1.2.3.4/cd', 'fake-node-uuid')
-        self.assertFalse(mock_copy.called)
 
-    def test_get_configdrive_bad_status_code(self, mock_session, mock_copy):
+    def test_get_configdrive_bad_status_code(self, mock_session):
         mock_get = mock.MagicMock(text='Not found',
                                   status_code=404)
         mock_session.return_value.get.return_value = mock_get
         self.assertRaises(errors.DeploymentError,
                           partition_utils.get_configdrive,
                           'http://1.2.3.4/cd', 'fake-node-uuid')
-        self.assertFalse(mock_copy.called)
+        self.assertFalse(mock_get.iter_content.called)
 
-    def test_get_configdrive_base64_error(self, mock_session, mock_copy):
+    @mock.patch.object(utils, 'unlink_without_raise', autospec=True)
+    def test_get_configdrive_connection_lost(self, mock_unlink,
+                                             mock_session):
+        def chunks():
+            yield _gzip_b64(b'foobar')[:8]
+            raise requests.exceptions.ChunkedEncodingError('lost')
+
+        resp = self._response()
+        resp.iter_content.return_value = chunks()
+        mock_session.return_value.get.return_value = resp
+        self.assertRaisesRegex(errors.DeploymentError, 'lost',
+                               partition_utils.get_configdrive,
+                               'http://1.2.3.4/cd', 'fake-node-uuid')
+        mock_unlink.assert_called_once_with(mock.ANY)
+        resp.close.assert_called_once_with()
+
+    def test_get_configdrive_base64_error(self, mock_session):
         self.assertRaises(errors.DeploymentError,
                           partition_utils.get_configdrive,
                           'malformed', 'fake-node-uuid')
-        self.assertFalse(mock_copy.called)
 
-    @mock.patch.object(gzip, 'GzipFile', autospec=True)
-    def test_get_configdrive_gzip_error(self, mock_gzip, mock_session,
-                                        mock_copy):
-        mock_get = mock.MagicMock(content='Zm9vYmFy',
-                                  status_code=200)
-        mock_session.return_value.get.return_value = mock_get
-        mock_copy.side_effect = IOError
-        self.assertRaises(errors.DeploymentError,
-                          partition_utils.get_configdrive,
-                          'http://1.2.3.4/cd', 'fake-node-uuid')
+    def test_get_configdrive_base64_error_url(self, mock_session):
+        # A valid gzip header followed by an incomplete quadruple
+        mock_session.return_value.get.return_value = self._response(
+            b'H4sI', b'abc')
+        self.assertRaisesRegex(errors.DeploymentError,
+                               'Downloaded from "http://1.2.3.4/cd"',
+                               partition_utils.get_configdrive,
+                               'http://1.2.3.4/cd', 'fake-node-uuid')
+
+    def test_get_configdrive_non_ascii(self, mock_session):
+        self.assertRaisesRegex(errors.DeploymentError,
+                               'not base64 encoded',
+                               partition_utils.get_configdrive,
+                               '\u00e9t\u00e9', 'fake-node-uuid')
+
+    @mock.patch.object(utils, 'unlink_without_raise', autospec=True)
+    def test_get_configdrive_gzip_error(self, mock_unlink, mock_session):
+        mock_session.return_value.get.return_value = self._response(
+            b'Zm9vYmFy')
+        self.assertRaisesRegex(errors.DeploymentError,
+                               'error while decompressing',
+                               partition_utils.get_configdrive,
+                               'http://1.2.3.4/cd', 'fake-node-uuid')
         mock_session.return_value.get.assert_called_once_with(
-            'http://1.2.3.4/cd', timeout=60)
-        mock_gzip.assert_called_once_with('configdrive', 'rb',
-                                          fileobj=mock.ANY)
-        mock_copy.assert_called_once_with(mock.ANY, mock.ANY)
+            'http://1.2.3.4/cd', timeout=60, stream=True)
+        mock_unlink.assert_called_once_with(mock.ANY)
+
+    def test_get_configdrive_truncated(self, mock_session):
+        mock_session.return_value.get.return_value = self._response(
+            base64.b64encode(gzip.compress(b'foobar')[:-6]))
+        self.assertRaisesRegex(errors.DeploymentError,
+                               'end-of-stream marker',
+                               partition_utils.get_configdrive,
+                               'http://1.2.3.4/cd', 'fake-node-uuid')
+
+    def test_get_configdrive_timeline(self, mock_session):
+        with timeline.recording('test') as tl:
+            self._get(_gzip_b64(b'foobar').decode())
+        self.assertEqual([('configdrive_download', 6)],
+                         [(phase['name'], phase['bytes'])
+                          for phase in tl.phases])
+
+    @mock.patch.object(partition_utils.LOG, 'debug', autospec=True)
+    @mock.patch.object(utils, 'get_peak_rss', autospec=True)
+    @mock.patch.object(utils, 'reset_peak_rss', autospec=True)
+    def test_get_configdrive_peak_rss(self, mock_reset, mock_peak,
+                                      mock_debug, mock_session):
+        mock_reset.return_value = True
+        mock_peak.return_value = 42 * units.Mi
+        self._get(_gzip_b64(b'foobar').decode())
+        mock_reset.assert_called_once_with()
+        mock_peak.assert_called_once_with()
+        mock_debug.assert_called_once_with(mock.ANY, {
+            'size': 6, 'node': 'fake-node-uuid', 'since': 'meanwhile',
+            'rss': 42.0})
 
 
 @mock.patch.object(utils, 'execute', autospec=True)
@@ -712,11 +783,14 @@ class CreateConfigDriveTestCases(base.IronicAgentTest):
             mock.call('sgdisk', '-n', '0:-64MB:0', '-u', '0:fake-uuid',
                       self.dev),
             mock.call('sync'),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('partprobe', self.dev, attempts=10),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('sgdisk', '-v', self.dev),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('test', '-e', expected_part, attempts=15,
                       delay_on_retry=True)
         ])
@@ -773,12 +847,15 @@ class CreateConfigDriveTestCases(base.IronicAgentTest):
             mock.call('sgdisk', '-n', '0:-64MB:0', '-u', '0:fake-uuid',
                       self.dev),
             mock.call('sync'),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('partprobe', self.dev, attempts=10),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('sgdisk', '-v', self.dev),
 
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('test', '-e', expected_part, attempts=15,
                       delay_on_retry=True)
         ])
@@ -839,11 +916,14 @@ class CreateConfigDriveTestCases(base.IronicAgentTest):
             mock.call('sgdisk', '-n', '0:-64MB:0', '-u', '0:fake-uuid',
                       self.dev),
             mock.call('sync'),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('partprobe', self.dev, attempts=10),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('sgdisk', '-v', self.dev),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('test', '-e', expected_part, attempts=15,
                       delay_on_retry=True)
         ])
@@ -942,11 +1022,14 @@ class CreateConfigDriveTestCases(base.IronicAgentTest):
         mock_execute.assert_has_calls([
             parted_call,
             mock.call('sync'),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('partprobe', self.dev, attempts=10),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('sgdisk', '-v', self.dev),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('test', '-e', expected_part, attempts=15,
                       delay_on_retry=True)
         ])
@@ -1042,9 +1125,11 @@ class CreateConfigDriveTestCases(base.IronicAgentTest):
                       self.dev, 'mkpart', 'primary',
                       'fat32', '-64MiB', '-0'),
             mock.call('sync'),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('partprobe', self.dev, attempts=10),
-            mock.call('udevadm', 'settle'),
+            mock.call('udevadm', 'trigger', '--settle',
+                      '--action=change', self.dev),
             mock.call('sgdisk', '-v', self.dev),
         ])
 
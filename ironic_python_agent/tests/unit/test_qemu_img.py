@@ -79,6 +79,31 @@ class ImageInfoTestCase(base.IronicAgentTest):
         image_info_mock.assert_not_called()
 
 
+class ImageMapTestCase(base.IronicAgentTest):
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    @mock.patch.object(os.path, 'exists', return_value=True, autospec=True)
+    def test_image_map(self, path_exists_mock, execute_mock):
+        execute_mock.return_value = (
+            '[{"start": 0, "length": 65536, "depth": 0, "present": true, '
+            '"zero": false, "data": true, "offset": 327680}]\n', '')
+        self.assertEqual([{'start': 0, 'length': 65536, 'depth': 0,
+                           'present': True, 'zero': False, 'data': True,
+                           'offset': 327680}],
+                         qemu_img.image_map('img', 'qcow2'))
+        execute_mock.assert_called_once_with(
+            'env', 'LC_ALL=C', 'LANG=C', 'qemu-img', 'map',
+            '--output=json', '-f', 'qcow2', 'img', prlimit=mock.ANY)
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    @mock.patch.object(os.path, 'exists', return_value=False, autospec=True)
+    def test_image_map_path_doesnt_exist(self, path_exists_mock,
+                                         execute_mock):
+        self.assertRaises(FileNotFoundError, qemu_img.image_map, 'noimg',
+                          'qcow2')
+        execute_mock.assert_not_called()
+
+
 class ConvertImageTestCase(base.IronicAgentTest):
 
     @mock.patch.object(utils, 'execute', autospec=True)
@@ -226,6 +251,18 @@ class ConvertImageTestCase(base.IronicAgentTest):
             use_standard_locale=True,
             env_variables={'MALLOC_ARENA_MAX': '3'})
 
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_convert_image_coroutines(self, execute_mock):
+        qemu_img.convert_image('source', 'dest', 'out_format',
+                               out_of_order=True, source_format='fmt',
+                               coroutines=16)
+        execute_mock.assert_called_once_with(
+            'qemu-img', 'convert', '-O',
+            'out_format', '-f', 'fmt', '-m', '16', '-W', 'source', 'dest',
+            prlimit=mock.ANY,
+            use_standard_locale=True,
+            env_variables={'MALLOC_ARENA_MAX': '3'})
+
     @mock.patch.object(utils, 'execute', autospec=True)
     def test_convert_image_retries(self, execute_mock):
         ret_err = 'qemu: qemu_thread_create: Resource temporarily unavailable'
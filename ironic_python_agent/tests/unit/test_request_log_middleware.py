@@ -182,9 +182,12 @@ class TestRequestLogMiddleware(base.IronicAgentTest):
         def start_response(status, headers, exc_info=None):
             return None
 
+        consumed = []
+
         def response_generator():
-            yield b'part1'
-            yield b'part2'
+            for part in (b'part1', b'part2'):
+                consumed.append(part)
+                yield part
 
         def mock_app_call(env, sr):
             sr('200 OK', [])
@@ -194,9 +197,43 @@ class TestRequestLogMiddleware(base.IronicAgentTest):
 
         response = self.middleware(environ, start_response)
 
-        # Response should be consumed and converted to list
-        self.assertEqual(response, [b'part1', b'part2'])
+        # The response is streamed, not consumed by the middleware
+        self.assertEqual([], consumed)
+        self.assertEqual([b'part1', b'part2'], list(response))
+        self.mock_log.info.assert_not_called()
+
+        # Logged once the server closes the response
+        response.close()
+        self.mock_log.info.assert_called_once_with(
+            self.template,
+            {'method': 'GET',
+             'path': '/v1/status',
+             'status': 200,
+             'duration': 500.0,
+             'source_ip': 'unknown'}
+        )
+
+    def test_iterable_response_closed(self):
+        """Test that the closing of iterable responses is passed on."""
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/v1/system_logs',
+            'QUERY_STRING': ''
+        }
+        body = mock.MagicMock()
+        body.__iter__.return_value = iter([b'data'])
+        body.close.side_effect = RuntimeError('close failed')
+
+        def mock_app_call(env, sr):
+            sr('200 OK', [])
+            return body
+
+        self.mock_app.side_effect = mock_app_call
 
+        response = self.middleware(environ, mock.Mock())
+        self.assertEqual([b'data'], list(response))
+        self.assertRaises(RuntimeError, response.close)
+        body.close.assert_called_once_with()
         self.mock_log.info.assert_called_once()
 
     def test_missing_environ_values(self):
@@ -0,0 +1,103 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+from unittest import mock
+
+from ironic_python_agent.metrics_lib import metrics_utils
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent import timeline
+
+
+@timeline.phase('decorated')
+def _decorated(size):
+    timeline.record_bytes(size)
+    return size
+
+
+class TestTimeline(base.IronicAgentTest):
+
+    def test_no_recording(self):
+        self.assertIsNone(timeline.current())
+        with timeline.phase('ignored'):
+            timeline.record_bytes(42)
+        self.assertEqual(42, _decorated(42))
+
+    def test_recording(self):
+        with timeline.recording('test') as tl:
+            self.assertIs(tl, timeline.current())
+            with timeline.phase('outer'):
+                timeline.record_bytes(1)
+                _decorated(10)
+                _decorated(20)
+                timeline.record_bytes(2)
+            with timeline.phase('last'):
+                pass
+        self.assertIsNone(timeline.current())
+
+        phases = tl.serialize()
+        self.assertEqual([('outer', 0, 3), ('decorated', 1, 10),
+                          ('decorated', 1, 20), ('last', 0, None)],
+                         [(phase['name'], phase['depth'], phase.get('bytes'))
+                          for phase in phases])
+        for phase in phases:
+            self.assertLessEqual(phase['start'], phase['end'])
+            self.assertGreaterEqual(phase['duration'], 0)
+            self.assertNotIn('failed', phase)
+        self.assertRegex(tl.summary(),
+                         r'^outer [0-9.]+s \(3 bytes\), last [0-9.]+s$')
+
+    def test_failed_phase(self):
+        with timeline.recording('test') as tl:
+            with timeline.phase('ok'):
+                pass
+            self.assertRaises(RuntimeError, self._fail)
+        phases = tl.serialize()
+        self.assertEqual(['ok', 'failing'],
+                         [phase['name'] for phase in phases])
+        self.assertTrue(phases[1]['failed'])
+        self.assertIn('duration', phases[1])
+
+    @timeline.phase('failing')
+    def _fail(self):
+        raise RuntimeError('boom')
+
+    def test_nested_recording(self):
+        with timeline.recording('outer') as outer:
+            with timeline.recording('inner') as inner:
+                with timeline.phase('phase'):
+                    pass
+            self.assertIs(outer, timeline.current())
+        self.assertEqual([], outer.phases)
+        self.assertEqual(1, len(inner.phases))
+
+    def test_other_thread(self):
+        with timeline.recording('test') as tl:
+            thread = threading.Thread(target=_decorated, args=(1,))
+            thread.start()
+            thread.join()
+        self.assertEqual([], tl.phases)
+
+    @mock.patch.object(metrics_utils, 'get_metrics_logger', autospec=True)
+    def test_send_metrics(self, mock_get_logger):
+        with timeline.recording('cmd') as tl:
+            _decorated(100)
+            with timeline.phase('empty'):
+                pass
+        tl.phases[0]['duration'] = 1.5
+        tl.send_metrics()
+        mock_logger = mock_get_logger.return_value
+        mock_logger.send_timer.assert_has_calls([
+            mock.call('cmd.decorated', 1500), mock.call('cmd.empty', mock.ANY)
+        ])
+        mock_logger.send_gauge.assert_called_once_with(
+            'cmd.decorated.bytes', 100)
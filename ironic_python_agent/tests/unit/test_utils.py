@@ -16,16 +16,23 @@
 import base64
 import errno
 import glob
+from http import server as http_server
 import io
+import json
 import os
 import shutil
+import ssl
 import subprocess
+import sys
 import tarfile
 import tempfile
+import threading
 import time
 from unittest import mock
 
+import fixtures
 from oslo_concurrency import processutils
+from oslo_utils import units
 import requests
 import testtools
 
@@ -387,6 +394,307 @@ class TestUtils(base.IronicAgentTest):
             member = tar.extractfile('fake-name')
             self.assertEqual(contents, member.read())
 
+    def test_iter_gzipped_tar(self):
+        contents = os.urandom(300 * units.Ki)
+        tmp = tempfile.NamedTemporaryFile()
+        self.addCleanup(tmp.close)
+        tmp.write(b'log line\n')
+        tmp.flush()
+        io_dict = {'fake-name': io.BytesIO(contents)}
+
+        chunks = list(utils.iter_gzipped_tar(io_dict=io_dict,
+                                             file_list=[tmp.name]))
+        self.assertGreater(len(chunks), 1)
+        with tarfile.open(fileobj=io.BytesIO(b''.join(chunks))) as tar:
+            self.assertEqual(contents, tar.extractfile('fake-name').read())
+            self.assertEqual(b'log line\n',
+                             tar.extractfile(tmp.name.lstrip('/')).read())
+
+    def test_iter_gzipped_tar_closed(self):
+        io_dict = {'fake-name': io.BytesIO(os.urandom(4 * units.Mi))}
+        stream = utils.iter_gzipped_tar(io_dict=io_dict)
+        self.assertTrue(next(stream))
+        stream.close()
+        self.assertNotIn('tar-stream',
+                         [thread.name for thread in threading.enumerate()])
+
+    def test_iter_gzipped_tar_failure(self):
+        stream = utils.iter_gzipped_tar(file_list=['/nonexistent/file'])
+        self.assertRaises(OSError, list, stream)
+
+    def _collect_logs(self, collect, journal_size=100, **kwargs):
+        tmp = tempfile.NamedTemporaryFile()
+        self.addCleanup(tmp.close)
+        tmp.write(b'agent log\n')
+        tmp.flush()
+        self.config(log_file=tmp.name)
+
+        def _dispatch(method, io_dict, file_list):
+            io_dict['dmesg'] = io.BytesIO(b'dmesg output')
+
+        journal = [sys.executable, '-c',
+                   'import sys; sys.stdout.write("j" * %d)' % journal_size]
+        with mock.patch.object(utils, 'is_journalctl_present',
+                               autospec=True, return_value=True), \
+                mock.patch.object(hardware, 'dispatch_to_all_managers',
+                                  autospec=True, side_effect=_dispatch), \
+                mock.patch.object(utils, '_journalctl_command',
+                                  autospec=True,
+                                  return_value=journal) as mock_cmd:
+            data = collect(**kwargs)
+        mock_cmd.assert_called_once_with(
+            lines=kwargs.get('journald_max_lines'), cursor_file=None)
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            contents = {member.name: tar.extractfile(member).read()
+                        for member in tar}
+        report = json.loads(contents.pop('collection_report.json'))
+        return tmp.name.lstrip('/'), contents, report['sources']
+
+    def test_collect_system_logs(self):
+        log_name, contents, report = self._collect_logs(
+            lambda **kw: base64.b64decode(utils.collect_system_logs(**kw)),
+            journald_max_lines=10)
+        self.assertEqual({'journal': b'j' * 100, 'dmesg': b'dmesg output',
+                          log_name: b'agent log\n'}, contents)
+        self.assertEqual([
+            {'name': 'journal', 'size': 100, 'truncated': False},
+            {'name': 'dmesg', 'size': 12, 'original_size': 12,
+             'truncated': False},
+            {'name': log_name, 'size': 10, 'original_size': 10,
+             'truncated': False},
+        ], report)
+
+    @mock.patch.object(utils, '_LOG_PART_SIZE', 64)
+    def test_stream_system_logs_parts(self):
+        log_name, contents, report = self._collect_logs(
+            lambda **kw: b''.join(utils.stream_system_logs(**kw)))
+        self.assertEqual({'journal': b'j' * 64, 'journal.part2': b'j' * 36,
+                          'dmesg': b'dmesg output',
+                          log_name: b'agent log\n'}, contents)
+        self.assertEqual({'name': 'journal', 'size': 100,
+                          'truncated': False}, report[0])
+
+    @mock.patch.object(utils, '_LOG_PART_SIZE', 64)
+    def test_stream_system_logs_budget(self):
+        # Less than 1 MiB of budget left once the journal is collected
+        self.config(system_logs_max_size=1)
+        log_name, contents, report = self._collect_logs(
+            lambda **kw: b''.join(utils.stream_system_logs(**kw)),
+            journal_size=units.Mi - 5)
+        self.assertEqual(b'dmesg', contents['dmesg'])
+        self.assertEqual(b'', contents[log_name])
+        self.assertEqual([
+            {'name': 'journal', 'size': units.Mi - 5, 'truncated': False},
+            {'name': 'dmesg', 'size': 5, 'original_size': 12,
+             'truncated': True},
+            {'name': log_name, 'size': 0, 'original_size': 10,
+             'truncated': True},
+        ], report)
+
+    def test_stream_system_logs_journal_truncated(self):
+        self.config(system_logs_max_size=1)
+        log_name, contents, report = self._collect_logs(
+            lambda **kw: b''.join(utils.stream_system_logs(**kw)),
+            journal_size=2 * units.Mi)
+        self.assertEqual(units.Mi, len(contents['journal']))
+        self.assertEqual({'name': 'journal', 'size': units.Mi,
+                          'truncated': True}, report[0])
+        self.assertTrue(report[1]['truncated'])
+
+    def test_log_archive_file_shrinks(self):
+        tmp = tempfile.NamedTemporaryFile()
+        self.addCleanup(tmp.close)
+        tmp.write(b'x' * 100)
+        tmp.flush()
+        stream = io.BytesIO()
+        real_open = open
+
+        class _Shrinking(object):
+            # Shrinks the file once its size is known
+            def __init__(self, f):
+                self._f = f
+
+            def __getattr__(self, name):
+                return getattr(self._f, name)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self._f.close()
+
+            def read(self, size):
+                tmp.truncate(40)
+                return self._f.read(size)
+
+        def _open(path, mode):
+            return _Shrinking(real_open(path, mode))
+
+        with tarfile.open(fileobj=stream, mode='w') as tar:
+            archive = utils._LogArchive(tar)
+            with mock.patch('builtins.open', _open):
+                archive.add_file(tmp.name)
+            archive.add_file('/nonexistent')
+
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            member = tar.extractfile(tmp.name.lstrip('/'))
+            self.assertEqual(b'x' * 40 + bytes(60), member.read())
+        self.assertIn('padded with 60 zero bytes',
+                      archive.report[0]['error'])
+        self.assertEqual('nonexistent', archive.report[1]['name'])
+        self.assertIn('No such file', archive.report[1]['error'])
+
+    def test_log_archive_command_fails(self):
+        stream = io.BytesIO()
+        with tarfile.open(fileobj=stream, mode='w') as tar:
+            archive = utils._LogArchive(tar)
+            archive.add_command('failing',
+                                [sys.executable, '-c', 'exit(3)'])
+            archive.add_command('missing', ['/nonexistent/command'])
+        self.assertEqual('failing', archive.report[0]['name'])
+        self.assertIn('exited with code 3', archive.report[0]['error'])
+        self.assertEqual('missing', archive.report[1]['name'])
+        self.assertIn('No such file', archive.report[1]['error'])
+
+    def _fake_journal(self, entries):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.useFixture(fixtures.MockPatchObject(
+            utils.tempfile, 'gettempdir', autospec=True,
+            return_value=tmpdir))
+        journal = os.path.join(tmpdir, 'journal')
+        with open(journal, 'w') as f:
+            f.writelines('%s\n' % entry for entry in entries)
+        # Shows the entries after the position in the cursor file
+        script = ('import sys\n'
+                  'path = sys.argv[sys.argv.index("--cursor-file") + 1]\n'
+                  'entries = open(%r).readlines()\n'
+                  'start = int(open(path).read() or 0)\n'
+                  'sys.stdout.write("".join(entries[start:]))\n'
+                  'open(path, "w").write(str(len(entries)))\n' % journal)
+
+        def _command(lines=None, cursor_file=None):
+            return [sys.executable, '-c', script, '--cursor-file',
+                    cursor_file]
+
+        for target, kwargs in [
+                ('is_journalctl_present', {'return_value': True}),
+                ('_journalctl_command', {'side_effect': _command})]:
+            self.useFixture(fixtures.MockPatchObject(
+                utils, target, autospec=True, **kwargs))
+        self.useFixture(fixtures.MockPatchObject(
+            hardware, 'dispatch_to_all_managers', autospec=True))
+        self.config(log_file=None, log_dir=None)
+        return journal
+
+    @staticmethod
+    def _journal_from_stream(data):
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            return tar.extractfile('journal').read()
+
+    def test_collect_system_logs_consumer(self):
+        journal = self._fake_journal(['one', 'two'])
+
+        def _collect(consumer):
+            data = base64.b64decode(
+                utils.collect_system_logs(consumer=consumer))
+            return self._journal_from_stream(data)
+
+        self.assertEqual(b'one\ntwo\n', _collect('conductor'))
+        self.assertEqual(b'', _collect('conductor'))
+        with open(journal, 'a') as f:
+            f.write('three\n')
+        self.assertEqual(b'three\n', _collect('conductor'))
+        # Consumers are independent
+        self.assertEqual(b'one\ntwo\nthree\n', _collect('other'))
+        # Only the cursors remain
+        self.assertEqual(
+            ['conductor', 'other'],
+            sorted(os.listdir(os.path.dirname(
+                utils.JournalCursor('conductor').path))))
+
+    def test_stream_system_logs_consumer_not_consumed(self):
+        self._fake_journal(['one'])
+
+        stream = utils.stream_system_logs(consumer='conductor')
+        next(stream)
+        stream.close()
+        # The cursor did not move
+        data = b''.join(utils.stream_system_logs(consumer='conductor'))
+        self.assertEqual(b'one\n', self._journal_from_stream(data))
+        data = b''.join(utils.stream_system_logs(consumer='conductor'))
+        self.assertEqual(b'', self._journal_from_stream(data))
+
+    @mock.patch.object(utils, 'get_requests_session', autospec=True)
+    def test_upload_system_logs_consumer(self, mock_session):
+        self._fake_journal(['one'])
+        session = mock_session.return_value
+        uploads = []
+        failed = mock.Mock()
+        failed.raise_for_status.side_effect = requests.HTTPError('500')
+
+        def _put(url, data, **kwargs):
+            uploads.append(b''.join(data))
+            return failed if len(uploads) == 1 else mock.Mock()
+
+        session.put.side_effect = _put
+        self.assertRaises(errors.CommandExecutionError,
+                          utils.upload_system_logs, 'http://example.com/x',
+                          consumer='conductor')
+        utils.upload_system_logs('http://example.com/x',
+                                 consumer='conductor')
+        utils.upload_system_logs('http://example.com/x',
+                                 consumer='conductor')
+        # The failed upload did not move the cursor
+        self.assertEqual([b'one\n', b'one\n', b''],
+                         [self._journal_from_stream(data)
+                          for data in uploads])
+
+    def test_journal_cursor_invalid(self):
+        for consumer in ('', '../etc', '.hidden', 'a/b', 'x' * 65, None):
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              utils.JournalCursor, consumer)
+
+    def test_b64encode_stream(self):
+        data = os.urandom(1000)
+        chunks = [data[:1], data[1:2], data[2:500], data[500:]]
+        self.assertEqual(base64.b64encode(data).decode('ascii'),
+                         utils._b64encode_stream(iter(chunks)))
+        self.assertEqual('', utils._b64encode_stream(iter([])))
+
+    @mock.patch.object(utils, '_iter_system_logs', autospec=True)
+    @mock.patch.object(utils, 'get_requests_session', autospec=True)
+    def test_upload_system_logs(self, mock_session, mock_iter):
+        chunks = mock.MagicMock()
+        chunks.__iter__.return_value = iter([b'abc', b'de'])
+        mock_iter.return_value = chunks
+        session = mock_session.return_value
+        uploaded = []
+        session.put.side_effect = (
+            lambda url, data, **kw: uploaded.extend(data) or mock.Mock())
+
+        self.assertEqual(5, utils.upload_system_logs('http://example.com/x',
+                                                     journald_max_lines=5))
+        mock_iter.assert_called_once_with(5, cursor=None)
+        self.assertEqual([b'abc', b'de'], uploaded)
+        session.put.assert_called_once_with(
+            'http://example.com/x', data=mock.ANY,
+            headers={'Content-Type': 'application/gzip'}, timeout=30)
+        chunks.close.assert_called_once_with()
+        session.close.assert_called_once_with()
+
+    @mock.patch.object(utils, '_iter_system_logs', autospec=True)
+    @mock.patch.object(utils, 'get_requests_session', autospec=True)
+    def test_upload_system_logs_fails(self, mock_session, mock_iter):
+        session = mock_session.return_value
+        session.put.return_value.raise_for_status.side_effect = (
+            requests.HTTPError('403 Forbidden'))
+        self.assertRaisesRegex(errors.CommandExecutionError, '403',
+                               utils.upload_system_logs,
+                               'http://example.com/x')
+        mock_iter.return_value.close.assert_called_once_with()
+
     @mock.patch.object(utils, 'execute', autospec=True)
     def test_get_command_output(self, mock_execute):
         contents = b'Sandra Sandy Cheeks'
@@ -469,79 +777,59 @@ class TestUtils(base.IronicAgentTest):
         mock_call.side_effect = os_error
         self.assertFalse(utils.is_journalctl_present())
 
-    @mock.patch.object(utils, 'gzip_and_b64encode', autospec=True)
     @mock.patch.object(hardware, 'dispatch_to_all_managers', autospec=True)
     @mock.patch.object(utils, 'is_journalctl_present', autospec=True)
-    @mock.patch.object(utils, 'get_journalctl_output', autospec=True)
-    def test_collect_system_logs_journald(
-            self, mock_logs, mock_journalctl, mock_dispatch, mock_gzip_b64):
+    def test_get_system_logs_journald(self, mock_journalctl, mock_dispatch):
         mock_journalctl.return_value = True
-        ret = 'Patrick Star'
-        mock_gzip_b64.return_value = ret
-
-        logs_string = utils.collect_system_logs()
-        self.assertEqual(ret, logs_string)
-        mock_logs.assert_called_once_with(lines=None)
-        mock_gzip_b64.assert_called_once_with(
-            io_dict=mock.ANY, file_list=[])
+
+        journal, io_dict, file_list = utils._get_system_logs()
+        self.assertTrue(journal)
+        self.assertEqual({}, io_dict)
+        self.assertEqual([], file_list)
         mock_dispatch.assert_called_once_with('collect_system_logs',
-                                              mock.ANY, [])
+                                              io_dict, [])
 
-    @mock.patch.object(utils, 'gzip_and_b64encode', autospec=True)
     @mock.patch.object(hardware, 'dispatch_to_all_managers', autospec=True)
     @mock.patch.object(utils, 'is_journalctl_present', autospec=True)
-    @mock.patch.object(utils, 'get_journalctl_output', autospec=True)
-    def test_collect_system_logs_journald_with_logfile(
-            self, mock_logs, mock_journalctl, mock_dispatch, mock_gzip_b64):
+    def test_get_system_logs_journald_with_logfile(self, mock_journalctl,
+                                                   mock_dispatch):
         tmp = tempfile.NamedTemporaryFile()
         self.addCleanup(lambda: tmp.close())
 
         self.config(log_file=tmp.name)
         mock_journalctl.return_value = True
-        ret = 'Patrick Star'
-        mock_gzip_b64.return_value = ret
-
-        logs_string = utils.collect_system_logs()
-        self.assertEqual(ret, logs_string)
-        mock_logs.assert_called_once_with(lines=None)
-        mock_gzip_b64.assert_called_once_with(
-            io_dict=mock.ANY, file_list=[tmp.name])
+
+        journal, io_dict, file_list = utils._get_system_logs()
+        self.assertTrue(journal)
+        self.assertEqual([tmp.name], file_list)
         mock_dispatch.assert_called_once_with('collect_system_logs',
                                               mock.ANY, [tmp.name])
 
-    @mock.patch.object(utils, 'gzip_and_b64encode', autospec=True)
     @mock.patch.object(hardware, 'dispatch_to_all_managers', autospec=True)
     @mock.patch.object(utils, 'is_journalctl_present', autospec=True)
-    def test_collect_system_logs_non_journald(
-            self, mock_journalctl, mock_dispatch, mock_gzip_b64):
+    def test_get_system_logs_non_journald(self, mock_journalctl,
+                                          mock_dispatch):
         mock_journalctl.return_value = False
-        ret = 'SpongeBob SquarePants'
-        mock_gzip_b64.return_value = ret
 
-        logs_string = utils.collect_system_logs()
-        self.assertEqual(ret, logs_string)
-        mock_gzip_b64.assert_called_once_with(
-            io_dict=mock.ANY, file_list=['/var/log'])
+        journal, io_dict, file_list = utils._get_system_logs()
+        self.assertFalse(journal)
+        self.assertEqual(['/var/log'], file_list)
         mock_dispatch.assert_called_once_with('collect_system_logs',
                                               mock.ANY, ['/var/log'])
 
-    @mock.patch.object(utils, 'gzip_and_b64encode', autospec=True)
     @mock.patch.object(hardware, 'dispatch_to_all_managers', autospec=True)
     @mock.patch.object(utils, 'is_journalctl_present', autospec=True)
-    def test_collect_system_logs_non_journald_with_logfile(
-            self, mock_journalctl, mock_dispatch, mock_gzip_b64):
+    def test_get_system_logs_non_journald_with_logfile(self, mock_journalctl,
+                                                       mock_dispatch):
         tmp = tempfile.NamedTemporaryFile()
         self.addCleanup(lambda: tmp.close())
 
         self.config(log_file=tmp.name)
         mock_journalctl.return_value = False
-        ret = 'SpongeBob SquarePants'
-        mock_gzip_b64.return_value = ret
 
-        logs_string = utils.collect_system_logs()
-        self.assertEqual(ret, logs_string)
-        mock_gzip_b64.assert_called_once_with(
-            io_dict=mock.ANY, file_list=['/var/log', tmp.name])
+        journal, io_dict, file_list = utils._get_system_logs()
+        self.assertFalse(journal)
+        self.assertEqual(['/var/log', tmp.name], file_list)
         mock_dispatch.assert_called_once_with('collect_system_logs',
                                               mock.ANY, ['/var/log', tmp.name])
 
@@ -1193,7 +1481,8 @@ class TestGetRequestsSession(base.IronicAgentTest):
 
         # Verify session.verify is explicitly set to False
         self.assertFalse(session.verify)
-        mock_create_ssl.assert_called_once_with('client')
+        mock_create_ssl.assert_called_once_with(
+            'client', resume_sessions=False)
         # get_ssl_client_options should not be called in insecure mode
         mock_get_ssl.assert_not_called()
 
@@ -1212,7 +1501,8 @@ class TestGetRequestsSession(base.IronicAgentTest):
         self.assertTrue(session.verify)
         # Verify cert is not set when no client cert provided (cert=None)
         # Note: session.cert will have a default value from requests.Session
-        mock_create_ssl.assert_called_once_with('client')
+        mock_create_ssl.assert_called_once_with(
+            'client', resume_sessions=False)
         mock_get_ssl.assert_called_once()
 
     @mock.patch.object(utils, 'get_ssl_client_options', autospec=True)
@@ -1228,7 +1518,8 @@ class TestGetRequestsSession(base.IronicAgentTest):
 
         # Verify session.verify is set to the CA file path
         self.assertEqual('/path/to/ca.crt', session.verify)
-        mock_create_ssl.assert_called_once_with('client')
+        mock_create_ssl.assert_called_once_with(
+            'client', resume_sessions=False)
         mock_get_ssl.assert_called_once()
 
     @mock.patch.object(utils, 'get_ssl_client_options', autospec=True)
@@ -1248,10 +1539,147 @@ class TestGetRequestsSession(base.IronicAgentTest):
         self.assertTrue(session.verify)
         self.assertEqual(('/path/to/cert.pem', '/path/to/key.pem'),
                          session.cert)
-        mock_create_ssl.assert_called_once_with('client')
+        mock_create_ssl.assert_called_once_with(
+            'client', resume_sessions=False)
         mock_get_ssl.assert_called_once()
 
 
+class _KeepAliveHandler(http_server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSharedRequestsSession(base.IronicAgentTest):
+
+    def test_shared(self):
+        with utils.sharing_requests_session() as session:
+            self.assertIs(session, utils.get_shared_requests_session())
+            adapter = session.get_adapter('https://example.com')
+            self.assertIsInstance(adapter.ssl_context,
+                                  utils.ResumingSSLContext)
+        self.assertIsNot(session, utils.get_shared_requests_session())
+
+    def test_nested(self):
+        with utils.sharing_requests_session() as session:
+            with utils.sharing_requests_session() as nested:
+                self.assertIs(session, nested)
+            self.assertIs(session, utils.get_shared_requests_session())
+        self.assertIsNot(session, utils.get_shared_requests_session())
+
+    def test_not_shared(self):
+        session = utils.get_shared_requests_session()
+        self.assertIsNot(session, utils.get_shared_requests_session())
+
+    def test_per_thread(self):
+        sessions = []
+
+        def _get():
+            sessions.append(utils.get_shared_requests_session())
+
+        with utils.sharing_requests_session() as session:
+            thread = threading.Thread(target=_get)
+            thread.start()
+            thread.join()
+        self.assertIsNot(session, sessions[0])
+
+    def test_cookies_dropped(self):
+        with utils.sharing_requests_session() as session:
+            session.cookies.set('token', 'secret', domain='example.com')
+        self.assertEqual(0, len(session.cookies))
+        with utils.sharing_requests_session() as other:
+            self.assertIsNot(session, other)
+            self.assertEqual(0, len(other.cookies))
+
+    def test_connection_reuse(self):
+        server = http_server.HTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        # The kept alive connection is closed before stopping the server
+        with utils.sharing_requests_session():
+            for path in ('checksum', 'image', 'configdrive'):
+                session = utils.get_shared_requests_session()
+                resp = session.get(url + path, timeout=10)
+                self.assertEqual(b'ok', resp.content)
+            self.assertEqual({'requests': 3, 'connections': 1,
+                              'tls_sessions': 0, 'resumed_tls_sessions': 0},
+                             utils.get_requests_session_stats(session))
+
+
+@mock.patch.object(ssl.SSLContext, 'wrap_socket', autospec=True)
+class TestResumingSSLContext(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestResumingSSLContext, self).setUp()
+        self.context = utils.create_ssl_context('client',
+                                                resume_sessions=True)
+
+    def test_resume(self, mock_wrap):
+        first = mock.Mock(server_hostname='example.com', session='s1',
+                          session_reused=False)
+        second = mock.Mock(server_hostname='example.com', session='s2',
+                           session_reused=True)
+        mock_wrap.side_effect = [first, second]
+
+        self.assertIs(first, self.context.wrap_socket(
+            'sock1', server_hostname='example.com'))
+        self.assertIs(second, self.context.wrap_socket(
+            'sock2', server_hostname='example.com'))
+        mock_wrap.assert_has_calls([
+            mock.call(self.context, 'sock1', server_side=False,
+                      do_handshake_on_connect=True,
+                      suppress_ragged_eofs=True,
+                      server_hostname='example.com', session=None),
+            mock.call(self.context, 'sock2', server_side=False,
+                      do_handshake_on_connect=True,
+                      suppress_ragged_eofs=True,
+                      server_hostname='example.com', session='s1'),
+        ])
+        self.assertEqual(2, self.context.opened_sessions)
+        self.assertEqual(1, self.context.resumed_sessions)
+
+    def test_remember_session_on_response(self, mock_wrap):
+        first = mock.Mock(spec=ssl.SSLSocket, server_hostname='example.com',
+                          session=None, session_reused=False)
+        mock_wrap.return_value = first
+        self.context.wrap_socket('sock1', server_hostname='example.com')
+        # The session ticket arrived after the handshake
+        first.session = 's1'
+        response = mock.Mock()
+        response.raw.connection.sock = first
+        self.assertIsNone(utils._remember_tls_session(self.context,
+                                                      response))
+        self.context.wrap_socket('sock2', server_hostname='example.com')
+        self.assertEqual('s1', mock_wrap.call_args.kwargs['session'])
+
+    def test_response_hook(self, mock_wrap):
+        session = utils.get_requests_session(resume_sessions=True)
+        self.assertEqual(1, len(session.hooks['response']))
+        session = utils.get_requests_session()
+        self.assertEqual([], session.hooks['response'])
+
+    def test_other_host(self, mock_wrap):
+        mock_wrap.return_value = mock.Mock(server_hostname='example.com',
+                                           session='s1',
+                                           session_reused=False)
+        self.context.wrap_socket('sock1', server_hostname='example.com')
+        self.context.wrap_socket('sock2', server_hostname='example.org')
+        self.assertIsNone(mock_wrap.call_args.kwargs['session'])
+        self.assertEqual(0, self.context.resumed_sessions)
+
+
 class TestCheckVirtualMedia(base.IronicAgentTest):
 
     @mock.patch.object(utils, 'execute', autospec=True)
@@ -1542,3 +1970,53 @@ TYPE="vfat" PART_ENTRY_SCHEME="gpt" PART_ENTRY_NAME="EFI System Partition"
             {'TYPE': 'vfat', 'PART_ENTRY_SCHEME': 'gpt',
              'PART_ENTRY_NAME': 'EFI System Partition'}
         ], result)
+
+
+class PeakRssTestCase(base.IronicAgentTest):
+
+    def test_get_peak_rss(self):
+        status = 'Name:\tpython\nVmPeak:\t  300000 kB\nVmHWM:\t   51200 kB\n'
+        with mock.patch('builtins.open', mock.mock_open(read_data=status)):
+            self.assertEqual(50 * units.Mi, utils.get_peak_rss())
+
+    def test_get_peak_rss_missing(self):
+        with mock.patch('builtins.open', mock.mock_open(read_data='Name:\n')):
+            self.assertIsNone(utils.get_peak_rss())
+
+    def test_get_peak_rss_error(self):
+        with mock.patch('builtins.open', autospec=True,
+                        side_effect=FileNotFoundError):
+            self.assertIsNone(utils.get_peak_rss())
+
+    def test_reset_peak_rss(self):
+        mock_open = mock.mock_open()
+        with mock.patch('builtins.open', mock_open):
+            self.assertTrue(utils.reset_peak_rss())
+        mock_open.assert_called_once_with('/proc/self/clear_refs', 'w')
+        mock_open.return_value.write.assert_called_once_with('5')
+
+    def test_reset_peak_rss_unsupported(self):
+        with mock.patch('builtins.open', autospec=True,
+                        side_effect=PermissionError):
+            self.assertFalse(utils.reset_peak_rss())
+
+
+@mock.patch.object(os, 'open', autospec=True)
+class OpenForDirectReadTestCase(base.IronicAgentTest):
+
+    def test_direct(self, mock_open):
+        self.assertEqual((mock_open.return_value, True),
+                         utils.open_for_direct_read('/dev/sda'))
+        mock_open.assert_called_once_with('/dev/sda',
+                                          os.O_RDONLY | os.O_DIRECT)
+
+    def test_direct_unsupported(self, mock_open):
+        mock_open.side_effect = [OSError(errno.EINVAL, 'invalid'), 42]
+        self.assertEqual((42, False), utils.open_for_direct_read('/tmp/x'))
+        mock_open.assert_called_with('/tmp/x', os.O_RDONLY)
+
+    def test_error(self, mock_open):
+        mock_open.side_effect = OSError(errno.ENOENT, 'missing')
+        self.assertRaises(OSError, utils.open_for_direct_read, '/dev/sdx')
+        mock_open.assert_called_once_with('/dev/sdx',
+                                          os.O_RDONLY | os.O_DIRECT)
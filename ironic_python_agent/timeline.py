@@ -0,0 +1,133 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Recording how long the phases of a long running command take.
+
+A :class:`Timeline` is activated for the current thread with
+:func:`recording`. Functions anywhere down the call stack mark their work
+with :func:`phase`, either as a context manager or as a decorator, and may
+report the amount of data they processed with :func:`record_bytes`. Both
+do nothing when no timeline is being recorded in the current thread.
+"""
+
+import contextlib
+import threading
+import time
+
+from ironic_python_agent.metrics_lib import metrics_utils
+
+_LOCAL = threading.local()
+
+
+class Timeline(object):
+    """Phases of a command in the order they started.
+
+    Phases may be nested, e.g. the ``write`` phase of an image includes the
+    ``udev_settle`` phases run meanwhile.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = []
+        self._active = []
+
+    def serialize(self):
+        """Get the phases as a list of dictionaries.
+
+        Each phase has a ``name``, ``start`` and ``end`` times in seconds
+        since the epoch, a ``duration`` in seconds, the nesting ``depth``
+        and optionally the number of ``bytes`` processed. Phases interrupted
+        by an exception are marked with ``failed``.
+        """
+        return [dict(phase) for phase in self.phases]
+
+    def summary(self):
+        """Get a human readable summary of the top level phases."""
+        parts = []
+        for phase in self.phases:
+            if phase['depth'] or 'duration' not in phase:
+                continue
+            part = '%s %.3fs' % (phase['name'], phase['duration'])
+            if phase.get('bytes') is not None:
+                part += ' (%d bytes)' % phase['bytes']
+            parts.append(part)
+        return ', '.join(parts)
+
+    def send_metrics(self):
+        """Send the duration and the size of each finished phase."""
+        metrics = metrics_utils.get_metrics_logger(__name__)
+        for phase in self.phases:
+            if 'duration' not in phase:
+                continue
+            name = '%s.%s' % (self.name, phase['name'])
+            metrics.send_timer(name, int(phase['duration'] * 1000))
+            if phase.get('bytes') is not None:
+                metrics.send_gauge('%s.bytes' % name, phase['bytes'])
+
+
+def current():
+    """Get the timeline recorded in the current thread, if any."""
+    return getattr(_LOCAL, 'timeline', None)
+
+
+@contextlib.contextmanager
+def recording(name):
+    """Record a timeline of the phases run in the current thread.
+
+    :param name: name of the timeline, used as a prefix for the metrics.
+    :returns: a context manager returning the new :class:`Timeline`.
+    """
+    previous = current()
+    timeline = Timeline(name)
+    _LOCAL.timeline = timeline
+    try:
+        yield timeline
+    finally:
+        _LOCAL.timeline = previous
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Record a phase of the current timeline.
+
+    Can be used as a context manager or as a function decorator.
+
+    :param name: name of the phase.
+    """
+    timeline = current()
+    if timeline is None:
+        yield
+        return
+
+    record = {'name': name, 'start': round(time.time(), 3),
+              'depth': len(timeline._active)}
+    timeline.phases.append(record)
+    timeline._active.append(record)
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        duration = time.monotonic() - start
+        record['end'] = round(record['start'] + duration, 3)
+        record['duration'] = round(duration, 3)
+        timeline._active.remove(record)
+
+
+def record_bytes(count):
+    """Add to the number of bytes processed by the innermost active phase."""
+    timeline = current()
+    if timeline is not None and timeline._active:
+        record = timeline._active[-1]
+        record['bytes'] = record.get('bytes', 0) + count
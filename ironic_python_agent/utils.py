@@ -17,11 +17,13 @@ from collections import abc
 import contextlib
 import copy
 import errno
+import functools
 import glob
 import io
 import ipaddress
 import json
 import os
+import queue
 import re
 import shlex
 import shutil
@@ -31,6 +33,7 @@ import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 import warnings
 
@@ -71,6 +74,15 @@ LSBLK_COLUMNS = ['KNAME', 'MODEL', 'SIZE', 'ROTA',
 
 DEVICE_EXTRACTOR = re.compile(r'^(?:(.*\d)p|(.*\D))(?:\d+)$')
 
+# Size of the chunks of the tarballs generated on the fly, and how many of
+# them may be waiting to be consumed
+_TAR_STREAM_CHUNK_SIZE = 64 * units.Ki
+_TAR_STREAM_QUEUE_SIZE = 16
+# Largest piece of output of unknown size kept in memory while collecting
+# logs, see _LogArchive.add_stream
+_LOG_PART_SIZE = 8 * units.Mi
+_JOURNAL_CONSUMER_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+
 
 _EARLY_LOG_BUFFER = []
 
@@ -267,6 +279,23 @@ def mounted(source, dest=None, opts=None, fs_type=None,
                     {'dest': dest, 'err': exc})
 
 
+def open_for_direct_read(path):
+    """Open a file for reading, bypassing the page cache if possible.
+
+    :returns: a tuple (file descriptor, whether O_DIRECT is used).
+    """
+    direct = getattr(os, 'O_DIRECT', 0)
+    try:
+        return os.open(path, os.O_RDONLY | direct), bool(direct)
+    except OSError as e:
+        # NOTE: some file systems (e.g. tmpfs) reject O_DIRECT.
+        if not direct or e.errno != errno.EINVAL:
+            raise
+        LOG.debug('O_DIRECT is not supported for %s, reading through the '
+                  'page cache', path)
+        return os.open(path, os.O_RDONLY), False
+
+
 def unlink_without_raise(path):
     try:
         os.unlink(path)
@@ -689,13 +718,18 @@ def get_journalctl_output(lines=None, units=None):
                   for everything.
     :returns: A log string.
     """
+    return get_command_output(_journalctl_command(lines=lines, units=units))
+
+
+def _journalctl_command(lines=None, units=None, cursor_file=None):
     cmd = ['journalctl', '--full', '--no-pager', '-b']
     if lines is not None:
         cmd.extend(['-n', str(lines)])
     if units is not None:
         [cmd.extend(['-u', u]) for u in units]
-
-    return get_command_output(cmd)
+    if cursor_file is not None:
+        cmd.extend(['--cursor-file', cursor_file])
+    return cmd
 
 
 def _encode_as_text(s):
@@ -713,27 +747,111 @@ def gzip_and_b64encode(io_dict=None, file_list=None):
     :param file_list: A list of file path.
     :returns: A gzipped and base64 encoded string.
     """
-    io_dict = io_dict or {}
-    file_list = file_list or []
-
     with io.BytesIO() as fp:
         with tarfile.open(fileobj=fp, mode='w:gz') as tar:
-            for fname in io_dict:
-                ioobj = io_dict[fname]
-                tarinfo = tarfile.TarInfo(name=fname)
-                tarinfo.size = ioobj.seek(0, 2)
-                tarinfo.mtime = time.time()
-                ioobj.seek(0)
-                tar.addfile(tarinfo, ioobj)
-
-            for f in file_list:
-                tar.add(f)
+            _add_to_tar(tar, io_dict, file_list)
 
         fp.seek(0)
 
         return _encode_as_text(fp.getvalue())
 
 
+def _add_to_tar(tar, io_dict=None, file_list=None):
+    io_dict = io_dict or {}
+    file_list = file_list or []
+
+    for fname in io_dict:
+        ioobj = io_dict[fname]
+        tarinfo = tarfile.TarInfo(name=fname)
+        tarinfo.size = ioobj.seek(0, 2)
+        tarinfo.mtime = time.time()
+        ioobj.seek(0)
+        tar.addfile(tarinfo, ioobj)
+
+    for f in file_list:
+        tar.add(f)
+
+
+class _QueueWriter(object):
+    """A write-only file object passing the written data to a queue."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = bytearray()
+        self.cancelled = threading.Event()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= _TAR_STREAM_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self._chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise OSError(errno.EPIPE, 'The stream has been closed')
+
+
+def iter_gzipped_tar(io_dict=None, file_list=None):
+    """Generate a gzipped tarball of files and BytesIO buffers on the fly.
+
+    The tarball is built in a separate thread, which stays at most a few
+    chunks ahead of the consumer.
+
+    :param io_dict: A dictionary containing whose the keys are the file
+        names and the value a BytesIO object.
+    :param file_list: A list of file path.
+    :returns: An iterator over the chunks of the gzipped tarball.
+    """
+    return _iter_tar_gz(functools.partial(_add_to_tar, io_dict=io_dict,
+                                          file_list=file_list))
+
+
+def _iter_tar_gz(build):
+    chunks = queue.Queue(maxsize=_TAR_STREAM_QUEUE_SIZE)
+    writer = _QueueWriter(chunks)
+    failure = []
+
+    def _build():
+        try:
+            with tarfile.open(fileobj=writer, mode='w|gz') as tar:
+                build(tar)
+            writer.flush()
+        except Exception as e:
+            if not writer.cancelled.is_set():
+                LOG.error('Failed to build a tarball: %s', e)
+                failure.append(e)
+        finally:
+            try:
+                writer.put(None)
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=_build, name='tar-stream', daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        # NOTE: stops the thread if the consumer gave up
+        writer.cancelled.set()
+        thread.join()
+    if failure:
+        raise failure[0]
+
+
 def try_collect_command_output(io_dict, file_name, command):
     LOG.debug('Collecting command output: %s', command)
     try:
@@ -742,7 +860,257 @@ def try_collect_command_output(io_dict, file_name, command):
         LOG.debug('Collecting logs from command %s has failed', command)
 
 
-def collect_system_logs(journald_max_lines=None):
+class _FixedSizeReader(object):
+    """Reads a given number of bytes from a file which may change.
+
+    Files shrinking or failing while they are read are padded with zeroes,
+    so that the size announced in the tar header is respected.
+    """
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._left = size
+        self.padded = 0
+        self.error = None
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        data = b''
+        if size and self.error is None:
+            try:
+                data = self._fileobj.read(size)
+            except OSError as e:
+                self.error = e
+        if len(data) < size:
+            self.padded += size - len(data)
+            data += bytes(size - len(data))
+        self._left -= size
+        return data
+
+
+class _LogArchive(object):
+    """Log sources written to a tarball within a size budget.
+
+    Every source is read incrementally. Once the total size of the collected
+    data reaches the budget, the remaining sources are truncated, which is
+    reported in the ``collection_report.json`` member added last.
+    """
+
+    def __init__(self, tar, max_size=None):
+        self._tar = tar
+        self._remaining = max_size
+        self.report = []
+
+    def _limit(self, size):
+        if self._remaining is None:
+            return size
+        return min(size, self._remaining)
+
+    def _add(self, tarinfo, fileobj):
+        self._tar.addfile(tarinfo, fileobj)
+        if self._remaining is not None:
+            self._remaining -= tarinfo.size
+
+    def _record(self, name, size, original_size=None, error=None):
+        entry = {'name': name, 'size': size,
+                 'truncated': (original_size is not None
+                               and size < original_size)}
+        if original_size is not None:
+            entry['original_size'] = original_size
+        if error is not None:
+            entry['error'] = str(error)
+        self.report.append(entry)
+        return entry
+
+    def add_buffer(self, name, ioobj):
+        """Add a BytesIO object."""
+        size = ioobj.seek(0, 2)
+        ioobj.seek(0)
+        tarinfo = tarfile.TarInfo(name=name)
+        tarinfo.size = self._limit(size)
+        tarinfo.mtime = time.time()
+        self._add(tarinfo, ioobj)
+        self._record(name, tarinfo.size, size)
+
+    def add_stream(self, name, stream):
+        """Add data of unknown size.
+
+        The data is added in members of at most :data:`_LOG_PART_SIZE`
+        bytes, the first one being called ``name``, the next ones
+        ``name.part2``, ``name.part3`` and so on.
+        """
+        total = 0
+        part = 1
+        truncated = False
+        while True:
+            limit = self._limit(_LOG_PART_SIZE)
+            if not limit:
+                truncated = bool(stream.read(1))
+                break
+            data = stream.read(limit)
+            if not data and part > 1:
+                break
+            tarinfo = tarfile.TarInfo(
+                name=name if part == 1 else '%s.part%d' % (name, part))
+            tarinfo.size = len(data)
+            tarinfo.mtime = time.time()
+            self._add(tarinfo, io.BytesIO(data))
+            if not data:
+                # NOTE: empty output is still added
+                break
+            total += len(data)
+            part += 1
+        entry = self._record(name, total)
+        entry['truncated'] = truncated
+        return entry
+
+    def add_command(self, name, command):
+        """Add the output of a command, read while it is running."""
+        LOG.debug('Collecting command output: %s', command)
+        try:
+            proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+        except OSError as e:
+            self._record(name, 0, error=e)
+            return
+        try:
+            entry = self.add_stream(name, proc.stdout)
+        finally:
+            if proc.poll() is None:
+                # NOTE: not needed anymore when truncated
+                proc.kill()
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode and not entry['truncated']:
+            entry['error'] = ('Command %s exited with code %d'
+                              % (command, returncode))
+
+    def add_path(self, path):
+        """Add a file, or the regular files in a directory."""
+        if not os.path.isdir(path):
+            self.add_file(path)
+            return
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                if os.path.isfile(file_path) and not os.path.islink(
+                        file_path):
+                    self.add_file(file_path)
+
+    def add_file(self, path):
+        """Add a file, reading it in pieces."""
+        name = path.lstrip('/')
+        try:
+            with open(path, 'rb') as f:
+                tarinfo = self._tar.gettarinfo(arcname=name, fileobj=f)
+                size = tarinfo.size
+                tarinfo.size = self._limit(size)
+                reader = _FixedSizeReader(f, tarinfo.size)
+                self._add(tarinfo, reader)
+        except OSError as e:
+            LOG.debug('Cannot collect file %(path)s: %(err)s',
+                      {'path': path, 'err': e})
+            self._record(name, 0, error=e)
+            return
+        entry = self._record(name, tarinfo.size, size)
+        if reader.error is not None:
+            entry['error'] = str(reader.error)
+        elif reader.padded:
+            entry['error'] = ('The file shrank while being read, padded '
+                              'with %d zero bytes' % reader.padded)
+
+    def add_report(self):
+        """Add the report of the collected sources.
+
+        The report is not counted in the budget.
+        """
+        data = json.dumps({'sources': self.report}, indent=2).encode()
+        tarinfo = tarfile.TarInfo(name='collection_report.json')
+        tarinfo.size = len(data)
+        tarinfo.mtime = time.time()
+        self._tar.addfile(tarinfo, io.BytesIO(data))
+
+
+def _b64encode_stream(chunks):
+    """Base64 encode data from an iterator into a string."""
+    encoded = []
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk
+        # NOTE: only encoding whole groups of 3 bytes until the end
+        cut = len(data) - len(data) % 3
+        encoded.append(base64.b64encode(data[:cut]).decode('ascii'))
+        rest = data[cut:]
+    encoded.append(base64.b64encode(rest).decode('ascii'))
+    return ''.join(encoded)
+
+
+class JournalCursor(object):
+    """Position in the journal up to which a consumer received the logs.
+
+    The cursor of each consumer is kept in a file. The journal is collected
+    with a copy of it, which journalctl moves to the last collected entry.
+    The copy replaces the cursor with :meth:`commit` once the logs have
+    been collected, sent or uploaded. Whether the consumer actually
+    received them is not known.
+    """
+
+    def __init__(self, consumer):
+        """Find the cursor of a consumer.
+
+        :param consumer: name of the consumer of the journal.
+        :raises: InvalidCommandParamsError if the name is invalid.
+        """
+        if (not isinstance(consumer, str)
+                or not _JOURNAL_CONSUMER_RE.match(consumer)):
+            raise errors.InvalidCommandParamsError(
+                'Invalid journal consumer %s, expected up to 64 letters, '
+                'digits, dots, dashes and underscores' % consumer)
+        self.consumer = consumer
+        self._directory = os.path.join(tempfile.gettempdir(),
+                                       'ipa-journal-cursors')
+        self.path = os.path.join(self._directory, consumer)
+        self._pending = None
+
+    def prepare(self):
+        """Copy the cursor for journalctl.
+
+        :returns: the path to the copy, to pass to journalctl with
+            ``--cursor-file``.
+        """
+        os.makedirs(self._directory, mode=0o700, exist_ok=True)
+        fd, self._pending = tempfile.mkstemp(dir=self._directory,
+                                             prefix='.%s.' % self.consumer)
+        with os.fdopen(fd, 'wb') as pending:
+            try:
+                with open(self.path, 'rb') as current:
+                    shutil.copyfileobj(current, pending)
+            except FileNotFoundError:
+                # NOTE: journalctl starts from the beginning with an empty
+                # cursor file.
+                pass
+        return self._pending
+
+    def commit(self):
+        """Move the cursor after the collected entries."""
+        if self._pending is not None:
+            os.replace(self._pending, self.path)
+            self._pending = None
+            LOG.debug('Moved the journal cursor of %s', self.consumer)
+
+    def discard(self):
+        """Keep the cursor where it was."""
+        if self._pending is not None:
+            try:
+                os.unlink(self._pending)
+            except FileNotFoundError:
+                pass
+            self._pending = None
+
+
+def collect_system_logs(journald_max_lines=None, consumer=None):
     """Collect system logs.
 
     Collect system logs, for distributions using systemd the logs will
@@ -751,15 +1119,133 @@ def collect_system_logs(journald_max_lines=None):
 
     :param journald_max_lines: Maximum number of lines to retrieve from
                                the journald. if None, return everything.
+    :param consumer: If provided, only the journal entries added since the
+                     previous collection for this consumer are returned.
+                     The journal cursor of the consumer moves once the logs
+                     have been collected, before they are returned.
     :returns: A tar, gzip base64 encoded string with the logs.
     """
     LOG.info('Collecting system logs and debugging information')
+    cursor = JournalCursor(consumer) if consumer is not None else None
+    try:
+        logs = _b64encode_stream(_iter_system_logs(journald_max_lines,
+                                                   cursor=cursor))
+        if cursor is not None:
+            cursor.commit()
+        return logs
+    finally:
+        if cursor is not None:
+            cursor.discard()
+
+
+def stream_system_logs(journald_max_lines=None, consumer=None):
+    """Collect system logs as a stream.
+
+    Same as :func:`collect_system_logs`, but the tarball is compressed
+    while it is being consumed instead of being built in memory.
+
+    :param journald_max_lines: Maximum number of lines to retrieve from
+                               the journald. if None, return everything.
+    :param consumer: If provided, only the journal entries added since the
+                     previous collection for this consumer are returned.
+                     The journal cursor of the consumer only moves once
+                     the whole stream has been consumed, e.g. sent to the
+                     client.
+    :returns: An iterator over the chunks of a gzipped tarball with the logs.
+    """
+    LOG.info('Streaming system logs and debugging information')
+    if consumer is None:
+        return _iter_system_logs(journald_max_lines)
+    cursor = JournalCursor(consumer)
+    return _iter_and_commit(
+        _iter_system_logs(journald_max_lines, cursor=cursor), cursor)
+
+
+def _iter_and_commit(chunks, cursor):
+    try:
+        yield from chunks
+        cursor.commit()
+    finally:
+        cursor.discard()
+
+
+def upload_system_logs(url, journald_max_lines=None, consumer=None):
+    """Collect system logs and upload them.
 
+    The gzipped tarball is sent in a PUT request with chunked transfer
+    encoding while it is being compressed.
+
+    :param url: URL to upload the logs to.
+    :param journald_max_lines: Maximum number of lines to retrieve from
+                               the journald. if None, return everything.
+    :param consumer: If provided, only the journal entries added since the
+                     previous collection for this consumer are uploaded.
+    :raises: CommandExecutionError if the upload fails.
+    :returns: The number of bytes uploaded.
+    """
+    LOG.info('Uploading system logs and debugging information to %s', url)
+    uploaded = 0
+
+    def _count(chunks):
+        nonlocal uploaded
+        for chunk in chunks:
+            uploaded += len(chunk)
+            yield chunk
+
+    cursor = JournalCursor(consumer) if consumer is not None else None
+    chunks = _iter_system_logs(journald_max_lines, cursor=cursor)
+    session = get_requests_session()
+    try:
+        resp = session.put(url, data=_count(chunks),
+                           headers={'Content-Type': 'application/gzip'},
+                           timeout=CONF.http_request_timeout)
+        resp.raise_for_status()
+        if cursor is not None:
+            cursor.commit()
+    except requests.RequestException as e:
+        raise errors.CommandExecutionError(
+            'Failed to upload the system logs to %s: %s' % (url, e))
+    finally:
+        chunks.close()
+        session.close()
+        if cursor is not None:
+            cursor.discard()
+    LOG.info('Uploaded %(size)d bytes of system logs to %(url)s',
+             {'size': uploaded, 'url': url})
+    return uploaded
+
+
+def _iter_system_logs(journald_max_lines=None, cursor=None):
+    journal, io_dict, file_list = _get_system_logs()
+    max_size = CONF.system_logs_max_size * units.Mi or None
+
+    def _build(tar):
+        archive = _LogArchive(tar, max_size=max_size)
+        if journal:
+            archive.add_command('journal', _journalctl_command(
+                lines=journald_max_lines,
+                cursor_file=cursor.prepare() if cursor is not None else None))
+        for name, ioobj in io_dict.items():
+            archive.add_buffer(name, ioobj)
+        for path in file_list:
+            archive.add_path(path)
+        archive.add_report()
+        truncated = [entry['name'] for entry in archive.report
+                     if entry['truncated']]
+        if truncated:
+            LOG.warning('System logs exceeded %(size)d MiB, truncated '
+                        '%(names)s', {'size': CONF.system_logs_max_size,
+                                      'names': ', '.join(truncated)})
+
+    return _iter_tar_gz(_build)
+
+
+def _get_system_logs():
     io_dict = {}
     file_list = []
     log_locations = [CONF.log_file, CONF.log_dir]
-    if is_journalctl_present():
-        io_dict['journal'] = get_journalctl_output(lines=journald_max_lines)
+    journal = is_journalctl_present()
+    if journal:
         for log_loc in log_locations:
             if log_loc and os.path.exists(log_loc):
                 file_list.append(log_loc)
@@ -778,7 +1264,7 @@ def collect_system_logs(journald_max_lines=None):
     except errors.HardwareManagerMethodNotFound:
         LOG.warning('All hardware managers failed to collect logs')
 
-    return gzip_and_b64encode(io_dict=io_dict, file_list=file_list)
+    return journal, io_dict, file_list
 
 
 def get_ssl_client_options(conf):
@@ -798,15 +1284,66 @@ def get_ssl_client_options(conf):
     return verify, cert
 
 
-def create_ssl_context(context_type='client'):
+class ResumingSSLContext(ssl.SSLContext):
+    """Client SSL context resuming the TLS sessions of earlier connections.
+
+    Sessions are remembered per server host name, so that reconnecting to
+    the same server, e.g. after the server closed an idle connection or
+    when retrying a request, skips the full TLS handshake.
+    """
+
+    def _session_cache(self):
+        try:
+            return self._tls_sessions
+        except AttributeError:
+            self._tls_sessions = {}
+            self.opened_sessions = 0
+            self.resumed_sessions = 0
+            return self._tls_sessions
+
+    def remember_session(self, sock):
+        """Store the TLS session of a client socket for later connections."""
+        if sock.server_hostname is None:
+            return
+        try:
+            session = sock.session
+        except (OSError, ValueError):
+            return
+        if session is not None:
+            self._session_cache()[sock.server_hostname] = session
+
+    def wrap_socket(self, sock, server_side=False,
+                    do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        sessions = self._session_cache()
+        if session is None and server_hostname is not None:
+            session = sessions.get(server_hostname)
+        sslsock = super(ResumingSSLContext, self).wrap_socket(
+            sock, server_side=server_side,
+            do_handshake_on_connect=do_handshake_on_connect,
+            suppress_ragged_eofs=suppress_ragged_eofs,
+            server_hostname=server_hostname, session=session)
+        self.opened_sessions += 1
+        if session is not None and sslsock.session_reused:
+            self.resumed_sessions += 1
+        if not server_side and do_handshake_on_connect:
+            self.remember_session(sslsock)
+        return sslsock
+
+
+def create_ssl_context(context_type='client', resume_sessions=False):
     """Create an SSL context with configured TLS version constraints.
 
     :param context_type: 'client' or 'server'
+    :param resume_sessions: Whether a client context should resume the TLS
+        sessions of its previous connections.
     :returns: ssl.SSLContext object configured with TLS version enforcement
     """
     # Create appropriate context
     if context_type == 'server':
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    elif resume_sessions:
+        context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
     else:
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
 
@@ -887,15 +1424,19 @@ class TLSAdapter(requests.adapters.HTTPAdapter):
             proxy, **proxy_kwargs)
 
 
-def get_requests_session(pool_connections=2, pool_maxsize=2):
+def get_requests_session(pool_connections=2, pool_maxsize=2,
+                         resume_sessions=False):
     """Create a requests Session with TLS version enforcement.
 
     :param pool_connections: Number of urllib3 connection pools to cache
     :param pool_maxsize: Maximum number of connections per pool
+    :param resume_sessions: Whether to resume the TLS sessions of previous
+        connections when opening new ones.
     :returns: requests.Session configured with SSL context
     """
     session = requests.Session()
-    ssl_context = create_ssl_context('client')
+    ssl_context = create_ssl_context('client',
+                                     resume_sessions=resume_sessions)
     adapter = TLSAdapter(ssl_context=ssl_context,
                          pool_connections=pool_connections,
                          pool_maxsize=pool_maxsize)
@@ -915,9 +1456,128 @@ def get_requests_session(pool_connections=2, pool_maxsize=2):
         if cert:
             session.cert = cert
 
+    if resume_sessions:
+        # NOTE: with TLS 1.3 the session ticket is only received after the
+        # handshake, remember the session again once a response arrives.
+        session.hooks['response'].append(
+            functools.partial(_remember_tls_session, ssl_context))
+
+    return session
+
+
+def _remember_tls_session(ssl_context, response, *args, **kwargs):
+    """Response hook storing the TLS session of the connection used."""
+    connection = getattr(response.raw, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    if isinstance(sock, ssl.SSLSocket):
+        ssl_context.remember_session(sock)
+
+
+_SESSION_LOCAL = threading.local()
+
+
+@contextlib.contextmanager
+def sharing_requests_session():
+    """Share a requests Session between the downloads of the current thread.
+
+    Reusing the same session for the checksum, the image, the configdrive
+    and for the retries of one deployment avoids repeating the DNS lookups,
+    the TCP and the TLS handshakes with the same servers. The session is
+    closed and its cookies are dropped when the outermost context manager
+    exits, it must not be used by other threads meanwhile.
+
+    :returns: a context manager returning the shared requests.Session.
+    """
+    session = getattr(_SESSION_LOCAL, 'session', None)
+    if session is not None:
+        yield session
+        return
+
+    session = get_requests_session(pool_connections=10, pool_maxsize=4,
+                                   resume_sessions=True)
+    _SESSION_LOCAL.session = session
+    try:
+        yield session
+    finally:
+        _SESSION_LOCAL.session = None
+        session.cookies.clear()
+        session.close()
+
+
+def get_shared_requests_session():
+    """Get the requests Session shared by the current thread.
+
+    :returns: the requests.Session shared with :func:`sharing_requests_session`
+        or, if no session is shared in the current thread, a new one.
+    """
+    session = getattr(_SESSION_LOCAL, 'session', None)
+    if session is None:
+        session = get_requests_session(resume_sessions=True)
     return session
 
 
+def get_requests_session_stats(session):
+    """Count the requests and connections made through a requests Session.
+
+    Connection pools evicted from the session are not taken into account.
+    Connections re-established after being closed by the server are only
+    counted in ``tls_sessions``.
+
+    :param session: a requests.Session.
+    :returns: a dictionary with the number of ``requests`` made, the number
+        of pooled ``connections``, of ``tls_sessions`` established and of
+        ``resumed_tls_sessions``.
+    """
+    stats = {'requests': 0, 'connections': 0, 'tls_sessions': 0,
+             'resumed_tls_sessions': 0}
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        managers = [adapter.poolmanager]
+        managers.extend(adapter.proxy_manager.values())
+        for manager in managers:
+            for pool_key in manager.pools.keys():
+                pool = manager.pools.get(pool_key)
+                if pool is None:
+                    continue
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        ssl_context = getattr(adapter, 'ssl_context', None)
+        stats['tls_sessions'] += getattr(ssl_context, 'opened_sessions', 0)
+        stats['resumed_tls_sessions'] += getattr(ssl_context,
+                                                 'resumed_sessions', 0)
+    return stats
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the current process.
+
+    :returns: True if the peak was reset, False if it is not supported.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError as e:
+        LOG.debug('Cannot reset the peak RSS: %s', e)
+        return False
+    return True
+
+
+def get_peak_rss():
+    """Get the peak resident set size of the current process.
+
+    :returns: the peak RSS in bytes since the process start or the last
+        call to reset_peak_rss, None if it is not available.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * units.Ki
+    except (OSError, ValueError, IndexError) as e:
+        LOG.debug('Cannot read the peak RSS: %s', e)
+    return None
+
+
 def extract_device(part):
     """Extract the device from a partition name or path.
 